@@ -6,6 +6,7 @@ from typing import List
 
 from auth import get_current_user, require_admin
 from models import DashboardStats, AdminSummary, ItemStatus
+from services.po_items_service import COLECAO as PO_ITEMS
 
 router = APIRouter(tags=["Dashboard"])
 
@@ -134,7 +135,12 @@ async def get_historico_cotacoes(
     current_user: dict = Depends(get_current_user)
 ):
     """Buscar histórico de cotações de um item em todas as OCs"""
-    pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(1000)
+    # Só as OCs que contêm o código (índice codigo_item do read-model po_items)
+    po_ids = await db[PO_ITEMS].distinct("po_id", {"codigo_item": codigo_item})
+    pos = await db.purchase_orders.find(
+        {"id": {"$in": po_ids}},
+        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
+    ).to_list(None)
     
     historico = []
     for po in pos:
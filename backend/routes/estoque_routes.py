@@ -9,6 +9,8 @@ import logging
 import uuid
 
 from auth import get_current_user, require_admin
+from services.item_patch_service import snapshot_itens, salvar_itens
+from services.po_items_service import COLECAO as PO_ITEMS
 
 logger = logging.getLogger(__name__)
 
@@ -33,75 +35,67 @@ async def listar_estoque(current_user: dict = Depends(get_current_user)):
     """
     estoque_map = {}
     
-    # 1. Buscar excedentes das OCs (itens comprados a mais)
-    pos = await db.purchase_orders.find(
-        {},
-        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
-    ).to_list(5000)
-    
-    for po in pos:
-        for idx, item in enumerate(po.get('items', [])):
-            quantidade_necessaria = item.get('quantidade', 0)
-            status = item.get('status', 'pendente')
+    # 1. Buscar excedentes das OCs (itens comprados a mais) no read-model po_items:
+    # só os itens já comprados e não atendidos por estoque, sem carregar as OCs
+    linhas = db[PO_ITEMS].find(
+        {
+            "status": {"$in": ['comprado', 'em_separacao', 'pronto_envio', 'em_transito', 'entregue']},
+            "atendido_por_estoque": {"$ne": True},
+            "codigo_item": {"$nin": [None, ""]},
+        },
+        {"_id": 0, "po_id": 1, "item_index": 1, "numero_oc": 1, "codigo_item": 1,
+         "descricao": 1, "marca_modelo": 1, "unidade": 1, "imagem_url": 1, "quantidade": 1,
+         "quantidade_comprada": 1, "quantidade_fontes": 1, "quantidade_usada_estoque": 1,
+         "fonte_compra": 1, "preco_compra": 1}
+    ).sort([("po_id", 1), ("item_index", 1)])
+    
+    async for item in linhas:
+        quantidade_necessaria = item.get('quantidade') or 0
+        
+        # Calcular quantidade comprada
+        fonte = item.get('fonte_compra')
+        if fonte is not None:
+            quantidade_comprada = item.get('quantidade_fontes')
+        else:
+            quantidade_comprada = item.get('quantidade_comprada')
+        
+        quantidade_usada_estoque = item.get('quantidade_usada_estoque') or 0
+        
+        # Verificar se há excedente
+        if quantidade_comprada and quantidade_comprada > (quantidade_necessaria + quantidade_usada_estoque):
+            excedente = quantidade_comprada - quantidade_necessaria - quantidade_usada_estoque
+            codigo_item = item['codigo_item']
             
-            # Só considerar itens que já foram comprados
-            if status not in ['comprado', 'em_separacao', 'pronto_envio', 'em_transito', 'entregue']:
-                continue
+            link_compra = fonte.get('link', '') if fonte is not None else ''
+            fornecedor = fonte.get('fornecedor', '') if fonte is not None else ''
+            preco_unitario = fonte.get('preco_unitario', 0) if fonte is not None else (item.get('preco_compra') or 0)
             
-            # Ignorar itens atendidos por estoque
-            if item.get('atendido_por_estoque'):
-                continue
+            ocorrencia = {
+                'numero_oc': item.get('numero_oc'),
+                'po_id': item.get('po_id'),
+                'item_index': item.get('item_index'),
+                'quantidade': excedente
+            }
             
-            # Calcular quantidade comprada
-            fontes = item.get('fontes_compra', [])
-            if fontes:
-                quantidade_comprada = sum(f.get('quantidade', 0) for f in fontes)
+            if codigo_item not in estoque_map:
+                estoque_map[codigo_item] = {
+                    'codigo_item': codigo_item,
+                    'descricao': item.get('descricao') or '',
+                    'marca_modelo': item.get('marca_modelo') or '',
+                    'unidade': item.get('unidade') or 'UN',
+                    'quantidade_estoque': excedente,
+                    'disponivel': excedente,
+                    'link_compra': link_compra,
+                    'fornecedor': fornecedor,
+                    'preco_unitario': preco_unitario,
+                    'imagem_url': item.get('imagem_url'),
+                    'origem': 'excedente_oc',
+                    'ocs_origem': [ocorrencia]
+                }
             else:
-                quantidade_comprada = item.get('quantidade_comprada', 0)
-            
-            quantidade_usada_estoque = item.get('quantidade_usada_estoque', 0)
-            
-            # Verificar se há excedente
-            if quantidade_comprada and quantidade_comprada > (quantidade_necessaria + quantidade_usada_estoque):
-                excedente = quantidade_comprada - quantidade_necessaria - quantidade_usada_estoque
-                codigo_item = item.get('codigo_item', '')
-                
-                if not codigo_item:
-                    continue
-                
-                link_compra = fontes[0].get('link', '') if fontes else ''
-                fornecedor = fontes[0].get('fornecedor', '') if fontes else ''
-                preco_unitario = fontes[0].get('preco_unitario', 0) if fontes else item.get('preco_compra', 0)
-                
-                if codigo_item not in estoque_map:
-                    estoque_map[codigo_item] = {
-                        'codigo_item': codigo_item,
-                        'descricao': item.get('descricao', ''),
-                        'marca_modelo': item.get('marca_modelo', ''),
-                        'unidade': item.get('unidade', 'UN'),
-                        'quantidade_estoque': excedente,
-                        'disponivel': excedente,
-                        'link_compra': link_compra,
-                        'fornecedor': fornecedor,
-                        'preco_unitario': preco_unitario,
-                        'imagem_url': item.get('imagem_url'),
-                        'origem': 'excedente_oc',
-                        'ocs_origem': [{
-                            'numero_oc': po.get('numero_oc'),
-                            'po_id': po.get('id'),
-                            'item_index': idx,
-                            'quantidade': excedente
-                        }]
-                    }
-                else:
-                    estoque_map[codigo_item]['quantidade_estoque'] += excedente
-                    estoque_map[codigo_item]['disponivel'] += excedente
-                    estoque_map[codigo_item]['ocs_origem'].append({
-                        'numero_oc': po.get('numero_oc'),
-                        'po_id': po.get('id'),
-                        'item_index': idx,
-                        'quantidade': excedente
-                    })
+                estoque_map[codigo_item]['quantidade_estoque'] += excedente
+                estoque_map[codigo_item]['disponivel'] += excedente
+                estoque_map[codigo_item]['ocs_origem'].append(ocorrencia)
     
     # 2. Buscar itens adicionados manualmente
     itens_manuais = await db.estoque_manual.find({}, {"_id": 0}).to_list(5000)
@@ -405,6 +399,7 @@ async def ajustar_quantidade_estoque_manual(
                 
                 # Atualizar o item na OC
                 items = po.get('items', [])
+                itens_antes = snapshot_itens(items)
                 items[idx]['quantidade_comprada'] = nova_quantidade_comprada
                 
                 # Atualizar nas fontes de compra também
@@ -413,10 +408,7 @@ async def ajustar_quantidade_estoque_manual(
                     diferenca = nova_quantidade_comprada - quantidade_comprada
                     items[idx]['fontes_compra'][0]['quantidade'] = fontes[0].get('quantidade', 0) + diferenca
                 
-                await db.purchase_orders.update_one(
-                    {"id": po['id']},
-                    {"$set": {"items": items}}
-                )
+                await salvar_itens(po['id'], itens_antes, items)
                 
                 return {
                     "success": True,
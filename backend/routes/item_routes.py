@@ -12,6 +12,7 @@ from models.schemas import (
 )
 from utils.database import db, get_logger
 from utils.config import TAX_PERCENTAGE
+from services.item_patch_service import snapshot_itens, salvar_itens, salvar_item
 
 router = APIRouter(prefix="/purchase-orders", tags=["Items"])
 logger = get_logger(__name__)
@@ -77,6 +78,7 @@ async def update_item_status(
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_updated = False
     
     for item in po['items']:
@@ -147,10 +149,7 @@ async def update_item_status(
     if not item_updated:
         raise HTTPException(status_code=404, detail="Item não encontrado")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_itens(po_id, itens_antes, po['items'])
     
     return {"message": "Item atualizado com sucesso"}
 
@@ -171,6 +170,7 @@ async def update_item_by_index_status(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     
     # Verificar permissão usando função centralizada
@@ -233,10 +233,7 @@ async def update_item_by_index_status(
     if update.codigo_rastreio is not None:
         item['codigo_rastreio'] = update.codigo_rastreio.strip().upper() if update.codigo_rastreio else None
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"message": "Item atualizado com sucesso"}
 
@@ -257,6 +254,7 @@ async def update_item_full(
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_updated = False
     
     for item in po['items']:
@@ -285,10 +283,7 @@ async def update_item_full(
     if not item_updated:
         raise HTTPException(status_code=404, detail="Item não encontrado")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_itens(po_id, itens_antes, po['items'])
     
     return {"message": "Item atualizado com sucesso"}
 
@@ -312,6 +307,7 @@ async def update_item_by_index(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     
     if update.descricao is not None:
@@ -332,9 +328,6 @@ async def update_item_by_index(
         item['preco_venda'] = update.preco_venda
         item['imposto'] = round(update.preco_venda * item.get('quantidade', 0) * (TAX_PERCENTAGE / 100), 2)
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"message": "Item atualizado com sucesso"}
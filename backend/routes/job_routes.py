@@ -0,0 +1,56 @@
+"""
+Job Routes - Acompanhamento dos jobs em background (services/job_service.py)
+"""
+from fastapi import APIRouter, Depends
+from typing import Optional
+import logging
+
+from auth import require_admin
+from services.job_service import obter_job, listar_jobs, cancelar_job, STATUS_FINAIS
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+
+@router.get("")
+async def listar_jobs_recentes(
+    tipo: Optional[str] = None,
+    status: Optional[str] = None,
+    limite: int = 50,
+    current_user: dict = Depends(require_admin)
+):
+    """Lista os jobs mais recentes (sem o resultado)"""
+    return {"jobs": await listar_jobs(tipo, status, min(limite, 200))}
+
+
+@router.get("/{job_id}")
+async def status_job(job_id: str, current_user: dict = Depends(require_admin)):
+    """
+    Status e progresso de um job.
+    O resultado é incluído quando o job termina, para evitar uma segunda chamada.
+    """
+    job = await obter_job(job_id)
+    if job["status"] in STATUS_FINAIS:
+        job = await obter_job(job_id, incluir_resultado=True)
+    return job
+
+
+@router.get("/{job_id}/resultado")
+async def resultado_job(job_id: str, current_user: dict = Depends(require_admin)):
+    """Resultado do job (None enquanto não terminar)"""
+    job = await obter_job(job_id, incluir_resultado=True)
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "erro": job.get("erro"),
+        "resultado": job.get("resultado")
+    }
+
+
+@router.post("/{job_id}/cancelar")
+async def cancelar(job_id: str, current_user: dict = Depends(require_admin)):
+    """Cancela um job pendente ou sinaliza o cancelamento de um job em execução"""
+    job = await cancelar_job(job_id)
+    logger.info(f"Cancelamento do job {job_id} solicitado por {current_user.get('sub')}")
+    return {"success": True, "job_id": job_id, "status": job["status"], "cancelar": job.get("cancelar")}
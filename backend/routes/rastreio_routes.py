@@ -1,78 +1,19 @@
 """
 Rastreamento dos Correios - Routes
 """
-import asyncio
 import logging
-import httpx
 from datetime import datetime, timezone
 from fastapi import APIRouter, HTTPException, Depends
 
 from auth import get_current_user
 from utils.database import db
+from services.item_patch_service import snapshot_itens, salvar_itens
+from services.rastreio_service import buscar_rastreio_api, agendar_rastreio_itens
 
 router = APIRouter(tags=["Rastreamento"])
 logger = logging.getLogger(__name__)
 
 
-async def buscar_rastreio_api(codigo: str) -> dict:
-    """Tenta buscar rastreio em múltiplas APIs"""
-    eventos = []
-    
-    # Tentar API do Seu Rastreio primeiro (com retry)
-    for tentativa in range(3):
-        try:
-            async with httpx.AsyncClient(timeout=15.0) as client:
-                response = await client.get(
-                    f"https://seurastreio.com.br/api/public/rastreio/{codigo}",
-                    headers={
-                        "Accept": "application/json",
-                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-                    }
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('success') and data.get('eventos'):
-                        for evento in data.get('eventos', []):
-                            eventos.append({
-                                "data": evento.get('data', ''),
-                                "hora": evento.get('hora', ''),
-                                "local": evento.get('local', evento.get('cidade', '')),
-                                "status": evento.get('descricao', evento.get('status', '')),
-                                "subStatus": evento.get('subStatus', [])
-                            })
-                        return {"success": True, "eventos": eventos}
-                    elif data.get('status') == 'service_error':
-                        await asyncio.sleep(2)
-                        continue
-        except Exception as e:
-            logger.warning(f"Erro ao consultar SeuRastreio (tentativa {tentativa+1}): {str(e)}")
-            await asyncio.sleep(1)
-    
-    # Fallback: tentar LinkTrack
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(
-                f"https://api.linketrack.com/track/json?user=teste&token=1abcd00b2731640e886fb41a8a9671ad1434c599dbaa0a0de9a5aa619f29a83f&codigo={codigo}",
-                headers={"Accept": "application/json"}
-            )
-            if response.status_code == 200:
-                data = response.json()
-                for evento in data.get('eventos', []):
-                    eventos.append({
-                        "data": evento.get('data', ''),
-                        "hora": evento.get('hora', ''),
-                        "local": evento.get('local', ''),
-                        "status": evento.get('status', ''),
-                        "subStatus": evento.get('subStatus', [])
-                    })
-                if eventos:
-                    return {"success": True, "eventos": eventos}
-    except Exception:
-        pass
-    
-    return {"success": False, "eventos": [], "message": "Não foi possível consultar o rastreio. APIs indisponíveis."}
-
-
 @router.get("/rastreio/{codigo}")
 async def buscar_rastreio(codigo: str, current_user: dict = Depends(get_current_user)):
     """Buscar rastreamento de um código dos Correios"""
@@ -101,6 +42,7 @@ async def definir_codigo_rastreio(
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_updated = False
     
     for item in po['items']:
@@ -120,10 +62,8 @@ async def definir_codigo_rastreio(
     if not item_updated:
         raise HTTPException(status_code=404, detail="Item não encontrado")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_itens(po_id, itens_antes, po['items'])
+    await agendar_rastreio_itens(item for item in po['items'] if item['codigo_item'] == codigo_item)
     
     return {"message": "Código de rastreio definido com sucesso", "codigo_rastreio": codigo_rastreio}
 
@@ -140,6 +80,7 @@ async def atualizar_rastreio(
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_found = None
     item_index = None
     
@@ -156,7 +97,8 @@ async def atualizar_rastreio(
     if not codigo_rastreio:
         raise HTTPException(status_code=400, detail="Item não possui código de rastreio")
     
-    rastreio_result = await buscar_rastreio_api(codigo_rastreio)
+    # Atualização pedida pelo usuário: não aceitar resultado vencido do cache
+    rastreio_result = await buscar_rastreio_api(codigo_rastreio, permitir_desatualizado=False)
     
     if rastreio_result.get('success'):
         eventos = rastreio_result.get('eventos', [])
@@ -187,10 +129,7 @@ async def atualizar_rastreio(
             }
             await db.notificacoes.insert_one(notificacao)
         
-        await db.purchase_orders.update_one(
-            {"id": po_id},
-            {"$set": {"items": po['items']}}
-        )
+        await salvar_itens(po_id, itens_antes, po['items'])
         
         return {
             "message": "Rastreio atualizado com sucesso",
@@ -217,6 +156,7 @@ async def marcar_item_entregue(
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_updated = False
     
     for item in po['items']:
@@ -229,9 +169,6 @@ async def marcar_item_entregue(
     if not item_updated:
         raise HTTPException(status_code=404, detail="Item não encontrado")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_itens(po_id, itens_antes, po['items'])
     
     return {"message": "Item marcado como entregue"}
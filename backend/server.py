@@ -1,10 +1,11 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Body, Form, Header
 from fastapi.security import HTTPBearer
 from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 import os
 import logging
 import asyncio
@@ -25,24 +26,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict
 import uuid
 from datetime import datetime, timezone, timedelta
 import openpyxl
 import resend
 import fitz  # PyMuPDF
 import re
+from urllib.parse import quote
 from pydantic import BaseModel
 
-# OCR para PDFs escaneados
-try:
-    import pytesseract
-    from PIL import Image
-    OCR_AVAILABLE = True
-except ImportError:
-    OCR_AVAILABLE = False
-    logger.warning("pytesseract ou PIL não instalados - OCR não disponível")
-
 # Importar modelos do módulo models
 from models import (
     UserRole, ItemStatus, User, UserCreate, LoginRequest, LoginResponse,
@@ -70,6 +63,62 @@ from routes.fornecedores_routes import router as fornecedores_router, init_forne
 from routes.dashboard_routes import router as dashboard_router, init_dashboard_routes
 from routes.estoque_routes import router as estoque_router, init_estoque_routes, verificar_estoque_item as estoque_verificar_item
 from routes.limites_routes import router as limites_router, init_limites_routes
+from routes.job_routes import router as job_router
+
+# Camada de atualização atômica de itens (diff por campo + controle de versão)
+from services.item_patch_service import snapshot_itens, salvar_itens, salvar_item, dividir_item, salvar_itens_em_lote, substituir_itens
+from services.parsing_service import extrair_oc_pdf, extrair_texto, encerrar_pool_parsing, VERSOES_PARSING
+# Análise de NF (PDF/XML) em uma única leitura do documento
+from services.nf_service import analisar_nf_pdf, analisar_nf_xml, VERSAO_ANALISE_NF
+# Cache de parsing por SHA-256 do conteúdo (LRU + coleção pdf_parse_cache)
+from services.parse_cache_service import (
+    obter_ou_calcular, criar_indices_parse_cache, estatisticas_parse_cache, COLECAO as PARSE_CACHE
+)
+from services.job_service import (
+    registrar_job, enfileirar_job, resposta_job_enfileirado, JobContext,
+    iniciar_workers, parar_workers, COLECAO as JOBS
+)
+from services.pdf_batch_service import (
+    ler_arquivos, parsear_em_lote, buscar_ocs_por_numero, buscar_referencias,
+    mapear_concorrente, evento_progresso, evento_resultado, responder_pipeline
+)
+from services.blob_service import (
+    salvar_blob, salvar_blob_stream, iterar_upload, tem_conteudo, tamanho_conteudo, iterar_conteudo, iterar_zip,
+    ler_conteudo, ler_conteudo_base64, criar_indices_blobs, migrar_blobs_legados, remover_blobs_orfaos, BUCKET_NAME as BLOB_BUCKET
+)
+# Variantes (miniatura/média) das imagens de itens e respostas com ETag/304
+from services.imagem_service import (
+    gerar_variantes, obter_variante, formato_aceito, responder_imagem, resposta_bytes_imagem, ler_imagem,
+    invalidar_cache_imagem, estatisticas_cache_imagens, resumo_imagens, versao_imagem,
+    VARIANTES as VARIANTES_IMAGEM, FORMATOS as FORMATOS_IMAGEM,
+    CACHE_REVALIDAR, CACHE_IMUTAVEL, casa_if_none_match, etag as etag_imagem
+)
+# Read-model de itens (coleção po_items) mantido a cada escrita em purchase_orders
+from services.po_items_service import (
+    sincronizar_po, sincronizar_pos, sincronizar_pos_por_filtro, remover_po, criar_indices_po_items,
+    reconstruir_po_items, po_items_precisa_reconstruir, normalizar_responsavel, COLECAO as PO_ITEMS
+)
+# Normalização e termos para buscas indexadas (sem acento, por prefixo)
+from services.busca_service import filtro_termos
+# Histórico de cotações indexado (mantido pela sincronização de po_items)
+from services.historico_cotacoes_service import (
+    buscar_historico, criar_indices_historico, historico_precisa_reconstruir,
+    LIMITE_PADRAO as LIMITE_HISTORICO, COLECAO as HISTORICO_COTACOES
+)
+# Backup em streaming (JSON/NDJSON, gzip/zstd), completo ou incremental
+from services.backup_service import (
+    ColecaoBackup, gerar_backup, resposta_backup, validar_opcoes,
+    ler_upload, ler_registros_backup, registros_de_dict, restaurar_backup,
+    preparar_backup, registrar_exclusao, listar_backups, criar_indices_backup, colecao_arquivos,
+    COLECOES_PROTEGIDAS as COLECOES_PROTEGIDAS_BACKUP, PREFIXO_TEMPORARIA as PREFIXO_RESTAURACAO,
+    COLECOES_CONTROLE as COLECOES_CONTROLE_BACKUP
+)
+# Contadores pré-calculados do dashboard, atualizados pela sincronização de po_items
+from services.dashboard_service import (
+    ler_contadores, reconciliar_contadores, CHAVE_TOTAL as CHAVE_TOTAL_DASHBOARD, COLECAO as DASHBOARD_COUNTERS
+)
+from services.correios_service import COLECAO_CACHE as RASTREIO_CACHE
+from services.rastreio_service import COLECAO_AGENDA as RASTREIO_AGENDA
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -432,6 +481,8 @@ async def reverter_uso_estoque(item: dict, po_id: str, numero_oc: str) -> dict:
             logger.warning(f"OC de origem {numero_oc_origem} não encontrada para reverter estoque")
             continue
         
+        itens_origem_antes = snapshot_itens(po_origem.get('items', []))
+        
         # Encontrar o item com o mesmo código na OC de origem
         codigo_item = item.get('codigo_item')
         item_origem_atualizado = False
@@ -457,11 +508,8 @@ async def reverter_uso_estoque(item: dict, po_id: str, numero_oc: str) -> dict:
             break
         
         if item_origem_atualizado:
-            # Salvar a OC de origem atualizada
-            await db.purchase_orders.update_one(
-                {"id": po_origem['id']},
-                {"$set": {"items": po_origem['items']}}
-            )
+            # Salvar a OC de origem atualizada (apenas o item alterado)
+            await salvar_itens(po_origem['id'], itens_origem_antes, po_origem['items'])
             
             resultado['fontes_revertidas'].append({
                 'numero_oc': numero_oc_origem,
@@ -557,404 +605,6 @@ def calcular_lucro_item(item: dict) -> None:
         item['lucro_liquido'] = round(receita_total - custo_total - frete_compra - impostos - frete_envio, 2)
 
 
-def extract_text_with_ocr(pdf_bytes: bytes) -> str:
-    """Extrair texto de PDF usando OCR (para PDFs escaneados)"""
-    if not OCR_AVAILABLE:
-        logger.warning("OCR não disponível - pytesseract não instalado")
-        return ""
-    
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
-        
-        for page_num, page in enumerate(doc):
-            # Converter página para imagem com alta resolução
-            mat = fitz.Matrix(2, 2)  # 2x zoom para melhor qualidade
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Converter para PIL Image
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            
-            # Usar OCR para extrair texto (português + inglês)
-            try:
-                page_text = pytesseract.image_to_string(img, lang='por+eng')
-                full_text += page_text + "\n"
-                logger.info(f"OCR página {page_num + 1}: {len(page_text)} caracteres extraídos")
-            except Exception as ocr_error:
-                logger.warning(f"Erro OCR na página {page_num + 1}: {ocr_error}")
-        
-        doc.close()
-        return full_text
-        
-    except Exception as e:
-        logger.error(f"Erro ao extrair texto com OCR: {e}")
-        return ""
-
-def extract_oc_from_pdf(pdf_bytes: bytes) -> dict:
-    """Extrair dados de OC de um PDF"""
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
-        
-        for page in doc:
-            full_text += page.get_text()
-        
-        doc.close()
-        
-        # Se o PDF não tem texto (é escaneado), usar OCR
-        if not full_text.strip() and OCR_AVAILABLE:
-            logger.info("PDF parece ser escaneado - tentando OCR...")
-            full_text = extract_text_with_ocr(pdf_bytes)
-            if full_text.strip():
-                logger.info(f"OCR extraiu {len(full_text)} caracteres")
-            else:
-                logger.warning("OCR não conseguiu extrair texto")
-        
-        # Extrair número da OC - procurar por padrões como OC-X.XXXXXX
-        oc_patterns = [
-            r'OC[- ]?(\d+[\.\d]+)',  # OC-2.121437 ou OC 2.121437
-            r'Ordem de Compra[:\s]+(\d+[\.\d]+)',
-            r'N[úu]mero[:\s]+(\d+[\.\d]+)'
-        ]
-        
-        numero_oc = None
-        for pattern in oc_patterns:
-            oc_match = re.search(pattern, full_text, re.IGNORECASE)
-            if oc_match:
-                numero_oc = f"OC-{oc_match.group(1)}"
-                break
-        
-        if not numero_oc:
-            numero_oc = "OC-" + str(uuid.uuid4())[:8]
-        
-        # Extrair endereço de entrega
-        endereco_patterns = [
-            r'Endere[çc]o de Entrega[:\s]*(.*?)(?:\n\n|Linha|Item)',
-            r'Local de Entrega[:\s]*(.*?)(?:\n\n|Linha|Item)',
-            r'Entregar em[:\s]*(.*?)(?:\n\n|Linha|Item)'
-        ]
-        
-        endereco_entrega = ""
-        for pattern in endereco_patterns:
-            endereco_match = re.search(pattern, full_text, re.IGNORECASE | re.DOTALL)
-            if endereco_match:
-                endereco_entrega = endereco_match.group(1).strip()
-                endereco_entrega = ' '.join(endereco_entrega.split())
-                break
-        
-        # Extrair região de entrega
-        regiao = ""
-        regiao_match = re.search(r'Regi[ãa]o[:\s]*(.*?)(?:\n|$)', full_text, re.IGNORECASE)
-        if regiao_match:
-            regiao = regiao_match.group(1).strip()
-        
-        # Extrair CNPJ do requisitante/cliente (FIEP/SESI)
-        # CNPJ padrão: XX.XXX.XXX/XXXX-XX
-        cnpj_requisitante = ""
-        cnpj_patterns = [
-            r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
-            r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})'
-        ]
-        
-        for pattern in cnpj_patterns:
-            cnpj_matches = re.findall(pattern, full_text)
-            if cnpj_matches:
-                # O primeiro CNPJ geralmente é do cliente/requisitante
-                # O CNPJ da ON (fornecedor) é 46.663.556/0001-69, então pegamos outro
-                for cnpj in cnpj_matches:
-                    if cnpj != "46.663.556/0001-69":  # Ignorar CNPJ do fornecedor (ON)
-                        cnpj_requisitante = cnpj
-                        break
-                break
-        
-        # Extrair Requisitante (nome e email)
-        requisitante_nome = ""
-        requisitante_email = ""
-        
-        # Padrão: "Requisitante: NOME -" seguido do email na próxima linha
-        lines = full_text.split('\n')
-        for i, line in enumerate(lines):
-            if 'requisitante:' in line.lower() and i + 1 < len(lines):
-                # Extrair nome do requisitante (formato: "Requisitante: NOME -" ou "Requisitante: NOME")
-                # O nome pode conter letras acentuadas e espaços
-                nome_match = re.search(r'requisitante[:\s]*([A-Za-záéíóúâêôãõçÁÉÍÓÚÂÊÔÃÕÇ\s]+?)[\s]*[-]?\s*$', line, re.IGNORECASE)
-                if nome_match:
-                    requisitante_nome = nome_match.group(1).strip()
-                else:
-                    # Tentar outro padrão: tudo depois de "Requisitante:" até o fim ou até um hífen
-                    nome_match2 = re.search(r'requisitante[:\s]+(.+?)(?:\s*-\s*)?$', line, re.IGNORECASE)
-                    if nome_match2:
-                        nome = nome_match2.group(1).strip().rstrip('-').strip()
-                        # Remover email se estiver no nome
-                        nome = re.sub(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', '', nome).strip()
-                        if nome:
-                            requisitante_nome = nome
-                
-                # Email geralmente está na próxima linha
-                next_line = lines[i + 1].strip()
-                email_match = re.search(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', next_line)
-                if email_match:
-                    requisitante_email = email_match.group(1)
-                
-                # Se o email estiver na mesma linha
-                if not requisitante_email:
-                    email_match = re.search(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', line)
-                    if email_match:
-                        requisitante_email = email_match.group(1)
-                
-                if requisitante_nome:
-                    break
-        
-        logger.info(f"Requisitante extraído: {requisitante_nome} - {requisitante_email}")
-        
-        # Extrair Data de Entrega (formato DD/MM/YYYY)
-        # A data pode estar em diferentes formatos e locais no PDF
-        data_entrega = None
-        data_patterns = [
-            r'Data de Entrega[:\s]*(\d{2}/\d{2}/\d{4})',
-            r'Data Entrega[:\s]*(\d{2}/\d{2}/\d{4})',
-            r'Entrega[:\s]*(\d{2}/\d{2}/\d{4})',
-            r'Prazo de Entrega[:\s]*(\d{2}/\d{2}/\d{4})',
-            r'Dt\.\s*Entrega[:\s]*(\d{2}/\d{2}/\d{4})'
-        ]
-        
-        for pattern in data_patterns:
-            data_match = re.search(pattern, full_text, re.IGNORECASE)
-            if data_match:
-                try:
-                    # Converter de DD/MM/YYYY para ISO format
-                    data_str = data_match.group(1)
-                    dia, mes, ano = data_str.split('/')
-                    data_entrega = f"{ano}-{mes}-{dia}"  # ISO format YYYY-MM-DD
-                    break
-                except:
-                    pass
-        
-        # Se não encontrou nos padrões acima, buscar na tabela de itens
-        # O formato é geralmente: "requisição DD/MM/YYYY" no final de cada linha de item
-        if not data_entrega:
-            # Buscar todas as datas no formato DD/MM/YYYY após um número de requisição
-            date_after_req = re.findall(r'\d{1,2}\.\d{2}\.\d{6,}\s*(\d{2}/\d{2}/\d{4})', full_text)
-            if date_after_req:
-                try:
-                    data_str = date_after_req[0]  # Pegar a primeira data encontrada
-                    dia, mes, ano = data_str.split('/')
-                    # Validar se é uma data futura ou recente (não muito antiga)
-                    if int(ano) >= 2024:
-                        data_entrega = f"{ano}-{mes}-{dia}"
-                except:
-                    pass
-        
-        # ========== PARSER MELHORADO PARA PDFS FIEP ==========
-        items = []
-        seen_items = set()
-        lines = full_text.split('\n')
-        
-        # PRIMEIRO: Extrair "Descritivo Completo" para cada código (mais confiável)
-        descricoes_completas = {}
-        for i, line in enumerate(lines):
-            if 'Descritivo Completo:' in line or 'Descritivo Completo' in line:
-                # Próxima linha deve ter o código e descrição
-                if i+1 < len(lines):
-                    desc_line = lines[i+1].strip()
-                    # Padrão: "085674 - DIODO; LED; COR: VERDE..."
-                    desc_match = re.match(r'^([01]\d{5})\s*-\s*(.+)$', desc_line)
-                    if desc_match:
-                        codigo_desc = desc_match.group(1)
-                        descricao_texto = desc_match.group(2).strip()
-                        # Pode continuar na próxima linha
-                        if i+2 < len(lines):
-                            next_line = lines[i+2].strip()
-                            # Se não começa com número ou "Descritivo", é continuação
-                            if next_line and not re.match(r'^\d', next_line) and 'Descritivo' not in next_line and 'Linha' not in next_line:
-                                descricao_texto += ' ' + next_line
-                        descricoes_completas[codigo_desc] = descricao_texto
-        
-        logger.info(f"Descritivos completos encontrados: {list(descricoes_completas.keys())}")
-        
-        # Códigos de produto FIEP começam com 0 ou 1 (ex: 089847, 114720)
-        # Códigos NCM começam com 8 ou 9 (ex: 853890, 903180) - ignorar
-        
-        for i, line in enumerate(lines):
-            line_stripped = line.strip()
-            
-            # Procurar código de 6 dígitos que começa com 0 ou 1
-            if re.match(r'^([01]\d{5})$', line_stripped):
-                codigo = line_stripped
-                
-                # Verificar se linha anterior é número de linha (1-50)
-                if i > 0:
-                    prev = lines[i-1].strip()
-                    if re.match(r'^\d{1,2}$', prev):
-                        try:
-                            linha_num = int(prev)
-                            if 1 <= linha_num <= 100:
-                                # Procurar quantidade nas próximas linhas (aumentado para 40 linhas para descrições longas)
-                                quantidade = 0
-                                unidade = "UN"
-                                descricao_parts = []
-                                preco_pdf = None  # Inicializar aqui
-                                ncm_item = None  # NCM do item
-                                
-                                for j in range(i+1, min(i+40, len(lines))):
-                                    check_line = lines[j].strip()
-                                    
-                                    # Se encontrar outro código de produto, parar
-                                    if re.match(r'^([01]\d{5})$', check_line):
-                                        break
-                                    
-                                    # Parar se encontrar "Descritivo Completo" (descrição já capturada)
-                                    if 'Descritivo Completo' in check_line:
-                                        break
-                                    
-                                    # Capturar NCM completo (8 dígitos começando com 1-9)
-                                    if re.match(r'^[1-9]\d{7}$', check_line) and ncm_item is None:
-                                        ncm_item = check_line
-                                        continue
-                                    
-                                    # Capturar NCM dividido (6 dígitos + 2 dígitos na próxima linha)
-                                    if re.match(r'^[1-9]\d{5}$', check_line) and ncm_item is None:
-                                        if j+1 < len(lines):
-                                            next_line = lines[j+1].strip()
-                                            if re.match(r'^\d{2}$', next_line):
-                                                ncm_item = check_line + next_line
-                                                continue
-                                    
-                                    # Coletar descrição curta (até encontrar quantidade) - usado como fallback
-                                    if len(check_line) > 2 and not re.match(r'^[\d.,]+$', check_line):
-                                        if check_line not in ['UN', 'UND', 'UNID', 'KG', 'PC', 'M', 'L', 'CX', 'PAR', 'KIT', 'CJ']:
-                                            if 'Descritivo Completo' not in check_line and 'CFOP' not in check_line:
-                                                # Não incluir NCM na descrição (6 ou 8 dígitos começando com 1-9)
-                                                if not re.match(r'^[1-9]\d{5,7}$', check_line):
-                                                    descricao_parts.append(check_line)
-                                    
-                                    # Procurar quantidade (número isolado seguido de unidade)
-                                    qty_match = re.match(r'^(\d+)$', check_line)
-                                    if qty_match and quantidade == 0:
-                                        qty = int(qty_match.group(1))
-                                        # Verificar se próxima linha é unidade
-                                        if j+1 < len(lines):
-                                            unit_line = lines[j+1].strip().upper()
-                                            # Lista expandida de unidades aceitas
-                                            valid_units = ['UN', 'UND', 'UNID', 'KG', 'PC', 'PÇA', 'PÇ', 'PCA', 'M', 'L', 'CX', 'PAR', 'PCT', 'KIT', 'JG', 'JOGO', 'RL', 'ROLO', 'MT', 'METRO', 'CT', 'CEN', 'CENTO', 'MILHEIRO', 'MIL', 'CJ']
-                                            if unit_line in valid_units:
-                                                quantidade = qty
-                                                # Normalizar unidades
-                                                if unit_line in ['UND', 'UNID', 'PÇA', 'PÇ', 'PCA', 'PC']:
-                                                    unidade = 'UN'
-                                                elif unit_line in ['MT', 'METRO']:
-                                                    unidade = 'M'
-                                                elif unit_line in ['JOGO']:
-                                                    unidade = 'JG'
-                                                elif unit_line in ['ROLO']:
-                                                    unidade = 'RL'
-                                                else:
-                                                    unidade = unit_line
-                                                
-                                                # EXTRAIR PREÇO: Após a unidade vem o preço unitário (formato: 518,95)
-                                                # Estrutura: QTD -> UN -> PREÇO_UNITARIO -> TOTAL
-                                                preco_pdf = None
-                                                if j+2 < len(lines):
-                                                    preco_line = lines[j+2].strip()
-                                                    # Preço no formato brasileiro: 518,95 ou 1.234,56
-                                                    preco_match = re.match(r'^(\d{1,3}(?:\.\d{3})*,\d{2})$', preco_line)
-                                                    if preco_match:
-                                                        # Converter formato BR para float
-                                                        preco_str = preco_match.group(1).replace('.', '').replace(',', '.')
-                                                        try:
-                                                            preco_pdf = float(preco_str)
-                                                        except:
-                                                            pass
-                                                
-                                                break
-                                
-                                if quantidade > 0:
-                                    key = f"{linha_num}-{codigo}"
-                                    if key not in seen_items:
-                                        seen_items.add(key)
-                                        # PRIORIZAR "Descritivo Completo" do PDF sobre descrição curta
-                                        if codigo in descricoes_completas:
-                                            descricao = descricoes_completas[codigo]
-                                        else:
-                                            descricao = ' '.join(descricao_parts) if descricao_parts else f"Item {codigo}"
-                                        
-                                        item_data = {
-                                            "codigo_item": codigo,
-                                            "quantidade": quantidade,
-                                            "descricao": descricao,  # Descrição completa do PDF
-                                            "unidade": unidade,
-                                            "endereco_entrega": endereco_entrega,
-                                            "regiao": regiao
-                                        }
-                                        # Adicionar preço extraído do PDF se encontrado
-                                        try:
-                                            if preco_pdf is not None:
-                                                item_data["preco_venda_pdf"] = preco_pdf
-                                        except NameError:
-                                            pass
-                                        # Adicionar NCM se encontrado
-                                        if ncm_item:
-                                            item_data["ncm"] = ncm_item
-                                        items.append(item_data)
-                        except ValueError:
-                            pass
-        
-        # Método 2 (fallback): Se NENHUM item encontrado, tentar padrão mais genérico
-        if len(items) == 0:
-            items = []
-            seen_codes = set()
-            
-            for i, line in enumerate(lines):
-                # Procurar códigos que começam com 0 ou 1
-                codigo_match = re.search(r'\b([01]\d{5})\b', line)
-                if codigo_match:
-                    codigo = codigo_match.group(1)
-                    
-                    if codigo in seen_codes:
-                        continue
-                    
-                    # Procurar quantidade
-                    quantidade = 0
-                    unidade = "UN"
-                    
-                    qty_match = re.search(r'\b(\d+)\s*(UN|UND|UNID|KG|PC|M|L|CX|KIT|CT|CEN|CENTO|PAR|PCT)\b', line, re.IGNORECASE)
-                    if qty_match:
-                        quantidade = int(qty_match.group(1))
-                        unidade = qty_match.group(2).upper()
-                    else:
-                        for j in range(i+1, min(i+8, len(lines))):
-                            qty_match = re.search(r'\b(\d+)\s*(UN|UND|UNID|KG|PC|M|L|CX|KIT|CT|CEN|CENTO|PAR|PCT)\b', lines[j], re.IGNORECASE)
-                            if qty_match:
-                                quantidade = int(qty_match.group(1))
-                                unidade = qty_match.group(2).upper()
-                                break
-                    
-                    if quantidade > 0:
-                        seen_codes.add(codigo)
-                        items.append({
-                            "codigo_item": codigo,
-                            "quantidade": quantidade,
-                            "descricao": f"Item {codigo}",
-                            "unidade": unidade,
-                            "endereco_entrega": endereco_entrega,
-                            "regiao": regiao
-                        })
-        
-        return {
-            "numero_oc": numero_oc,
-            "items": items,
-            "endereco_entrega": endereco_entrega,
-            "regiao": regiao,
-            "cnpj_requisitante": cnpj_requisitante,
-            "data_entrega": data_entrega,
-            "requisitante_nome": requisitante_nome,
-            "requisitante_email": requisitante_email
-        }
-    
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Erro ao processar PDF: {str(e)}")
-
-
 async def send_password_reset_email(email: str, reset_token: str):
     """Envia email com link de reset de senha"""
     reset_link = f"{os.environ.get('FRONTEND_URL', 'http://localhost:3000')}/reset-password?token={reset_token}"
@@ -1259,6 +909,7 @@ async def debug_update(
         debug_info["erro"] = f"Índice inválido. Total items: {len(po['items'])}"
         return debug_info
     
+    itens_antes = snapshot_itens(po['items'])
     item = po['items'][item_index]
     
     debug_info["item_antes"] = {
@@ -1297,15 +948,11 @@ async def debug_update(
         "fontes_compra": len(item.get('fontes_compra', []))
     }
     
-    # Salvar
-    result = await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    # Salvar (apenas campos alterados do item)
+    salvo = await salvar_itens(po_id, itens_antes, po['items'], levantar_conflito=False)
     
     debug_info["mongodb"] = {
-        "matched": result.matched_count,
-        "modified": result.modified_count
+        "salvo": salvo
     }
     
     # Verificar se salvou
@@ -1338,6 +985,7 @@ async def test_update_direto(po_id: str, item_index: int, current_user: dict = D
             return {"erro": "Índice inválido", "item_index": item_index, "total": len(po['items'])}
         
         # 2. Pegar o item
+        itens_antes = snapshot_itens(po['items'])
         item = po['items'][item_index]
         valor_antigo = item.get('preco_compra')
         
@@ -1346,10 +994,7 @@ async def test_update_direto(po_id: str, item_index: int, current_user: dict = D
         item['_teste_update'] = "FUNCIONOU"
         
         # 4. Salvar
-        result = await db.purchase_orders.update_one(
-            {"id": po_id},
-            {"$set": {"items": po['items']}}
-        )
+        salvo = await salvar_itens(po_id, itens_antes, po['items'], levantar_conflito=False)
         
         # 5. Buscar novamente para confirmar
         po_depois = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0})
@@ -1362,8 +1007,7 @@ async def test_update_direto(po_id: str, item_index: int, current_user: dict = D
             "valor_antigo": valor_antigo,
             "valor_novo": item_depois.get('preco_compra'),
             "teste_campo": item_depois.get('_teste_update'),
-            "mongodb_matched": result.matched_count,
-            "mongodb_modified": result.modified_count
+            "mongodb_salvo": salvo
         }
     except Exception as e:
         return {"erro": str(e)}
@@ -1380,15 +1024,13 @@ async def test_edit(po_id: str, item_index: int, current_user: dict = Depends(ge
     if item_index < 0 or item_index >= len(po['items']):
         return {"error": "Índice inválido", "item_index": item_index, "total_items": len(po['items'])}
     
+    itens_antes = snapshot_itens(po['items'])
     item = po['items'][item_index]
     
     # Tentar atualizar
     try:
         item['_test_edit'] = "OK"
-        await db.purchase_orders.update_one(
-            {"id": po_id},
-            {"$set": {"items": po['items']}}
-        )
+        await salvar_itens(po_id, itens_antes, po['items'])
         return {
             "success": True,
             "message": "Edição funcionou!",
@@ -1475,72 +1117,20 @@ async def get_reference_items(codigo: Optional[str] = None, current_user: dict =
 async def get_historico_cotacoes(
     codigo_item: Optional[str] = None,
     descricao: Optional[str] = None,
+    limite: int = LIMITE_HISTORICO,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Buscar histórico de cotações anteriores para um item.
-    Retorna links e fornecedores de itens já cotados/comprados com mesmo código ou descrição similar.
+    Retorna links e fornecedores de itens já cotados/comprados com mesmo código
+    ou com todas as palavras da descrição (sem acento, por prefixo).
+    Consulta indexada na coleção historico_cotacoes, mais recentes primeiro
+    (limite até historico_cotacoes_service.LIMITE_MAXIMO).
     """
     if not codigo_item and not descricao:
         return {"historico": [], "encontrado": False}
     
-    # Buscar todas as OCs
-    pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(5000)
-    
-    historico = []
-    seen_combinations = set()  # Para evitar duplicatas
-    
-    # Status que indicam que o item já foi cotado
-    status_cotados = ['cotado', 'comprado', 'em_separacao', 'em_transito', 'entregue']
-    
-    for po in pos:
-        for item in po.get('items', []):
-            item_status = item.get('status', '').lower()
-            
-            # Verificar se o item já foi cotado
-            if item_status not in status_cotados:
-                continue
-            
-            # Verificar se é o mesmo item (por código ou descrição similar)
-            match_codigo = codigo_item and item.get('codigo_item', '').upper() == codigo_item.upper()
-            match_descricao = descricao and descricao.upper() in (item.get('descricao', '') or '').upper()
-            
-            if not match_codigo and not match_descricao:
-                continue
-            
-            # Extrair fontes de compra do item
-            fontes_compra = item.get('fontes_compra', [])
-            
-            for fonte in fontes_compra:
-                fornecedor = fonte.get('fornecedor', '').strip()
-                link = fonte.get('link', '').strip()
-                preco = fonte.get('preco_unitario', 0)
-                frete = fonte.get('frete', 0)
-                
-                # Criar chave única para evitar duplicatas
-                key = f"{fornecedor}_{link}_{preco}"
-                if key in seen_combinations:
-                    continue
-                seen_combinations.add(key)
-                
-                if fornecedor or link:
-                    historico.append({
-                        "numero_oc": po.get('numero_oc', ''),
-                        "codigo_item": item.get('codigo_item', ''),
-                        "descricao": item.get('descricao', ''),
-                        "status": item_status,
-                        "fornecedor": fornecedor,
-                        "link": link,
-                        "preco_unitario": preco,
-                        "frete": frete,
-                        "data_compra": item.get('updated_at') or item.get('created_at', '')
-                    })
-    
-    # Ordenar por data mais recente
-    historico.sort(key=lambda x: x.get('data_compra', ''), reverse=True)
-    
-    # Limitar a 10 resultados mais recentes
-    historico = historico[:10]
+    historico = await buscar_historico(codigo_item, descricao, limite)
     
     return {
         "historico": historico,
@@ -1559,7 +1149,7 @@ async def preview_pdf_purchase_order(file: UploadFile = File(...), current_user:
     pdf_content = await file.read()
     
     # Extrair dados
-    oc_data = extract_oc_from_pdf(pdf_content)
+    oc_data = await extrair_oc_pdf(pdf_content)
     
     if not oc_data["items"]:
         raise HTTPException(status_code=400, detail="Nenhum item encontrado no PDF. Verifique o formato do arquivo.")
@@ -1637,7 +1227,7 @@ async def upload_pdf_purchase_order(file: UploadFile = File(...), current_user:
     pdf_content = await file.read()
     
     # Extrair dados
-    oc_data = extract_oc_from_pdf(pdf_content)
+    oc_data = await extrair_oc_pdf(pdf_content)
     
     if not oc_data["items"]:
         raise HTTPException(status_code=400, detail="Nenhum item encontrado no PDF. Verifique o formato do arquivo.")
@@ -1762,12 +1352,14 @@ async def upload_pdf_purchase_order(file: UploadFile = File(...), current_user:
     doc['pdf_original'] = {
         'filename': file.filename,
         'content_type': 'application/pdf',
-        'data': base64.b64encode(pdf_content).decode('utf-8'),
+        **(await salvar_blob(pdf_content, file.filename, 'application/pdf')),
         'uploaded_at': datetime.now(timezone.utc).isoformat()
     }
     doc['has_pdf'] = True  # Marcar que tem PDF disponível
+    doc['updated_at'] = doc['pdf_original']['uploaded_at']
     
     await db.purchase_orders.insert_one(doc)
+    await sincronizar_po(doc['id'])
     
     # REPROCESSAR automaticamente para garantir que todos os dados estejam corretos
     # Isso atualiza: descrição, lote, responsável, região, marca/modelo, preço de venda
@@ -1781,6 +1373,7 @@ async def upload_pdf_purchase_order(file: UploadFile = File(...), current_user:
                     ref_lookup_update[codigo] = []
                 ref_lookup_update[codigo].append(ref)
         
+        itens_antes = snapshot_itens(doc.get("items", []))
         items_updated = False
         for item in doc.get("items", []):
             codigo = item.get("codigo_item", "")
@@ -1811,10 +1404,7 @@ async def upload_pdf_purchase_order(file: UploadFile = File(...), current_user:
                     items_updated = True
         
         if items_updated:
-            await db.purchase_orders.update_one(
-                {"id": po.id},
-                {"$set": {"items": doc["items"]}}
-            )
+            await salvar_itens(po.id, itens_antes, doc["items"])
             logger.info(f"OC {po.numero_oc} reprocessada automaticamente após criação")
     except Exception as e:
         logger.warning(f"Erro ao reprocessar OC automaticamente: {e}")
@@ -1833,10 +1423,103 @@ async def upload_pdf_purchase_order(file: UploadFile = File(...), current_user:
     }
 
 @api_router.post("/purchase-orders/upload-multiple-pdfs")
-async def upload_multiple_pdfs(files: List[UploadFile] = File(...), current_user: dict = Depends(require_admin)):
-    """Upload de múltiplos PDFs de Ordens de Compra (ADMIN ONLY)"""
+async def upload_multiple_pdfs(
+    files: List[UploadFile] = File(...),
+    stream: bool = False,
+    current_user: dict = Depends(require_admin)
+):
+    """
+    Upload de múltiplos PDFs de Ordens de Compra (ADMIN ONLY)
+    
+    Processa o lote em etapas (leitura concorrente, parsing paralelo, uma consulta
+    de duplicadas e de referências, insert_many). Com ?stream=true a resposta é
+    NDJSON com uma linha de progresso por arquivo e o resultado na última linha.
+    """
+    arquivos = await ler_arquivos(files)
+    return await responder_pipeline(_pipeline_upload_multiplos_pdfs(arquivos, current_user), stream)
+
+
+def _aplicar_referencia_item_pdf(item: dict, oc_data: dict, ref_lookup: dict) -> POItem:
+    """Monta o POItem de um item extraído do PDF usando a planilha de referência"""
+    import random
+    
+    ref_items = ref_lookup.get(item["codigo_item"], [])
+    
+    responsavel = item.get("responsavel", "")
+    lote = item.get("lote", "")
+    lot_number = 0
+    descricao = item.get("descricao", "")
+    regiao = item.get("regiao", "")
+    marca_modelo = item.get("marca_modelo", "")
+    ref_item = None
+    
+    if ref_items:
+        ref_item = ref_items[0]
+        if len(ref_items) > 1:
+            ref_item = random.choice(ref_items)
+        responsavel = ref_item.get("responsavel", "")  # Campo correto
+        lote = ref_item.get("lote", "")
+        # Usar descrição da planilha
+        if ref_item.get("descricao"):
+            descricao = ref_item.get("descricao")
+        regiao = ref_item.get("regiao", regiao)
+        marca_modelo = ref_item.get("marca_modelo", marca_modelo)
+        try:
+            lot_number = int(''.join(filter(str.isdigit, lote))) if lote else 0
+        except:
+            lot_number = 0
+    
+    preco_venda = item.get("preco_venda_pdf") or item.get("preco_venda") or (ref_item.get("preco_venda_unitario") if ref_item else None)
+    
+    return POItem(
+        codigo_item=item["codigo_item"],
+        quantidade=int(item.get("quantidade", 1)),
+        unidade=item.get("unidade", "UN"),
+        descricao=descricao,  # Usar descrição da planilha
+        endereco_entrega=oc_data.get("endereco_entrega", ""),
+        responsavel=responsavel,
+        lote=lote,
+        lot_number=lot_number,
+        regiao=regiao,
+        status="pendente",
+        preco_venda=preco_venda,
+        marca_modelo=marca_modelo,
+        ncm=item.get("ncm", "")
+    )
+
+
+def _completar_itens_com_referencia(items: List[dict], ref_lookup: dict):
+    """
+    Preenche responsável/lote/preço ainda vazios a partir da referência.
+    Antes era um "reprocessamento" gravado após o insert; agora é aplicado
+    no documento antes da gravação.
+    """
     import random
     
+    for item in items:
+        ref_items = ref_lookup.get(item.get("codigo_item", ""), [])
+        if not ref_items:
+            continue
+        ref_item = ref_items[0] if len(ref_items) == 1 else random.choice(ref_items)
+        
+        if not item.get("responsavel") or "NÃO ENCONTRADO" in item.get("responsavel", ""):
+            item["responsavel"] = ref_item.get("responsavel", "")
+        
+        if not item.get("lote") or "NÃO ENCONTRADO" in item.get("lote", ""):
+            item["lote"] = ref_item.get("lote", "")
+        
+        if not item.get("preco_venda") and ref_item.get("preco_venda_unitario"):
+            item["preco_venda"] = ref_item.get("preco_venda_unitario")
+
+
+def _endereco_sem_cep(endereco: str) -> bool:
+    return bool(endereco) and not re.search(r'CEP[:\s]*\d{5}-?\d{3}', endereco, re.IGNORECASE)
+
+
+async def _pipeline_upload_multiplos_pdfs(arquivos: List[dict], current_user: dict):
+    """Gerador de eventos do upload múltiplo (ver pdf_batch_service)"""
+    from pymongo.errors import BulkWriteError
+    
     results = {
         "success": [],
         "failed": [],
@@ -1844,101 +1527,59 @@ async def upload_multiple_pdfs(files: List[UploadFile] = File(...), current_user
         "total_processed": 0,
         "total_items_created": 0
     }
+    total = len(arquivos)
+    
+    # ===== ETAPA 1: parsing em paralelo =====
+    parseados = []
+    processados = 0
+    async for arquivo in parsear_em_lote(arquivos):
+        processados += 1
+        oc_data = arquivo.get("oc_data") or {}
+        if not arquivo["erro"] and not oc_data.get("items"):
+            arquivo["erro"] = "Nenhum item encontrado no PDF"
+        
+        if arquivo["erro"]:
+            results["failed"].append({"filename": arquivo["filename"], "error": arquivo["erro"]})
+            yield evento_progresso(arquivo["filename"], processados, total, status="erro", erro=arquivo["erro"])
+            continue
+        
+        parseados.append(arquivo)
+        yield evento_progresso(arquivo["filename"], processados, total, status="lido", numero_oc=oc_data["numero_oc"])
     
-    for file in files:
+    # Manter a ordem de envio dos arquivos nas etapas seguintes
+    parseados.sort(key=lambda a: a["indice"])
+    
+    # ===== ETAPA 2: consultas únicas para o lote =====
+    existentes = await buscar_ocs_por_numero(
+        [a["oc_data"]["numero_oc"] for a in parseados],
+        {"_id": 0, "id": 1, "numero_oc": 1}
+    )
+    ref_lookup = await buscar_referencias(
+        [item["codigo_item"] for a in parseados for item in a["oc_data"]["items"]]
+    )
+    ceps = await mapear_concorrente(
+        buscar_cep_por_endereco,
+        [a["oc_data"].get("endereco_entrega") for a in parseados if _endereco_sem_cep(a["oc_data"].get("endereco_entrega"))]
+    )
+    
+    # ===== ETAPA 3: montar documentos =====
+    docs = []
+    arquivos_docs = []
+    for arquivo in parseados:
+        oc_data = arquivo["oc_data"]
+        
+        # Duplicada no banco ou repetida dentro do próprio lote
+        existing_po = existentes.get(oc_data["numero_oc"])
+        if existing_po:
+            results["duplicates"].append({
+                "filename": arquivo["filename"],
+                "numero_oc": oc_data["numero_oc"],
+                "existing_id": existing_po["id"]
+            })
+            continue
+        
         try:
-            if not file.filename.endswith('.pdf'):
-                results["failed"].append({
-                    "filename": file.filename,
-                    "error": "Arquivo não é PDF"
-                })
-                continue
-            
-            # Ler conteúdo do PDF
-            pdf_content = await file.read()
-            
-            # Extrair dados
-            oc_data = extract_oc_from_pdf(pdf_content)
-            
-            if not oc_data.get("items"):
-                results["failed"].append({
-                    "filename": file.filename,
-                    "error": "Nenhum item encontrado no PDF"
-                })
-                continue
-            
-            # Verificar se OC já existe
-            existing_po = await db.purchase_orders.find_one({"numero_oc": oc_data["numero_oc"]}, {"_id": 0})
-            if existing_po:
-                results["duplicates"].append({
-                    "filename": file.filename,
-                    "numero_oc": oc_data["numero_oc"],
-                    "existing_id": existing_po["id"]
-                })
-                continue
-            
-            # Processar itens com dados de referência
-            processed_items = []
-            
-            # OTIMIZAÇÃO: Batch query - buscar todas as referências de uma vez
-            all_codigo_items = [item["codigo_item"] for item in oc_data["items"]]
-            all_ref_items = await db.reference_items.find(
-                {"codigo_item": {"$in": all_codigo_items}},
-                {"_id": 0}
-            ).to_list(5000)
-            
-            # Criar lookup dictionary
-            ref_lookup = {}
-            for ref in all_ref_items:
-                codigo = ref["codigo_item"]
-                if codigo not in ref_lookup:
-                    ref_lookup[codigo] = []
-                ref_lookup[codigo].append(ref)
-            
-            for item in oc_data["items"]:
-                # Buscar do lookup
-                ref_items = ref_lookup.get(item["codigo_item"], [])
-                
-                responsavel = item.get("responsavel", "")
-                lote = item.get("lote", "")
-                lot_number = 0
-                descricao = item.get("descricao", "")
-                regiao = item.get("regiao", "")
-                marca_modelo = item.get("marca_modelo", "")
-                
-                if ref_items:
-                    ref_item = ref_items[0]
-                    if len(ref_items) > 1:
-                        ref_item = random.choice(ref_items)
-                    responsavel = ref_item.get("responsavel", "")  # Campo correto
-                    lote = ref_item.get("lote", "")
-                    # Usar descrição da planilha
-                    if ref_item.get("descricao"):
-                        descricao = ref_item.get("descricao")
-                    regiao = ref_item.get("regiao", regiao)
-                    marca_modelo = ref_item.get("marca_modelo", marca_modelo)
-                    try:
-                        lot_number = int(''.join(filter(str.isdigit, lote))) if lote else 0
-                    except:
-                        lot_number = 0
-                
-                preco_venda = item.get("preco_venda_pdf") or item.get("preco_venda") or (ref_item.get("preco_venda_unitario") if ref_items else None)
-                
-                processed_items.append(POItem(
-                    codigo_item=item["codigo_item"],
-                    quantidade=int(item.get("quantidade", 1)),
-                    unidade=item.get("unidade", "UN"),
-                    descricao=descricao,  # Usar descrição da planilha
-                    endereco_entrega=oc_data.get("endereco_entrega", ""),
-                    responsavel=responsavel,
-                    lote=lote,
-                    lot_number=lot_number,
-                    regiao=regiao,
-                    status="pendente",
-                    preco_venda=preco_venda,
-                    marca_modelo=marca_modelo,
-                    ncm=item.get("ncm", "")
-                ))
+            processed_items = [_aplicar_referencia_item_pdf(item, oc_data, ref_lookup) for item in oc_data["items"]]
             
             # Criar OC com data de entrega
             po = PurchaseOrder(
@@ -1964,72 +1605,69 @@ async def upload_multiple_pdfs(files: List[UploadFile] = File(...), current_user
             # Adicionar endereço de entrega COM BUSCA AUTOMÁTICA DE CEP
             if oc_data.get("endereco_entrega"):
                 endereco = oc_data["endereco_entrega"]
-                # Buscar CEP automaticamente se não tiver
-                if not re.search(r'CEP[:\s]*\d{5}-?\d{3}', endereco, re.IGNORECASE):
-                    cep = await buscar_cep_por_endereco(endereco)
-                    if cep:
-                        endereco = f"{endereco}, CEP: {cep}"
+                cep = ceps.get(endereco)
+                if cep:
+                    endereco = f"{endereco}, CEP: {cep}"
                 doc['endereco_entrega'] = endereco
             
-            # SALVAR PDF ORIGINAL para download posterior
-            import base64
-            doc['pdf_original'] = {
-                'filename': file.filename,
-                'content_type': 'application/pdf',
-                'data': base64.b64encode(pdf_content).decode('utf-8'),
-                'uploaded_at': datetime.now(timezone.utc).isoformat()
-            }
-            doc['has_pdf'] = True  # Marcar que tem PDF disponível
-            
-            await db.purchase_orders.insert_one(doc)
-            
-            # REPROCESSAR automaticamente para garantir que todos os dados estejam corretos
-            try:
-                items_updated = False
-                for item in doc.get("items", []):
-                    codigo = item.get("codigo_item", "")
-                    ref_items = ref_lookup.get(codigo, [])
-                    
-                    if ref_items:
-                        ref_item = ref_items[0] if len(ref_items) == 1 else random.choice(ref_items)
-                        
-                        if not item.get("responsavel") or "NÃO ENCONTRADO" in item.get("responsavel", ""):
-                            item["responsavel"] = ref_item.get("responsavel", "")
-                            items_updated = True
-                        
-                        if not item.get("lote") or "NÃO ENCONTRADO" in item.get("lote", ""):
-                            item["lote"] = ref_item.get("lote", "")
-                            items_updated = True
-                        
-                        if not item.get("preco_venda") and ref_item.get("preco_venda_unitario"):
-                            item["preco_venda"] = ref_item.get("preco_venda_unitario")
-                            items_updated = True
-                
-                if items_updated:
-                    await db.purchase_orders.update_one(
-                        {"id": po.id},
-                        {"$set": {"items": doc["items"]}}
-                    )
-            except Exception as e:
-                logger.warning(f"Erro ao reprocessar OC automaticamente: {e}")
-            
-            results["success"].append({
-                "filename": file.filename,
-                "numero_oc": po.numero_oc,
-                "po_id": po.id,
-                "total_items": len(processed_items)
-            })
-            results["total_items_created"] += len(processed_items)
-            
+            _completar_itens_com_referencia(doc["items"], ref_lookup)
         except Exception as e:
-            results["failed"].append({
-                "filename": file.filename,
-                "error": str(e)
-            })
+            results["failed"].append({"filename": arquivo["filename"], "error": str(e)})
+            continue
+        
+        existentes[oc_data["numero_oc"]] = {"id": doc["id"], "numero_oc": doc["numero_oc"]}
+        docs.append(doc)
+        arquivos_docs.append(arquivo)
+    
+    # SALVAR PDFs ORIGINAIS para download posterior (GridFS, em paralelo)
+    blobs = await asyncio.gather(
+        *[salvar_blob(a["conteudo"], a["filename"], 'application/pdf') for a in arquivos_docs],
+        return_exceptions=True
+    )
+    docs_validos = []
+    arquivos_validos = []
+    for doc, arquivo, blob in zip(docs, arquivos_docs, blobs):
+        if isinstance(blob, Exception):
+            results["failed"].append({"filename": arquivo["filename"], "error": f"Erro ao salvar PDF: {blob}"})
+            continue
+        doc['pdf_original'] = {
+            'filename': arquivo["filename"],
+            'content_type': 'application/pdf',
+            **blob,
+            'uploaded_at': datetime.now(timezone.utc).isoformat()
+        }
+        doc['has_pdf'] = True  # Marcar que tem PDF disponível
+        docs_validos.append(doc)
+        arquivos_validos.append(arquivo)
+    docs, arquivos_docs = docs_validos, arquivos_validos
+    
+    # ===== ETAPA 4: gravação única =====
+    falhas_insert = {}
+    if docs:
+        agora = datetime.now(timezone.utc).isoformat()
+        for doc in docs:
+            doc["updated_at"] = agora
+        try:
+            await db.purchase_orders.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            falhas_insert = {err["index"]: err.get("errmsg", "Erro ao inserir") for err in e.details.get("writeErrors", [])}
+        await sincronizar_pos(doc["id"] for idx, doc in enumerate(docs) if idx not in falhas_insert)
+    
+    for idx, (doc, arquivo) in enumerate(zip(docs, arquivos_docs)):
+        if idx in falhas_insert:
+            results["failed"].append({"filename": arquivo["filename"], "error": falhas_insert[idx]})
+            continue
+        results["success"].append({
+            "filename": arquivo["filename"],
+            "numero_oc": doc["numero_oc"],
+            "po_id": doc["id"],
+            "total_items": len(doc["items"])
+        })
+        results["total_items_created"] += len(doc["items"])
     
-    results["total_processed"] = len(files)
+    results["total_processed"] = total
     
-    return results
+    yield evento_resultado(results)
 
 @api_router.get("/purchase-orders/check-duplicate/{numero_oc}")
 async def check_duplicate_purchase_order(numero_oc: str, current_user: dict = Depends(require_admin)):
@@ -2148,8 +1786,10 @@ async def create_purchase_order(po_create: PurchaseOrderCreate, current_user: di
     # Garantir que endereco_entrega está no documento
     if po_create.endereco_entrega:
         doc['endereco_entrega'] = po_create.endereco_entrega
+    doc['updated_at'] = datetime.now(timezone.utc).isoformat()
     
     await db.purchase_orders.insert_one(doc)
+    await sincronizar_po(doc['id'])
     
     return po
 
@@ -2185,7 +1825,7 @@ async def get_purchase_orders(
                     pass
         
         # Adicionar flag has_pdf
-        po['has_pdf'] = bool(po.get('pdf_original') and po['pdf_original'].get('data'))
+        po['has_pdf'] = tem_conteudo(po.get('pdf_original'), 'data')
         # Remover dados pesados do PDF para não sobrecarregar a resposta
         if 'pdf_original' in po:
             del po['pdf_original']
@@ -2217,8 +1857,8 @@ async def get_items_by_status_optimized(
 ):
     """
     Endpoint OTIMIZADO para buscar itens por status.
-    Usa agregação MongoDB para filtrar diretamente no banco,
-    evitando carregar todas as OCs na memória.
+    Filtra, ordena e pagina no read-model po_items (índice por status/responsável)
+    e só então lê as OCs da página, sem $unwind de todas as OCs.
     """
     # Validar status
     status_validos = ["pendente", "cotado", "comprado", "em_separacao", "pronto_envio", "em_transito", "entregue"]
@@ -2229,83 +1869,52 @@ async def get_items_by_status_optimized(
     limit = min(limit, 2000)
     skip = (page - 1) * limit
     
-    # Pipeline de agregação otimizado
-    pipeline = [
-        # 1. Filtrar OCs que têm pelo menos um item com o status desejado
-        {"$match": {"items.status": status}},
-        
-        # 2. Desestruturar os itens
-        {"$unwind": {"path": "$items", "includeArrayIndex": "_itemIndex"}},
-        
-        # 3. Filtrar apenas itens com o status desejado
-        {"$match": {"items.status": status}},
-    ]
-    
+    filtro = {"status": status}
     # Se não for admin, filtrar por responsável
     if current_user['role'] != 'admin' and current_user.get('owner_name'):
-        user_name = current_user['owner_name'].strip()
-        pipeline.append({
-            "$match": {
-                "$expr": {
-                    "$eq": [
-                        {"$toUpper": {"$trim": {"input": {"$ifNull": ["$items.responsavel", ""]}}}},
-                        user_name.upper()
-                    ]
-                }
-            }
+        filtro["responsavel_norm"] = normalizar_responsavel(current_user['owner_name'])
+    
+    linhas = await db[PO_ITEMS].find(
+        filtro, {"_id": 0, "po_id": 1, "item_index": 1}
+    ).sort([("numero_oc", -1), ("item_index", 1)]).skip(skip).limit(limit).to_list(limit)
+    
+    po_ids = list(dict.fromkeys(linha['po_id'] for linha in linhas))
+    pos_por_id = {}
+    if po_ids:
+        cursor = db.purchase_orders.find({"id": {"$in": po_ids}}, {
+            "_id": 0, "id": 1, "numero_oc": 1, "data_entrega": 1, "endereco_entrega": 1,
+            "requisitante_nome": 1, "requisitante_email": 1, "notas_fiscais_venda": 1,
+            "dados_bancarios_custom": 1, "items": 1
         })
+        async for po in cursor:
+            pos_por_id[po['id']] = po
     
-    # 4. Projetar campos necessários (REDUZIDO para performance)
-    pipeline.append({
-        "$project": {
-            "_id": 0,
-            "po_id": "$id",
-            "numero_oc": 1,
-            "data_entrega": 1,
-            "endereco_entrega": 1,
-            "requisitante_nome": 1,
-            "requisitante_email": 1,
-            "notas_fiscais_venda": 1,
-            "dados_bancarios_custom": 1,
-            "item": {
-                "$mergeObjects": [
-                    "$items",
-                    {"_itemIndexInPO": "$_itemIndex", "_originalIndex": "$_itemIndex"}
-                ]
-            }
-        }
-    })
-    
-    # 5. Ordenar e paginar
-    pipeline.append({"$sort": {"numero_oc": -1}})
-    pipeline.append({"$skip": skip})
-    pipeline.append({"$limit": limit})
-    
-    # Executar agregação
-    cursor = db.purchase_orders.aggregate(pipeline)
-    results = await cursor.to_list(limit)
+    results = []
+    for linha in linhas:
+        po = pos_por_id.get(linha['po_id'])
+        idx = linha['item_index']
+        if not po or idx >= len(po.get('items', [])):
+            continue
+        item = po['items'][idx]
+        # Linha desatualizada (escrita concorrente): respeitar o estado real da OC
+        if item.get('status') != status:
+            continue
+        results.append({
+            **{k: v for k, v in po.items() if k != 'items'},
+            "po_id": po['id'],
+            "item": {**item, "_itemIndexInPO": idx, "_originalIndex": idx}
+        })
     
-    # Coletar IDs das OCs para buscar itens pendentes
-    # SÓ busca itens pendentes para status avançados (onde faz sentido mostrar "próxima remessa")
-    po_ids = set(r['po_id'] for r in results)
+    # Itens pendentes para "próxima remessa" - só para status onde faz sentido
     itens_pendentes_map = {}
-    
-    # Só buscar itens pendentes para status onde faz sentido
-    if po_ids and status in ['em_separacao', 'pronto_envio']:
+    if status in ['em_separacao', 'pronto_envio']:
         status_avancados = ['em_separacao', 'pronto_envio', 'em_transito', 'entregue']
-        pipeline_pendentes = [
-            {"$match": {"id": {"$in": list(po_ids)}}},
-            {"$unwind": "$items"},
-            {"$match": {"items.status": {"$nin": status_avancados}}},
-            {"$group": {
-                "_id": "$id",
-                "itens_pendentes": {"$addToSet": "$items.codigo_item"}
-            }}
-        ]
-        cursor_pendentes = db.purchase_orders.aggregate(pipeline_pendentes)
-        pendentes_results = await cursor_pendentes.to_list(500)
-        for p in pendentes_results:
-            itens_pendentes_map[p['_id']] = p['itens_pendentes']
+        for po_id, po in pos_por_id.items():
+            pendentes = list(dict.fromkeys(
+                i.get('codigo_item') for i in po.get('items', []) if i.get('status') not in status_avancados
+            ))
+            if pendentes:
+                itens_pendentes_map[po_id] = pendentes
     
     # Agrupar por OC para manter estrutura esperada pelo frontend
     ocs_map = {}
@@ -2359,7 +1968,10 @@ async def get_purchase_orders_simple(
 ):
     """Listar Ordens de Compra de forma simplificada (para carregamento rápido)
     Retorna apenas dados essenciais com paginação
-    Suporta filtros server-side para performance"""
+    Suporta filtros server-side para performance
+    
+    search_oc/search_codigo/search_descricao: todas as palavras precisam
+    aparecer (como prefixo, sem diferenciar acentos/maiúsculas) no mesmo item"""
     
     # Limitar para evitar sobrecarga extrema
     limit = min(limit, 1000)
@@ -2368,9 +1980,17 @@ async def get_purchase_orders_simple(
     # Construir query base
     query = {}
     
-    # Filtro por número da OC
-    if search_oc:
-        query["numero_oc"] = {"$regex": search_oc, "$options": "i"}
+    # Filtros de texto: termos normalizados de po_items (índice multikey)
+    # -> itens que casam, por OC
+    indices_por_po = None
+    filtro_texto = filtro_termos({"OC": search_oc, "COD": search_codigo, "DESC": search_descricao})
+    if filtro_texto:
+        if current_user['role'] != 'admin' and current_user.get('owner_name'):
+            filtro_texto["responsavel_norm"] = normalizar_responsavel(current_user['owner_name'])
+        indices_por_po = {}
+        async for linha in db[PO_ITEMS].find(filtro_texto, {"_id": 0, "po_id": 1, "item_index": 1}):
+            indices_por_po.setdefault(linha['po_id'], set()).add(linha['item_index'])
+        query["id"] = {"$in": list(indices_por_po)}
     
     # Filtro por data
     if date_from or date_to:
@@ -2393,14 +2013,6 @@ async def get_purchase_orders_simple(
         else:
             query["items.responsavel"] = search_responsavel
     
-    # Filtro por código do item
-    if search_codigo:
-        query["items.codigo_item"] = {"$regex": search_codigo, "$options": "i"}
-    
-    # Filtro por descrição
-    if search_descricao:
-        query["items.descricao"] = {"$regex": search_descricao, "$options": "i"}
-    
     # Se não for admin, adicionar filtro de responsável
     if current_user['role'] != 'admin' and current_user.get('owner_name'):
         user_name = current_user['owner_name'].strip()
@@ -2433,20 +2045,17 @@ async def get_purchase_orders_simple(
     for po in pos:
         items = po.get('items', [])
         
+        # Apenas os itens que casaram com os filtros de texto
+        if indices_por_po is not None:
+            indices = indices_por_po.get(po['id'], ())
+            items = [item for idx, item in enumerate(items) if idx in indices]
+        
         # Se não for admin, filtrar apenas itens do responsável
         if current_user['role'] != 'admin' and current_user.get('owner_name'):
             user_name = current_user['owner_name'].strip().upper()
             items = [item for item in items if (item.get('responsavel') or '').strip().upper() == user_name]
         
         # Aplicar filtros adicionais nos itens
-        if search_codigo:
-            search_codigo_upper = search_codigo.upper()
-            items = [item for item in items if search_codigo_upper in (item.get('codigo_item') or '').upper()]
-        
-        if search_descricao:
-            search_descricao_upper = search_descricao.upper()
-            items = [item for item in items if search_descricao_upper in (item.get('descricao') or '').upper()]
-        
         if search_responsavel and search_responsavel != 'nao_atribuido':
             items = [item for item in items if item.get('responsavel') == search_responsavel]
         elif search_responsavel == 'nao_atribuido':
@@ -2524,14 +2133,37 @@ async def delete_purchase_order(po_id: str, current_user: dict = Depends(require
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    await remover_po(po_id)
+    await registrar_exclusao("purchase_orders", po_id)
     return {"message": "Ordem de Compra deletada com sucesso"}
 
 
+def _content_disposition(filename: str) -> str:
+    """attachment com fallback ASCII e filename* (RFC 5987) para nomes acentuados"""
+    ascii_nome = filename.encode('ascii', 'ignore').decode().replace('"', '') or "arquivo"
+    return f"attachment; filename=\"{ascii_nome}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def resposta_arquivo(ref: dict, campo_legado: str, filename: str, content_type: Optional[str]):
+    """StreamingResponse do conteúdo (GridFS ou legado) com Content-Length quando conhecido"""
+    from fastapi.responses import StreamingResponse
+    
+    headers = {"Content-Disposition": _content_disposition(filename)}
+    tamanho = tamanho_conteudo(ref, campo_legado)
+    if tamanho is not None:
+        headers["Content-Length"] = str(tamanho)
+    
+    return StreamingResponse(
+        iterar_conteudo(ref, campo_legado),
+        media_type=content_type or "application/octet-stream",
+        headers=headers
+    )
+
+
 @api_router.get("/purchase-orders/{po_id}/download-pdf")
 async def download_oc_pdf(po_id: str, current_user: dict = Depends(get_current_user)):
-    """Download do PDF original da OC"""
-    from fastapi.responses import Response
-    import base64
+    """Download do PDF original da OC (streaming em chunks a partir do GridFS)"""
+    from fastapi.responses import StreamingResponse
     
     po = await db.purchase_orders.find_one(
         {"id": po_id},
@@ -2542,23 +2174,19 @@ async def download_oc_pdf(po_id: str, current_user: dict = Depends(get_current_u
         raise HTTPException(status_code=404, detail="OC não encontrada")
     
     pdf_data = po.get('pdf_original')
-    if not pdf_data or not pdf_data.get('data'):
+    if not tem_conteudo(pdf_data, 'data'):
         raise HTTPException(status_code=404, detail="PDF da OC não disponível. Faça upload do PDF para disponibilizá-lo.")
     
-    # Decodificar o PDF
-    try:
-        pdf_bytes = base64.b64decode(pdf_data['data'])
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Erro ao processar o PDF")
-    
     filename = pdf_data.get('filename') or f"{po['numero_oc']}.pdf"
+    headers = {"Content-Disposition": f"attachment; filename=\"{filename}\""}
+    tamanho = tamanho_conteudo(pdf_data, 'data')
+    if tamanho is not None:
+        headers["Content-Length"] = str(tamanho)
     
-    return Response(
-        content=pdf_bytes,
+    return StreamingResponse(
+        iterar_conteudo(pdf_data, 'data'),
         media_type="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename=\"{filename}\""
-        }
+        headers=headers
     )
 
 
@@ -2573,7 +2201,7 @@ async def check_oc_has_pdf(po_id: str, current_user: dict = Depends(get_current_
     if not po:
         raise HTTPException(status_code=404, detail="OC não encontrada")
     
-    has_pdf = bool(po.get('pdf_original') and po['pdf_original'].get('data'))
+    has_pdf = tem_conteudo(po.get('pdf_original'), 'data')
     
     return {
         "has_pdf": has_pdf,
@@ -2602,14 +2230,14 @@ async def upload_pdf_to_oc(
     pdf_data = {
         'filename': file.filename,
         'content_type': file.content_type or 'application/pdf',
-        'data': base64.b64encode(content).decode('utf-8'),
+        **(await salvar_blob(content, file.filename, file.content_type or 'application/pdf')),
         'uploaded_at': datetime.now(timezone.utc).isoformat(),
         'uploaded_by': current_user.get('sub')
     }
     
     result = await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": {"pdf_original": pdf_data}}
+        {"$set": {"pdf_original": pdf_data, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
     return {
@@ -2654,15 +2282,18 @@ async def update_purchase_order(po_id: str, po_update: PurchaseOrderCreate, curr
         
         processed_items.append(item)
     
-    # Atualizar
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {
-            "numero_oc": po_update.numero_oc,
-            "data_entrega": po_update.data_entrega,
-            "items": [item.model_dump() for item in processed_items]
-        }}
-    )
+    # Atualizar: diff por item contra o que foi lido (409 em edição concorrente);
+    # se o número de itens mudou, regravação completa com guarda de nível de OC
+    itens_antes = snapshot_itens(po.get('items', []))
+    itens_novos = [item.model_dump() for item in processed_items]
+    campos_oc = {
+        "numero_oc": po_update.numero_oc,
+        "data_entrega": po_update.data_entrega,
+    }
+    if len(itens_novos) == len(itens_antes):
+        await salvar_itens(po_id, itens_antes, itens_novos, campos_oc)
+    else:
+        await substituir_itens(po_id, itens_antes, itens_novos, campos_oc)
     
     return {"message": "Ordem de Compra atualizada com sucesso"}
 
@@ -2692,8 +2323,9 @@ async def update_data_entrega(
     
     await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": {"data_entrega": data_entrega}}
+        {"$set": {"data_entrega": data_entrega, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await sincronizar_po(po_id)
     
     return {"message": "Data de entrega atualizada com sucesso", "data_entrega": data_entrega}
 
@@ -2708,6 +2340,7 @@ async def update_item_status(po_id: str, codigo_item: str, update: ItemStatusUpd
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_updated = False
     user_role = current_user.get('role', '')
     user_email = current_user.get('sub', '')
@@ -2794,10 +2427,10 @@ async def update_item_status(po_id: str, codigo_item: str, update: ItemStatusUpd
     if not item_updated:
         raise HTTPException(status_code=404, detail="Item não encontrado")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_itens(po_id, itens_antes, po['items'])
+    
+    if update.codigo_rastreio or update.status is not None:
+        await agendar_rastreio_itens(item for item in po['items'] if item['codigo_item'] == codigo_item)
     
     return {"message": "Item atualizado com sucesso"}
 
@@ -2820,6 +2453,7 @@ async def update_item_by_index_status(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     status_anterior = item.get('status', 'pendente')
     logger.info(f"Editando item {item.get('codigo_item')} - user: {current_user.get('sub')}, status_anterior={status_anterior}, novo_status={update.status}")
@@ -2900,11 +2534,11 @@ async def update_item_by_index_status(
     elif update.status == ItemStatus.ENTREGUE:
         item['data_entrega'] = now
     
-    # SALVAR
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    # SALVAR - apenas os campos alterados deste item
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
+    
+    if update.codigo_rastreio or update.status is not None:
+        await agendar_rastreio_itens([item])
     
     return {"message": "Item atualizado com sucesso"}
 
@@ -2951,6 +2585,7 @@ async def comprar_parcialmente(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item_original = po['items'][item_index]
     quantidade_total = item_original.get('quantidade', 0)
     
@@ -3002,14 +2637,8 @@ async def comprar_parcialmente(
     item_original['quantidade'] = quantidade_restante
     item_original['quantidade_original_antes_compra_parcial'] = quantidade_total
     
-    # Inserir item comprado logo após o original
-    po['items'].insert(item_index + 1, item_comprado)
-    
-    # Salvar
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    # Salvar o original atualizado e inserir o item comprado logo após ele (operação atômica)
+    await dividir_item(po_id, item_index, item_antes, item_original, item_comprado, len(po['items']))
     
     logger.info(f"Compra parcial realizada: {request.quantidade_comprar} de {quantidade_total} unidades do item {item_original.get('codigo_item')}")
     
@@ -3063,6 +2692,7 @@ async def enviar_parcialmente(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item_original = po['items'][item_index]
     quantidade_total = item_original.get('quantidade', 0)
     
@@ -3097,14 +2727,9 @@ async def enviar_parcialmente(
     item_original['quantidade'] = quantidade_restante
     item_original['quantidade_original_antes_envio_parcial'] = quantidade_total
     
-    # Inserir item enviado logo após o original
-    po['items'].insert(item_index + 1, item_enviado)
-    
-    # Salvar
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    # Salvar o original atualizado e inserir o item enviado logo após ele (operação atômica)
+    await dividir_item(po_id, item_index, item_antes, item_original, item_enviado, len(po['items']))
+    await agendar_rastreio_itens([item_enviado])
     
     logger.info(f"Envio parcial realizado: {request.quantidade_enviar} de {quantidade_total} unidades do item {item_original.get('codigo_item')}")
     
@@ -3154,6 +2779,7 @@ async def mover_carrinho_para_comprado(
                 errors.append(f"OC {po_id} não encontrada")
                 continue
             
+            itens_antes = snapshot_itens(po['items'])
             for item_index in indices:
                 if 0 <= item_index < len(po['items']):
                     item = po['items'][item_index]
@@ -3164,10 +2790,7 @@ async def mover_carrinho_para_comprado(
                 else:
                     errors.append(f"Índice {item_index} inválido na OC {po_id}")
             
-            await db.purchase_orders.update_one(
-                {"id": po_id},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po_id, itens_antes, po['items'])
         except Exception as e:
             errors.append(f"Erro ao atualizar OC {po_id}: {str(e)}")
     
@@ -3192,6 +2815,7 @@ async def update_item_full(
     if not po:
         raise HTTPException(status_code=404, detail="OC não encontrada")
     
+    itens_antes = snapshot_itens(po['items'])
     item_updated = False
     for item in po['items']:
         if item['codigo_item'] == codigo_item:
@@ -3218,10 +2842,7 @@ async def update_item_full(
     if not item_updated:
         raise HTTPException(status_code=404, detail="Item não encontrado")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_itens(po_id, itens_antes, po['items'])
     
     return {"message": "Item atualizado com sucesso"}
 
@@ -3243,6 +2864,7 @@ async def update_item_by_index(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     status_anterior = item.get('status', 'pendente')
     
@@ -3280,120 +2902,60 @@ async def update_item_by_index(
     # Recalcular imposto e lucro usando a função centralizada
     calcular_lucro_item(item)
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
+    
+    if update.status is not None:
+        await agendar_rastreio_itens([item])
     
     return {"message": "Item atualizado com sucesso"}
 
 @api_router.get("/dashboard", response_model=DashboardStats)
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
-    """Estatísticas do dashboard - OTIMIZADO com agregação MongoDB"""
+    """
+    Estatísticas do dashboard - lidas dos contadores pré-calculados
+    (services/dashboard_service.py), sem agregar os itens a cada carregamento.
+    """
+    import unicodedata
     
     is_admin = current_user['role'] == 'admin'
     user_name = current_user.get('owner_name', '').strip().upper() if not is_admin else None
     
-    # Pipeline de agregação para contar itens por status
-    pipeline = [
-        {"$unwind": "$items"},
-    ]
-    
-    # Filtrar por responsável se não for admin
-    if not is_admin and user_name:
-        pipeline.append({
-            "$match": {
-                "$expr": {
-                    "$eq": [
-                        {"$toUpper": {"$trim": {"input": {"$ifNull": ["$items.responsavel", ""]}}}},
-                        user_name
-                    ]
-                }
-            }
-        })
-    
-    # Agrupar para contar por status
-    pipeline.append({
-        "$group": {
-            "_id": "$items.status",
-            "count": {"$sum": 1}
-        }
-    })
-    
-    cursor = db.purchase_orders.aggregate(pipeline)
-    results = await cursor.to_list(20)
+    status_lista = ["pendente", "cotado", "comprado", "em_separacao", "pronto_envio", "em_transito", "entregue"]
     
-    # Mapear resultados
-    status_counts = {r['_id']: r['count'] for r in results}
+    def breakdown(doc: Optional[dict]) -> dict:
+        itens = (doc or {}).get('itens', {})
+        return {"total": (doc or {}).get('total', 0), **{s: itens.get(s, 0) for s in status_lista}}
     
-    # Contar OCs
     if is_admin:
-        total_ocs = await db.purchase_orders.count_documents({})
+        docs = await ler_contadores()
+        totais = next((d for d in docs if d['_id'] == CHAVE_TOTAL_DASHBOARD), None)
     else:
-        # Contar OCs que têm itens do usuário
-        pipeline_ocs = [
-            {"$unwind": "$items"},
-            {"$match": {
-                "$expr": {
-                    "$eq": [
-                        {"$toUpper": {"$trim": {"input": {"$ifNull": ["$items.responsavel", ""]}}}},
-                        user_name
-                    ]
-                }
-            }},
-            {"$group": {"_id": "$id"}},
-            {"$count": "total"}
-        ]
-        cursor_ocs = db.purchase_orders.aggregate(pipeline_ocs)
-        ocs_result = await cursor_ocs.to_list(1)
-        total_ocs = ocs_result[0]['total'] if ocs_result else 0
-    
-    # Calcular totais
-    items_pendentes = status_counts.get('pendente', 0)
-    items_cotados = status_counts.get('cotado', 0)
-    items_comprados = status_counts.get('comprado', 0)
-    items_em_separacao = status_counts.get('em_separacao', 0)
-    items_pronto_envio = status_counts.get('pronto_envio', 0)
-    items_em_transito = status_counts.get('em_transito', 0)
-    items_entregues = status_counts.get('entregue', 0)
+        # Sem owner_name o usuário vê os totais (mesmo comportamento de antes)
+        docs = await ler_contadores(user_name or CHAVE_TOTAL_DASHBOARD)
+        totais = docs[0] if docs else None
     
-    total_items = sum(status_counts.values())
+    contagem = breakdown(totais)
+    if is_admin or not user_name:
+        # Todas as OCs, inclusive as sem itens (fora dos contadores)
+        total_ocs = await db.purchase_orders.count_documents({})
+    else:
+        total_ocs = (totais or {}).get('ocs', 0)
+    total_items = contagem['total']
     
     # Breakdown por responsável (apenas para admins)
     items_por_responsavel = {}
     if is_admin:
-        pipeline_resp = [
-            {"$unwind": "$items"},
-            {"$group": {
-                "_id": {
-                    "responsavel": {"$trim": {"input": {"$ifNull": ["$items.responsavel", ""]}}},
-                    "status": "$items.status"
-                },
-                "count": {"$sum": 1}
-            }}
-        ]
-        cursor_resp = db.purchase_orders.aggregate(pipeline_resp)
-        resp_results = await cursor_resp.to_list(500)
-        
         # Organizar por responsável - case-insensitive e sem acentos
         resp_data = {}
-        for r in resp_results:
-            responsavel_original = r['_id'].get('responsavel', '').strip()
-            if not responsavel_original:
+        for doc in docs:
+            if doc['_id'] in (CHAVE_TOTAL_DASHBOARD, ""):
                 continue
-            status = r['_id'].get('status', 'pendente')
-            count = r['count']
-            
-            # Normalizar nome para comparação (sem acentos, maiúsculo)
-            import unicodedata
-            responsavel_normalizado = unicodedata.normalize('NFD', responsavel_original.upper())
+            responsavel_normalizado = unicodedata.normalize('NFD', doc['_id'])
             responsavel_normalizado = ''.join(c for c in responsavel_normalizado if unicodedata.category(c) != 'Mn')
             
-            if responsavel_normalizado not in resp_data:
-                resp_data[responsavel_normalizado] = {"total": 0, "pendente": 0, "cotado": 0, "comprado": 0, 
-                                          "em_separacao": 0, "pronto_envio": 0, "em_transito": 0, "entregue": 0}
-            resp_data[responsavel_normalizado][status] = resp_data[responsavel_normalizado].get(status, 0) + count
-            resp_data[responsavel_normalizado]["total"] += count
+            atual = resp_data.setdefault(responsavel_normalizado, breakdown(None))
+            for chave, valor in breakdown(doc).items():
+                atual[chave] += valor
         
         # Mapear para os nomes conhecidos
         owner_mapping = {
@@ -3405,36 +2967,23 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
         }
         
         for owner_upper, owner_display in owner_mapping.items():
-            if owner_upper in resp_data:
-                items_por_responsavel[owner_display] = resp_data[owner_upper]
-            else:
-                items_por_responsavel[owner_display] = {"total": 0, "pendente": 0, "cotado": 0, "comprado": 0,
-                                                "em_separacao": 0, "pronto_envio": 0, "em_transito": 0, "entregue": 0}
+            items_por_responsavel[owner_display] = resp_data.get(owner_upper, breakdown(None))
     else:
         # Usuário não-admin vê apenas seus próprios itens
         owner_name = current_user.get('owner_name')
         if owner_name:
-            items_por_responsavel[owner_name] = {
-                "total": total_items,
-                "pendente": items_pendentes,
-                "cotado": items_cotados,
-                "comprado": items_comprados,
-                "em_separacao": items_em_separacao,
-                "pronto_envio": items_pronto_envio,
-                "em_transito": items_em_transito,
-                "entregue": items_entregues
-            }
+            items_por_responsavel[owner_name] = contagem
     
     return DashboardStats(
         total_ocs=total_ocs,
         total_items=total_items,
-        items_pendentes=items_pendentes,
-        items_cotados=items_cotados,
-        items_comprados=items_comprados,
-        items_em_separacao=items_em_separacao,
-        items_pronto_envio=items_pronto_envio,
-        items_em_transito=items_em_transito,
-        items_entregues=items_entregues,
+        items_pendentes=contagem['pendente'],
+        items_cotados=contagem['cotado'],
+        items_comprados=contagem['comprado'],
+        items_em_separacao=contagem['em_separacao'],
+        items_pronto_envio=contagem['pronto_envio'],
+        items_em_transito=contagem['em_transito'],
+        items_entregues=contagem['entregue'],
         items_por_responsavel=items_por_responsavel
     )
 
@@ -3526,6 +3075,7 @@ async def fix_responsaveis(current_user: dict = Depends(require_admin)):
     
     for po in pos:
         updated = False
+        itens_antes = snapshot_itens(po['items'])
         for item in po['items']:
             if not item.get('responsavel'):
                 ref_items = ref_lookup.get(item["codigo_item"], [])
@@ -3546,10 +3096,7 @@ async def fix_responsaveis(current_user: dict = Depends(require_admin)):
                     updated = True
         
         if updated:
-            await db.purchase_orders.update_one(
-                {"id": po['id']},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po['id'], itens_antes, po['items'], levantar_conflito=False)
     
     return {"message": f"{total_fixed} itens corrigidos com sucesso"}
 
@@ -3584,6 +3131,7 @@ async def fix_marca_modelo(current_user: dict = Depends(require_admin)):
     
     for po in pos:
         updated = False
+        itens_antes = snapshot_itens(po['items'])
         for item in po['items']:
             if not item.get('marca_modelo'):
                 ref_items = ref_lookup.get(item["codigo_item"], [])
@@ -3599,10 +3147,7 @@ async def fix_marca_modelo(current_user: dict = Depends(require_admin)):
                             break
         
         if updated:
-            await db.purchase_orders.update_one(
-                {"id": po['id']},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po['id'], itens_antes, po['items'], levantar_conflito=False)
     
     return {"message": f"{total_fixed} itens corrigidos com marca/modelo"}
 
@@ -3624,6 +3169,7 @@ async def normalize_fornecedores(current_user: dict = Depends(require_admin)):
     
     for po in pos:
         updated = False
+        itens_antes = snapshot_itens(po['items'])
         for item in po['items']:
             fontes = item.get('fontes_compra', [])
             for fonte in fontes:
@@ -3635,10 +3181,7 @@ async def normalize_fornecedores(current_user: dict = Depends(require_admin)):
                     updated = True
         
         if updated:
-            await db.purchase_orders.update_one(
-                {"id": po['id']},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po['id'], itens_antes, po['items'], levantar_conflito=False)
     
     return {"message": f"{total_normalized} fornecedores normalizados com sucesso"}
 
@@ -3650,6 +3193,7 @@ async def update_all_descriptions(current_user: dict = Depends(require_admin)):
     
     for po in pos:
         updated = False
+        itens_antes = snapshot_itens(po['items'])
         for item in po['items']:
             codigo_item = item.get('codigo_item')
             if codigo_item:
@@ -3668,191 +3212,179 @@ async def update_all_descriptions(current_user: dict = Depends(require_admin)):
                         updated = True
         
         if updated:
-            await db.purchase_orders.update_one(
-                {"id": po['id']},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po['id'], itens_antes, po['items'], levantar_conflito=False)
     
     return {"message": f"{total_updated} descrições atualizadas com sucesso"}
 
+def _colecoes_backup_completo(nomes: List[str]) -> List[ColecaoBackup]:
+    """
+    Todas as coleções, sem binários inline legados. As referências ao GridFS
+    (pdf_original.blob_id etc.) são mantidas; o conteúdo vai em colecao_arquivos().
+    """
+    campos_remover = {"pdf_original.data": 0, "nf_pdf": 0, "imagem_base64": 0}
+    colecoes = []
+    for nome in nomes:
+        if nome == 'purchase_orders':
+            colecoes.append(ColecaoBackup(nome, projecao={"_id": 0, **campos_remover}))
+        elif nome == 'imagens_itens':
+            colecoes.append(ColecaoBackup(nome, projecao={"_id": 0, "imagem_base64": 0}))
+        else:
+            colecoes.append(ColecaoBackup(nome))
+    return colecoes
+
+
+# Coleções derivadas ou operacionais: nunca exportadas nem restauradas.
+# po_items, historico_cotacoes e dashboard_counters são reconstruídas a partir
+# de purchase_orders (job reconstruir_po_items) e a agenda de rastreio é
+# ressincronizada após a restauração; caches (parsing de PDFs, Correios) são
+# refeitos sob demanda; a fila de jobs é do servidor atual - jobs pendentes de
+# um backup antigo seriam executados de novo sobre os dados restaurados.
+COLECOES_NAO_RESTAURAVEIS = (
+    PO_ITEMS, HISTORICO_COTACOES, DASHBOARD_COUNTERS, RASTREIO_AGENDA, RASTREIO_CACHE, PARSE_CACHE, JOBS
+)
+
+
+async def _nomes_colecoes_backup() -> List[str]:
+    # As coleções do GridFS não são exportadas como tais: o conteúdo vai em colecao_arquivos().
+    # Coleções temporárias de uma restauração em andamento e o controle dos
+    # backups incrementais (histórico/exclusões) também ficam de fora.
+    return [
+        c for c in await db.list_collection_names()
+        if not c.startswith((f"{BLOB_BUCKET}.", PREFIXO_RESTAURACAO))
+        and c not in COLECOES_NAO_RESTAURAVEIS and c not in COLECOES_CONTROLE_BACKUP
+    ]
+
+
+def _nome_arquivo_backup(modo: str = "completo") -> str:
+    sufixo = "_incremental" if modo == "incremental" else ""
+    return f"backup_fiep_{datetime.now().strftime('%Y%m%d_%H%M%S')}{sufixo}"
+
+
 @api_router.get("/backup/export")
-async def export_backup(current_user: dict = Depends(require_admin)):
-    """Exportar backup completo do sistema (ADMIN ONLY)"""
-    from datetime import datetime
-    import base64
+async def export_backup(
+    formato: str = "json",
+    compressao: str = "nenhuma",
+    arquivos: bool = True,
+    current_user: dict = Depends(require_admin)
+):
+    """
+    Exportar backup completo do sistema (ADMIN ONLY).
+    Gerado em streaming (services/backup_service.py); as estatísticas são
+    calculadas durante a exportação e vão em backup_info no final do arquivo.
+    arquivos=true inclui o conteúdo do GridFS (PDFs, NFs, imagens).
+    """
+    validar_opcoes(formato, compressao)
     
-    try:
-        # Buscar todos os dados COMPLETOS de todas as collections
-        pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(10000)
-        users = await db.users.find({}, {"_id": 0}).to_list(1000)
-        reference_items = await db.reference_items.find({}, {"_id": 0}).to_list(50000)
-        notifications = await db.notifications.find({}, {"_id": 0}).to_list(10000)
-        
-        # Collections adicionais
-        estoque = await db.estoque.find({}, {"_id": 0}).to_list(10000)
-        configuracoes = await db.configuracoes.find({}, {"_id": 0}).to_list(100)
-        custos_diversos = await db.custos_diversos.find({}, {"_id": 0}).to_list(1000)
-        fechamentos_lucro = await db.fechamentos_lucro.find({}, {"_id": 0}).to_list(1000)
-        fornecedores = await db.fornecedores.find({}, {"_id": 0}).to_list(1000) if "fornecedores" in await db.list_collection_names() else []
-        
-        # Calcular estatísticas detalhadas
-        total_items = 0
-        status_counts = {}
-        items_com_cotacao = 0
-        items_com_link = 0
-        items_com_foto = 0
-        items_com_pdf = 0
-        total_valor_venda = 0
-        total_valor_compra = 0
-        total_fretes = 0
-        
-        for po in pos:
-            # Contar PDFs
-            if po.get('pdf_original') or po.get('has_pdf'):
-                items_com_pdf += 1
+    stats = {
+        "total_itens": 0, "status_itens": {}, "items_com_cotacao": 0, "items_com_link": 0,
+        "items_com_foto": 0, "ocs_com_pdf": 0,
+        "valor_total_venda": 0, "valor_total_compra": 0, "total_fretes": 0
+    }
+    
+    def observar(colecao: str, po: dict):
+        if colecao != 'purchase_orders':
+            return
+        # Contar PDFs
+        if po.get('pdf_original') or po.get('has_pdf'):
+            stats["ocs_com_pdf"] += 1
+        
+        for item in po.get('items', []):
+            stats["total_itens"] += 1
+            status = item.get('status', 'pendente')
+            stats["status_itens"][status] = stats["status_itens"].get(status, 0) + 1
             
-            for item in po.get('items', []):
-                total_items += 1
-                status = item.get('status', 'pendente')
-                status_counts[status] = status_counts.get(status, 0) + 1
-                
-                # Contar cotações e links
-                fontes = item.get('fontes_compra', [])
-                if fontes and len(fontes) > 0:
-                    items_com_cotacao += 1
-                    for f in fontes:
-                        if f.get('link'):
-                            items_com_link += 1
-                
-                # Contar fotos
-                if item.get('imagem_url') or item.get('imagens'):
-                    items_com_foto += 1
-                
-                # Somar valores
-                preco_venda = item.get('preco_venda', 0) or 0
-                preco_compra = item.get('preco_compra', 0) or 0
-                quantidade = item.get('quantidade', 0) or 0
-                frete_compra = item.get('frete_compra', 0) or 0
-                frete_envio = item.get('frete_envio', 0) or 0
-                
-                total_valor_venda += preco_venda * quantidade
-                total_valor_compra += preco_compra * quantidade
-                total_fretes += frete_compra + frete_envio
-        
-        backup = {
-            "backup_info": {
-                "data_export": datetime.now().isoformat(),
-                "versao": "3.0",
-                "sistema": "FIEP - Sistema de Gestão de OCs",
-                "estatisticas": {
-                    "total_ocs": len(pos),
-                    "total_itens": total_items,
-                    "total_usuarios": len(users),
-                    "total_itens_referencia": len(reference_items),
-                    "total_notificacoes": len(notifications),
-                    "total_estoque": len(estoque),
-                    "total_configuracoes": len(configuracoes),
-                    "total_custos_diversos": len(custos_diversos),
-                    "total_fechamentos": len(fechamentos_lucro),
-                    "total_fornecedores": len(fornecedores),
-                    "items_com_cotacao": items_com_cotacao,
-                    "items_com_link": items_com_link,
-                    "items_com_foto": items_com_foto,
-                    "ocs_com_pdf": items_com_pdf,
-                    "valor_total_venda": round(total_valor_venda, 2),
-                    "valor_total_compra": round(total_valor_compra, 2),
-                    "total_fretes": round(total_fretes, 2),
-                    "status_itens": status_counts
-                }
-            },
-            "purchase_orders": pos,
-            "users": users,
-            "reference_items": reference_items,
-            "notifications": notifications,
-            "estoque": estoque,
-            "configuracoes": configuracoes,
-            "custos_diversos": custos_diversos,
-            "fechamentos_lucro": fechamentos_lucro,
-            "fornecedores": fornecedores
+            # Contar cotações e links
+            fontes = item.get('fontes_compra', [])
+            if fontes:
+                stats["items_com_cotacao"] += 1
+                stats["items_com_link"] += sum(1 for f in fontes if f.get('link'))
+            
+            # Contar fotos
+            if item.get('imagem_url') or item.get('imagens'):
+                stats["items_com_foto"] += 1
+            
+            # Somar valores
+            quantidade = item.get('quantidade', 0) or 0
+            stats["valor_total_venda"] += (item.get('preco_venda', 0) or 0) * quantidade
+            stats["valor_total_compra"] += (item.get('preco_compra', 0) or 0) * quantidade
+            stats["total_fretes"] += (item.get('frete_compra', 0) or 0) + (item.get('frete_envio', 0) or 0)
+    
+    def estatisticas_extras() -> dict:
+        return {
+            **stats,
+            "valor_total_venda": round(stats["valor_total_venda"], 2),
+            "valor_total_compra": round(stats["valor_total_compra"], 2),
+            "total_fretes": round(stats["total_fretes"], 2)
         }
-        
-        return backup
-        
-    except Exception as e:
-        logger.error(f"Erro ao exportar backup: {e}")
-        raise HTTPException(status_code=500, detail=f"Erro ao exportar backup: {str(e)}")
+    
+    # Dados COMPLETOS das collections principais
+    colecoes = [ColecaoBackup(nome) for nome in [
+        "purchase_orders", "users", "reference_items", "notifications", "estoque",
+        "configuracoes", "custos_diversos", "fechamentos_lucro", "fornecedores"
+    ]]
+    if arquivos:
+        colecoes.append(colecao_arquivos())
+    info = {
+        "data_export": datetime.now().isoformat(),
+        "versao": "3.0",
+        "sistema": "FIEP - Sistema de Gestão de OCs"
+    }
+    return resposta_backup(
+        gerar_backup(colecoes, info, formato, compressao, observar, estatisticas_extras),
+        _nome_arquivo_backup(), formato, compressao
+    )
 
 
 @api_router.get("/backup/download")
-async def download_backup(token: str = None, current_user: dict = Depends(require_admin)):
-    """Download backup simples e rápido"""
-    from datetime import datetime
-    from fastapi.responses import Response
-    import json
-    
-    try:
-        logger.info("Gerando backup...")
-        
-        # Buscar dados sem campos pesados
-        projection = {"_id": 0, "pdf_original": 0, "nf_pdf": 0, "imagem_base64": 0}
-        
-        pos = await db.purchase_orders.find({}, projection).to_list(None)
-        users = await db.users.find({}, {"_id": 0, "password": 0}).to_list(None)
-        reference_items = await db.reference_items.find({}, {"_id": 0}).to_list(None)
-        limites = await db.limites_contrato.find({}, {"_id": 0}).to_list(None)
-        estoque = await db.estoque_manual.find({}, {"_id": 0}).to_list(None)
-        configuracoes = await db.configuracoes.find({}, {"_id": 0}).to_list(None)
-        custos = await db.custos_diversos.find({}, {"_id": 0}).to_list(None)
-        
-        total_items = sum(len(po.get('items', [])) for po in pos)
-        itens_rastreio = sum(1 for po in pos for item in po.get('items', []) if item.get('codigo_rastreio'))
-        
-        backup = {
-            "backup_info": {
-                "data_export": datetime.now().isoformat(),
-                "versao": "4.3",
-                "estatisticas": {
-                    "ocs": len(pos), "itens": total_items, "rastreios": itens_rastreio,
-                    "usuarios": len(users), "referencias": len(reference_items),
-                    "limites": len(limites), "estoque": len(estoque)
-                }
-            },
-            "purchase_orders": pos,
-            "users": users,
-            "reference_items": reference_items,
-            "limites_contrato": limites,
-            "estoque_manual": estoque,
-            "configuracoes": configuracoes,
-            "custos_diversos": custos
-        }
-        
-        json_str = json.dumps(backup, ensure_ascii=False, default=str, separators=(',', ':'))
-        logger.info(f"Backup: {len(json_str)} bytes")
-        
-        return Response(
-            content=json_str.encode('utf-8'),
-            media_type="application/json",
-            headers={
-                "Content-Disposition": f'attachment; filename="backup_fiep_{datetime.now().strftime("%Y%m%d")}.json"',
-                "Content-Type": "application/json; charset=utf-8",
-                "Content-Length": str(len(json_str.encode('utf-8')))
-            }
-        )
-        
-    except Exception as e:
-        logger.error(f"Erro backup: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=str(e))
+async def download_backup(
+    token: str = None,
+    formato: str = "json",
+    compressao: str = "nenhuma",
+    modo: str = "completo",
+    current_user: dict = Depends(require_admin)
+):
+    """
+    Download backup simples e rápido (streaming, sem campos pesados).
+    modo=incremental exporta só as OCs alteradas (e excluídas) desde o
+    último backup registrado.
+    """
+    validar_opcoes(formato, compressao)
+    logger.info("Gerando backup...")
+    
+    stats = {"itens": 0, "rastreios": 0}
+    
+    def observar(colecao: str, po: dict):
+        if colecao == 'purchase_orders':
+            items = po.get('items', [])
+            stats["itens"] += len(items)
+            stats["rastreios"] += sum(1 for item in items if item.get('codigo_rastreio'))
+    
+    colecoes = [
+        # Sem campos pesados
+        ColecaoBackup("purchase_orders", projecao={"_id": 0, "pdf_original": 0, "nf_pdf": 0, "imagem_base64": 0}),
+        ColecaoBackup("users", projecao={"_id": 0, "password": 0}),
+        ColecaoBackup("reference_items"),
+        ColecaoBackup("limites_contrato"),
+        ColecaoBackup("estoque_manual"),
+        ColecaoBackup("configuracoes"),
+        ColecaoBackup("custos_diversos"),
+    ]
+    info = {"data_export": datetime.now().isoformat(), "versao": "4.3"}
+    colecoes, info, ao_concluir = await preparar_backup(modo, colecoes, info)
+    return resposta_backup(
+        gerar_backup(colecoes, info, formato, compressao, observar, lambda: dict(stats), ao_concluir),
+        _nome_arquivo_backup(modo), formato, compressao
+    )
 
 # Endpoint de download direto via link (sem necessidade de JavaScript fetch)
 @api_router.get("/backup/direct")
-async def download_backup_direct(token: str):
-    """Download backup direto via link - aceita token na URL"""
-    from datetime import datetime
-    from fastapi.responses import Response
+async def download_backup_direct(token: str, formato: str = "json", compressao: str = "nenhuma", modo: str = "completo",
+                                 arquivos: bool = True):
+    """
+    Download backup direto via link - aceita token na URL (modo=completo|incremental).
+    arquivos=true inclui o conteúdo do GridFS (no incremental, só os arquivos novos).
+    """
     from auth import SECRET_KEY, ALGORITHM
-    import json
     
     # Validar token manualmente
     try:
@@ -3869,218 +3401,138 @@ async def download_backup_direct(token: str):
         logger.error(f"Erro ao validar token: {e}")
         raise HTTPException(status_code=401, detail="Token inválido")
     
-    try:
-        logger.info("Gerando backup direto...")
-        
-        collection_names = await db.list_collection_names()
-        all_data = {}
-        estatisticas = {}
-        
-        campos_remover = ['pdf_original', 'nf_pdf', 'imagem_base64']
-        
-        for col_name in collection_names:
-            try:
-                docs = await db[col_name].find({}, {"_id": 0}).to_list(None)
-                
-                if col_name == 'purchase_orders':
-                    for doc in docs:
-                        for campo in campos_remover:
-                            if campo in doc:
-                                del doc[campo]
-                
-                if col_name == 'imagens_itens':
-                    for doc in docs:
-                        if 'imagem_base64' in doc:
-                            del doc['imagem_base64']
-                
-                all_data[col_name] = docs
-                estatisticas[f"total_{col_name}"] = len(docs)
-            except Exception as col_error:
-                logger.warning(f"Erro ao exportar {col_name}: {col_error}")
-                all_data[col_name] = []
-                estatisticas[f"total_{col_name}"] = 0
-        
-        pos = all_data.get('purchase_orders', [])
-        total_items = sum(len(po.get('items', [])) for po in pos)
-        itens_com_rastreio = sum(1 for po in pos for item in po.get('items', []) if item.get('codigo_rastreio'))
-        
-        backup = {
-            "backup_info": {
-                "data_export": datetime.now().isoformat(),
-                "versao": "4.1",
-                "sistema": "FIEP - Sistema de Gestão de OCs",
-                "tipo": "BACKUP_DADOS",
-                "nota": "Backup completo sem PDFs",
-                "collections_exportadas": collection_names,
-                "estatisticas": {
-                    **estatisticas,
-                    "total_itens_em_ocs": total_items,
-                    "itens_com_rastreio": itens_com_rastreio
-                }
-            },
-            **all_data
-        }
-        
-        json_str = json.dumps(backup, ensure_ascii=False, default=str)
-        filename = f"backup_fiep_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        
-        logger.info(f"Backup gerado: {len(json_str)} bytes")
-        
-        return Response(
-            content=json_str,
-            media_type="application/json",
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"',
-                "Content-Type": "application/json; charset=utf-8",
-                "Access-Control-Allow-Origin": "*"
-            }
-        )
-        
-    except Exception as e:
-        logger.error(f"Erro ao gerar backup direto: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
+    validar_opcoes(formato, compressao)
+    logger.info("Gerando backup direto...")
+    
+    collection_names = await _nomes_colecoes_backup()
+    stats = {"total_itens_em_ocs": 0, "itens_com_rastreio": 0}
+    
+    def observar(colecao: str, po: dict):
+        if colecao == 'purchase_orders':
+            items = po.get('items', [])
+            stats["total_itens_em_ocs"] += len(items)
+            stats["itens_com_rastreio"] += sum(1 for item in items if item.get('codigo_rastreio'))
+    
+    info = {
+        "data_export": datetime.now().isoformat(),
+        "versao": "4.1",
+        "sistema": "FIEP - Sistema de Gestão de OCs",
+        "tipo": "BACKUP_DADOS",
+        "nota": "Backup completo com arquivos do GridFS" if arquivos else "Backup completo sem arquivos",
+        "collections_exportadas": collection_names
+    }
+    colecoes = _colecoes_backup_completo(collection_names)
+    if arquivos:
+        colecoes.append(colecao_arquivos())
+    colecoes, info, ao_concluir = await preparar_backup(modo, colecoes, info)
+    return resposta_backup(
+        gerar_backup(colecoes, info, formato, compressao, observar, lambda: dict(stats), ao_concluir),
+        _nome_arquivo_backup(modo), formato, compressao,
+        headers={"Access-Control-Allow-Origin": "*"}
+    )
 
 # Endpoint alternativo para backup em JSON puro (sem compressão) - para debug
 @api_router.get("/backup/download-json")
 async def download_backup_json(current_user: dict = Depends(require_admin)):
-    """Download backup em JSON puro (mais lento mas mais compatível)"""
-    from datetime import datetime
-    from fastapi.responses import Response
-    import json
+    """Download backup em JSON puro (todas as collections, documentos completos e arquivos do GridFS)"""
+    logger.info("Gerando backup em JSON puro...")
+    
+    collection_names = await _nomes_colecoes_backup()
+    info = {"data_export": datetime.now().isoformat(), "versao": "4.0"}
+    return resposta_backup(
+        gerar_backup([ColecaoBackup(nome) for nome in collection_names] + [colecao_arquivos()], info),
+        _nome_arquivo_backup(), "json", "nenhuma",
+        headers={"Access-Control-Allow-Origin": "*"}
+    )
+
+async def _executar_restauracao(registros, current_user: dict, forcar: bool = False) -> dict:
+    """Restauração comum aos dois endpoints (coleções temporárias + rename)"""
+    logger.info("Iniciando restauração de backup...")
     
-    try:
-        logger.info("Gerando backup em JSON puro...")
-        
-        collection_names = await db.list_collection_names()
-        all_data = {"backup_info": {"data_export": datetime.now().isoformat(), "versao": "4.0"}}
-        
-        for col_name in collection_names:
-            docs = await db[col_name].find({}, {"_id": 0}).to_list(None)
-            all_data[col_name] = docs
-        
-        json_str = json.dumps(all_data, ensure_ascii=False, default=str)
-        filename = f"backup_fiep_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        
-        return Response(
-            content=json_str,
-            media_type="application/json",
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"',
-                "Access-Control-Allow-Origin": "*"
-            }
-        )
-    except Exception as e:
-        logger.error(f"Erro backup JSON: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    # Backups antigos trazem essas coleções: são ignoradas e reconstruídas abaixo
+    resultado = await restaurar_backup(registros, ignorar=COLECOES_NAO_RESTAURAVEIS, forcar=forcar)
+    info = resultado["info"]
+    estatisticas_restauracao = resultado["colecoes"]
+    
+    versao_backup = info.get("versao", "desconhecida")
+    logger.info(f"Versão do backup: {versao_backup} ({resultado['tipo']})")
+    
+    # Read-model de itens, histórico de cotações e contadores a partir das OCs restauradas
+    if "purchase_orders" in estatisticas_restauracao or resultado["excluidos"]:
+        await enfileirar_job("reconstruir_po_items", criado_por=current_user.get('sub'))
+        await sincronizar_agenda_rastreio()
+    
+    return {
+        "success": True,
+        "message": "Backup restaurado com sucesso!",
+        "detalhes": {
+            "data_backup": info.get("data_export", "N/A"),
+            "versao_backup": versao_backup,
+            "tipo": resultado["tipo"],
+            "backup_id": info.get("backup_id"),
+            "excluidos": resultado["excluidos"],
+            "arquivos": resultado["arquivos"],
+            "collections_restauradas": estatisticas_restauracao,
+            "total_documentos_restaurados": sum(estatisticas_restauracao.values()),
+            "collections_protegidas": list(COLECOES_PROTEGIDAS_BACKUP)
+        }
+    }
+
 
 @api_router.post("/backup/restore")
-async def restore_backup(current_user: dict = Depends(require_admin)):
-    """Restaurar backup do sistema - CUIDADO: substitui todos os dados! (ADMIN ONLY)"""
-    # Este endpoint espera o JSON do backup no body
-    # Será chamado via upload de arquivo no frontend
-    pass
+async def restore_backup(
+    file: UploadFile = File(...),
+    forcar: bool = False,
+    current_user: dict = Depends(require_admin)
+):
+    """
+    Restaurar backup a partir do arquivo enviado - SUBSTITUI TODOS OS DADOS! (ADMIN ONLY)
+    Aceita JSON ou NDJSON, opcionalmente gzip/zstd. O arquivo é lido em
+    streaming e gravado em lotes em coleções temporárias, trocadas pelas
+    originais só no final - uma falha no meio não altera o banco.
+    
+    Incrementais são aplicados sobre o estado atual, na ordem da cadeia
+    (forcar=true ignora a verificação).
+    """
+    try:
+        return await _executar_restauracao(ler_registros_backup(ler_upload(file)), current_user, forcar)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao restaurar backup: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"Erro ao restaurar backup: {str(e)}")
 
 @api_router.post("/backup/restore-data")
-async def restore_backup_data(backup_data: dict, current_user: dict = Depends(require_admin)):
-    """Restaurar TODOS os dados do backup (ADMIN ONLY) - SUBSTITUI TODOS OS DADOS!"""
-    from datetime import datetime
-    
+async def restore_backup_data(backup_data: dict, forcar: bool = False, current_user: dict = Depends(require_admin)):
+    """
+    Restaurar TODOS os dados do backup (ADMIN ONLY) - SUBSTITUI TODOS OS DADOS!
+    Backup enviado como corpo JSON (carregado inteiro em memória) - para
+    arquivos grandes use POST /backup/restore com upload.
+    """
     try:
-        # Verificar se é um backup válido
-        if "backup_info" not in backup_data:
-            raise HTTPException(status_code=400, detail="Arquivo de backup inválido - falta backup_info")
-        
-        logger.info("Iniciando restauração de backup completo...")
-        
-        # Lista de collections que NÃO devem ser restauradas automaticamente (segurança)
-        collections_protegidas = ['users']
-        
-        # Obter versão do backup
-        versao_backup = backup_data.get("backup_info", {}).get("versao", "desconhecida")
-        logger.info(f"Versão do backup: {versao_backup}")
-        
-        # Estatísticas de restauração
-        estatisticas_restauracao = {}
-        
-        # Restaurar cada collection presente no backup
-        for key, value in backup_data.items():
-            # Pular metadados e collections protegidas
-            if key == "backup_info" or key in collections_protegidas:
-                continue
-            
-            # Verificar se é uma lista de documentos
-            if isinstance(value, list):
-                collection_name = key
-                docs = value
-                
-                if len(docs) > 0:
-                    try:
-                        # Limpar collection existente
-                        await db[collection_name].delete_many({})
-                        # Inserir documentos do backup
-                        await db[collection_name].insert_many(docs)
-                        estatisticas_restauracao[collection_name] = len(docs)
-                        logger.info(f"  {collection_name}: {len(docs)} documentos restaurados")
-                    except Exception as col_error:
-                        logger.warning(f"Erro ao restaurar {collection_name}: {col_error}")
-                        estatisticas_restauracao[collection_name] = f"ERRO: {str(col_error)}"
-                else:
-                    # Collection vazia - apenas limpar
-                    await db[collection_name].delete_many({})
-                    estatisticas_restauracao[collection_name] = 0
-        
-        # Resumo final
-        total_restaurado = sum(v for v in estatisticas_restauracao.values() if isinstance(v, int))
-        
-        return {
-            "success": True,
-            "message": "Backup restaurado com sucesso!",
-            "detalhes": {
-                "data_backup": backup_data.get("backup_info", {}).get("data_export", "N/A"),
-                "versao_backup": versao_backup,
-                "collections_restauradas": estatisticas_restauracao,
-                "total_documentos_restaurados": total_restaurado,
-                "collections_protegidas": collections_protegidas
-            }
-        }
+        return await _executar_restauracao(registros_de_dict(backup_data), current_user, forcar)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao restaurar backup: {e}")
         import traceback
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Erro ao restaurar backup: {str(e)}")
 
-# ================== RASTREAMENTO CORREIOS ==================
+@api_router.get("/backup/historico")
+async def historico_backups(limite: int = 50, current_user: dict = Depends(require_admin)):
+    """Backups registrados (gerados ou restaurados), do mais recente ao mais antigo"""
+    return {"backups": await listar_backups(min(limite, 200))}
 
-import httpx
-from services.correios_service import rastrear_objeto_correios, verificar_status_evento
+# ================== RASTREAMENTO CORREIOS ==================
 
-async def buscar_rastreio_api(codigo: str) -> dict:
-    """
-    Busca rastreio usando a API oficial dos Correios (com fallback para API pública).
-    """
-    result = await rastrear_objeto_correios(codigo)
-    
-    if result.get('success'):
-        return {
-            "success": True,
-            "eventos": result.get('eventos', []),
-            "entregue": result.get('entregue', False),
-            "saiu_para_entrega": result.get('saiu_para_entrega', False),
-            "tentativa_entrega": result.get('tentativa_entrega', False),
-            "fonte": result.get('fonte', 'correios'),
-            "link_detalhes": result.get('link_detalhes', '')
-        }
-    
-    # Retornar informações úteis quando falhar
-    return {
-        "success": False, 
-        "eventos": [], 
-        "message": result.get('error', "Não foi possível consultar o rastreio."),
-        "rastreamento_manual": result.get('rastreamento_manual', False),
-        "link_correios": f"https://rastreamento.correios.com.br/app/resultado.php?objeto={codigo}"
-    }
+from services.correios_service import fechar_cliente_correios, criar_indices_cache_rastreio
+from services.rastreio_service import (
+    buscar_rastreio_api, verificar_rastreios_em_lote, verificar_rastreios_devidos, montar_notificacao_rastreio,
+    agendar_rastreio_itens, sincronizar_agenda_rastreio, criar_indices_agenda_rastreio
+)
 
 # Endpoint para consultar rastreio (usando API dos Correios)
 @api_router.get("/rastreio/{codigo}")
@@ -4108,6 +3560,38 @@ async def verificar_todos_rastreios(current_user: dict = Depends(get_current_use
     return {"message": "Verificação de rastreios iniciada em background. As notificações aparecerão quando houver atualizações."}
 
 
+def _aplicar_rastreio_manual(po: dict, item: dict, result: dict, stats: dict, notificacoes: list) -> bool:
+    """Regras da verificação manual (itens em trânsito). Retorna True se a OC deve ser gravada."""
+    logger = logging.getLogger(__name__)
+    
+    if not (result.get('success') and result.get('eventos')):
+        return False
+    
+    eventos = result['eventos']
+    eventos_anteriores = item.get('rastreio_eventos', [])
+    qtd_anterior = len(eventos_anteriores)
+    item['rastreio_eventos'] = eventos
+    novos_eventos = len(eventos) > qtd_anterior
+    now = datetime.now(timezone.utc)
+    
+    if result.get('entregue'):
+        item['status'] = ItemStatus.ENTREGUE.value
+        item['data_entrega'] = now.isoformat()
+        stats["entregues"] += 1
+        notificacoes.append(montar_notificacao_rastreio(po, item, "entrega", "✅ Item Entregue", f"O item {item['codigo_item']} foi entregue."))
+        logger.info(f"✅ Item {item['codigo_item']} ENTREGUE")
+    elif result.get('saiu_para_entrega') and novos_eventos and not item.get('notificado_saiu_entrega'):
+        stats["saiu_entrega"] += 1
+        item['notificado_saiu_entrega'] = True
+        notificacoes.append(montar_notificacao_rastreio(po, item, "saiu_entrega", "🚚 Saiu para Entrega", f"O item {item['codigo_item']} saiu para entrega."))
+    elif result.get('tentativa_entrega') and novos_eventos:
+        stats["tentativa"] += 1
+        item['notificado_tentativa'] = True
+        notificacoes.append(montar_notificacao_rastreio(po, item, "tentativa", "⚠️ Tentativa de Entrega", f"Tentativa de entrega: {item['codigo_item']}"))
+    
+    return True
+
+
 async def _executar_verificacao_rastreios_uma_vez():
     """Executa uma única verificação de rastreios (para chamadas manuais)."""
     logger = logging.getLogger(__name__)
@@ -4115,58 +3599,8 @@ async def _executar_verificacao_rastreios_uma_vez():
     try:
         logger.info("Iniciando verificação manual de rastreios (API Correios)...")
         
-        cursor = db.purchase_orders.find(
-            {"items.status": "em_transito"},
-            {"_id": 0}
-        )
-        
         stats = {"verificados": 0, "entregues": 0, "saiu_entrega": 0, "tentativa": 0, "erros": 0}
-        
-        async for po in cursor:
-            po_atualizado = False
-            
-            for item in po['items']:
-                if item.get('status') == 'em_transito' and item.get('codigo_rastreio'):
-                    codigo = item['codigo_rastreio']
-                    stats["verificados"] += 1
-                    
-                    try:
-                        result = await buscar_rastreio_api(codigo)
-                        
-                        if result.get('success') and result.get('eventos'):
-                            eventos = result['eventos']
-                            eventos_anteriores = item.get('rastreio_eventos', [])
-                            qtd_anterior = len(eventos_anteriores)
-                            item['rastreio_eventos'] = eventos
-                            novos_eventos = len(eventos) > qtd_anterior
-                            now = datetime.now(timezone.utc)
-                            
-                            if result.get('entregue'):
-                                item['status'] = ItemStatus.ENTREGUE.value
-                                item['data_entrega'] = now.isoformat()
-                                stats["entregues"] += 1
-                                po_atualizado = True
-                                await _criar_notificacao_rastreio(po, item, "entrega", "✅ Item Entregue", f"O item {item['codigo_item']} foi entregue.")
-                                logger.info(f"✅ Item {item['codigo_item']} ENTREGUE")
-                            elif result.get('saiu_para_entrega') and novos_eventos and not item.get('notificado_saiu_entrega'):
-                                stats["saiu_entrega"] += 1
-                                item['notificado_saiu_entrega'] = True
-                                po_atualizado = True
-                                await _criar_notificacao_rastreio(po, item, "saiu_entrega", "🚚 Saiu para Entrega", f"O item {item['codigo_item']} saiu para entrega.")
-                            elif result.get('tentativa_entrega') and novos_eventos:
-                                stats["tentativa"] += 1
-                                item['notificado_tentativa'] = True
-                                po_atualizado = True
-                                await _criar_notificacao_rastreio(po, item, "tentativa", "⚠️ Tentativa de Entrega", f"Tentativa de entrega: {item['codigo_item']}")
-                            else:
-                                po_atualizado = True
-                                
-                    except Exception as e:
-                        stats["erros"] += 1
-                        logger.warning(f"Erro ao verificar {codigo}: {e}")
-            
-            if po_atualizado:
-                await db.purchase_orders.update_one({"id": po['id']}, {"$set": {"items": po['items']}})
+        await verificar_rastreios_em_lote(['em_transito'], _aplicar_rastreio_manual, stats)
         
         logger.info(f"Verificação manual concluída. Stats: {stats}")
         
@@ -4181,6 +3615,147 @@ async def _executar_verificacao_rastreios_uma_vez():
 
 # ================== VERIFICAÇÃO AUTOMÁTICA DE RASTREIO ==================
 
+def _aplicar_rastreio_agendado(po: dict, item: dict, result: dict, stats: dict, notificacoes: list) -> bool:
+    """
+    Regras da verificação automática para um item (pronto_envio ou em_transito).
+    Retorna True se a OC deve ser gravada.
+    """
+    logger = logging.getLogger(__name__)
+    status_atual = item.get('status')
+    codigo = item['codigo_rastreio']
+    po_atualizado = False
+    
+    if not (result.get('success') and result.get('eventos')):
+        return False
+    
+    eventos = result['eventos']
+    
+    # Comparar com eventos anteriores para detectar novidades
+    eventos_anteriores = item.get('rastreio_eventos', [])
+    qtd_anterior = len(eventos_anteriores)
+    
+    # Atualizar eventos no item
+    item['rastreio_eventos'] = eventos
+    
+    # Verificar se há novos eventos
+    novos_eventos = len(eventos) > qtd_anterior
+    
+    now = datetime.now(timezone.utc)
+    
+    # ===== LÓGICA PARA ITENS "PRONTO_ENVIO" =====
+    # Se está "pronto_envio" e tem eventos de movimentação REAL → mudar para "em_transito"
+    # IMPORTANTE: "etiqueta emitida" ou "objeto criado eletronicamente" NÃO são postagens reais
+    if status_atual == 'pronto_envio' and len(eventos) > 0:
+        # Verificar se tem evento de postagem/movimentação REAL
+        evento_recente = eventos[0] if eventos else {}
+        descricao = evento_recente.get('descricao', '').lower()
+        status_evento = evento_recente.get('status', '').lower()
+        
+        # Palavras que indicam que o objeto foi REALMENTE postado/está em movimento
+        indicadores_postagem_real = [
+            'objeto postado',
+            'postado após o horário limite',
+            'objeto recebido na unidade',
+            'objeto recebido pelos correios',
+            'em trânsito',
+            'encaminhado',
+            'saiu para',
+            'em transferência',
+            'objeto coletado',
+        ]
+        
+        # Palavras que indicam que a etiqueta foi apenas EMITIDA (não postado de verdade)
+        indicadores_apenas_etiqueta = [
+            'objeto criado eletronicamente',
+            'etiqueta',
+            'pré-postagem',
+            'aguardando postagem',
+            'pendente',
+            'coleta agendada',
+            'informações prestadas',
+            'ar digital',
+        ]
+        
+        # Verificar se é postagem real (e não apenas etiqueta emitida)
+        texto_analise = descricao + ' ' + status_evento
+        
+        # Se contém indicador de "apenas etiqueta", NÃO é postagem real
+        apenas_etiqueta = any(ind in texto_analise for ind in indicadores_apenas_etiqueta)
+        
+        # Verificar se é postagem real
+        foi_postado_real = any(ind in texto_analise for ind in indicadores_postagem_real)
+        
+        # Só marcar como postado se for postagem REAL e NÃO for apenas etiqueta
+        if foi_postado_real and not apenas_etiqueta:
+            item['status'] = 'em_transito'
+            item['data_postagem'] = now.isoformat()
+            stats["postados"] += 1
+            po_atualizado = True
+            
+            # Criar notificação de postagem
+            notificacoes.append(montar_notificacao_rastreio(
+                po, item, "postagem", "📦 Item Postado",
+                f"O item {item['codigo_item']} foi postado e está em trânsito. Código: {codigo}"
+            ))
+            
+            logger.info(f"Item {item['codigo_item']} postado - {codigo}")
+        elif apenas_etiqueta:
+            # Apenas atualizar eventos sem mudar status
+            logger.debug(f"Item {item['codigo_item']} - apenas etiqueta emitida, aguardando postagem real")
+    
+    # ===== LÓGICA PARA ITENS "EM_TRANSITO" =====
+    elif status_atual == 'em_transito':
+        # Verificar se foi entregue
+        if result.get('entregue'):
+            item['status'] = ItemStatus.ENTREGUE.value
+            item['data_entrega_real'] = now.isoformat()
+            stats["entregues"] += 1
+            po_atualizado = True
+            
+            # Criar notificação de entrega
+            notificacoes.append(montar_notificacao_rastreio(
+                po, item, "entrega", "✅ Item Entregue",
+                f"O item {item['codigo_item']} foi entregue ao destinatário."
+            ))
+            
+            logger.info(f"✅ Item {item['codigo_item']} da OC {po['numero_oc']} ENTREGUE")
+        
+        # Verificar se saiu para entrega (apenas se houver novos eventos)
+        elif result.get('saiu_para_entrega') and novos_eventos:
+            if not item.get('notificado_saiu_entrega'):
+                stats["saiu_entrega"] += 1
+                item['notificado_saiu_entrega'] = True
+                po_atualizado = True
+                
+                notificacoes.append(montar_notificacao_rastreio(
+                    po, item, "saiu_entrega", "🚚 Saiu para Entrega",
+                    f"O item {item['codigo_item']} saiu para entrega ao destinatário."
+                ))
+                
+                logger.info(f"🚚 Item {item['codigo_item']} da OC {po['numero_oc']} SAIU PARA ENTREGA")
+        
+        # Verificar tentativa de entrega (apenas se houver novos eventos)
+        elif result.get('tentativa_entrega') and novos_eventos:
+            if not item.get('notificado_tentativa') or item.get('tentativas_count', 0) < len([e for e in eventos if 'ausente' in (e.get('status', '') or '').lower() or 'não entregue' in (e.get('status', '') or '').lower()]):
+                stats["tentativa"] += 1
+                item['notificado_tentativa'] = True
+                item['tentativas_count'] = item.get('tentativas_count', 0) + 1
+                po_atualizado = True
+                
+                ultimo_evento = eventos[0] if eventos else {}
+                notificacoes.append(montar_notificacao_rastreio(
+                    po, item, "tentativa", "⚠️ Tentativa de Entrega",
+                    f"Tentativa de entrega para o item {item['codigo_item']}: {ultimo_evento.get('status', 'Destinatário ausente')}"
+                ))
+                
+                logger.info(f"⚠️ Item {item['codigo_item']} da OC {po['numero_oc']} TENTATIVA DE ENTREGA")
+        
+        # Atualizar eventos mesmo sem mudança de status
+        po_atualizado = True
+    
+    return po_atualizado
+
+
 async def verificar_rastreios_agendado():
     """
     Verifica todos os itens com rastreio (pronto_envio e em_transito) e atualiza status automaticamente.
@@ -4193,21 +3768,14 @@ async def verificar_rastreios_agendado():
     - Se detectar entrega → muda para "entregue"
     - Cria notificações para: saiu para entrega, tentativa de entrega, entregue
     
-    Executado 1x por hora (a cada hora cheia no horário de Brasília).
+    Executado a cada 15 minutos, mas consulta apenas os códigos com verificação
+    vencida na agenda adaptativa (services/rastreio_service.py): códigos sem
+    novidade são consultados cada vez menos e entregues saem da agenda.
     """
     logger = logging.getLogger(__name__)
     
     try:
-        logger.info("Iniciando verificação automática de rastreios (API Correios) - A cada hora...")
-        
-        # Buscar todas as OCs com itens em trânsito OU pronto para envio (com código de rastreio)
-        cursor = db.purchase_orders.find(
-            {"$or": [
-                {"items.status": "em_transito"},
-                {"items.status": "pronto_envio"}
-            ]},
-            {"_id": 0}
-        )
+        logger.info("Iniciando verificação automática de rastreios (API Correios) - códigos com verificação vencida...")
         
         stats = {
             "verificados": 0,
@@ -4218,166 +3786,17 @@ async def verificar_rastreios_agendado():
             "erros": 0
         }
         
-        async for po in cursor:
-                po_atualizado = False
-                
-                for item in po['items']:
-                    codigo_rastreio = item.get('codigo_rastreio')
-                    status_atual = item.get('status')
-                    
-                    # Verificar apenas itens com código de rastreio e status relevante
-                    if not codigo_rastreio:
-                        continue
-                    if status_atual not in ['pronto_envio', 'em_transito']:
-                        continue
-                    
-                    codigo = codigo_rastreio
-                    stats["verificados"] += 1
-                    
-                    try:
-                        # Buscar rastreio na API dos Correios
-                        result = await buscar_rastreio_api(codigo)
-                        
-                        if result.get('success') and result.get('eventos'):
-                            eventos = result['eventos']
-                            
-                            # Comparar com eventos anteriores para detectar novidades
-                            eventos_anteriores = item.get('rastreio_eventos', [])
-                            qtd_anterior = len(eventos_anteriores)
-                            
-                            # Atualizar eventos no item
-                            item['rastreio_eventos'] = eventos
-                            
-                            # Verificar se há novos eventos
-                            novos_eventos = len(eventos) > qtd_anterior
-                            
-                            now = datetime.now(timezone.utc)
-                            
-                            # ===== LÓGICA PARA ITENS "PRONTO_ENVIO" =====
-                            # Se está "pronto_envio" e tem eventos de movimentação REAL → mudar para "em_transito"
-                            # IMPORTANTE: "etiqueta emitida" ou "objeto criado eletronicamente" NÃO são postagens reais
-                            if status_atual == 'pronto_envio' and len(eventos) > 0:
-                                # Verificar se tem evento de postagem/movimentação REAL
-                                evento_recente = eventos[0] if eventos else {}
-                                descricao = evento_recente.get('descricao', '').lower()
-                                status_evento = evento_recente.get('status', '').lower()
-                                
-                                # Palavras que indicam que o objeto foi REALMENTE postado/está em movimento
-                                indicadores_postagem_real = [
-                                    'objeto postado',
-                                    'postado após o horário limite',
-                                    'objeto recebido na unidade',
-                                    'objeto recebido pelos correios',
-                                    'em trânsito',
-                                    'encaminhado',
-                                    'saiu para',
-                                    'em transferência',
-                                    'objeto coletado',
-                                ]
-                                
-                                # Palavras que indicam que a etiqueta foi apenas EMITIDA (não postado de verdade)
-                                indicadores_apenas_etiqueta = [
-                                    'objeto criado eletronicamente',
-                                    'etiqueta',
-                                    'pré-postagem',
-                                    'aguardando postagem',
-                                    'pendente',
-                                    'coleta agendada',
-                                    'informações prestadas',
-                                    'ar digital',
-                                ]
-                                
-                                # Verificar se é postagem real (e não apenas etiqueta emitida)
-                                texto_analise = descricao + ' ' + status_evento
-                                
-                                # Se contém indicador de "apenas etiqueta", NÃO é postagem real
-                                apenas_etiqueta = any(ind in texto_analise for ind in indicadores_apenas_etiqueta)
-                                
-                                # Verificar se é postagem real
-                                foi_postado_real = any(ind in texto_analise for ind in indicadores_postagem_real)
-                                
-                                # Só marcar como postado se for postagem REAL e NÃO for apenas etiqueta
-                                if foi_postado_real and not apenas_etiqueta:
-                                    item['status'] = 'em_transito'
-                                    item['data_postagem'] = now.isoformat()
-                                    stats["postados"] += 1
-                                    po_atualizado = True
-                                    
-                                    # Criar notificação de postagem
-                                    await _criar_notificacao_rastreio(
-                                        po, item, "postagem", "📦 Item Postado",
-                                        f"O item {item['codigo_item']} foi postado e está em trânsito. Código: {codigo}"
-                                    )
-                                    
-                                    logger.info(f"Item {item['codigo_item']} postado - {codigo}")
-                                elif apenas_etiqueta:
-                                    # Apenas atualizar eventos sem mudar status
-                                    logger.debug(f"Item {item['codigo_item']} - apenas etiqueta emitida, aguardando postagem real")
-                            
-                            # ===== LÓGICA PARA ITENS "EM_TRANSITO" =====
-                            elif status_atual == 'em_transito':
-                                # Verificar se foi entregue
-                                if result.get('entregue'):
-                                    item['status'] = ItemStatus.ENTREGUE.value
-                                    item['data_entrega_real'] = now.isoformat()
-                                    stats["entregues"] += 1
-                                    po_atualizado = True
-                                    
-                                    # Criar notificação de entrega
-                                    await _criar_notificacao_rastreio(
-                                        po, item, "entrega", "✅ Item Entregue",
-                                        f"O item {item['codigo_item']} foi entregue ao destinatário."
-                                    )
-                                    
-                                    logger.info(f"✅ Item {item['codigo_item']} da OC {po['numero_oc']} ENTREGUE")
-                                
-                                # Verificar se saiu para entrega (apenas se houver novos eventos)
-                                elif result.get('saiu_para_entrega') and novos_eventos:
-                                    if not item.get('notificado_saiu_entrega'):
-                                        stats["saiu_entrega"] += 1
-                                        item['notificado_saiu_entrega'] = True
-                                        po_atualizado = True
-                                        
-                                        await _criar_notificacao_rastreio(
-                                            po, item, "saiu_entrega", "🚚 Saiu para Entrega",
-                                            f"O item {item['codigo_item']} saiu para entrega ao destinatário."
-                                        )
-                                        
-                                        logger.info(f"🚚 Item {item['codigo_item']} da OC {po['numero_oc']} SAIU PARA ENTREGA")
-                                
-                                # Verificar tentativa de entrega (apenas se houver novos eventos)
-                                elif result.get('tentativa_entrega') and novos_eventos:
-                                    if not item.get('notificado_tentativa') or item.get('tentativas_count', 0) < len([e for e in eventos if 'ausente' in (e.get('status', '') or '').lower() or 'não entregue' in (e.get('status', '') or '').lower()]):
-                                        stats["tentativa"] += 1
-                                        item['notificado_tentativa'] = True
-                                        item['tentativas_count'] = item.get('tentativas_count', 0) + 1
-                                        po_atualizado = True
-                                        
-                                        ultimo_evento = eventos[0] if eventos else {}
-                                        await _criar_notificacao_rastreio(
-                                            po, item, "tentativa", "⚠️ Tentativa de Entrega",
-                                            f"Tentativa de entrega para o item {item['codigo_item']}: {ultimo_evento.get('status', 'Destinatário ausente')}"
-                                        )
-                                        
-                                        logger.info(f"⚠️ Item {item['codigo_item']} da OC {po['numero_oc']} TENTATIVA DE ENTREGA")
-                                
-                                # Atualizar eventos mesmo sem mudança de status
-                                po_atualizado = True
-                                
-                    except Exception as e:
-                        stats["erros"] += 1
-                        logger.warning(f"Erro ao verificar rastreio {codigo}: {str(e)}")
-                
-                # Atualizar OC no banco se houve alterações
-                if po_atualizado:
-                    await db.purchase_orders.update_one(
-                        {"id": po['id']},
-                        {"$set": {"items": po['items']}}
-                    )
+        # Códigos repetidos são consultados uma vez, em paralelo; OCs alteradas
+        # são gravadas num único bulk_write (em conflito com edição do usuário,
+        # a edição prevalece)
+        await verificar_rastreios_devidos(_aplicar_rastreio_agendado, stats)
+        if not stats.get("codigos_devidos"):
+            logger.info("Nenhum código de rastreio com verificação vencida")
+            return
         
         logger.info(
             f"Verificação concluída. "
-            f"Verificados: {stats['verificados']}, "
+            f"Verificados: {stats['verificados']} ({stats['codigos_consultados']} códigos), "
             f"Postados: {stats['postados']}, "
             f"Entregues: {stats['entregues']}, "
             f"Saiu p/ Entrega: {stats['saiu_entrega']}, "
@@ -4389,26 +3808,6 @@ async def verificar_rastreios_agendado():
         logger.error(f"Erro na verificação automática de rastreios: {str(e)}")
 
 
-async def _criar_notificacao_rastreio(po: dict, item: dict, tipo: str, titulo: str, mensagem: str):
-    """Cria uma notificação de rastreio no banco de dados."""
-    now = datetime.now(timezone.utc)
-    
-    notificacao = {
-        "id": str(uuid.uuid4()),
-        "tipo": tipo,
-        "titulo": titulo,
-        "mensagem": mensagem,
-        "numero_oc": po.get('numero_oc', ''),
-        "codigo_item": item.get('codigo_item', ''),
-        "codigo_rastreio": item.get('codigo_rastreio', ''),
-        "descricao_item": (item.get('descricao', '')[:50] + '...') if len(item.get('descricao', '')) > 50 else item.get('descricao', ''),
-        "lida": False,
-        "created_at": now.isoformat()
-    }
-    
-    await db.notificacoes.insert_one(notificacao)
-
-
 # ============== ENDPOINTS DE NOTIFICAÇÕES ==============
 
 @api_router.get("/notificacoes")
@@ -4480,275 +3879,7 @@ async def marcar_todas_notificacoes_lidas(
 
 # ============== FUNÇÕES DE NOTAS FISCAIS ==============
 
-def extract_ncm_from_xml(xml_content: str) -> Optional[str]:
-    """Extrair TODOS os NCMs de um XML de Nota Fiscal Eletrônica (NFe)"""
-    import xml.etree.ElementTree as ET
-    try:
-        # Remover BOM se existir
-        if xml_content.startswith('\ufeff'):
-            xml_content = xml_content[1:]
-        
-        root = ET.fromstring(xml_content)
-        
-        # Namespace padrão da NFe
-        namespaces = {
-            'nfe': 'http://www.portalfiscal.inf.br/nfe'
-        }
-        
-        ncm_list = set()  # Usar set para evitar duplicatas
-        
-        # Tentar encontrar NCM com namespace
-        ncm_elements = root.findall('.//nfe:NCM', namespaces)
-        for elem in ncm_elements:
-            if elem.text:
-                ncm_list.add(elem.text.strip())
-        
-        # Tentar sem namespace
-        if not ncm_list:
-            ncm_elements = root.findall('.//NCM')
-            for elem in ncm_elements:
-                if elem.text:
-                    ncm_list.add(elem.text.strip())
-        
-        # Tentar padrão alternativo
-        if not ncm_list:
-            for elem in root.iter():
-                if elem.tag.endswith('NCM') and elem.text:
-                    ncm_list.add(elem.text.strip())
-        
-        if ncm_list:
-            return ', '.join(sorted(ncm_list))
-        
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao extrair NCM do XML: {str(e)}")
-        return None
-
-def extract_ncm_from_pdf(pdf_bytes: bytes) -> Optional[str]:
-    """Tentar extrair TODOS os NCMs de um PDF de Nota Fiscal"""
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
-        
-        for page in doc:
-            full_text += page.get_text()
-        
-        doc.close()
-        
-        ncm_list = set()  # Usar set para evitar duplicatas
-        
-        # Lista de valores que NÃO são NCM (CEPs, códigos de barras, etc.)
-        invalid_ncms = {
-            '17582008', '83005430',  # CEPs
-            '83704614',  # Código de vendedor/outro
-        }
-        
-        # Estratégia 1: Procurar padrão "NCM/SH" seguido diretamente por 8 dígitos (mais confiável)
-        # Em DANFEs, o NCM aparece na coluna NCM/SH
-        ncm_direct_pattern = r'NCM[/\s]*SH[:\s]*(\d{8})'
-        matches = re.findall(ncm_direct_pattern, full_text, re.IGNORECASE)
-        for m in matches:
-            if len(m) == 8 and m.isdigit() and m not in invalid_ncms:
-                ncm_list.add(m)
-        
-        # Estratégia 2: Procurar na estrutura típica de DANFE
-        # O NCM geralmente aparece após o código do produto e antes do CFOP
-        # Padrão: linha com NCM/SH seguida de 8 dígitos em formato específico
-        ncm_table_pattern = r'(?:NCM|NCM/SH)\s*\n?\s*(\d{8})'
-        matches = re.findall(ncm_table_pattern, full_text, re.IGNORECASE | re.MULTILINE)
-        for m in matches:
-            if len(m) == 8 and m.isdigit() and m not in invalid_ncms:
-                # Verificar se os primeiros 2 dígitos são capítulos válidos de NCM
-                capitulo = int(m[:2])
-                # Capítulos comuns: 84, 85 (máquinas/elétricos), 73 (ferro/aço), etc.
-                # Capítulos válidos: 01-97
-                if 1 <= capitulo <= 97:
-                    ncm_list.add(m)
-        
-        # Estratégia 3: Buscar números de 8 dígitos que começam com capítulos comuns
-        # Capítulos mais comuns em compras: 84, 85, 73, 39, 40, 48, 90, etc.
-        common_chapters = ['84', '85', '73', '39', '40', '48', '90', '94', '72', '76', '83']
-        all_8digit = re.findall(r'\b(\d{8})\b', full_text)
-        for num in all_8digit:
-            if num[:2] in common_chapters and num not in invalid_ncms:
-                ncm_list.add(num)
-        
-        # Estratégia 4: Padrões tradicionais com formatação
-        patterns = [
-            r'NCM[:\s]*(\d{4}[\.\s]?\d{2}[\.\s]?\d{2})',
-            r'Classifica[çc][ãa]o Fiscal[:\s]*(\d{4}[\.\s]?\d{2}[\.\s]?\d{2})',
-            r'(\d{4}\.\d{2}\.\d{2})',  # Padrão com pontos (mais específico)
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, full_text, re.IGNORECASE)
-            for match in matches:
-                ncm = re.sub(r'[\.\s]', '', match)
-                if len(ncm) == 8 and ncm.isdigit() and ncm not in invalid_ncms:
-                    capitulo = int(ncm[:2])
-                    if 1 <= capitulo <= 97:
-                        ncm_list.add(ncm)
-        
-        if ncm_list:
-            # Ordenar e retornar
-            return ', '.join(sorted(ncm_list))
-        
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao extrair NCM do PDF: {str(e)}")
-        return None
-
-
-def extract_items_with_ncm_from_pdf(pdf_bytes: bytes) -> List[dict]:
-    """Extrair lista de itens com seus respectivos NCMs do PDF de NF"""
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
-        for page in doc:
-            full_text += page.get_text()
-        doc.close()
-        
-        items = []
-        invalid_ncms = {'17582008', '83005430', '83704614'}
-        
-        # Procurar seção de produtos
-        start = full_text.find("DADOS DO PRODUTO")
-        if start == -1:
-            start = full_text.find("DADOS DOS PRODUTOS")
-        
-        if start != -1:
-            # Pegar seção de produtos (até CÁLCULO ou DADOS ADICIONAIS)
-            end_markers = ["CÁLCULO DO ISSQN", "DADOS ADICIONAIS", "INFORMAÇÕES COMPLEMENTARES"]
-            end = len(full_text)
-            for marker in end_markers:
-                idx = full_text.find(marker, start)
-                if idx != -1 and idx < end:
-                    end = idx
-            
-            product_section = full_text[start:end]
-            
-            # Encontrar todos os NCMs de 8 dígitos na seção de produtos
-            ncm_matches = list(re.finditer(r'\b(\d{8})\b', product_section))
-            
-            for match in ncm_matches:
-                ncm = match.group(1)
-                capitulo = int(ncm[:2])
-                
-                # Verificar se é um NCM válido (capítulos 01-97)
-                if 1 <= capitulo <= 97 and ncm not in invalid_ncms:
-                    # A descrição pode estar ANTES ou DEPOIS do NCM dependendo do layout
-                    # Tentar primeiro DEPOIS do NCM (padrão mais comum em DANFEs)
-                    after_text = product_section[match.end():match.end()+500]
-                    lines_after = after_text.split('\n')[:8]
-                    
-                    descricao = ""
-                    for line in lines_after:
-                        line = line.strip()
-                        # Descrição tem mais de 15 chars, contém letras e não é cabeçalho
-                        if len(line) > 15 and re.search(r'[A-Za-z]', line):
-                            if not any(header in line.upper() for header in ['DESCRIÇÃO', 'NCM/SH', 'CFOP', 'QUANT', 'VALOR', 'DADOS DO', 'CST', 'ALÍQUOTA']):
-                                # Limpar a descrição (remover | Ped: etc)
-                                descricao = re.sub(r'\s*\|\s*Ped:.*', '', line)
-                                descricao = descricao[:80].strip()
-                                break
-                    
-                    # Se não encontrou depois, tentar antes
-                    if not descricao:
-                        before_text = product_section[:match.start()]
-                        lines_before = before_text.split('\n')[-10:]
-                        
-                        for line in reversed(lines_before):
-                            line = line.strip()
-                            if len(line) > 15 and re.search(r'[A-Za-z]', line):
-                                if not any(header in line.upper() for header in ['DESCRIÇÃO', 'NCM/SH', 'CFOP', 'QUANT', 'VALOR', 'DADOS DO']):
-                                    descricao = re.sub(r'\s*\|\s*Ped:.*', '', line)
-                                    descricao = descricao[:80].strip()
-                                    break
-                    
-                    if descricao:
-                        items.append({
-                            'descricao': descricao.upper(),
-                            'ncm': ncm
-                        })
-        
-        # Remover duplicatas mantendo ordem
-        seen = set()
-        unique_items = []
-        for item in items:
-            key = (item['descricao'], item['ncm'])
-            if key not in seen:
-                seen.add(key)
-                unique_items.append(item)
-        
-        return unique_items
-    except Exception as e:
-        logging.error(f"Erro ao extrair itens do PDF: {str(e)}")
-        return []
-
-
-import base64
-
-def extract_numero_nf_from_xml(xml_content: str) -> Optional[str]:
-    """Extrair número da Nota Fiscal do XML"""
-    import xml.etree.ElementTree as ET
-    try:
-        if xml_content.startswith('\ufeff'):
-            xml_content = xml_content[1:]
-        
-        root = ET.fromstring(xml_content)
-        
-        namespaces = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-        
-        # Tentar encontrar número da NF com namespace
-        # nNF = número da nota fiscal
-        for tag in ['nNF', 'nf', 'numero']:
-            elements = root.findall(f'.//nfe:{tag}', namespaces)
-            if elements and elements[0].text:
-                return elements[0].text.strip()
-            elements = root.findall(f'.//{tag}')
-            if elements and elements[0].text:
-                return elements[0].text.strip()
-        
-        # Tentar encontrar no texto
-        for elem in root.iter():
-            if elem.tag.endswith('nNF') and elem.text:
-                return elem.text.strip()
-        
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao extrair número da NF do XML: {str(e)}")
-        return None
-
-def extract_numero_nf_from_pdf(pdf_bytes: bytes) -> Optional[str]:
-    """Tentar extrair número da NF de um PDF"""
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
-        
-        for page in doc:
-            full_text += page.get_text()
-        
-        doc.close()
-        
-        # Padrões comuns para número de NF
-        patterns = [
-            r'N[°º]?\s*(?:da\s*)?(?:NF|Nota|Nota Fiscal)[:\s]*(\d{6,9})',
-            r'(?:NF|Nota Fiscal)\s*N[°º]?\s*(\d{6,9})',
-            r'N[úu]mero[:\s]*(\d{6,9})',
-            r'(\d{9})',  # Número de 9 dígitos solto
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE)
-            if match:
-                num = match.group(1)
-                if len(num) >= 6:
-                    return num
-        
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao extrair número da NF do PDF: {str(e)}")
-        return None
+# Análise de NF em uma leitura (PDF/DANFE ou XML): services/nf_service.py
 
 class NFUploadRequest(BaseModel):
     """Request para upload de nota fiscal"""
@@ -4766,14 +3897,12 @@ class NFEmitidaRequest(BaseModel):
     """Request para marcar NF como emitida/pronto para despacho"""
     nf_emitida_pronto_despacho: bool
 
-@api_router.post("/purchase-orders/{po_id}/items/by-index/{item_index}/notas-fiscais")
-async def upload_nota_fiscal(
-    po_id: str,
-    item_index: int,
-    request: NFUploadRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Upload de nota fiscal para um item"""
+# Limite dos uploads de NF (multipart)
+NF_MAX_BYTES = int(os.environ.get('NF_MAX_BYTES') or 20 * 1024 * 1024)
+TIPOS_NF_ITEM = ("fornecedor", "revenda")
+
+
+async def _po_para_nf_item(po_id: str, item_index: int) -> dict:
     po = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0})
     
     if not po:
@@ -4781,62 +3910,83 @@ async def upload_nota_fiscal(
     
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
-    
-    item = po['items'][item_index]
-    
-    # Tentar extrair NCM, número da NF e itens
-    ncm = request.ncm_manual
-    numero_nf = None
-    itens_nf = []  # Lista de itens com NCMs
+    return po
+
+
+def _reler_upload(file: UploadFile) -> bytes:
+    """Bytes de um UploadFile já enviado ao GridFS (arquivo temporário do multipart). Síncrono: rodar em thread."""
+    file.file.seek(0)
+    return file.file.read()
+
+
+async def _analisar_nf(filename: str, content_type: str, sha256: str, ler: Callable[[], bytes]) -> Optional[dict]:
+    """
+    NCM, número, itens e chave de acesso do XML/PDF da NF, fora do event loop.
+    O PDF passa pelo cache de parsing pelo SHA-256 já calculado: em caso de
+    acerto, ler() nem é chamado.
+    """
     try:
-        file_bytes = base64.b64decode(request.file_data)
-        
-        if request.content_type == 'text/xml' or request.filename.endswith('.xml'):
-            xml_content = file_bytes.decode('utf-8')
-            if not ncm:
-                ncm = extract_ncm_from_xml(xml_content)
-            numero_nf = extract_numero_nf_from_xml(xml_content)
-        elif request.content_type == 'application/pdf' or request.filename.endswith('.pdf'):
-            if not ncm:
-                ncm = extract_ncm_from_pdf(file_bytes)
-            numero_nf = extract_numero_nf_from_pdf(file_bytes)
-            # Extrair itens com NCMs
-            itens_nf = extract_items_with_ncm_from_pdf(file_bytes)
+        if content_type == 'text/xml' or filename.endswith('.xml'):
+            return await asyncio.to_thread(lambda: analisar_nf_xml(ler()))
+        if content_type == 'application/pdf' or filename.endswith('.pdf'):
+            return await obter_ou_calcular(
+                "nf", VERSAO_ANALISE_NF, None,
+                lambda: asyncio.to_thread(lambda: analisar_nf_pdf(ler())),
+                sha256=sha256
+            )
     except Exception as e:
         logging.error(f"Erro ao processar arquivo: {str(e)}")
+    return None
+
+
+async def _registrar_nf_item(
+    po: dict,
+    item_index: int,
+    tipo: str,
+    ncm_manual: Optional[str],
+    filename: str,
+    content_type: str,
+    blob: dict,
+    analise: Optional[dict],
+    current_user: dict
+) -> dict:
+    """Grava a NF (já no GridFS) no item: fornecedor entra na lista, revenda substitui a anterior"""
+    po_id = po["id"]
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
+    item = po['items'][item_index]
+    
+    # NCM, número da NF, itens e chave de acesso extraídos (NCM manual tem prioridade)
+    analise = analise or {}
+    ncm = ncm_manual or analise.get("ncm")
+    itens_nf = analise.get("itens_nf") or []  # Lista de itens com NCMs
     
     # Criar documento da NF
     nf_doc = {
         "id": str(uuid.uuid4()),
-        "filename": request.filename,
-        "content_type": request.content_type,
-        "file_data": request.file_data,
+        "filename": filename,
+        "content_type": content_type,
+        **blob,
         "ncm": ncm,
-        "numero_nf": numero_nf,  # Número da NF extraído
-        "itens_nf": itens_nf,  # Lista de itens com NCMs
+        "numero_nf": analise.get("numero_nf"),  # Número da NF extraído
+        "itens_nf": itens_nf,
+        "chave_acesso": analise.get("chave_acesso"),  # Chave de acesso da NFe (44 dígitos)
         "uploaded_at": datetime.now(timezone.utc).isoformat(),
         "uploaded_by": current_user.get('sub')
     }
     
-    if request.tipo == "fornecedor":
+    if tipo == "fornecedor":
         # Adicionar às NFs de fornecedor (múltiplas)
         if 'notas_fiscais_fornecedor' not in item:
             item['notas_fiscais_fornecedor'] = []
         item['notas_fiscais_fornecedor'].append(nf_doc)
         logging.info(f"NF Fornecedor adicionada - po_id: {po_id}, item_index: {item_index}, total NFs: {len(item['notas_fiscais_fornecedor'])}")
-    elif request.tipo == "revenda":
+    else:
         # Substituir NF de revenda (única)
         item['nota_fiscal_revenda'] = nf_doc
         logging.info(f"NF Revenda adicionada - po_id: {po_id}, item_index: {item_index}")
-    else:
-        raise HTTPException(status_code=400, detail="Tipo deve ser 'fornecedor' ou 'revenda'")
     
-    # Atualizar o item específico no array usando arrayFilters ou posicional
-    result = await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
-    logging.info(f"Update result - matched: {result.matched_count}, modified: {result.modified_count}")
+    # Atualizar apenas o item específico (NF nova entra via $push, sem regravar as anteriores)
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {
         "success": True,
@@ -4847,6 +3997,61 @@ async def upload_nota_fiscal(
     }
 
 
+def _validar_tipo_nf(tipo: str):
+    if tipo not in TIPOS_NF_ITEM:
+        raise HTTPException(status_code=400, detail="Tipo deve ser 'fornecedor' ou 'revenda'")
+
+
+@api_router.post("/purchase-orders/{po_id}/items/by-index/{item_index}/notas-fiscais")
+async def upload_nota_fiscal(
+    po_id: str,
+    item_index: int,
+    request: NFUploadRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload de nota fiscal para um item (base64 em JSON; preferir /notas-fiscais/upload)"""
+    po = await _po_para_nf_item(po_id, item_index)
+    _validar_tipo_nf(request.tipo)
+    
+    try:
+        file_bytes = base64.b64decode(request.file_data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Conteúdo do arquivo inválido (base64 esperado)")
+    
+    blob = await salvar_blob(file_bytes, request.filename, request.content_type)
+    analise = await _analisar_nf(request.filename, request.content_type, blob["sha256"], lambda: file_bytes)
+    return await _registrar_nf_item(
+        po, item_index, request.tipo, request.ncm_manual,
+        request.filename, request.content_type, blob, analise, current_user
+    )
+
+
+@api_router.post("/purchase-orders/{po_id}/items/by-index/{item_index}/notas-fiscais/upload")
+async def upload_nota_fiscal_arquivo(
+    po_id: str,
+    item_index: int,
+    file: UploadFile = File(...),
+    tipo: str = Form(...),
+    ncm_manual: Optional[str] = Form(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Upload multipart de nota fiscal para um item: sem base64, o arquivo vai em
+    chunks para o GridFS com SHA-256 e tamanho calculados no caminho.
+    """
+    po = await _po_para_nf_item(po_id, item_index)
+    _validar_tipo_nf(tipo)
+    
+    filename = file.filename or "nota_fiscal"
+    content_type = file.content_type or ('text/xml' if filename.lower().endswith('.xml') else 'application/pdf')
+    blob = await salvar_blob_stream(iterar_upload(file), filename, content_type, max_bytes=NF_MAX_BYTES)
+    analise = await _analisar_nf(filename, content_type, blob["sha256"], lambda: _reler_upload(file))
+    return await _registrar_nf_item(
+        po, item_index, tipo, ncm_manual or None,
+        filename, content_type, blob, analise, current_user
+    )
+
+
 # ============== ENDPOINTS PARA NF DE VENDA DA OC (não do item) ==============
 
 class NFVendaOCRequest(BaseModel):
@@ -4856,59 +4061,65 @@ class NFVendaOCRequest(BaseModel):
     itens_indices: Optional[List[int]] = None  # Índices dos itens incluídos na NF
 
 
-@api_router.post("/purchase-orders/{po_id}/nf-venda")
-async def add_nf_venda_oc(
-    po_id: str,
-    request: NFVendaOCRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Adicionar NF de Venda para a OC (pode ser parcial com itens selecionados)"""
+_PADROES_NUMERO_NF_VENDA = [
+    re.compile(r'NF[- ]?e?[:\s]*(\d{6,})', re.IGNORECASE),
+    re.compile(r'N[úu]mero[:\s]*(\d{6,})', re.IGNORECASE),
+    re.compile(r'NOTA FISCAL[:\s]*(\d{6,})', re.IGNORECASE)
+]
+
+
+def _extrair_numero_nf_venda(pdf_bytes: bytes) -> Optional[str]:
+    """Número da NF de venda a partir do texto do PDF. Síncrono: rodar em thread."""
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        text = ""
+        for page in doc:
+            text += page.get_text()
+        doc.close()
+        
+        for padrao in _PADROES_NUMERO_NF_VENDA:
+            match = padrao.search(text)
+            if match:
+                return match.group(1)
+    except Exception as e:
+        logger.warning(f"Erro ao extrair número da NF: {e}")
+    return None
+
+
+async def _po_para_nf_venda(po_id: str) -> dict:
     po = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0})
     
     if not po:
         raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
-    
-    # Extrair número da NF do PDF se aplicável
-    numero_nf = None
-    if request.filename.lower().endswith('.pdf'):
-        try:
-            import base64
-            pdf_bytes = base64.b64decode(request.file_data)
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            text = ""
-            for page in doc:
-                text += page.get_text()
-            doc.close()
-            
-            nf_patterns = [
-                r'NF[- ]?e?[:\s]*(\d{6,})',
-                r'N[úu]mero[:\s]*(\d{6,})',
-                r'NOTA FISCAL[:\s]*(\d{6,})'
-            ]
-            for pattern in nf_patterns:
-                match = re.search(pattern, text, re.IGNORECASE)
-                if match:
-                    numero_nf = match.group(1)
-                    break
-        except Exception as e:
-            logger.warning(f"Erro ao extrair número da NF: {e}")
-    
+    return po
+
+
+async def _registrar_nf_venda(
+    po: dict,
+    filename: str,
+    content_type: str,
+    blob: dict,
+    numero_nf: Optional[str],
+    itens_indices: Optional[List[int]],
+    current_user: dict
+) -> dict:
+    """Grava a NF de venda (já no GridFS) na OC, parcial com os itens selecionados"""
     # Se itens_indices foi fornecido, usar; senão, incluir todos os itens
     items = po.get('items', [])
     total_itens = len(items)
     
     # Determinar quais itens serão incluídos nesta NF
-    if request.itens_indices is not None and len(request.itens_indices) > 0:
-        itens_nf = request.itens_indices
+    if itens_indices is not None and len(itens_indices) > 0:
+        itens_nf = itens_indices
     else:
         # Incluir todos os itens que estão em "em_separacao"
         itens_nf = [i for i, item in enumerate(items) if item.get('status') == 'em_separacao']
     
     nf_doc = {
         "id": str(uuid.uuid4()),
-        "filename": request.filename,
-        "content_type": request.content_type,
-        "file_data": request.file_data,
+        "filename": filename,
+        "content_type": content_type,
+        **blob,
         "numero_nf": numero_nf,
         "uploaded_at": datetime.now(timezone.utc).isoformat(),
         "uploaded_by": current_user.get('sub'),
@@ -4921,10 +4132,11 @@ async def add_nf_venda_oc(
     
     # Também manter retrocompatibilidade com nota_fiscal_venda (última NF)
     await db.purchase_orders.update_one(
-        {"id": po_id},
+        {"id": po["id"]},
         {"$set": {
             "nota_fiscal_venda": nf_doc,
-            "notas_fiscais_venda": existing_nfs
+            "notas_fiscais_venda": existing_nfs,
+            "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
     
@@ -4938,6 +4150,62 @@ async def add_nf_venda_oc(
     }
 
 
+@api_router.post("/purchase-orders/{po_id}/nf-venda")
+async def add_nf_venda_oc(
+    po_id: str,
+    request: NFVendaOCRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Adicionar NF de Venda para a OC (base64 em JSON; preferir /nf-venda/upload)"""
+    po = await _po_para_nf_venda(po_id)
+    
+    try:
+        file_bytes = base64.b64decode(request.file_data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Conteúdo do arquivo inválido (base64 esperado)")
+    
+    # Extrair número da NF do PDF se aplicável (fora do event loop)
+    numero_nf = None
+    if request.filename.lower().endswith('.pdf'):
+        numero_nf = await asyncio.to_thread(_extrair_numero_nf_venda, file_bytes)
+    
+    blob = await salvar_blob(file_bytes, request.filename, request.content_type)
+    return await _registrar_nf_venda(
+        po, request.filename, request.content_type, blob, numero_nf, request.itens_indices, current_user
+    )
+
+
+@api_router.post("/purchase-orders/{po_id}/nf-venda/upload")
+async def add_nf_venda_oc_arquivo(
+    po_id: str,
+    file: UploadFile = File(...),
+    itens_indices: Optional[str] = Form(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Upload multipart da NF de Venda da OC, em streaming para o GridFS.
+    itens_indices: índices separados por vírgula ("0,2,5"); vazio = itens em separação.
+    """
+    po = await _po_para_nf_venda(po_id)
+    
+    indices = None
+    if itens_indices:
+        try:
+            indices = [int(i) for i in itens_indices.split(',') if i.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="itens_indices deve ser uma lista de números separados por vírgula")
+    
+    filename = file.filename or "nf_venda.pdf"
+    content_type = file.content_type or 'application/pdf'
+    blob = await salvar_blob_stream(iterar_upload(file), filename, content_type, max_bytes=NF_MAX_BYTES)
+    
+    numero_nf = None
+    if filename.lower().endswith('.pdf'):
+        numero_nf = await asyncio.to_thread(lambda: _extrair_numero_nf_venda(_reler_upload(file)))
+    
+    return await _registrar_nf_venda(po, filename, content_type, blob, numero_nf, indices, current_user)
+
+
 @api_router.get("/purchase-orders/{po_id}/nf-venda/download")
 async def download_nf_venda_oc(
     po_id: str,
@@ -4956,10 +4224,34 @@ async def download_nf_venda_oc(
     return {
         "filename": nf_venda['filename'],
         "content_type": nf_venda['content_type'],
-        "file_data": nf_venda['file_data']
+        "file_data": await ler_conteudo_base64(nf_venda, 'file_data')
     }
 
 
+@api_router.get("/purchase-orders/{po_id}/nf-venda/arquivo")
+async def download_nf_venda_oc_arquivo(
+    po_id: str,
+    nf_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Download binário (streaming) da NF de Venda da OC - a última ou a de nf_id"""
+    po = await db.purchase_orders.find_one(
+        {"id": po_id},
+        {"_id": 0, "nota_fiscal_venda": 1, "notas_fiscais_venda": 1}
+    )
+    
+    if not po:
+        raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
+    
+    nf_venda = po.get('nota_fiscal_venda')
+    if nf_id:
+        nf_venda = next((nf for nf in po.get('notas_fiscais_venda') or [] if nf.get('id') == nf_id), None)
+    if not tem_conteudo(nf_venda, 'file_data'):
+        raise HTTPException(status_code=404, detail="NF de Venda não encontrada")
+    
+    return resposta_arquivo(nf_venda, 'file_data', nf_venda.get('filename') or "nf_venda", nf_venda.get('content_type'))
+
+
 @api_router.delete("/purchase-orders/{po_id}/nf-venda")
 async def delete_nf_venda_oc(
     po_id: str,
@@ -4984,14 +4276,18 @@ async def delete_nf_venda_oc(
             {"id": po_id},
             {"$set": {
                 "notas_fiscais_venda": existing_nfs,
-                "nota_fiscal_venda": last_nf
+                "nota_fiscal_venda": last_nf,
+                "updated_at": datetime.now(timezone.utc).isoformat()
             }}
         )
     else:
         # Remover todas as NFs
         await db.purchase_orders.update_one(
             {"id": po_id},
-            {"$unset": {"nota_fiscal_venda": "", "notas_fiscais_venda": ""}}
+            {
+                "$unset": {"nota_fiscal_venda": "", "notas_fiscais_venda": ""},
+                "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+            }
         )
     
     return {"success": True, "message": "NF de Venda removida"}
@@ -5015,7 +4311,7 @@ async def toggle_pronto_despacho_oc(
     
     await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": {"pronto_despacho": request.pronto_despacho}}
+        {"$set": {"pronto_despacho": request.pronto_despacho, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
     return {"success": True, "pronto_despacho": request.pronto_despacho}
@@ -5045,7 +4341,7 @@ async def download_nota_fiscal(
             return {
                 "filename": nf['filename'],
                 "content_type": nf['content_type'],
-                "file_data": nf['file_data']
+                "file_data": await ler_conteudo_base64(nf, 'file_data')
             }
     
     # Procurar NF de revenda
@@ -5054,92 +4350,176 @@ async def download_nota_fiscal(
         return {
             "filename": nf_revenda['filename'],
             "content_type": nf_revenda['content_type'],
-            "file_data": nf_revenda['file_data']
+            "file_data": await ler_conteudo_base64(nf_revenda, 'file_data')
         }
     
     raise HTTPException(status_code=404, detail="Nota fiscal não encontrada")
 
 
+@api_router.get("/purchase-orders/{po_id}/items/by-index/{item_index}/notas-fiscais/{nf_id}/arquivo")
+async def download_nota_fiscal_arquivo(
+    po_id: str,
+    item_index: int,
+    nf_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Download binário (streaming do GridFS) de uma nota fiscal do item, sem base64"""
+    po = await db.purchase_orders.find_one(
+        {"id": po_id},
+        {"_id": 0, "items.notas_fiscais_fornecedor": 1, "items.nota_fiscal_revenda": 1}
+    )
+    
+    if not po:
+        raise HTTPException(status_code=404, detail="Ordem de Compra não encontrada")
+    
+    if item_index < 0 or item_index >= len(po['items']):
+        raise HTTPException(status_code=404, detail="Índice de item inválido")
+    
+    item = po['items'][item_index]
+    candidatas = list(item.get('notas_fiscais_fornecedor') or [])
+    if item.get('nota_fiscal_revenda'):
+        candidatas.append(item['nota_fiscal_revenda'])
+    
+    for nf in candidatas:
+        if nf.get('id') == nf_id and tem_conteudo(nf, 'file_data'):
+            return resposta_arquivo(nf, 'file_data', nf.get('filename') or "nota_fiscal", nf.get('content_type'))
+    
+    raise HTTPException(status_code=404, detail="Nota fiscal não encontrada")
+
+
 class BulkDownloadRequest(BaseModel):
     nfs: List[dict]  # Lista de {po_id, item_index, nf_id, tipo}
 
 
-@api_router.post("/admin/notas-fiscais/bulk-download")
-async def bulk_download_notas_fiscais(
+async def _localizar_nfs_bulk(nfs: List[dict]) -> List[dict]:
+    """
+    Resolve a lista {po_id, item_index, nf_id, tipo} com uma única consulta
+    ($in) às OCs. Devolve, na ordem pedida, as NFs encontradas com o nome da
+    entrada no ZIP e o caminho usado para marcar o download.
+    """
+    po_ids = list({nf_info.get('po_id') for nf_info in nfs if nf_info.get('po_id')})
+    pos = {}
+    async for po in db.purchase_orders.find(
+        {"id": {"$in": po_ids}},
+        {"_id": 0, "id": 1, "numero_oc": 1, "items.codigo_item": 1,
+         "items.notas_fiscais_fornecedor": 1, "items.nota_fiscal_revenda": 1}
+    ):
+        pos[po["id"]] = po
+    
+    encontradas = []
+    for nf_info in nfs:
+        po = pos.get(nf_info.get('po_id'))
+        item_index = nf_info.get('item_index')
+        nf_id = nf_info.get('nf_id')
+        tipo = nf_info.get('tipo', 'fornecedor')
+        if not po or not isinstance(item_index, int) or not 0 <= item_index < len(po['items']):
+            continue
+        
+        item = po['items'][item_index]
+        nf_data = None
+        caminho = None
+        if tipo == 'fornecedor':
+            for idx, nf in enumerate(item.get('notas_fiscais_fornecedor') or []):
+                if nf.get('id') == nf_id:
+                    nf_data = nf
+                    caminho = f"items.{item_index}.notas_fiscais_fornecedor.{idx}"
+                    break
+        else:
+            nf_revenda = item.get('nota_fiscal_revenda')
+            if nf_revenda and nf_revenda.get('id') == nf_id:
+                nf_data = nf_revenda
+                caminho = f"items.{item_index}.nota_fiscal_revenda"
+        
+        if nf_data and tem_conteudo(nf_data, 'file_data'):
+            encontradas.append({
+                "po_id": po["id"],
+                "nf_id": nf_id,
+                "caminho": caminho,
+                "ref": nf_data,
+                "nome_zip": f"{po['numero_oc']}_{item.get('codigo_item', 'item')}_{nf_data.get('filename')}"
+            })
+    return encontradas
+
+
+async def _marcar_nfs_baixadas(encontradas: List[dict], user_name: str):
+    """Marca quem baixou e quando, num único bulk_write (guardado pelo id da NF)"""
+    if not encontradas:
+        return
+    downloaded_at = datetime.now(timezone.utc).isoformat()
+    operacoes = [
+        UpdateOne(
+            {"id": nf["po_id"], f"{nf['caminho']}.id": nf["nf_id"]},
+            {"$set": {
+                f"{nf['caminho']}.baixado_por": user_name,
+                f"{nf['caminho']}.baixado_em": downloaded_at,
+                "updated_at": downloaded_at
+            }}
+        )
+        for nf in encontradas
+    ]
+    await db.purchase_orders.bulk_write(operacoes, ordered=False)
+
+
+async def _zip_nfs_bulk(encontradas: List[dict], user_name: str):
+    """Chunks do ZIP; as NFs só são marcadas como baixadas se o ZIP foi gerado até o fim"""
+    async def entradas():
+        for nf in encontradas:
+            yield nf["nome_zip"], iterar_conteudo(nf["ref"], 'file_data')
+    
+    async for chunk in iterar_zip(entradas()):
+        yield chunk
+    
+    try:
+        await _marcar_nfs_baixadas(encontradas, user_name)
+    except Exception as e:
+        logger.warning(f"Erro ao marcar NFs como baixadas: {e}")
+
+
+def _nome_zip_nfs() -> str:
+    return f"notas_fiscais_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+
+
+@api_router.post("/admin/notas-fiscais/bulk-download/arquivo")
+async def bulk_download_notas_fiscais_arquivo(
     request: BulkDownloadRequest,
     current_user: dict = Depends(require_admin)
 ):
-    """Download de múltiplas notas fiscais em formato ZIP"""
-    import zipfile
-    import io
-    import base64
+    """
+    Download de múltiplas notas fiscais em ZIP, em streaming: as OCs vêm de
+    uma consulta só e cada NF é lida do GridFS e comprimida direto na resposta.
+    """
+    from fastapi.responses import StreamingResponse
     
     if not request.nfs:
         raise HTTPException(status_code=400, detail="Nenhuma NF selecionada")
     
-    # Criar arquivo ZIP em memória
-    zip_buffer = io.BytesIO()
+    encontradas = await _localizar_nfs_bulk(request.nfs)
     user_name = current_user.get('owner_name', current_user.get('email', 'admin'))
-    downloaded_at = datetime.now(timezone.utc).isoformat()
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for nf_info in request.nfs:
-            po_id = nf_info.get('po_id')
-            item_index = nf_info.get('item_index')
-            nf_id = nf_info.get('nf_id')
-            tipo = nf_info.get('tipo', 'fornecedor')
-            
-            po = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0})
-            if not po or item_index >= len(po['items']):
-                continue
-            
-            item = po['items'][item_index]
-            nf_data = None
-            
-            if tipo == 'fornecedor':
-                for nf in item.get('notas_fiscais_fornecedor', []):
-                    if nf['id'] == nf_id:
-                        nf_data = nf
-                        break
-            else:
-                nf_revenda = item.get('nota_fiscal_revenda')
-                if nf_revenda and nf_revenda['id'] == nf_id:
-                    nf_data = nf_revenda
-            
-            if nf_data:
-                # Decodificar arquivo base64
-                file_bytes = base64.b64decode(nf_data['file_data'])
-                filename = f"{po['numero_oc']}_{item.get('codigo_item', 'item')}_{nf_data['filename']}"
-                zip_file.writestr(filename, file_bytes)
-                
-                # Marcar NF como baixada
-                if tipo == 'fornecedor':
-                    for idx, nf in enumerate(item.get('notas_fiscais_fornecedor', [])):
-                        if nf['id'] == nf_id:
-                            await db.purchase_orders.update_one(
-                                {"id": po_id},
-                                {"$set": {
-                                    f"items.{item_index}.notas_fiscais_fornecedor.{idx}.baixado_por": user_name,
-                                    f"items.{item_index}.notas_fiscais_fornecedor.{idx}.baixado_em": downloaded_at
-                                }}
-                            )
-                            break
-                else:
-                    await db.purchase_orders.update_one(
-                        {"id": po_id},
-                        {"$set": {
-                            f"items.{item_index}.nota_fiscal_revenda.baixado_por": user_name,
-                            f"items.{item_index}.nota_fiscal_revenda.baixado_em": downloaded_at
-                        }}
-                    )
+    return StreamingResponse(
+        _zip_nfs_bulk(encontradas, user_name),
+        media_type="application/zip",
+        headers={"Content-Disposition": _content_disposition(_nome_zip_nfs())}
+    )
+
+
+@api_router.post("/admin/notas-fiscais/bulk-download")
+async def bulk_download_notas_fiscais(
+    request: BulkDownloadRequest,
+    current_user: dict = Depends(require_admin)
+):
+    """Download de múltiplas notas fiscais em ZIP (base64 em JSON; preferir /bulk-download/arquivo)"""
+    if not request.nfs:
+        raise HTTPException(status_code=400, detail="Nenhuma NF selecionada")
     
-    zip_buffer.seek(0)
-    zip_base64 = base64.b64encode(zip_buffer.read()).decode('utf-8')
+    encontradas = await _localizar_nfs_bulk(request.nfs)
+    user_name = current_user.get('owner_name', current_user.get('email', 'admin'))
+    zip_bytes = b"".join([chunk async for chunk in _zip_nfs_bulk(encontradas, user_name)])
     
     return {
-        "filename": f"notas_fiscais_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+        "filename": _nome_zip_nfs(),
         "content_type": "application/zip",
-        "file_data": zip_base64,
+        "file_data": base64.b64encode(zip_bytes).decode('utf-8'),
         "total_nfs": len(request.nfs)
     }
 
@@ -5161,6 +4541,7 @@ async def delete_nota_fiscal(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     
     if tipo == "fornecedor":
@@ -5176,10 +4557,7 @@ async def delete_nota_fiscal(
     else:
         raise HTTPException(status_code=400, detail="Tipo deve ser 'fornecedor' ou 'revenda'")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"success": True, "message": "Nota fiscal removida com sucesso"}
 
@@ -5200,6 +4578,7 @@ async def update_nf_ncm(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     updated = False
     
@@ -5219,10 +4598,7 @@ async def update_nf_ncm(
     if not updated:
         raise HTTPException(status_code=404, detail="Nota fiscal não encontrada")
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"success": True, "message": "NCM atualizado com sucesso"}
 
@@ -5242,13 +4618,11 @@ async def update_nf_emitida_status(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     item['nf_emitida_pronto_despacho'] = request.nf_emitida_pronto_despacho
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"success": True, "message": "Status atualizado com sucesso"}
 
@@ -5268,13 +4642,11 @@ async def update_endereco_entrega(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     item['endereco_entrega'] = endereco.upper()
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"success": True, "message": "Endereço atualizado com sucesso"}
 
@@ -5297,13 +4669,11 @@ async def update_endereco_entrega_v2(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     item['endereco_entrega'] = request.endereco.upper()
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {"success": True, "message": "Endereço atualizado com sucesso"}
 
@@ -5318,6 +4688,45 @@ ALLOWED_IMAGE_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif"]
 MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
 
 
+async def _salvar_imagem_codigo(
+    codigo_item: str,
+    contents: bytes,
+    filename: str,
+    content_type: str,
+    imagem_url: str,
+    current_user: dict
+):
+    """
+    Grava a imagem do código em imagens_itens (original no GridFS, deduplicado
+    por SHA-256) junto com as variantes miniatura/média geradas fora do event loop.
+    """
+    blob_ref = await salvar_blob(contents, filename, content_type)
+    variantes = await gerar_variantes(contents, codigo_item)
+    
+    remover = {"imagem_base64": ""}
+    if not variantes:
+        remover.update({"variantes": "", "variantes_de": ""})
+    
+    await db.imagens_itens.update_one(
+        {"codigo_item": codigo_item},
+        {
+            "$set": {
+                "codigo_item": codigo_item,
+                "imagem_url": imagem_url,
+                **blob_ref,
+                **variantes,
+                "content_type": content_type,
+                "tamanho_bytes": len(contents),
+                "data_upload": datetime.now(timezone.utc).isoformat(),
+                "uploaded_by": current_user.get('email')
+            },
+            "$unset": remover
+        },
+        upsert=True
+    )
+    invalidar_cache_imagem(codigo_item)
+
+
 @api_router.post("/purchase-orders/{po_id}/items/by-index/{item_index}/imagem")
 async def upload_item_image(
     po_id: str,
@@ -5365,10 +4774,6 @@ async def upload_item_image(
     item = po['items'][item_index]
     codigo_item = item.get('codigo_item', 'unknown')
     
-    # Converter imagem para base64 para salvar no MongoDB (PERSISTENTE)
-    import base64
-    imagem_base64 = base64.b64encode(contents).decode('utf-8')
-    
     # Determinar content type
     ext = file.filename.split('.')[-1].lower() if '.' in file.filename else 'jpg'
     content_types = {
@@ -5384,33 +4789,22 @@ async def upload_item_image(
     unique_id = str(uuid.uuid4())[:8]
     imagem_url = f"/api/item-images-db/{codigo_item}"
     
-    # Salvar na coleção de imagens por código (PERSISTENTE NO MONGODB)
-    await db.imagens_itens.update_one(
-        {"codigo_item": codigo_item},
-        {
-            "$set": {
-                "codigo_item": codigo_item,
-                "imagem_url": imagem_url,
-                "imagem_base64": imagem_base64,  # SALVAR BASE64 NO BANCO
-                "content_type": content_type,
-                "tamanho_bytes": len(contents),
-                "data_upload": datetime.now(timezone.utc).isoformat(),
-                "uploaded_by": current_user.get('email')
-            }
-        },
-        upsert=True
-    )
+    # Salvar na coleção de imagens por código (PERSISTENTE NO MONGODB), com miniatura/média
+    await _salvar_imagem_codigo(codigo_item, contents, file.filename, content_type, imagem_url, current_user)
     
     # Atualizar TODOS os itens com este código em TODAS as OCs
     result = await db.purchase_orders.update_many(
         {"items.codigo_item": codigo_item},
         {
             "$set": {
-                "items.$[elem].imagem_url": imagem_url
+                "items.$[elem].imagem_url": imagem_url,
+                "updated_at": datetime.now(timezone.utc).isoformat()
             }
         },
         array_filters=[{"elem.codigo_item": codigo_item}]
     )
+    # imagem_url faz parte das linhas de po_items
+    await sincronizar_pos_por_filtro({"items.codigo_item": codigo_item})
     
     logger.info(f"Imagem salva no MongoDB para código {codigo_item}: {len(contents)} bytes - {result.modified_count} OCs atualizadas")
     
@@ -5447,15 +4841,13 @@ async def copiar_imagem_item(
     if item_index < 0 or item_index >= len(po['items']):
         raise HTTPException(status_code=404, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     item['imagem_url'] = imagem_url
     if imagem_filename:
         item['imagem_filename'] = imagem_filename
     
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     logger.info(f"Imagem copiada para item {item.get('codigo_item')} na OC {po.get('numero_oc')}")
     
@@ -5486,10 +4878,6 @@ async def upload_imagem_por_codigo(
     if len(contents) < 1000:
         raise HTTPException(status_code=400, detail="Arquivo muito pequeno ou corrompido")
     
-    # Converter imagem para base64 para salvar no MongoDB (PERSISTENTE)
-    import base64
-    imagem_base64 = base64.b64encode(contents).decode('utf-8')
-    
     # Determinar content type
     ext = file.filename.split('.')[-1].lower() if '.' in file.filename else 'jpg'
     content_types = {
@@ -5504,27 +4892,17 @@ async def upload_imagem_por_codigo(
     # Gerar URL para servir a imagem
     imagem_url = f"/api/item-images-db/{codigo_item}"
     
-    # Salvar na coleção imagens_itens (formato padronizado)
-    await db.imagens_itens.update_one(
-        {"codigo_item": codigo_item},
-        {"$set": {
-            "codigo_item": codigo_item,
-            "imagem_url": imagem_url,
-            "imagem_base64": imagem_base64,  # SALVAR BASE64 NO BANCO
-            "content_type": content_type,
-            "tamanho_bytes": len(contents),
-            "data_upload": datetime.now(timezone.utc).isoformat(),
-            "uploaded_by": current_user.get('email')
-        }},
-        upsert=True
-    )
+    # Salvar na coleção imagens_itens (formato padronizado), com miniatura/média
+    await _salvar_imagem_codigo(codigo_item, contents, file.filename, content_type, imagem_url, current_user)
     
     # Atualizar imagem em TODOS os itens com esse código em todas as OCs
     await db.purchase_orders.update_many(
         {"items.codigo_item": codigo_item},
-        {"$set": {"items.$[elem].imagem_url": imagem_url}},
+        {"$set": {"items.$[elem].imagem_url": imagem_url, "updated_at": datetime.now(timezone.utc).isoformat()}},
         array_filters=[{"elem.codigo_item": codigo_item}]
     )
+    # imagem_url faz parte das linhas de po_items
+    await sincronizar_pos_por_filtro({"items.codigo_item": codigo_item})
     
     # Atualizar no estoque também
     await db.stock.update_many(
@@ -5537,34 +4915,76 @@ async def upload_imagem_por_codigo(
     return {"success": True, "message": f"Imagem salva para o item {codigo_item}", "imagem_url": imagem_url}
 
 
+# Sem imagem_base64: o original legado só é lido (e decodificado) em miss do LRU de imagens
+PROJECAO_IMAGEM = {
+    "_id": 0, "codigo_item": 1, "blob_id": 1, "sha256": 1, "size": 1,
+    "content_type": 1, "data_upload": 1, "variantes": 1
+}
+
+
+async def _servir_imagem_item(
+    imagem_doc: dict,
+    variante: Optional[str],
+    accept: Optional[str],
+    if_none_match: Optional[str],
+    v: Optional[str] = None
+):
+    """
+    Original ou variante (thumb/media, WebP se o navegador aceitar) com ETag.
+    Sem Pillow, ou com imagem que não pôde ser reduzida, devolve o original.
+    Com ?v= igual à versão atual a resposta é imutável (cache de um ano).
+    None se o documento não tem conteúdo.
+    """
+    versao = versao_imagem(imagem_doc)
+    cache_control = CACHE_IMUTAVEL if v and v == versao else CACHE_REVALIDAR
+    
+    if variante and variante != "original":
+        if variante not in VARIANTES_IMAGEM:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Variante inválida. Use: original, {', '.join(VARIANTES_IMAGEM)}"
+            )
+        formato = formato_aceito(accept)
+        ref = await obter_variante(imagem_doc, variante, formato)
+        if ref:
+            return await responder_imagem(
+                imagem_doc, FORMATOS_IMAGEM[formato], if_none_match, cache_control,
+                nome=f"{variante}.{formato}", ref=ref, vary="Accept"
+            )
+    
+    return await responder_imagem(
+        imagem_doc, imagem_doc.get('content_type', 'image/jpeg'), if_none_match, cache_control
+    )
+
+
 @api_router.get("/itens/{codigo_item}/imagem")
-async def get_imagem_por_codigo(codigo_item: str):
+async def get_imagem_por_codigo(
+    codigo_item: str,
+    variante: Optional[str] = None,
+    v: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Retorna a imagem de um item pelo código.
-    Suporta formato antigo (data URL) e novo (base64 separado).
+    Suporta formato antigo (data URL), base64 separado e GridFS.
+    variante=thumb|media devolve a versão reduzida (WebP/JPEG).
     """
-    from fastapi.responses import Response, RedirectResponse
+    from fastapi.responses import RedirectResponse
     import base64
     
     # Buscar na coleção imagens_itens
-    imagem_info = await db.imagens_itens.find_one({"codigo_item": codigo_item}, {"_id": 0})
+    imagem_info = await db.imagens_itens.find_one(
+        {"codigo_item": codigo_item}, {**PROJECAO_IMAGEM, "imagem_url": 1}
+    )
     
     if not imagem_info:
         raise HTTPException(status_code=404, detail="Imagem não encontrada")
     
-    # Priorizar formato novo (imagem_base64 separado)
-    if imagem_info.get('imagem_base64'):
-        imagem_bytes = base64.b64decode(imagem_info['imagem_base64'])
-        content_type = imagem_info.get('content_type', 'image/jpeg')
-        
-        return Response(
-            content=imagem_bytes,
-            media_type=content_type,
-            headers={
-                "Cache-Control": "public, max-age=31536000",
-                "Content-Length": str(len(imagem_bytes))
-            }
-        )
+    # Priorizar formato novo (GridFS ou imagem_base64 separado)
+    resposta = await _servir_imagem_item(imagem_info, variante, accept, if_none_match, v)
+    if resposta is not None:
+        return resposta
     
     imagem_url = imagem_info.get('imagem_url')
     
@@ -5578,17 +4998,9 @@ async def get_imagem_por_codigo(codigo_item: str):
             header, data = imagem_url.split(',', 1)
             content_type = header.split(':')[1].split(';')[0]
             image_bytes = base64.b64decode(data)
-            
-            return Response(
-                content=image_bytes,
-                media_type=content_type,
-                headers={
-                    "Cache-Control": "public, max-age=31536000",
-                    "Content-Length": str(len(image_bytes))
-                }
-            )
         except:
             raise HTTPException(status_code=500, detail="Erro ao processar imagem")
+        return resposta_bytes_imagem(image_bytes, content_type, if_none_match)
     else:
         # URL externa ou endpoint interno - redirecionar
         return RedirectResponse(url=imagem_url)
@@ -5604,6 +5016,7 @@ async def delete_imagem_por_codigo(
     """
     # Remover da coleção imagens_itens
     result = await db.imagens_itens.delete_one({"codigo_item": codigo_item})
+    invalidar_cache_imagem(codigo_item)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Imagem não encontrada")
@@ -5611,9 +5024,11 @@ async def delete_imagem_por_codigo(
     # Remover de todos os itens com esse código em todas as OCs
     await db.purchase_orders.update_many(
         {"items.codigo_item": codigo_item},
-        {"$unset": {"items.$[elem].imagem_url": ""}},
+        {"$unset": {"items.$[elem].imagem_url": ""}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
         array_filters=[{"elem.codigo_item": codigo_item}]
     )
+    # imagem_url faz parte das linhas de po_items
+    await sincronizar_pos_por_filtro({"items.codigo_item": codigo_item})
     
     # Remover do estoque também
     await db.stock.update_many(
@@ -5649,6 +5064,84 @@ async def get_mapa_imagens_itens(current_user: dict = Depends(get_current_user))
     return {item['codigo_item']: item['imagem_url'] for item in imagens}
 
 
+async def _um_chunk(conteudo: bytes):
+    yield conteudo
+
+
+LIMITE_LOTE_IMAGENS = int(os.environ.get('LIMITE_LOTE_IMAGENS') or 2000)
+
+
+class ImagensLoteRequest(BaseModel):
+    codigos: List[str]
+    variante: Optional[str] = "media"  # Só para o ZIP: original, thumb ou media
+
+
+def _codigos_lote(request: ImagensLoteRequest) -> List[str]:
+    codigos = list(dict.fromkeys(c for c in request.codigos if c))
+    if len(codigos) > LIMITE_LOTE_IMAGENS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {LIMITE_LOTE_IMAGENS} códigos por requisição")
+    return codigos
+
+
+@api_router.post("/imagens-itens/lote")
+async def get_imagens_lote(
+    request: ImagensLoteRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Imagens de vários códigos em uma requisição: URL versionada (cache
+    imutável), SHA-256, dimensões da miniatura e uma prévia LQIP inline.
+    Códigos sem imagem ficam de fora.
+    """
+    return await resumo_imagens(_codigos_lote(request))
+
+
+@api_router.post("/imagens-itens/lote/zip")
+async def download_imagens_lote_zip(
+    request: ImagensLoteRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    ZIP (em streaming) com as imagens dos códigos pedidos, para impressão
+    offline. variante=media (padrão) ou thumb usa o JPEG reduzido; original
+    manda o arquivo enviado.
+    """
+    from fastapi.responses import StreamingResponse
+    
+    codigos = _codigos_lote(request)
+    variante = request.variante or "original"
+    if variante != "original" and variante not in VARIANTES_IMAGEM:
+        raise HTTPException(status_code=400, detail=f"Variante inválida. Use: original, {', '.join(VARIANTES_IMAGEM)}")
+    
+    extensoes = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/gif': 'gif'}
+    
+    async def entradas():
+        async for doc in db.imagens_itens.find({"codigo_item": {"$in": codigos}}, PROJECAO_IMAGEM):
+            ref = None
+            if variante != "original":
+                ref = await obter_variante(doc, variante, "jpeg")
+            if ref:
+                yield f"{doc['codigo_item']}.jpg", iterar_conteudo(ref, 'imagem_base64')
+                continue
+            
+            ext = extensoes.get(doc.get('content_type'), 'jpg')
+            if doc.get('blob_id'):
+                yield f"{doc['codigo_item']}.{ext}", iterar_conteudo(doc, 'imagem_base64')
+            else:
+                # Original legado (base64 no documento)
+                lido = await ler_imagem(doc)
+                if lido:
+                    yield f"{doc['codigo_item']}.{ext}", _um_chunk(lido[0])
+    
+    return StreamingResponse(
+        iterar_zip(entradas()),
+        media_type="application/zip",
+        headers={"Content-Disposition": _content_disposition(
+            f"imagens_itens_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        )}
+    )
+
+
 @api_router.delete("/purchase-orders/{po_id}/items/by-index/{item_index}/imagem")
 async def delete_item_image(
     po_id: str,
@@ -5682,6 +5175,7 @@ async def delete_item_image(
     
     # Remover da coleção imagens_itens
     await db.imagens_itens.delete_one({"codigo_item": codigo_item})
+    invalidar_cache_imagem(codigo_item)
     
     # Limpar imagem de TODOS os itens com este código em TODAS as OCs
     result = await db.purchase_orders.update_many(
@@ -5689,11 +5183,14 @@ async def delete_item_image(
         {
             "$set": {
                 "items.$[elem].imagem_url": None,
-                "items.$[elem].imagem_filename": None
+                "items.$[elem].imagem_filename": None,
+                "updated_at": datetime.now(timezone.utc).isoformat()
             }
         },
         array_filters=[{"elem.codigo_item": codigo_item}]
     )
+    # imagem_url faz parte das linhas de po_items
+    await sincronizar_pos_por_filtro({"items.codigo_item": codigo_item})
     
     logger.info(f"Imagem removida para código {codigo_item}: {result.modified_count} OCs atualizadas")
     
@@ -5706,38 +5203,31 @@ async def delete_item_image(
 
 # NOVO ENDPOINT: Servir imagens do MongoDB (PERSISTENTE)
 @api_router.get("/item-images-db/{codigo_item}")
-async def get_item_image_from_db(codigo_item: str):
-    """Servir imagem de item diretamente do MongoDB (persistente)"""
-    import base64
-    from fastapi.responses import Response
-    
-    # Buscar imagem no MongoDB
-    imagem_doc = await db.imagens_itens.find_one(
-        {"codigo_item": codigo_item},
-        {"_id": 0, "imagem_base64": 1, "content_type": 1}
-    )
+async def get_item_image_from_db(
+    codigo_item: str,
+    variante: Optional[str] = None,
+    v: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Servir imagem de item diretamente do MongoDB (GridFS, em chunks).
+    variante=thumb|media para as grades; ETag + If-None-Match respondem 304;
+    v=<versão> (de /imagens-itens/lote) torna a resposta imutável.
+    """
+    # Buscar referência da imagem no MongoDB
+    imagem_doc = await db.imagens_itens.find_one({"codigo_item": codigo_item}, PROJECAO_IMAGEM)
     
-    if not imagem_doc or not imagem_doc.get('imagem_base64'):
+    resposta = await _servir_imagem_item(imagem_doc, variante, accept, if_none_match, v) if imagem_doc else None
+    if resposta is None:
         raise HTTPException(status_code=404, detail="Imagem não encontrada")
-    
-    # Decodificar base64
-    imagem_bytes = base64.b64decode(imagem_doc['imagem_base64'])
-    content_type = imagem_doc.get('content_type', 'image/jpeg')
-    
-    return Response(
-        content=imagem_bytes,
-        media_type=content_type,
-        headers={
-            "Cache-Control": "public, max-age=31536000",  # Cache por 1 ano (imagem não muda)
-            "Content-Length": str(len(imagem_bytes))
-        }
-    )
+    return resposta
 
 
 # Manter endpoint antigo para compatibilidade (arquivos em disco)
 @api_router.get("/item-images/{filename}")
 @api_router.head("/item-images/{filename}")
-async def get_item_image(filename: str):
+async def get_item_image(filename: str, if_none_match: Optional[str] = Header(None)):
     """Servir imagem de item do disco (legado - para compatibilidade)"""
     filepath = UPLOAD_DIR / filename
     
@@ -5755,16 +5245,17 @@ async def get_item_image(filename: str):
     }
     content_type = content_types.get(ext, 'image/jpeg')
     
-    # Adicionar headers de cache para garantir atualização
-    return FileResponse(
-        filepath, 
-        media_type=content_type,
-        headers={
-            "Cache-Control": "no-cache, no-store, must-revalidate",
-            "Pragma": "no-cache",
-            "Expires": "0"
-        }
-    )
+    # ETag pelo arquivo (mtime + tamanho): o navegador guarda e revalida, e um
+    # arquivo substituído muda o ETag
+    stat = filepath.stat()
+    headers = {
+        "Cache-Control": CACHE_REVALIDAR,
+        "ETag": etag_imagem(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    }
+    if casa_if_none_match(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    return FileResponse(filepath, media_type=content_type, headers=headers, stat_result=stat)
 
 
 
@@ -5919,73 +5410,69 @@ async def get_comissoes(current_user: dict = Depends(require_admin)):
             return None
         return resp.strip().upper()
     
-    # Obter todas as OCs
-    pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(length=1000)
+    # Itens entregues direto do read-model po_items (índice por status)
+    linhas = db[PO_ITEMS].find(
+        {"status": "entregue", "numero_oc": {"$nin": OCS_EXCLUIDAS_COMISSAO}},
+        {"_id": 0, "numero_oc": 1, "codigo_item": 1, "status": 1, "lote": 1,
+         "responsavel": 1, "preco_venda": 1, "quantidade": 1}
+    )
     
     # Dicionários para acumular valores por pessoa
     valor_venda_por_pessoa = {}
     itens_por_pessoa = {}
-    lotes_por_pessoa = {}
-    
-    # Inicializar com as pessoas que têm lotes fixos
-    for nome in LOTES_POR_PESSOA.keys():
-        valor_venda_por_pessoa[nome] = 0
-        itens_por_pessoa[nome] = []
-        lotes_por_pessoa[nome] = LOTES_POR_PESSOA[nome].copy()
-    
-    for po in pos:
-        numero_oc = po.get('numero_oc', '')
-        
-        # Pular OCs que foram cotadas por admin
-        if numero_oc in OCS_EXCLUIDAS_COMISSAO:
-            continue
-            
-        for item in po.get('items', []):
-            item_status = item.get('status', '')
-            # Apenas itens "entregue" geram comissão
-            if item_status != 'entregue':
-                continue
-            
-            # Calcular valor total de venda do item
-            preco_venda = item.get('preco_venda', 0) or 0
-            quantidade = item.get('quantidade', 1) or 1
-            valor_total_venda = preco_venda * quantidade
-            
-            lote_str = item.get('lote', '')
-            numero_lote = extrair_numero_lote(lote_str)
-            
-            pessoa_responsavel = None
-            
-            # LÓGICA 1: Se tem lote numérico, usar mapeamento fixo
-            if numero_lote is not None:
-                for pessoa, lotes in LOTES_POR_PESSOA.items():
-                    if numero_lote in lotes:
-                        pessoa_responsavel = pessoa
-                        break
-            
-            # LÓGICA 2: Se não tem lote numérico, usar campo responsavel
-            if pessoa_responsavel is None:
-                responsavel_item = normalizar_responsavel(item.get('responsavel', ''))
-                if responsavel_item and responsavel_item not in ['JOÃO', 'MATEUS', 'ADMIN']:
-                    pessoa_responsavel = responsavel_item
-            
-            # Se encontrou um responsável, contabilizar
-            if pessoa_responsavel:
-                # Inicializar se for pessoa nova
-                if pessoa_responsavel not in valor_venda_por_pessoa:
-                    valor_venda_por_pessoa[pessoa_responsavel] = 0
-                    itens_por_pessoa[pessoa_responsavel] = []
-                    lotes_por_pessoa[pessoa_responsavel] = []
-                
-                valor_venda_por_pessoa[pessoa_responsavel] += valor_total_venda
-                itens_por_pessoa[pessoa_responsavel].append({
-                    'numero_oc': numero_oc,
-                    'codigo_item': item.get('codigo_item'),
-                    'lote': lote_str,
-                    'valor_venda': valor_total_venda,
-                    'status': item_status,
-                    'fonte': 'lote' if numero_lote is not None else 'responsavel'
-                })
+    lotes_por_pessoa = {}
+    
+    # Inicializar com as pessoas que têm lotes fixos
+    for nome in LOTES_POR_PESSOA.keys():
+        valor_venda_por_pessoa[nome] = 0
+        itens_por_pessoa[nome] = []
+        lotes_por_pessoa[nome] = LOTES_POR_PESSOA[nome].copy()
+    
+    # Apenas itens "entregue" geram comissão; OCs cotadas por admin já filtradas
+    async for item in linhas:
+        numero_oc = item.get('numero_oc') or ''
+        item_status = item.get('status', '')
+        
+        # Calcular valor total de venda do item
+        preco_venda = item.get('preco_venda', 0) or 0
+        quantidade = item.get('quantidade', 1) or 1
+        valor_total_venda = preco_venda * quantidade
+        
+        lote_str = item.get('lote') or ''
+        numero_lote = extrair_numero_lote(lote_str)
+        
+        pessoa_responsavel = None
+        
+        # LÓGICA 1: Se tem lote numérico, usar mapeamento fixo
+        if numero_lote is not None:
+            for pessoa, lotes in LOTES_POR_PESSOA.items():
+                if numero_lote in lotes:
+                    pessoa_responsavel = pessoa
+                    break
+        
+        # LÓGICA 2: Se não tem lote numérico, usar campo responsavel
+        if pessoa_responsavel is None:
+            responsavel_item = normalizar_responsavel(item.get('responsavel', ''))
+            if responsavel_item and responsavel_item not in ['JOÃO', 'MATEUS', 'ADMIN']:
+                pessoa_responsavel = responsavel_item
+        
+        # Se encontrou um responsável, contabilizar
+        if pessoa_responsavel:
+            # Inicializar se for pessoa nova
+            if pessoa_responsavel not in valor_venda_por_pessoa:
+                valor_venda_por_pessoa[pessoa_responsavel] = 0
+                itens_por_pessoa[pessoa_responsavel] = []
+                lotes_por_pessoa[pessoa_responsavel] = []
+            
+            valor_venda_por_pessoa[pessoa_responsavel] += valor_total_venda
+            itens_por_pessoa[pessoa_responsavel].append({
+                'numero_oc': numero_oc,
+                'codigo_item': item.get('codigo_item'),
+                'lote': lote_str,
+                'valor_venda': valor_total_venda,
+                'status': item_status,
+                'fonte': 'lote' if numero_lote is not None else 'responsavel'
+            })
     
     # Montar resposta
     resultado = []
@@ -6416,7 +5903,7 @@ async def update_po_endereco_entrega(
     
     result = await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": {"endereco_entrega": endereco}}
+        {"$set": {"endereco_entrega": endereco, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
     if result.modified_count == 0:
@@ -6469,7 +5956,7 @@ async def update_dados_bancarios(
     
     result = await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": {"dados_bancarios": dados_bancarios}}
+        {"$set": {"dados_bancarios": dados_bancarios, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
     if result.matched_count == 0:
@@ -6501,7 +5988,7 @@ async def update_requisitante(
     
     result = await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": updates}
+        {"$set": {**updates, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
     if result.matched_count == 0:
@@ -6522,32 +6009,39 @@ async def reprocessar_requisitantes(
     """
     Reprocessa todos os PDFs salvos para extrair o requisitante automaticamente.
     Útil para OCs criadas antes da feature de extração de requisitante.
+    Executado em background - acompanhar por GET /jobs/{job_id}.
     """
-    import base64
-    
+    job = await enfileirar_job("reprocessar_requisitantes", criado_por=current_user.get('sub'))
+    return resposta_job_enfileirado(job, "Reprocessamento de requisitantes iniciado")
+
+
+@registrar_job("reprocessar_requisitantes")
+async def _job_reprocessar_requisitantes(params: dict, ctx: JobContext) -> dict:
+    """Job de /admin/reprocessar-requisitantes"""
     # Buscar todas as OCs que têm PDF salvo mas não têm requisitante
-    cursor = db.purchase_orders.find(
-        {
-            "pdf_original": {"$exists": True},
-            "$or": [
-                {"requisitante_nome": {"$exists": False}},
-                {"requisitante_nome": ""},
-                {"requisitante_nome": None}
-            ]
-        },
-        {"_id": 0, "id": 1, "numero_oc": 1, "pdf_original": 1}
-    )
-    
-    ocs = await cursor.to_list(5000)
+    filtro = {
+        "pdf_original": {"$exists": True},
+        "$or": [
+            {"requisitante_nome": {"$exists": False}},
+            {"requisitante_nome": ""},
+            {"requisitante_nome": None}
+        ]
+    }
+    total = await db.purchase_orders.count_documents(filtro)
+    cursor = db.purchase_orders.find(filtro, {"_id": 0, "id": 1, "numero_oc": 1, "pdf_original": 1})
     
     resultados = []
+    total_processados = 0
     total_atualizados = 0
     total_sem_requisitante = 0
     
-    for oc in ocs:
+    async for oc in cursor:
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(total_processados, total)
+        total_processados += 1
         try:
             pdf_data = oc.get('pdf_original', {})
-            if not pdf_data or not pdf_data.get('data'):
+            if not tem_conteudo(pdf_data, 'data'):
                 resultados.append({
                     "numero_oc": oc.get('numero_oc'),
                     "status": "sem_pdf",
@@ -6555,15 +6049,11 @@ async def reprocessar_requisitantes(
                 })
                 continue
             
-            # Decodificar PDF
-            pdf_content = base64.b64decode(pdf_data['data'])
+            # Ler PDF (GridFS ou base64 legado)
+            pdf_content = await ler_conteudo(pdf_data, 'data')
             
-            # Extrair texto do PDF
-            doc = fitz.open(stream=pdf_content, filetype="pdf")
-            full_text = ""
-            for page in doc:
-                full_text += page.get_text()
-            doc.close()
+            # Extrair texto do PDF (fora do event loop)
+            full_text = await extrair_texto(pdf_content)
             
             # Extrair requisitante
             requisitante_nome = ""
@@ -6605,7 +6095,8 @@ async def reprocessar_requisitantes(
                     {"id": oc['id']},
                     {"$set": {
                         "requisitante_nome": requisitante_nome,
-                        "requisitante_email": requisitante_email
+                        "requisitante_email": requisitante_email,
+                        "updated_at": datetime.now(timezone.utc).isoformat()
                     }}
                 )
                 total_atualizados += 1
@@ -6632,7 +6123,7 @@ async def reprocessar_requisitantes(
     
     return {
         "success": True,
-        "total_processados": len(ocs),
+        "total_processados": total_processados,
         "total_atualizados": total_atualizados,
         "total_sem_requisitante": total_sem_requisitante,
         "resultados": resultados
@@ -6659,18 +6150,14 @@ async def reprocessar_requisitante_oc(
         raise HTTPException(status_code=404, detail="OC não encontrada")
     
     pdf_data = oc.get('pdf_original', {})
-    if not pdf_data or not pdf_data.get('data'):
+    if not tem_conteudo(pdf_data, 'data'):
         raise HTTPException(status_code=400, detail="PDF não encontrado para esta OC")
     
-    # Decodificar PDF
-    pdf_content = base64.b64decode(pdf_data['data'])
+    # Ler PDF (GridFS ou base64 legado)
+    pdf_content = await ler_conteudo(pdf_data, 'data')
     
-    # Extrair texto do PDF
-    doc = fitz.open(stream=pdf_content, filetype="pdf")
-    full_text = ""
-    for page in doc:
-        full_text += page.get_text()
-    doc.close()
+    # Extrair texto do PDF (fora do event loop)
+    full_text = await extrair_texto(pdf_content)
     
     # Extrair requisitante
     requisitante_nome = ""
@@ -6711,7 +6198,8 @@ async def reprocessar_requisitante_oc(
         {"id": po_id},
         {"$set": {
             "requisitante_nome": requisitante_nome,
-            "requisitante_email": requisitante_email
+            "requisitante_email": requisitante_email,
+            "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
     
@@ -7107,6 +6595,17 @@ async def gerar_relatorio_completo(
     )
 
 
+# ==================== CACHES EM MEMÓRIA ====================
+
+@api_router.get("/admin/caches")
+async def get_estatisticas_caches(current_user: dict = Depends(require_admin)):
+    """Acertos/falhas/remoções dos caches em memória deste processo (imagens e parsing de PDFs)"""
+    return {
+        "imagens": estatisticas_cache_imagens(),
+        "parse_pdf": estatisticas_parse_cache()
+    }
+
+
 # ==================== CONFIGURAÇÕES GERAIS ====================
 
 @api_router.get("/admin/configuracoes")
@@ -7241,11 +6740,13 @@ async def get_resumo_lucro_admin(
     percentual_imposto = config.get('percentual_imposto', 11.0)
     frete_correios_mensal = config.get('frete_correios_mensal', 0)
     
-    # Buscar todos os itens entregues
-    cursor = db.purchase_orders.find(
-        {"items.status": "entregue"},
-        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
-    )
+    # Itens entregues direto do read-model po_items (índice por status):
+    # a mesma leitura alimenta os totais e as comissões abaixo
+    linhas_entregues = await db[PO_ITEMS].find(
+        {"status": "entregue"},
+        {"_id": 0, "numero_oc": 1, "codigo_item": 1, "lote": 1, "responsavel": 1,
+         "quantidade": 1, "preco_venda": 1, "preco_compra": 1, "frete_compra": 1}
+    ).sort([("numero_oc", -1), ("item_index", 1)]).to_list(None)
     
     itens_entregues = []
     total_venda = 0
@@ -7253,34 +6754,32 @@ async def get_resumo_lucro_admin(
     total_frete_compra = 0
     total_imposto = 0
     
-    async for po in cursor:
-        for item in po.get('items', []):
-            if item.get('status') == 'entregue':
-                qtd = item.get('quantidade', 0)
-                preco_venda = item.get('preco_venda', 0) or 0
-                preco_compra = item.get('preco_compra', 0) or 0
-                frete_compra = item.get('frete_compra', 0) or 0
-                
-                valor_venda_total = preco_venda * qtd
-                valor_compra_total = preco_compra * qtd
-                imposto_item = valor_venda_total * (percentual_imposto / 100)
-                
-                total_venda += valor_venda_total
-                total_compra += valor_compra_total
-                total_frete_compra += frete_compra
-                total_imposto += imposto_item
-                
-                itens_entregues.append({
-                    "codigo_item": item.get('codigo_item'),
-                    "numero_oc": po.get('numero_oc', '').replace('OC-', ''),
-                    "quantidade": qtd,
-                    "preco_venda": preco_venda,
-                    "preco_compra": preco_compra,
-                    "valor_venda_total": valor_venda_total,
-                    "valor_compra_total": valor_compra_total,
-                    "frete_compra": frete_compra,
-                    "imposto": imposto_item
-                })
+    for item in linhas_entregues:
+        qtd = item.get('quantidade') or 0
+        preco_venda = item.get('preco_venda', 0) or 0
+        preco_compra = item.get('preco_compra', 0) or 0
+        frete_compra = item.get('frete_compra', 0) or 0
+        
+        valor_venda_total = preco_venda * qtd
+        valor_compra_total = preco_compra * qtd
+        imposto_item = valor_venda_total * (percentual_imposto / 100)
+        
+        total_venda += valor_venda_total
+        total_compra += valor_compra_total
+        total_frete_compra += frete_compra
+        total_imposto += imposto_item
+        
+        itens_entregues.append({
+            "codigo_item": item.get('codigo_item'),
+            "numero_oc": (item.get('numero_oc') or '').replace('OC-', ''),
+            "quantidade": qtd,
+            "preco_venda": preco_venda,
+            "preco_compra": preco_compra,
+            "valor_venda_total": valor_venda_total,
+            "valor_compra_total": valor_compra_total,
+            "frete_compra": frete_compra,
+            "imposto": imposto_item
+        })
     
     # Buscar custos diversos
     cursor_custos = db.custos_diversos.find({}, {"_id": 0})
@@ -7311,35 +6810,30 @@ async def get_resumo_lucro_admin(
     
     # Calcular comissões dos itens entregues
     total_comissoes = 0
-    cursor_comissoes = db.purchase_orders.find({}, {"_id": 0, "numero_oc": 1, "items": 1})
-    async for po in cursor_comissoes:
-        numero_oc = po.get('numero_oc', '')
-        if numero_oc in OCS_EXCLUIDAS_COMISSAO:
+    for item in linhas_entregues:
+        if item.get('numero_oc') in OCS_EXCLUIDAS_COMISSAO:
             continue
-        for item in po.get('items', []):
-            if item.get('status') != 'entregue':
-                continue
-            preco_venda = item.get('preco_venda', 0) or 0
-            quantidade = item.get('quantidade', 1) or 1
-            valor_total_venda = preco_venda * quantidade
-            
-            lote_str = item.get('lote', '')
-            numero_lote = extrair_numero_lote_lucro(lote_str)
-            
-            pessoa_responsavel = None
-            if numero_lote is not None:
-                for pessoa, lotes in LOTES_POR_PESSOA.items():
-                    if numero_lote in lotes:
-                        pessoa_responsavel = pessoa
-                        break
-            
-            if pessoa_responsavel is None:
-                responsavel_item = (item.get('responsavel', '') or '').strip().upper()
-                if responsavel_item and responsavel_item not in ['JOÃO', 'MATEUS', 'ADMIN']:
-                    pessoa_responsavel = responsavel_item
-            
-            if pessoa_responsavel:
-                total_comissoes += valor_total_venda * (PERCENTUAL_COMISSAO / 100)
+        preco_venda = item.get('preco_venda', 0) or 0
+        quantidade = item.get('quantidade', 1) or 1
+        valor_total_venda = preco_venda * quantidade
+        
+        lote_str = item.get('lote') or ''
+        numero_lote = extrair_numero_lote_lucro(lote_str)
+        
+        pessoa_responsavel = None
+        if numero_lote is not None:
+            for pessoa, lotes in LOTES_POR_PESSOA.items():
+                if numero_lote in lotes:
+                    pessoa_responsavel = pessoa
+                    break
+        
+        if pessoa_responsavel is None:
+            responsavel_item = (item.get('responsavel', '') or '').strip().upper()
+            if responsavel_item and responsavel_item not in ['JOÃO', 'MATEUS', 'ADMIN']:
+                pessoa_responsavel = responsavel_item
+        
+        if pessoa_responsavel:
+            total_comissoes += valor_total_venda * (PERCENTUAL_COMISSAO / 100)
     
     # Buscar status de pagamento
     pagamento_info = await db.configuracoes.find_one({"tipo": "pagamento_lucro"}, {"_id": 0}) or {
@@ -7531,6 +7025,7 @@ async def atualizar_status_em_massa(
     
     # Atualizar status dos itens (selecionados ou todos)
     items = po.get('items', [])
+    itens_antes = snapshot_itens(items)
     itens_atualizados = 0
     
     # Definir categorias de status
@@ -7568,11 +7063,8 @@ async def atualizar_status_em_massa(
                 atualizar_data_compra(item, novo_status)  # Atualiza data de compra automaticamente
                 itens_atualizados += 1
     
-    # Salvar alterações
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": items}}
-    )
+    # Salvar alterações (apenas os itens modificados)
+    await salvar_itens(po_id, itens_antes, items)
     
     return {
         "success": True,
@@ -7620,6 +7112,7 @@ async def aplicar_frete_envio_multiplo(
     
     # Atualizar cada item
     items = po.get('items', [])
+    itens_antes = snapshot_itens(items)
     itens_atualizados = []
     
     for idx in item_indices:
@@ -7636,11 +7129,8 @@ async def aplicar_frete_envio_multiplo(
         # Recalcular lucro líquido usando a função centralizada
         calcular_lucro_item(items[idx])
     
-    # Salvar alterações
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": items}}
-    )
+    # Salvar alterações (apenas os itens modificados)
+    await salvar_itens(po_id, itens_antes, items)
     
     return {
         "success": True,
@@ -7668,7 +7158,7 @@ async def aplicar_rastreio_multiplo(
     """
     
     item_indices = data.get("item_indices", [])
-    codigo_rastreio = data.get("codigo_rastreio", "").strip()
+    codigo_rastreio = data.get("codigo_rastreio", "").strip().upper()
     
     if not item_indices:
         raise HTTPException(status_code=400, detail="Nenhum item selecionado")
@@ -7683,6 +7173,7 @@ async def aplicar_rastreio_multiplo(
     
     # Atualizar cada item com o código de rastreio
     items = po.get('items', [])
+    itens_antes = snapshot_itens(items)
     itens_atualizados = []
     
     for idx in item_indices:
@@ -7696,11 +7187,9 @@ async def aplicar_rastreio_multiplo(
             "codigo_rastreio": codigo_rastreio
         })
     
-    # Salvar alterações
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": items}}
-    )
+    # Salvar alterações (apenas os itens modificados)
+    await salvar_itens(po_id, itens_antes, items)
+    await agendar_rastreio_itens(items[i["indice"]] for i in itens_atualizados)
     
     return {
         "success": True,
@@ -7729,7 +7218,7 @@ async def aplicar_rastreio_frete_multiplo(
     """
     
     item_indices = data.get("item_indices", [])
-    codigo_rastreio = data.get("codigo_rastreio", "").strip() if data.get("codigo_rastreio") else None
+    codigo_rastreio = data.get("codigo_rastreio", "").strip().upper() if data.get("codigo_rastreio") else None
     frete_por_item = data.get("frete_por_item")
     
     if not item_indices:
@@ -7745,6 +7234,7 @@ async def aplicar_rastreio_frete_multiplo(
     
     # Atualizar cada item
     items = po.get('items', [])
+    itens_antes = snapshot_itens(items)
     itens_atualizados = []
     
     for idx in item_indices:
@@ -7766,11 +7256,10 @@ async def aplicar_rastreio_frete_multiplo(
             **updates
         })
     
-    # Salvar alterações
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": items}}
-    )
+    # Salvar alterações (apenas os itens modificados)
+    await salvar_itens(po_id, itens_antes, items)
+    if codigo_rastreio:
+        await agendar_rastreio_itens(items[i["indice"]] for i in itens_atualizados)
     
     return {
         "success": True,
@@ -7815,6 +7304,7 @@ async def aplicar_status_multiplo(
     
     # Atualizar cada item com o novo status
     items = po.get('items', [])
+    itens_antes = snapshot_itens(items)
     itens_atualizados = []
     
     for idx in item_indices:
@@ -7833,11 +7323,8 @@ async def aplicar_status_multiplo(
             "novo_status": novo_status
         })
     
-    # Salvar alterações
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": items}}
-    )
+    # Salvar alterações (apenas os itens modificados)
+    await salvar_itens(po_id, itens_antes, items)
     
     return {
         "success": True,
@@ -7925,7 +7412,7 @@ async def atualizar_oc_com_pdf(
     content = await file.read()
     
     # Usar a função de extração existente para pegar todos os dados
-    pdf_data = extract_oc_from_pdf(content)
+    pdf_data = await extrair_oc_pdf(content)
     
     if not pdf_data.get('items'):
         raise HTTPException(status_code=400, detail="Não foi possível extrair itens do PDF")
@@ -8082,7 +7569,7 @@ async def atualizar_oc_com_pdf(
     updates['pdf_original'] = {
         'filename': file.filename,
         'content_type': 'application/pdf',
-        'data': base64.b64encode(content).decode('utf-8'),
+        **(await salvar_blob(content, file.filename, 'application/pdf')),
         'uploaded_at': datetime.now(timezone.utc).isoformat()
     }
     campos_atualizados.append("pdf_original")
@@ -8100,8 +7587,9 @@ async def atualizar_oc_com_pdf(
     # Aplicar atualizações
     await db.purchase_orders.update_one(
         {"id": po_id},
-        {"$set": updates}
+        {"$set": {**updates, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await sincronizar_po(po_id)
     
     return {
         "success": True,
@@ -8129,19 +7617,32 @@ async def atualizar_ceps_todos_enderecos(
     """
     Atualiza todos os endereços de entrega das OCs adicionando o CEP automaticamente
     onde ainda não existe.
+    Executado em background - acompanhar por GET /jobs/{job_id}.
     """
-    
+    job = await enfileirar_job("atualizar_ceps_enderecos", criado_por=current_user.get('sub'))
+    return resposta_job_enfileirado(job, "Atualização de CEPs iniciada")
+
+
+@registrar_job("atualizar_ceps_enderecos")
+async def _job_atualizar_ceps_enderecos(params: dict, ctx: JobContext) -> dict:
+    """Job de /admin/atualizar-ceps-enderecos"""
     # Buscar todas as OCs que têm endereço mas não têm CEP
+    filtro = {"endereco_entrega": {"$exists": True, "$ne": None, "$ne": ""}}
+    total = await db.purchase_orders.count_documents(filtro)
     ocs_cursor = db.purchase_orders.find(
-        {"endereco_entrega": {"$exists": True, "$ne": None, "$ne": ""}},
+        filtro,
         {"_id": 0, "id": 1, "numero_oc": 1, "endereco_entrega": 1}
     )
     
     atualizados = 0
     erros = 0
     detalhes = []
+    processados = 0
     
     async for oc in ocs_cursor:
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(processados, total)
+        processados += 1
         endereco = oc.get('endereco_entrega', '')
         
         # Verificar se já tem CEP
@@ -8154,7 +7655,7 @@ async def atualizar_ceps_todos_enderecos(
             novo_endereco = f"{endereco}, CEP: {cep}"
             await db.purchase_orders.update_one(
                 {"id": oc['id']},
-                {"$set": {"endereco_entrega": novo_endereco}}
+                {"$set": {"endereco_entrega": novo_endereco, "updated_at": datetime.now(timezone.utc).isoformat()}}
             )
             atualizados += 1
             detalhes.append({
@@ -8179,6 +7680,7 @@ async def atualizar_ceps_todos_enderecos(
 @api_router.post("/admin/atualizar-todas-ocs-pdf")
 async def atualizar_todas_ocs_com_pdfs(
     files: List[UploadFile] = File(...),
+    stream: bool = False,
     current_user: dict = Depends(require_admin)
 ):
     """
@@ -8188,294 +7690,366 @@ async def atualizar_todas_ocs_com_pdfs(
     
     Atualiza: Endereço, Data de Entrega, NCM, Preços dos itens (preco_pdf e preco_venda_unitario)
     Preserva: Status, responsável, fontes de compra, notas fiscais, observações
+    
+    O lote é processado em etapas (parsing paralelo, uma consulta de OCs e de
+    referências, insert_many + bulk_write). Com ?stream=true a resposta é NDJSON
+    com uma linha de progresso por arquivo e o resultado na última linha.
     """
-    import base64
+    arquivos = await ler_arquivos(files)
+    return await responder_pipeline(_pipeline_atualizar_ocs_pdf(arquivos, current_user), stream)
+
+
+def _montar_nova_oc_de_pdf(pdf_data: dict, ref_lookup: dict, current_user: dict) -> dict:
+    """Documento de uma OC nova criada a partir do PDF (sem o pdf_original)"""
+    import random
     
-    resultados = []
+    processed_items = []
+    for item in pdf_data.get("items", []):
+        codigo = item.get("codigo_item", "")
+        ref_items = ref_lookup.get(codigo, [])
+        
+        responsavel = ""
+        lote = ""
+        lot_number = 0
+        descricao_ref = item.get("descricao", "")  # Fallback para descrição do PDF
+        ref_item = None
+        
+        if ref_items:
+            ref_item = ref_items[0] if len(ref_items) == 1 else random.choice(ref_items)
+            responsavel = ref_item.get("responsavel", "")  # Campo correto
+            lote = ref_item.get("lote", "")
+            # Usar descrição da planilha se disponível
+            if ref_item.get("descricao"):
+                descricao_ref = ref_item.get("descricao")
+            try:
+                lot_number = int(''.join(filter(str.isdigit, lote))) if lote else 0
+            except:
+                lot_number = 0
+        
+        processed_items.append({
+            "codigo_item": codigo,
+            "quantidade": int(item.get("quantidade", 1)),
+            "unidade": item.get("unidade", "UN"),
+            "descricao": descricao_ref,  # Usar descrição da planilha
+            "endereco_entrega": pdf_data.get("endereco_entrega", ""),
+            "responsavel": responsavel,
+            "lote": lote,
+            "lot_number": lot_number,
+            "regiao": ref_item.get("regiao", "") if ref_item else item.get("regiao", ""),
+            "status": "pendente",
+            "preco_venda": item.get("preco_venda_pdf") or item.get("preco_venda") or (ref_item.get("preco_venda_unitario") if ref_item else None),
+            "ncm": item.get("ncm", ""),
+            "marca_modelo": ref_item.get("marca_modelo", "") if ref_item else ""
+        })
     
-    for file in files:
-        if not file.filename.lower().endswith('.pdf'):
-            resultados.append({
-                "arquivo": file.filename,
-                "success": False,
-                "erro": "Arquivo não é PDF"
-            })
-            continue
+    return {
+        "id": str(uuid.uuid4()),
+        "numero_oc": pdf_data["numero_oc"],
+        "cnpj_requisitante": pdf_data.get("cnpj_requisitante", ""),
+        "items": processed_items,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_by": current_user.get('sub'),
+        "data_entrega": pdf_data.get("data_entrega"),
+        "endereco_entrega": pdf_data.get("endereco_entrega", "")
+    }
+
+
+def _calcular_atualizacao_oc_de_pdf(existing_po: dict, pdf_data: dict, novo_endereco: str):
+    """
+    Compara a OC existente com os dados do PDF.
+    Retorna (campos_oc, itens_depois, campos_atualizados, itens_atualizados).
+    """
+    # Criar lookup de itens do PDF por código
+    pdf_items_map = {}
+    for item in pdf_data.get('items', []):
+        codigo = item.get('codigo_item', '')
+        if codigo:
+            if codigo not in pdf_items_map:
+                pdf_items_map[codigo] = []
+            pdf_items_map[codigo].append(item)
+    
+    updates = {}
+    campos_atualizados = ["pdf_original"]
+    itens_atualizados = 0
+    
+    # ============ ATUALIZAR CABEÇALHO ============
+    
+    # Endereço de Entrega (CEP já resolvido pelo pipeline)
+    endereco_atual = existing_po.get('endereco_entrega', '').strip()
+    if novo_endereco and novo_endereco != endereco_atual:
+        updates['endereco_entrega'] = novo_endereco
+        campos_atualizados.append("endereco")
+    
+    # Data de Entrega
+    nova_data_entrega = pdf_data.get('data_entrega')
+    data_atual = existing_po.get('data_entrega', '')
+    if nova_data_entrega and nova_data_entrega != data_atual:
+        updates['data_entrega'] = nova_data_entrega
+        campos_atualizados.append("data_entrega")
+    
+    # CNPJ Requisitante
+    novo_cnpj = pdf_data.get('cnpj_requisitante', '')
+    cnpj_atual = existing_po.get('cnpj_requisitante', '')
+    if novo_cnpj and novo_cnpj != cnpj_atual:
+        updates['cnpj_requisitante'] = novo_cnpj
+        campos_atualizados.append("cnpj_requisitante")
+    
+    # Requisitante Nome
+    novo_requisitante_nome = pdf_data.get('requisitante_nome', '')
+    requisitante_nome_atual = existing_po.get('requisitante_nome', '')
+    if novo_requisitante_nome and novo_requisitante_nome != requisitante_nome_atual:
+        updates['requisitante_nome'] = novo_requisitante_nome
+        campos_atualizados.append("requisitante_nome")
+    
+    # Requisitante Email
+    novo_requisitante_email = pdf_data.get('requisitante_email', '')
+    requisitante_email_atual = existing_po.get('requisitante_email', '')
+    if novo_requisitante_email and novo_requisitante_email != requisitante_email_atual:
+        updates['requisitante_email'] = novo_requisitante_email
+        campos_atualizados.append("requisitante_email")
+    
+    # ============ ATUALIZAR ITENS ============
+    existing_items = existing_po.get('items', [])
+    updated_items = []
+    items_modified = False
+    
+    for idx, existing_item in enumerate(existing_items):
+        codigo = existing_item.get('codigo_item', '')
+        pdf_matches = pdf_items_map.get(codigo, [])
         
-        content = await file.read()
+        updated_item = dict(existing_item)
         
-        # Usar a função de extração completa
-        try:
-            pdf_data = extract_oc_from_pdf(content)
-        except Exception as e:
-            resultados.append({
-                "arquivo": file.filename,
-                "success": False,
-                "erro": f"Erro ao ler PDF: {str(e)}"
-            })
+        if pdf_matches:
+            pdf_item = pdf_matches[0]
+            if len(pdf_matches) > 1:
+                same_code_existing = [i for i, x in enumerate(existing_items) if x.get('codigo_item') == codigo]
+                item_order = same_code_existing.index(idx) if idx in same_code_existing else 0
+                if item_order < len(pdf_matches):
+                    pdf_item = pdf_matches[item_order]
+            
+            # PREÇO DO PDF
+            preco_pdf_novo = pdf_item.get('preco_pdf') or pdf_item.get('preco_venda_pdf')
+            preco_pdf_atual = existing_item.get('preco_pdf')
+            if preco_pdf_novo is not None and preco_pdf_novo != preco_pdf_atual:
+                updated_item['preco_pdf'] = preco_pdf_novo
+                items_modified = True
+            
+            # PREÇO DE VENDA - SEMPRE atualiza com valor do PDF se diferente
+            preco_venda_atual = existing_item.get('preco_venda')
+            if preco_pdf_novo is not None and preco_pdf_novo != preco_venda_atual:
+                updated_item['preco_venda'] = preco_pdf_novo
+                items_modified = True
+                itens_atualizados += 1
+            
+            # QUANTIDADE
+            qtd_nova = pdf_item.get('quantidade')
+            qtd_atual = existing_item.get('quantidade')
+            if qtd_nova is not None and qtd_nova != qtd_atual:
+                updated_item['quantidade'] = qtd_nova
+                items_modified = True
+            
+            # NCM
+            ncm_novo = pdf_item.get('ncm')
+            ncm_atual = existing_item.get('ncm')
+            if ncm_novo and ncm_novo != ncm_atual:
+                updated_item['ncm'] = ncm_novo
+                items_modified = True
+        
+        updated_items.append(updated_item)
+    
+    if items_modified:
+        campos_atualizados.append(f"{itens_atualizados} preços")
+    
+    return updates, updated_items, campos_atualizados, itens_atualizados
+
+
+async def _pipeline_atualizar_ocs_pdf(arquivos: List[dict], current_user: dict):
+    """Gerador de eventos da atualização de OCs em lote (ver pdf_batch_service)"""
+    from pymongo.errors import BulkWriteError
+    
+    resultados_por_indice = {}
+    total = len(arquivos)
+    
+    # ===== ETAPA 1: parsing em paralelo =====
+    parseados = []
+    processados = 0
+    async for arquivo in parsear_em_lote(arquivos):
+        processados += 1
+        pdf_data = arquivo.get("oc_data") or {}
+        if arquivo["erro"]:
+            erro = arquivo["erro"] if arquivo["conteudo"] is None else f"Erro ao ler PDF: {arquivo['erro']}"
+        elif not pdf_data.get("numero_oc"):
+            erro = "Não foi possível identificar o número da OC no PDF"
+        else:
+            erro = None
+        
+        if erro:
+            resultados_por_indice[arquivo["indice"]] = {"arquivo": arquivo["filename"], "success": False, "erro": erro}
+            yield evento_progresso(arquivo["filename"], processados, total, status="erro", erro=erro)
             continue
         
-        # Extrair número da OC
-        numero_oc = pdf_data.get('numero_oc')
-        if not numero_oc:
-            resultados.append({
-                "arquivo": file.filename,
+        parseados.append(arquivo)
+        yield evento_progresso(arquivo["filename"], processados, total, status="lido", numero_oc=pdf_data["numero_oc"])
+    
+    parseados.sort(key=lambda a: a["indice"])
+    
+    # ===== ETAPA 2: consultas únicas para o lote =====
+    existentes = await buscar_ocs_por_numero([a["oc_data"]["numero_oc"] for a in parseados])
+    ref_lookup = await buscar_referencias([
+        item.get("codigo_item")
+        for a in parseados if a["oc_data"]["numero_oc"] not in existentes
+        for item in a["oc_data"].get("items", [])
+    ])
+    ceps = await mapear_concorrente(
+        buscar_cep_por_endereco,
+        [
+            a["oc_data"].get("endereco_entrega", "").strip() for a in parseados
+            if a["oc_data"]["numero_oc"] in existentes and _endereco_sem_cep(a["oc_data"].get("endereco_entrega", "").strip())
+        ]
+    )
+    
+    # ===== ETAPA 3: montar inserções e atualizações =====
+    novas = []  # (arquivo, doc)
+    atualizacoes = []  # (arquivo, existing_po, itens_antes, itens_depois, campos_oc, campos_atualizados, itens_atualizados)
+    numeros_no_lote = {}
+    for arquivo in parseados:
+        pdf_data = arquivo["oc_data"]
+        numero_oc = pdf_data["numero_oc"]
+        
+        if numero_oc in numeros_no_lote:
+            resultados_por_indice[arquivo["indice"]] = {
+                "arquivo": arquivo["filename"],
+                "numero_oc": numero_oc,
                 "success": False,
-                "erro": "Não foi possível identificar o número da OC no PDF"
-            })
+                "erro": f"OC repetida neste lote (já processada pelo arquivo {numeros_no_lote[numero_oc]})"
+            }
             continue
+        numeros_no_lote[numero_oc] = arquivo["filename"]
         
-        # Buscar OC existente
-        existing_po = await db.purchase_orders.find_one({"numero_oc": numero_oc}, {"_id": 0})
+        existing_po = existentes.get(numero_oc)
         
         # Se OC não existe, CRIAR uma nova
         if not existing_po:
-            import random
-            import uuid
-            
             try:
-                # Buscar referências para os itens
-                all_codigo_items = [item.get("codigo_item") for item in pdf_data.get("items", []) if item.get("codigo_item")]
-                all_ref_items = await db.reference_items.find(
-                    {"codigo_item": {"$in": all_codigo_items}},
-                    {"_id": 0}
-                ).to_list(5000)
-                
-                ref_lookup = {}
-                for ref in all_ref_items:
-                    codigo = ref["codigo_item"]
-                    if codigo not in ref_lookup:
-                        ref_lookup[codigo] = []
-                    ref_lookup[codigo].append(ref)
-                
-                # Processar itens
-                processed_items = []
-                for item in pdf_data.get("items", []):
-                    codigo = item.get("codigo_item", "")
-                    ref_items = ref_lookup.get(codigo, [])
-                    
-                    responsavel = ""
-                    lote = ""
-                    lot_number = 0
-                    descricao_ref = item.get("descricao", "")  # Fallback para descrição do PDF
-                    
-                    if ref_items:
-                        ref_item = ref_items[0] if len(ref_items) == 1 else random.choice(ref_items)
-                        responsavel = ref_item.get("responsavel", "")  # Campo correto
-                        lote = ref_item.get("lote", "")
-                        # Usar descrição da planilha se disponível
-                        if ref_item.get("descricao"):
-                            descricao_ref = ref_item.get("descricao")
-                        try:
-                            lot_number = int(''.join(filter(str.isdigit, lote))) if lote else 0
-                        except:
-                            lot_number = 0
-                    
-                    processed_items.append({
-                        "codigo_item": codigo,
-                        "quantidade": int(item.get("quantidade", 1)),
-                        "unidade": item.get("unidade", "UN"),
-                        "descricao": descricao_ref,  # Usar descrição da planilha
-                        "endereco_entrega": pdf_data.get("endereco_entrega", ""),
-                        "responsavel": responsavel,
-                        "lote": lote,
-                        "lot_number": lot_number,
-                        "regiao": ref_item.get("regiao", "") if ref_items else item.get("regiao", ""),
-                        "status": "pendente",
-                        "preco_venda": item.get("preco_venda_pdf") or item.get("preco_venda") or (ref_item.get("preco_venda_unitario") if ref_items else None),
-                        "ncm": item.get("ncm", ""),
-                        "marca_modelo": ref_item.get("marca_modelo", "") if ref_items else ""
-                    })
-                
-                # Criar documento da OC
-                new_po = {
-                    "id": str(uuid.uuid4()),
-                    "numero_oc": numero_oc,
-                    "cnpj_requisitante": pdf_data.get("cnpj_requisitante", ""),
-                    "items": processed_items,
-                    "created_at": datetime.now(timezone.utc).isoformat(),
-                    "created_by": current_user.get('sub'),
-                    "data_entrega": pdf_data.get("data_entrega"),
-                    "endereco_entrega": pdf_data.get("endereco_entrega", ""),
-                    "pdf_original": {
-                        'filename': file.filename,
-                        'content_type': 'application/pdf',
-                        'data': base64.b64encode(content).decode('utf-8'),
-                        'uploaded_at': datetime.now(timezone.utc).isoformat()
-                    }
-                }
-                
-                await db.purchase_orders.insert_one(new_po)
-                
-                resultados.append({
-                    "arquivo": file.filename,
-                    "numero_oc": numero_oc,
-                    "success": True,
-                    "campos_atualizados": ["NOVA OC CRIADA", f"{len(processed_items)} itens", "pdf_original"],
-                    "itens_atualizados": len(processed_items),
-                    "nova_oc": True
-                })
-                continue
-                
+                novas.append((arquivo, _montar_nova_oc_de_pdf(pdf_data, ref_lookup, current_user)))
             except Exception as e:
-                resultados.append({
-                    "arquivo": file.filename,
+                resultados_por_indice[arquivo["indice"]] = {
+                    "arquivo": arquivo["filename"],
                     "numero_oc": numero_oc,
                     "success": False,
                     "erro": f"Erro ao criar nova OC: {str(e)}"
-                })
-                continue
-        
-        # Se chegou aqui, OC existe - fazer atualização normal
-        # Criar lookup de itens do PDF por código
-        pdf_items_map = {}
-        for item in pdf_data.get('items', []):
-            codigo = item.get('codigo_item', '')
-            if codigo:
-                if codigo not in pdf_items_map:
-                    pdf_items_map[codigo] = []
-                pdf_items_map[codigo].append(item)
-        
-        # Preparar atualizações
-        updates = {}
-        campos_atualizados = []
-        itens_atualizados = 0
+                }
+            continue
         
-        # ============ ATUALIZAR CABEÇALHO ============
+        # OC existe - fazer atualização normal
+        novo_endereco = pdf_data.get('endereco_entrega', '').strip()
+        cep = ceps.get(novo_endereco)
+        if cep:
+            novo_endereco = f"{novo_endereco}, CEP: {cep}"
         
-        # SALVAR PDF ORIGINAL para download posterior
-        import base64
-        updates['pdf_original'] = {
-            'filename': file.filename,
+        itens_antes = snapshot_itens(existing_po.get('items', []))
+        campos_oc, itens_depois, campos_atualizados, itens_atualizados = _calcular_atualizacao_oc_de_pdf(
+            existing_po, pdf_data, novo_endereco
+        )
+        atualizacoes.append((arquivo, existing_po, itens_antes, itens_depois, campos_oc, campos_atualizados, itens_atualizados))
+    
+    # SALVAR PDFs ORIGINAIS para download posterior (GridFS, em paralelo)
+    todos = [n[0] for n in novas] + [a[0] for a in atualizacoes]
+    blobs = await asyncio.gather(
+        *[salvar_blob(a["conteudo"], a["filename"], 'application/pdf') for a in todos],
+        return_exceptions=True
+    )
+    pdf_por_indice = {}
+    for arquivo, blob in zip(todos, blobs):
+        if isinstance(blob, Exception):
+            resultados_por_indice[arquivo["indice"]] = {
+                "arquivo": arquivo["filename"],
+                "numero_oc": arquivo["oc_data"]["numero_oc"],
+                "success": False,
+                "erro": f"Erro ao salvar PDF: {blob}"
+            }
+            continue
+        pdf_por_indice[arquivo["indice"]] = {
+            'filename': arquivo["filename"],
             'content_type': 'application/pdf',
-            'data': base64.b64encode(content).decode('utf-8'),
+            **blob,
             'uploaded_at': datetime.now(timezone.utc).isoformat()
         }
-        campos_atualizados.append("pdf_original")
-        
-        # Endereço de Entrega
-        novo_endereco = pdf_data.get('endereco_entrega', '').strip()
-        endereco_atual = existing_po.get('endereco_entrega', '').strip()
-        if novo_endereco:
-            if not re.search(r'CEP[:\s]*\d{5}-?\d{3}', novo_endereco, re.IGNORECASE):
-                cep = await buscar_cep_por_endereco(novo_endereco)
-                if cep:
-                    novo_endereco = f"{novo_endereco}, CEP: {cep}"
-            
-            if novo_endereco != endereco_atual:
-                updates['endereco_entrega'] = novo_endereco
-                campos_atualizados.append("endereco")
-        
-        # Data de Entrega
-        nova_data_entrega = pdf_data.get('data_entrega')
-        data_atual = existing_po.get('data_entrega', '')
-        if nova_data_entrega and nova_data_entrega != data_atual:
-            updates['data_entrega'] = nova_data_entrega
-            campos_atualizados.append("data_entrega")
-        
-        # CNPJ Requisitante
-        novo_cnpj = pdf_data.get('cnpj_requisitante', '')
-        cnpj_atual = existing_po.get('cnpj_requisitante', '')
-        if novo_cnpj and novo_cnpj != cnpj_atual:
-            updates['cnpj_requisitante'] = novo_cnpj
-            campos_atualizados.append("cnpj_requisitante")
-        
-        # Requisitante Nome
-        novo_requisitante_nome = pdf_data.get('requisitante_nome', '')
-        requisitante_nome_atual = existing_po.get('requisitante_nome', '')
-        if novo_requisitante_nome and novo_requisitante_nome != requisitante_nome_atual:
-            updates['requisitante_nome'] = novo_requisitante_nome
-            campos_atualizados.append("requisitante_nome")
-        
-        # Requisitante Email
-        novo_requisitante_email = pdf_data.get('requisitante_email', '')
-        requisitante_email_atual = existing_po.get('requisitante_email', '')
-        if novo_requisitante_email and novo_requisitante_email != requisitante_email_atual:
-            updates['requisitante_email'] = novo_requisitante_email
-            campos_atualizados.append("requisitante_email")
-        
-        # ============ ATUALIZAR ITENS ============
-        existing_items = existing_po.get('items', [])
-        updated_items = []
-        items_modified = False
-        
-        for idx, existing_item in enumerate(existing_items):
-            codigo = existing_item.get('codigo_item', '')
-            pdf_matches = pdf_items_map.get(codigo, [])
-            
-            updated_item = dict(existing_item)
-            
-            if pdf_matches:
-                pdf_item = pdf_matches[0]
-                if len(pdf_matches) > 1:
-                    same_code_existing = [i for i, x in enumerate(existing_items) if x.get('codigo_item') == codigo]
-                    item_order = same_code_existing.index(idx) if idx in same_code_existing else 0
-                    if item_order < len(pdf_matches):
-                        pdf_item = pdf_matches[item_order]
-                
-                # PREÇO DO PDF
-                preco_pdf_novo = pdf_item.get('preco_pdf') or pdf_item.get('preco_venda_pdf')
-                preco_pdf_atual = existing_item.get('preco_pdf')
-                if preco_pdf_novo is not None and preco_pdf_novo != preco_pdf_atual:
-                    updated_item['preco_pdf'] = preco_pdf_novo
-                    items_modified = True
-                
-                # PREÇO DE VENDA - SEMPRE atualiza com valor do PDF se diferente
-                preco_venda_atual = existing_item.get('preco_venda')
-                if preco_pdf_novo is not None and preco_pdf_novo != preco_venda_atual:
-                    updated_item['preco_venda'] = preco_pdf_novo
-                    items_modified = True
-                    itens_atualizados += 1
-                
-                # QUANTIDADE
-                qtd_nova = pdf_item.get('quantidade')
-                qtd_atual = existing_item.get('quantidade')
-                if qtd_nova is not None and qtd_nova != qtd_atual:
-                    updated_item['quantidade'] = qtd_nova
-                    items_modified = True
-                
-                # NCM
-                ncm_novo = pdf_item.get('ncm')
-                ncm_atual = existing_item.get('ncm')
-                if ncm_novo and ncm_novo != ncm_atual:
-                    updated_item['ncm'] = ncm_novo
-                    items_modified = True
-            
-            updated_items.append(updated_item)
-        
-        if items_modified:
-            updates['items'] = updated_items
-            campos_atualizados.append(f"{itens_atualizados} preços")
-        
-        if updates:
-            await db.purchase_orders.update_one(
-                {"id": existing_po['id']},
-                {"$set": updates}
-            )
-        
-        resultados.append({
-            "arquivo": file.filename,
-            "numero_oc": numero_oc,
+    novas = [(a, doc) for a, doc in novas if a["indice"] in pdf_por_indice]
+    atualizacoes = [u for u in atualizacoes if u[0]["indice"] in pdf_por_indice]
+    
+    # ===== ETAPA 4: gravação única =====
+    # Novas OCs: um insert_many
+    falhas_insert = {}
+    if novas:
+        agora = datetime.now(timezone.utc).isoformat()
+        for arquivo, doc in novas:
+            doc["pdf_original"] = pdf_por_indice[arquivo["indice"]]
+            doc["updated_at"] = agora
+        try:
+            await db.purchase_orders.insert_many([doc for _, doc in novas], ordered=False)
+        except BulkWriteError as e:
+            falhas_insert = {err["index"]: err.get("errmsg", "Erro ao inserir") for err in e.details.get("writeErrors", [])}
+        await sincronizar_pos(doc["id"] for idx, (_, doc) in enumerate(novas) if idx not in falhas_insert)
+    
+    for idx, (arquivo, doc) in enumerate(novas):
+        if idx in falhas_insert:
+            resultados_por_indice[arquivo["indice"]] = {
+                "arquivo": arquivo["filename"],
+                "numero_oc": doc["numero_oc"],
+                "success": False,
+                "erro": f"Erro ao criar nova OC: {falhas_insert[idx]}"
+            }
+            continue
+        resultados_por_indice[arquivo["indice"]] = {
+            "arquivo": arquivo["filename"],
+            "numero_oc": doc["numero_oc"],
+            "success": True,
+            "campos_atualizados": ["NOVA OC CRIADA", f"{len(doc['items'])} itens", "pdf_original"],
+            "itens_atualizados": len(doc["items"]),
+            "nova_oc": True
+        }
+    
+    # OCs existentes: um bulk_write com updates atômicos por item (versao_item)
+    aplicados = await salvar_itens_em_lote([
+        (existing_po["id"], itens_antes, itens_depois, {**campos_oc, "pdf_original": pdf_por_indice[arquivo["indice"]]})
+        for arquivo, existing_po, itens_antes, itens_depois, campos_oc, _, _ in atualizacoes
+    ])
+    
+    for (arquivo, existing_po, _, _, _, campos_atualizados, itens_atualizados), aplicado in zip(atualizacoes, aplicados):
+        if not aplicado:
+            resultados_por_indice[arquivo["indice"]] = {
+                "arquivo": arquivo["filename"],
+                "numero_oc": existing_po["numero_oc"],
+                "success": False,
+                "erro": "A OC foi alterada por outro usuário durante a atualização. Envie o PDF novamente."
+            }
+            continue
+        resultados_por_indice[arquivo["indice"]] = {
+            "arquivo": arquivo["filename"],
+            "numero_oc": existing_po["numero_oc"],
             "success": True,
             "campos_atualizados": campos_atualizados,
             "itens_com_preco_atualizado": itens_atualizados,
             "message": f"Atualizado: {', '.join(campos_atualizados)}" if campos_atualizados else "Sem alterações necessárias"
-        })
+        }
+    
+    resultados = [resultados_por_indice[i] for i in sorted(resultados_por_indice)]
     
     atualizados = sum(1 for r in resultados if r.get('success') and r.get('campos_atualizados'))
     sem_alteracao = sum(1 for r in resultados if r.get('success') and not r.get('campos_atualizados'))
     erros = sum(1 for r in resultados if not r.get('success'))
     total_precos = sum(r.get('itens_com_preco_atualizado', 0) for r in resultados if r.get('success'))
     
-    return {
+    yield evento_resultado({
         "success": True,
-        "total_arquivos": len(files),
+        "total_arquivos": total,
         "atualizados": atualizados,
         "sem_alteracao": sem_alteracao,
         "erros": erros,
         "total_precos_atualizados": total_precos,
         "resultados": resultados
-    }
+    })
 
 
 @api_router.post("/admin/migrar-enderecos")
@@ -8507,7 +8081,7 @@ async def migrar_enderecos_itens_para_oc(current_user: dict = Depends(require_ad
             try:
                 await db.purchase_orders.update_one(
                     {"id": po['id']},
-                    {"$set": {"endereco_entrega": endereco}}
+                    {"$set": {"endereco_entrega": endereco, "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
                 migrados += 1
             except Exception as e:
@@ -8521,19 +8095,69 @@ async def migrar_enderecos_itens_para_oc(current_user: dict = Depends(require_ad
     }
 
 
+@api_router.post("/admin/migrar-arquivos-gridfs")
+async def migrar_arquivos_gridfs(
+    remover_orfaos: bool = False,
+    current_user: dict = Depends(require_admin)
+):
+    """
+    Migrar PDFs de OC, NFs e imagens de itens (base64 nos documentos) para o GridFS.
+    Idempotente - pode ser executado novamente para migrar o que faltou.
+    Com remover_orfaos=true, também apaga arquivos do GridFS que ninguém referencia.
+    """
+    stats = await migrar_blobs_legados()
+    if remover_orfaos:
+        stats["orfaos_removidos"] = await remover_blobs_orfaos()
+
+    return {"success": True, **stats}
+
+
+@api_router.post("/admin/po-items/reconstruir")
+async def reconstruir_read_model_itens(current_user: dict = Depends(require_admin)):
+    """
+    Reconstrói a coleção po_items (read-model de itens) a partir de todas as OCs.
+    Executado em background - acompanhar por GET /jobs/{job_id}.
+    """
+    job = await enfileirar_job("reconstruir_po_items", criado_por=current_user.get('sub'))
+    return resposta_job_enfileirado(job, "Reconstrução de po_items iniciada")
+
+
+@registrar_job("reconstruir_po_items")
+async def _job_reconstruir_po_items(params: dict, ctx: JobContext) -> dict:
+    """Job de /admin/po-items/reconstruir (também disparado no startup e após restaurar backup)"""
+    async def progresso(processadas, total):
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(processadas, total)
+    
+    return await reconstruir_po_items(progresso)
+
+
 @api_router.post("/admin/recalcular-lucros")
 async def recalcular_lucros_todos_itens(current_user: dict = Depends(require_admin)):
     """
     Endpoint de migração para recalcular o lucro de todos os itens.
     Usa a nova fórmula que considera apenas a quantidade necessária, não a quantidade comprada.
+    Executado em background - acompanhar por GET /jobs/{job_id}.
     """
-    pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(5000)
+    job = await enfileirar_job("recalcular_lucros", criado_por=current_user.get('sub'))
+    return resposta_job_enfileirado(job, "Recálculo de lucros iniciado")
+
+
+@registrar_job("recalcular_lucros")
+async def _job_recalcular_lucros(params: dict, ctx: JobContext) -> dict:
+    """Job de /admin/recalcular-lucros"""
+    total = await db.purchase_orders.count_documents({})
     
     itens_recalculados = 0
     ocs_atualizadas = 0
+    processados = 0
     
-    for po in pos:
+    async for po in db.purchase_orders.find({}, {"_id": 0, "id": 1, "items": 1}):
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(processados, total)
+        processados += 1
         items_modified = False
+        itens_antes = snapshot_itens(po.get('items', []))
         for item in po.get('items', []):
             old_lucro = item.get('lucro_liquido')
             calcular_lucro_item(item)
@@ -8544,10 +8168,7 @@ async def recalcular_lucros_todos_itens(current_user: dict = Depends(require_adm
                 items_modified = True
         
         if items_modified:
-            await db.purchase_orders.update_one(
-                {"id": po['id']},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po['id'], itens_antes, po['items'], levantar_conflito=False)
             ocs_atualizadas += 1
     
     return {
@@ -8569,17 +8190,27 @@ async def reprocessar_itens_com_planilha(
     
     Se numero_oc for especificado, processa apenas essa OC.
     Caso contrário, processa TODAS as OCs.
+    Executado em background - acompanhar por GET /jobs/{job_id}.
     """
+    job = await enfileirar_job(
+        "reprocessar_itens_planilha",
+        {"numero_oc": numero_oc},
+        criado_por=current_user.get('sub')
+    )
+    return resposta_job_enfileirado(job, "Reprocessamento de itens iniciado")
+
+
+@registrar_job("reprocessar_itens_planilha")
+async def _job_reprocessar_itens_planilha(params: dict, ctx: JobContext) -> dict:
+    """Job de /admin/reprocessar-itens-planilha"""
     import random
     
     query = {}
-    if numero_oc:
-        query["numero_oc"] = numero_oc
-    
-    # Buscar OCs
-    pos = await db.purchase_orders.find(query, {"_id": 0}).to_list(5000)
+    if params.get("numero_oc"):
+        query["numero_oc"] = params["numero_oc"]
     
-    if not pos:
+    total = await db.purchase_orders.count_documents(query)
+    if not total:
         return {"success": False, "message": "Nenhuma OC encontrada"}
     
     # Buscar todos os itens de referência
@@ -8597,9 +8228,14 @@ async def reprocessar_itens_com_planilha(
     ocs_atualizadas = 0
     itens_atualizados = 0
     itens_nao_encontrados = []
+    processados = 0
     
-    for po in pos:
+    async for po in db.purchase_orders.find(query, {"_id": 0, "id": 1, "items": 1}):
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(processados, total)
+        processados += 1
         items_modified = False
+        itens_antes = snapshot_itens(po.get("items", []))
         
         for item in po.get("items", []):
             codigo = item.get("codigo_item", "")
@@ -8662,15 +8298,12 @@ async def reprocessar_itens_com_planilha(
                 itens_atualizados += 1
         
         if items_modified:
-            await db.purchase_orders.update_one(
-                {"id": po["id"]},
-                {"$set": {"items": po["items"]}}
-            )
+            await salvar_itens(po["id"], itens_antes, po["items"], levantar_conflito=False)
             ocs_atualizadas += 1
     
     return {
         "success": True,
-        "ocs_processadas": len(pos),
+        "ocs_processadas": processados,
         "ocs_atualizadas": ocs_atualizadas,
         "itens_atualizados": itens_atualizados,
         "itens_nao_encontrados_na_planilha": itens_nao_encontrados[:50]  # Limitar para não sobrecarregar resposta
@@ -8686,31 +8319,52 @@ async def atualizar_ncm_em_massa(
     Atualizar o NCM de todos os itens a partir dos PDFs das OCs.
     Cada PDF será parseado para extrair os NCMs dos itens.
     Os itens são atualizados pelo código_item.
+    Os PDFs são guardados no GridFS e processados em background -
+    acompanhar por GET /jobs/{job_id}.
     """
-    
-    resultados = []
-    total_ncm_atualizados = 0
-    
+    arquivos = []
+    rejeitados = []
     for file in files:
         if not file.filename.lower().endswith('.pdf'):
-            resultados.append({
+            rejeitados.append({
                 "arquivo": file.filename,
                 "success": False,
                 "erro": "Arquivo não é PDF"
             })
             continue
-        
-        content = await file.read()
+        blob = await salvar_blob(await file.read(), file.filename, "application/pdf")
+        arquivos.append({"filename": file.filename, **blob})
+    
+    job = await enfileirar_job(
+        "atualizar_ncm_em_massa",
+        {"arquivos": arquivos, "rejeitados": rejeitados},
+        criado_por=current_user.get('sub')
+    )
+    return resposta_job_enfileirado(job, f"Atualização de NCM iniciada ({len(arquivos)} PDF(s))")
+
+
+@registrar_job("atualizar_ncm_em_massa")
+async def _job_atualizar_ncm_em_massa(params: dict, ctx: JobContext) -> dict:
+    """
+    Job de /admin/atualizar-ncm-em-massa.
+    Os blobs dos PDFs ficam sem referência ao final e são recolhidos por
+    remover_blobs_orfaos().
+    """
+    resultados = list(params.get("rejeitados", []))
+    total_ncm_atualizados = 0
+    arquivos = params.get("arquivos", [])
+    
+    for indice, arquivo in enumerate(arquivos):
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(indice, len(arquivos), mensagem=arquivo["filename"])
+        nome_arquivo = arquivo["filename"]
         
         try:
-            pdf_doc = fitz.open(stream=content, filetype="pdf")
-            full_text = ""
-            for page in pdf_doc:
-                full_text += page.get_text()
-            pdf_doc.close()
+            content = await ler_conteudo(arquivo, 'data')
+            full_text = await extrair_texto(content)
         except Exception as e:
             resultados.append({
-                "arquivo": file.filename,
+                "arquivo": nome_arquivo,
                 "success": False,
                 "erro": f"Erro ao ler PDF: {str(e)}"
             })
@@ -8732,7 +8386,7 @@ async def atualizar_ncm_em_massa(
         
         if not numero_oc:
             resultados.append({
-                "arquivo": file.filename,
+                "arquivo": nome_arquivo,
                 "success": False,
                 "erro": "Não foi possível identificar o número da OC no PDF"
             })
@@ -8776,7 +8430,7 @@ async def atualizar_ncm_em_massa(
         
         if not ncm_por_item:
             resultados.append({
-                "arquivo": file.filename,
+                "arquivo": nome_arquivo,
                 "numero_oc": numero_oc,
                 "success": False,
                 "erro": "Nenhum NCM encontrado no PDF"
@@ -8787,7 +8441,7 @@ async def atualizar_ncm_em_massa(
         existing_po = await db.purchase_orders.find_one({"numero_oc": numero_oc}, {"_id": 0})
         if not existing_po:
             resultados.append({
-                "arquivo": file.filename,
+                "arquivo": nome_arquivo,
                 "numero_oc": numero_oc,
                 "success": False,
                 "erro": f"OC {numero_oc} não encontrada no sistema"
@@ -8795,6 +8449,7 @@ async def atualizar_ncm_em_massa(
             continue
         
         # Atualizar NCMs nos itens
+        itens_antes = snapshot_itens(existing_po.get('items', []))
         items_atualizados = 0
         for item in existing_po.get('items', []):
             codigo_item = item.get('codigo_item', '')
@@ -8807,14 +8462,11 @@ async def atualizar_ncm_em_massa(
                     items_atualizados += 1
         
         if items_atualizados > 0:
-            await db.purchase_orders.update_one(
-                {"id": existing_po['id']},
-                {"$set": {"items": existing_po['items']}}
-            )
+            await salvar_itens(existing_po['id'], itens_antes, existing_po['items'], levantar_conflito=False)
             total_ncm_atualizados += items_atualizados
         
         resultados.append({
-            "arquivo": file.filename,
+            "arquivo": nome_arquivo,
             "numero_oc": numero_oc,
             "success": True,
             "ncm_encontrados": len(ncm_por_item),
@@ -8824,7 +8476,7 @@ async def atualizar_ncm_em_massa(
     
     return {
         "success": True,
-        "total_arquivos": len(files),
+        "total_arquivos": len(arquivos) + len(params.get("rejeitados", [])),
         "total_ncm_atualizados": total_ncm_atualizados,
         "resultados": resultados
     }
@@ -8864,6 +8516,7 @@ async def ajustar_estoque(
     if item_index < 0 or item_index >= len(po.get('items', [])):
         raise HTTPException(status_code=400, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     
     # Atualizar quantidade comprada
@@ -8875,10 +8528,7 @@ async def ajustar_estoque(
         fontes[0]['quantidade'] = nova_qtd
     
     # Salvar
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {
         "success": True,
@@ -8904,6 +8554,7 @@ async def limpar_estoque(
     if item_index < 0 or item_index >= len(po.get('items', [])):
         raise HTTPException(status_code=400, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     quantidade_necessaria = item.get('quantidade', 0)
     
@@ -8920,10 +8571,7 @@ async def limpar_estoque(
         item['fontes_compra'] = [fontes[0]]
     
     # Salvar
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {
         "success": True,
@@ -8949,6 +8597,7 @@ async def resetar_uso_estoque(
     if item_index < 0 or item_index >= len(po.get('items', [])):
         raise HTTPException(status_code=400, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     
     # Resetar campos de uso
@@ -8956,10 +8605,7 @@ async def resetar_uso_estoque(
     item['estoque_usado_em'] = []
     
     # Salvar
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {
         "success": True,
@@ -8976,14 +8622,31 @@ async def limpar_dados_estoque_inconsistentes(
     mas ainda têm dados de uso de estoque (atendido_por_estoque, estoque_origem, etc).
     
     Esta é uma operação de migração/correção para dados legados.
+    Executado em background - acompanhar por GET /jobs/{job_id}.
     """
-    pos = await db.purchase_orders.find({}, {"_id": 0}).to_list(5000)
+    job = await enfileirar_job("limpar_dados_estoque_inconsistentes", criado_por=current_user.get('sub'))
+    return resposta_job_enfileirado(job, "Limpeza de dados de estoque iniciada")
+
+
+@registrar_job("limpar_dados_estoque_inconsistentes")
+async def _job_limpar_dados_estoque_inconsistentes(params: dict, ctx: JobContext) -> dict:
+    """Job de /admin/limpar-dados-estoque-inconsistentes"""
+    status_antes_compra = ['pendente', 'cotado']
+    filtro = {"$or": [
+        {"items.status": {"$in": status_antes_compra}},
+        {"items": {"$elemMatch": {"status": {"$exists": False}}}}  # sem status = pendente
+    ]}
+    total = await db.purchase_orders.count_documents(filtro)
     
     itens_corrigidos = []
-    status_antes_compra = ['pendente', 'cotado']
+    processados = 0
     
-    for po in pos:
+    async for po in db.purchase_orders.find(filtro, {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}):
+        await ctx.verificar_cancelamento()
+        await ctx.progresso(processados, total)
+        processados += 1
         po_modificado = False
+        itens_antes = snapshot_itens(po.get('items', []))
         
         for idx, item in enumerate(po.get('items', [])):
             status = item.get('status', 'pendente')
@@ -9019,6 +8682,7 @@ async def limpar_dados_estoque_inconsistentes(
                         if not po_origem:
                             continue
                         
+                        itens_origem_antes = snapshot_itens(po_origem.get('items', []))
                         codigo_item = item.get('codigo_item')
                         
                         for item_origem in po_origem.get('items', []):
@@ -9039,10 +8703,7 @@ async def limpar_dados_estoque_inconsistentes(
                             break
                         
                         # Salvar OC de origem
-                        await db.purchase_orders.update_one(
-                            {"id": po_origem['id']},
-                            {"$set": {"items": po_origem['items']}}
-                        )
+                        await salvar_itens(po_origem['id'], itens_origem_antes, po_origem['items'], levantar_conflito=False)
                     
                     item['estoque_origem'] = []
                     teve_correcao = True
@@ -9075,10 +8736,7 @@ async def limpar_dados_estoque_inconsistentes(
                     po_modificado = True
         
         if po_modificado:
-            await db.purchase_orders.update_one(
-                {"id": po['id']},
-                {"$set": {"items": po['items']}}
-            )
+            await salvar_itens(po['id'], itens_antes, po['items'], levantar_conflito=False)
     
     return {
         "success": True,
@@ -9091,6 +8749,41 @@ async def limpar_dados_estoque_inconsistentes(
 
 
 # ============== PLANILHA DE ITENS CONSOLIDADA ==============
+# Campos de po_items usados pelas planilhas consolidadas
+PROJECAO_PLANILHA = {
+    "_id": 0, "po_id": 1, "numero_oc": 1, "codigo_item": 1, "descricao": 1, "unidade": 1,
+    "imagem_url": 1, "quantidade": 1, "status": 1, "lote": 1, "responsavel": 1, "marca_modelo": 1,
+    "preco_compra": 1, "fonte_compra": 1, "quantidade_comprada": 1, "data_compra": 1,
+}
+STATUS_COMPRADO_OU_ADIANTE = ['comprado', 'em_separacao', 'em_transito', 'entregue']
+
+
+async def _linhas_planilha() -> List[dict]:
+    """Itens com código de todas as OCs, lidos do read-model po_items (sem carregar as OCs)"""
+    return await db[PO_ITEMS].find(
+        {"codigo_item": {"$nin": [None, ""]}}, PROJECAO_PLANILHA
+    ).sort([("po_id", 1), ("item_index", 1)]).to_list(None)
+
+
+def _ocorrencia_planilha(linha: dict) -> dict:
+    """Ocorrência de um item numa OC, como exibida nas planilhas"""
+    status = linha.get('status') or 'pendente'
+    fonte = linha.get('fonte_compra')
+    return {
+        'numero_oc': linha.get('numero_oc'),
+        'po_id': linha.get('po_id'),
+        'lote': linha.get('lote') or '',
+        'responsavel': linha.get('responsavel') or '',
+        'marca_modelo': linha.get('marca_modelo') or '',
+        'preco_unitario': fonte.get('preco_unitario', 0) if fonte is not None else (linha.get('preco_compra') or 0),
+        'quantidade': linha.get('quantidade') or 0,
+        'status': status,
+        'ja_comprado': status in STATUS_COMPRADO_OU_ADIANTE,
+        'quantidade_comprada': linha.get('quantidade_comprada'),
+        'data_compra': linha.get('data_compra')
+    }
+
+
 @api_router.get("/planilha-itens")
 async def listar_planilha_itens(current_user: dict = Depends(get_current_user)):
     """
@@ -9102,71 +8795,42 @@ async def listar_planilha_itens(current_user: dict = Depends(get_current_user)):
     - Detalhes de cada ocorrência (lote, responsável, valor, OC)
     """
     
-    # Buscar todos os itens de todas as OCs
-    pos = await db.purchase_orders.find(
-        {},
-        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
-    ).to_list(5000)
-    
     # Mapa: codigo_item -> {info consolidada}
     itens_map = {}
-    status_comprado_ou_adiante = ['comprado', 'em_separacao', 'em_transito', 'entregue']
     
-    for po in pos:
-        for idx, item in enumerate(po.get('items', [])):
-            codigo_item = item.get('codigo_item', '')
-            if not codigo_item:
-                continue
-            
-            quantidade = item.get('quantidade', 0)
-            status = item.get('status', 'pendente')
-            ja_comprado = status in status_comprado_ou_adiante
-            
-            # Pegar info das fontes de compra
-            fontes = item.get('fontes_compra', [])
-            preco_unitario = fontes[0].get('preco_unitario', 0) if fontes else item.get('preco_compra', 0)
-            
-            ocorrencia = {
-                'numero_oc': po.get('numero_oc'),
-                'po_id': po.get('id'),
-                'lote': item.get('lote', ''),
-                'responsavel': item.get('responsavel', ''),
-                'marca_modelo': item.get('marca_modelo', ''),
-                'preco_unitario': preco_unitario,
-                'quantidade': quantidade,
-                'status': status,
-                'ja_comprado': ja_comprado,
-                'quantidade_comprada': item.get('quantidade_comprada'),
-                'data_compra': item.get('data_compra')
+    for item in await _linhas_planilha():
+        codigo_item = item['codigo_item']
+        quantidade = item.get('quantidade') or 0
+        ocorrencia = _ocorrencia_planilha(item)
+        ja_comprado = ocorrencia['ja_comprado']
+        
+        if codigo_item not in itens_map:
+            itens_map[codigo_item] = {
+                'codigo_item': codigo_item,
+                'descricao': item.get('descricao') or '',
+                'unidade': item.get('unidade') or 'UN',
+                'imagem_url': item.get('imagem_url'),  # URL da imagem
+                'quantidade_total_necessaria': quantidade,
+                'quantidade_total_comprada': quantidade if ja_comprado else 0,
+                'quantidade_faltante': 0 if ja_comprado else quantidade,
+                'ocorrencias': [ocorrencia],
+                'lotes_unicos': set([ocorrencia['lote']]),
+                'responsaveis_unicos': set([ocorrencia['responsavel']]),
+                'marcas_unicas': set([ocorrencia['marca_modelo']])
             }
-            
-            if codigo_item not in itens_map:
-                itens_map[codigo_item] = {
-                    'codigo_item': codigo_item,
-                    'descricao': item.get('descricao', ''),
-                    'unidade': item.get('unidade', 'UN'),
-                    'imagem_url': item.get('imagem_url'),  # URL da imagem
-                    'quantidade_total_necessaria': quantidade,
-                    'quantidade_total_comprada': quantidade if ja_comprado else 0,
-                    'quantidade_faltante': 0 if ja_comprado else quantidade,
-                    'ocorrencias': [ocorrencia],
-                    'lotes_unicos': set([item.get('lote', '')]),
-                    'responsaveis_unicos': set([item.get('responsavel', '')]),
-                    'marcas_unicas': set([item.get('marca_modelo', '')])
-                }
+        else:
+            itens_map[codigo_item]['quantidade_total_necessaria'] += quantidade
+            if ja_comprado:
+                itens_map[codigo_item]['quantidade_total_comprada'] += quantidade
             else:
-                itens_map[codigo_item]['quantidade_total_necessaria'] += quantidade
-                if ja_comprado:
-                    itens_map[codigo_item]['quantidade_total_comprada'] += quantidade
-                else:
-                    itens_map[codigo_item]['quantidade_faltante'] += quantidade
-                itens_map[codigo_item]['ocorrencias'].append(ocorrencia)
-                itens_map[codigo_item]['lotes_unicos'].add(item.get('lote', ''))
-                itens_map[codigo_item]['responsaveis_unicos'].add(item.get('responsavel', ''))
-                itens_map[codigo_item]['marcas_unicas'].add(item.get('marca_modelo', ''))
-                # Atualizar imagem_url se não tiver
-                if not itens_map[codigo_item].get('imagem_url') and item.get('imagem_url'):
-                    itens_map[codigo_item]['imagem_url'] = item.get('imagem_url')
+                itens_map[codigo_item]['quantidade_faltante'] += quantidade
+            itens_map[codigo_item]['ocorrencias'].append(ocorrencia)
+            itens_map[codigo_item]['lotes_unicos'].add(ocorrencia['lote'])
+            itens_map[codigo_item]['responsaveis_unicos'].add(ocorrencia['responsavel'])
+            itens_map[codigo_item]['marcas_unicas'].add(ocorrencia['marca_modelo'])
+            # Atualizar imagem_url se não tiver
+            if not itens_map[codigo_item].get('imagem_url') and item.get('imagem_url'):
+                itens_map[codigo_item]['imagem_url'] = item.get('imagem_url')
     
     # Converter sets para listas e calcular estatísticas
     resultado = []
@@ -9229,71 +8893,45 @@ async def listar_planilha_contrato(current_user: dict = Depends(get_current_user
     # Criar mapa de limites: codigo_item -> quantidade_maxima_contrato
     limites_map = {item['codigo_item']: item['quantidade_maxima_contrato'] for item in limites_list}
     
-    # Buscar todos os itens de todas as OCs
-    pos = await db.purchase_orders.find(
-        {},
-        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
-    ).to_list(5000)
-    
     # Mapa: codigo_item -> {info consolidada das OCs}
     ocs_map = {}
-    status_comprado_ou_adiante = ['comprado', 'em_separacao', 'em_transito', 'entregue']
     
-    for po in pos:
-        for idx, item in enumerate(po.get('items', [])):
-            codigo_item = item.get('codigo_item', '')
-            if not codigo_item:
-                continue
-            
-            quantidade = item.get('quantidade', 0)
-            status = item.get('status', 'pendente')
-            ja_comprado = status in status_comprado_ou_adiante
-            
-            # Considerar quantidade_comprada se disponível (pode ser maior que quantidade necessária)
-            quantidade_efetivamente_comprada = item.get('quantidade_comprada', quantidade) if ja_comprado else 0
-            
-            # Pegar info das fontes de compra
-            fontes = item.get('fontes_compra', [])
-            preco_unitario = fontes[0].get('preco_unitario', 0) if fontes else item.get('preco_compra', 0)
-            
-            ocorrencia = {
-                'numero_oc': po.get('numero_oc'),
-                'po_id': po.get('id'),
-                'lote': item.get('lote', ''),
-                'responsavel': item.get('responsavel', ''),
-                'marca_modelo': item.get('marca_modelo', ''),
-                'preco_unitario': preco_unitario,
-                'quantidade': quantidade,
-                'status': status,
-                'ja_comprado': ja_comprado,
-                'quantidade_comprada': item.get('quantidade_comprada'),
-                'data_compra': item.get('data_compra')
+    for item in await _linhas_planilha():
+        codigo_item = item['codigo_item']
+        quantidade = item.get('quantidade') or 0
+        ocorrencia = _ocorrencia_planilha(item)
+        ja_comprado = ocorrencia['ja_comprado']
+        
+        # Considerar quantidade_comprada se disponível (pode ser maior que quantidade necessária)
+        quantidade_comprada_item = item.get('quantidade_comprada')
+        quantidade_efetivamente_comprada = (
+            quantidade if quantidade_comprada_item is None else quantidade_comprada_item
+        ) if ja_comprado else 0
+        
+        if codigo_item not in ocs_map:
+            ocs_map[codigo_item] = {
+                'descricao': item.get('descricao') or '',
+                'unidade': item.get('unidade') or 'UN',
+                'imagem_url': item.get('imagem_url'),
+                'quantidade_nas_ocs': quantidade,
+                'quantidade_comprada': quantidade_efetivamente_comprada,
+                'ocorrencias': [ocorrencia],
+                'lotes_unicos': set([ocorrencia['lote']]),
+                'responsaveis_unicos': set([ocorrencia['responsavel']]),
+                'marcas_unicas': set([ocorrencia['marca_modelo']])
             }
-            
-            if codigo_item not in ocs_map:
-                ocs_map[codigo_item] = {
-                    'descricao': item.get('descricao', ''),
-                    'unidade': item.get('unidade', 'UN'),
-                    'imagem_url': item.get('imagem_url'),
-                    'quantidade_nas_ocs': quantidade,
-                    'quantidade_comprada': quantidade_efetivamente_comprada,
-                    'ocorrencias': [ocorrencia],
-                    'lotes_unicos': set([item.get('lote', '')]),
-                    'responsaveis_unicos': set([item.get('responsavel', '')]),
-                    'marcas_unicas': set([item.get('marca_modelo', '')])
-                }
-            else:
-                ocs_map[codigo_item]['quantidade_nas_ocs'] += quantidade
-                ocs_map[codigo_item]['quantidade_comprada'] += quantidade_efetivamente_comprada
-                ocs_map[codigo_item]['ocorrencias'].append(ocorrencia)
-                ocs_map[codigo_item]['lotes_unicos'].add(item.get('lote', ''))
-                ocs_map[codigo_item]['responsaveis_unicos'].add(item.get('responsavel', ''))
-                ocs_map[codigo_item]['marcas_unicas'].add(item.get('marca_modelo', ''))
-                # Atualizar imagem_url e descrição se não tiver
-                if not ocs_map[codigo_item].get('imagem_url') and item.get('imagem_url'):
-                    ocs_map[codigo_item]['imagem_url'] = item.get('imagem_url')
-                if not ocs_map[codigo_item].get('descricao') and item.get('descricao'):
-                    ocs_map[codigo_item]['descricao'] = item.get('descricao')
+        else:
+            ocs_map[codigo_item]['quantidade_nas_ocs'] += quantidade
+            ocs_map[codigo_item]['quantidade_comprada'] += quantidade_efetivamente_comprada
+            ocs_map[codigo_item]['ocorrencias'].append(ocorrencia)
+            ocs_map[codigo_item]['lotes_unicos'].add(ocorrencia['lote'])
+            ocs_map[codigo_item]['responsaveis_unicos'].add(ocorrencia['responsavel'])
+            ocs_map[codigo_item]['marcas_unicas'].add(ocorrencia['marca_modelo'])
+            # Atualizar imagem_url e descrição se não tiver
+            if not ocs_map[codigo_item].get('imagem_url') and item.get('imagem_url'):
+                ocs_map[codigo_item]['imagem_url'] = item.get('imagem_url')
+            if not ocs_map[codigo_item].get('descricao') and item.get('descricao'):
+                ocs_map[codigo_item]['descricao'] = item.get('descricao')
     
     # Construir resultado final baseado nos limites do contrato
     resultado = []
@@ -9363,6 +9001,36 @@ async def listar_planilha_contrato(current_user: dict = Depends(get_current_user
 
 
 # ============== USAR ESTOQUE ==============
+async def _excedentes_estoque(codigo_item: str) -> List[dict]:
+    """
+    Itens de um código comprados a mais (fontes do estoque), lidos de po_items.
+    Cada linha volta com `excedente` > 0 já calculado.
+    """
+    linhas = db[PO_ITEMS].find(
+        {
+            "codigo_item": codigo_item,
+            "status": {"$in": STATUS_COMPRADO_OU_ADIANTE},
+            # IMPORTANTE: Itens que foram atendidos pelo estoque não geram excedente
+            "atendido_por_estoque": {"$ne": True},
+        },
+        {"_id": 0, "po_id": 1, "item_index": 1, "numero_oc": 1, "quantidade": 1,
+         "quantidade_comprada": 1, "quantidade_fontes": 1, "quantidade_usada_estoque": 1,
+         "fonte_compra": 1, "preco_compra": 1, "data_compra": 1}
+    ).sort([("po_id", 1), ("item_index", 1)])
+    
+    excedentes = []
+    async for linha in linhas:
+        # Calcular quantidade comprada: PRIORIZAR fontes_compra (mais preciso)
+        if linha.get('quantidade_fontes') is not None:
+            qtd_comprada = linha['quantidade_fontes']
+        else:
+            qtd_comprada = linha.get('quantidade_comprada') or 0
+        linha['excedente'] = qtd_comprada - (linha.get('quantidade') or 0) - (linha.get('quantidade_usada_estoque') or 0)
+        if linha['excedente'] > 0:
+            excedentes.append(linha)
+    return excedentes
+
+
 @api_router.post("/estoque/usar")
 async def usar_estoque(
     data: dict,
@@ -9399,6 +9067,7 @@ async def usar_estoque(
     if item_index < 0 or item_index >= len(po.get('items', [])):
         raise HTTPException(status_code=400, detail="Índice de item inválido")
     
+    item_antes = snapshot_itens([po['items'][item_index]])[0]
     item = po['items'][item_index]
     codigo_item = item.get('codigo_item')
     quantidade_necessaria = item.get('quantidade', 0)
@@ -9427,71 +9096,53 @@ async def usar_estoque(
     if quantidade_efetiva <= 0:
         raise HTTPException(status_code=400, detail="Este item já foi totalmente atendido ou não há quantidade faltante")
     
-    # Buscar informações do estoque (preço, OC de origem)
-    pos_com_estoque = await db.purchase_orders.find(
-        {"items.codigo_item": codigo_item},
-        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
-    ).to_list(1000)
+    # Encontrar as OCs que têm excedente deste item (po_items) e carregar só elas
+    excedentes = await _excedentes_estoque(codigo_item)
+    pos_com_estoque = {
+        po_origem['id']: po_origem
+        async for po_origem in db.purchase_orders.find(
+            {"id": {"$in": list({linha['po_id'] for linha in excedentes})}},
+            {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
+        )
+    }
     
-    # Encontrar as OCs que têm excedente deste item
     fontes_estoque = []
-    for po_origem in pos_com_estoque:
-        for idx, item_origem in enumerate(po_origem.get('items', [])):
-            if item_origem.get('codigo_item') != codigo_item:
-                continue
-            
-            status_origem = item_origem.get('status', 'pendente')
-            if status_origem not in ['comprado', 'em_separacao', 'em_transito', 'entregue']:
-                continue
-            
-            # IMPORTANTE: Itens que foram atendidos pelo estoque não geram excedente
-            if item_origem.get('atendido_por_estoque'):
-                continue
-            
-            # Calcular quantidade comprada: PRIORIZAR fontes_compra (mais preciso)
-            fontes = item_origem.get('fontes_compra', [])
-            if fontes:
-                qtd_comprada = sum(f.get('quantidade', 0) for f in fontes)
-            else:
-                qtd_comprada = item_origem.get('quantidade_comprada', 0)
-            
-            qtd_necessaria_origem = item_origem.get('quantidade', 0)
-            
-            # Já usado anteriormente
-            qtd_ja_usada = item_origem.get('quantidade_usada_estoque', 0)
-            
-            # Excedente disponível
-            excedente = qtd_comprada - qtd_necessaria_origem - qtd_ja_usada
-            
-            if excedente > 0:
-                # Pegar preço unitário
-                if fontes:
-                    preco_unitario = fontes[0].get('preco_unitario', 0)
-                    frete_unitario = fontes[0].get('frete', 0)
-                    link_compra = fontes[0].get('link', '')
-                    fornecedor = fontes[0].get('fornecedor', '')
-                else:
-                    preco_unitario = item_origem.get('preco_compra', 0)
-                    frete_unitario = item_origem.get('frete_compra', 0)
-                    link_compra = item_origem.get('link_compra', '')
-                    fornecedor = item_origem.get('fornecedor', '')
-                
-                # Capturar todos os dados do item original para copiar
-                fontes_estoque.append({
-                    'po_id': po_origem.get('id'),
-                    'numero_oc': po_origem.get('numero_oc'),
-                    'item_index': idx,
-                    'excedente_disponivel': excedente,
-                    'preco_unitario': preco_unitario,
-                    # Dados adicionais do item original
-                    'frete': frete_unitario,
-                    'link': link_compra,
-                    'fornecedor': fornecedor,
-                    'observacao': item_origem.get('observacao', ''),
-                    'imagem_url': item_origem.get('imagem_url', ''),
-                    'imagem_filename': item_origem.get('imagem_filename', ''),
-                    'marca_modelo': item_origem.get('marca_modelo', '')
-                })
+    for linha in excedentes:
+        po_origem = pos_com_estoque.get(linha['po_id'])
+        idx = linha['item_index']
+        if not po_origem or idx >= len(po_origem.get('items', [])):
+            continue
+        item_origem = po_origem['items'][idx]
+        
+        # Pegar preço unitário
+        fontes = item_origem.get('fontes_compra', [])
+        if fontes:
+            preco_unitario = fontes[0].get('preco_unitario', 0)
+            frete_unitario = fontes[0].get('frete', 0)
+            link_compra = fontes[0].get('link', '')
+            fornecedor = fontes[0].get('fornecedor', '')
+        else:
+            preco_unitario = item_origem.get('preco_compra', 0)
+            frete_unitario = item_origem.get('frete_compra', 0)
+            link_compra = item_origem.get('link_compra', '')
+            fornecedor = item_origem.get('fornecedor', '')
+        
+        # Capturar todos os dados do item original para copiar
+        fontes_estoque.append({
+            'po_id': po_origem.get('id'),
+            'numero_oc': po_origem.get('numero_oc'),
+            'item_index': idx,
+            'excedente_disponivel': linha['excedente'],
+            'preco_unitario': preco_unitario,
+            # Dados adicionais do item original
+            'frete': frete_unitario,
+            'link': link_compra,
+            'fornecedor': fornecedor,
+            'observacao': item_origem.get('observacao', ''),
+            'imagem_url': item_origem.get('imagem_url', ''),
+            'imagem_filename': item_origem.get('imagem_filename', ''),
+            'marca_modelo': item_origem.get('marca_modelo', '')
+        })
     
     if not fontes_estoque:
         raise HTTPException(status_code=400, detail="Estoque não encontrado")
@@ -9511,6 +9162,7 @@ async def usar_estoque(
         # Registrar uso na OC de origem
         po_origem = await db.purchase_orders.find_one({"id": fonte['po_id']}, {"_id": 0})
         if po_origem:
+            item_origem_antes = snapshot_itens([po_origem['items'][fonte['item_index']]])[0]
             item_origem = po_origem['items'][fonte['item_index']]
             qtd_ja_usada = item_origem.get('quantidade_usada_estoque', 0)
             item_origem['quantidade_usada_estoque'] = qtd_ja_usada + qtd_usar_desta_fonte
@@ -9525,10 +9177,7 @@ async def usar_estoque(
                 'data': datetime.now(timezone.utc).strftime('%Y-%m-%d')
             })
             
-            await db.purchase_orders.update_one(
-                {"id": fonte['po_id']},
-                {"$set": {"items": po_origem['items']}}
-            )
+            await salvar_item(fonte['po_id'], fonte['item_index'], item_origem_antes, item_origem, len(po_origem['items']))
         
         ocs_utilizadas.append({
             'numero_oc': fonte['numero_oc'],
@@ -9625,10 +9274,7 @@ async def usar_estoque(
         mensagem = f"Item parcialmente atendido pelo estoque ({total_usado} UN). Faltam {item['quantidade_faltante']} UN"
     
     # Salvar item destino
-    await db.purchase_orders.update_one(
-        {"id": po_id},
-        {"$set": {"items": po['items']}}
-    )
+    await salvar_item(po_id, item_index, item_antes, item, len(po['items']))
     
     return {
         "success": True,
@@ -9649,57 +9295,27 @@ async def get_estoque_detalhes(codigo_item: str, current_user: dict = Depends(ge
     Retorna detalhes do estoque disponível para um item específico.
     Usado no modal de "Usar do Estoque" para mostrar de onde vem e o preço.
     """
-    # Buscar todas as OCs com este item
-    pos = await db.purchase_orders.find(
-        {"items.codigo_item": codigo_item},
-        {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
-    ).to_list(1000)
-    
     fontes = []
     total_disponivel = 0
     
-    for po in pos:
-        for idx, item in enumerate(po.get('items', [])):
-            if item.get('codigo_item') != codigo_item:
-                continue
-            
-            status = item.get('status', 'pendente')
-            if status not in ['comprado', 'em_separacao', 'em_transito', 'entregue']:
-                continue
-            
-            # IMPORTANTE: Itens que foram atendidos pelo estoque não geram excedente
-            if item.get('atendido_por_estoque'):
-                continue
-            
-            # Calcular quantidade comprada: PRIORIZAR fontes_compra (mais preciso)
-            fontes_compra = item.get('fontes_compra', [])
-            if fontes_compra:
-                qtd_comprada = sum(f.get('quantidade', 0) for f in fontes_compra)
-            else:
-                qtd_comprada = item.get('quantidade_comprada', 0)
-            
-            qtd_necessaria = item.get('quantidade', 0)
-            qtd_ja_usada = item.get('quantidade_usada_estoque', 0)
-            
-            excedente = qtd_comprada - qtd_necessaria - qtd_ja_usada
-            
-            if excedente > 0:
-                # Pegar preço unitário
-                if fontes_compra:
-                    preco = fontes_compra[0].get('preco_unitario', 0)
-                    fornecedor = fontes_compra[0].get('fornecedor', '')
-                else:
-                    preco = item.get('preco_compra', 0)
-                    fornecedor = ''
-                
-                fontes.append({
-                    'numero_oc': po.get('numero_oc'),
-                    'quantidade_disponivel': excedente,
-                    'preco_unitario': preco,
-                    'fornecedor': fornecedor,
-                    'data_compra': item.get('data_compra')
-                })
-                total_disponivel += excedente
+    for item in await _excedentes_estoque(codigo_item):
+        # Pegar preço unitário
+        fonte_compra = item.get('fonte_compra')
+        if fonte_compra is not None:
+            preco = fonte_compra.get('preco_unitario', 0)
+            fornecedor = fonte_compra.get('fornecedor', '')
+        else:
+            preco = item.get('preco_compra') or 0
+            fornecedor = ''
+        
+        fontes.append({
+            'numero_oc': item.get('numero_oc'),
+            'quantidade_disponivel': item['excedente'],
+            'preco_unitario': preco,
+            'fornecedor': fornecedor,
+            'data_compra': item.get('data_compra')
+        })
+        total_disponivel += item['excedente']
     
     return {
         "codigo_item": codigo_item,
@@ -9708,6 +9324,14 @@ async def get_estoque_detalhes(codigo_item: str, current_user: dict = Depends(ge
     }
 
 
+async def reconciliar_contadores_agendado():
+    """Recalcula os contadores do dashboard a partir de po_items (corrige desvios dos incrementos)"""
+    try:
+        await reconciliar_contadores()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Erro ao reconciliar contadores do dashboard: {e}")
+
+
 @app.on_event("startup")
 async def startup_event():
     """Iniciar job de verificação de rastreios e criar índices no MongoDB"""
@@ -9733,28 +9357,80 @@ async def startup_event():
         await db.notifications.create_index("user_email")
         await db.notifications.create_index("created_at")
         
+        # Índice de deduplicação dos arquivos no GridFS
+        await criar_indices_blobs()
+        
+        # Cache de rastreamento (busca por código + TTL) e agenda de verificação
+        await criar_indices_cache_rastreio()
+        await criar_indices_agenda_rastreio()
+        
+        # Read-model de itens e histórico de cotações
+        await criar_indices_po_items()
+        await criar_indices_historico()
+        
+        # Marca d'água (updated_at) e histórico dos backups incrementais
+        await criar_indices_backup()
+        
+        # Cache de parsing: descarta resultados de versões antigas dos parsers
+        await criar_indices_parse_cache({**VERSOES_PARSING, "nf": VERSAO_ANALISE_NF})
+        
         logging.getLogger(__name__).info("Índices do MongoDB criados/verificados com sucesso")
     except Exception as e:
         logging.getLogger(__name__).warning(f"Erro ao criar índices: {e}")
     
-    # Agendar verificação de rastreios a cada hora (horário de Brasília)
-    # Executa no minuto 0 de cada hora: 00:00, 01:00, 02:00, ..., 23:00
+    # Verificação de rastreios a cada 15 minutos (horário de Brasília).
+    # Cada execução consulta apenas os códigos vencidos na agenda adaptativa.
     brasilia_tz = pytz.timezone('America/Sao_Paulo')
     scheduler.add_job(
         verificar_rastreios_agendado,
-        CronTrigger(minute=0, timezone=brasilia_tz),  # A cada hora cheia
+        CronTrigger(minute='*/15', timezone=brasilia_tz),
         id='verificar_rastreios_horario',
-        name='Verificação de rastreios a cada hora',
+        name='Verificação de rastreios (agenda adaptativa)',
+        replace_existing=True
+    )
+    # Reconciliação da agenda com as OCs: diária às 04:30 e logo no startup
+    scheduler.add_job(
+        sincronizar_agenda_rastreio,
+        CronTrigger(hour=4, minute=30, timezone=brasilia_tz),
+        id='sincronizar_agenda_rastreio',
+        name='Sincronização da agenda de rastreio',
+        next_run_time=datetime.now(brasilia_tz),
+        replace_existing=True
+    )
+    # Reconciliação dos contadores do dashboard com po_items: de hora em hora e no startup
+    scheduler.add_job(
+        reconciliar_contadores_agendado,
+        CronTrigger(minute=50, timezone=brasilia_tz),
+        id='reconciliar_contadores_dashboard',
+        name='Reconciliação dos contadores do dashboard',
+        next_run_time=datetime.now(brasilia_tz),
         replace_existing=True
     )
     scheduler.start()
-    logging.getLogger(__name__).info("Scheduler iniciado - Verificação de rastreios agendada para cada hora cheia (Brasília)")
+    logging.getLogger(__name__).info("Scheduler iniciado - Verificação de rastreios a cada 15 minutos (agenda adaptativa, Brasília)")
+    
+    # Workers da fila de jobs em background (services/job_service.py)
+    await iniciar_workers()
+    
+    # Primeira execução (ou coleção descartada): construir o read-model de itens
+    # e o histórico de cotações
+    try:
+        job_ativo = await db.jobs.find_one({
+            "tipo": "reconstruir_po_items", "status": {"$in": ["pendente", "executando"]}
+        })
+        if not job_ativo and (await po_items_precisa_reconstruir() or await historico_precisa_reconstruir()):
+            await enfileirar_job("reconstruir_po_items", criado_por="startup")
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"Erro ao verificar po_items: {e}")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Desligar o scheduler ao encerrar a aplicação"""
+    """Desligar o scheduler, os workers de jobs, o pool de parsing e o cliente HTTP dos Correios"""
     scheduler.shutdown()
+    await parar_workers()
+    encerrar_pool_parsing()
+    await fechar_cliente_correios()
 
 # Inicializar routers modulares com database e constantes
 init_admin_routes(db, LOT_ASSIGNMENTS, LOT_TO_OWNER, EXCLUDED_OCS_FROM_COMMISSION)
@@ -9774,6 +9450,7 @@ api_router.include_router(fornecedores_router)
 api_router.include_router(dashboard_router)
 api_router.include_router(estoque_router)
 api_router.include_router(limites_router)
+api_router.include_router(job_router)
 
 # Include the router in the main app
 app.include_router(api_router)
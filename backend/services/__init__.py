@@ -3,16 +3,94 @@ Services - Lógica de negócio do sistema FIEP OC
 """
 from .email_service import send_password_reset_email
 from .pdf_service import extract_oc_from_pdf
+from .oc_parser_service import extrair_dados_oc_texto, VERSAO_PARSER
+from .parsing_service import extrair_oc_pdf, extrair_texto
+from .parse_cache_service import obter_ou_calcular, estatisticas_parse_cache
+from .nf_service import analisar_nf_pdf, analisar_nf_xml
 from .estoque_service import (
     reverter_uso_estoque,
     atualizar_data_compra,
     calcular_lucro_item
 )
+from .item_patch_service import (
+    snapshot_itens,
+    salvar_itens,
+    salvar_item,
+    dividir_item
+)
+from .blob_service import (
+    salvar_blob,
+    ler_conteudo,
+    iterar_conteudo,
+    iterar_zip,
+    migrar_blobs_legados
+)
+from .imagem_service import (
+    gerar_variantes,
+    obter_variante,
+    responder_imagem,
+    resumo_imagens,
+    invalidar_cache_imagem,
+    estatisticas_cache_imagens
+)
+from .job_service import (
+    registrar_job,
+    enfileirar_job,
+    JobContext
+)
+from .dashboard_service import (
+    ler_contadores,
+    reconciliar_contadores
+)
+from .po_items_service import (
+    sincronizar_po,
+    sincronizar_pos,
+    reconstruir_po_items
+)
+from .busca_service import normalizar_texto, termos_indexados, termos_consulta, filtro_termos
+from .historico_cotacoes_service import buscar_historico, sincronizar_historico
 
 __all__ = [
     'send_password_reset_email',
     'extract_oc_from_pdf',
+    'extrair_dados_oc_texto',
+    'VERSAO_PARSER',
+    'extrair_oc_pdf',
+    'extrair_texto',
+    'obter_ou_calcular',
+    'estatisticas_parse_cache',
+    'analisar_nf_pdf',
+    'analisar_nf_xml',
     'reverter_uso_estoque',
     'atualizar_data_compra',
-    'calcular_lucro_item'
+    'calcular_lucro_item',
+    'snapshot_itens',
+    'salvar_itens',
+    'salvar_item',
+    'dividir_item',
+    'salvar_blob',
+    'ler_conteudo',
+    'iterar_conteudo',
+    'iterar_zip',
+    'migrar_blobs_legados',
+    'gerar_variantes',
+    'obter_variante',
+    'responder_imagem',
+    'resumo_imagens',
+    'invalidar_cache_imagem',
+    'estatisticas_cache_imagens',
+    'registrar_job',
+    'enfileirar_job',
+    'JobContext',
+    'ler_contadores',
+    'reconciliar_contadores',
+    'sincronizar_po',
+    'sincronizar_pos',
+    'reconstruir_po_items',
+    'normalizar_texto',
+    'termos_indexados',
+    'termos_consulta',
+    'filtro_termos',
+    'buscar_historico',
+    'sincronizar_historico'
 ]
@@ -0,0 +1,933 @@
+"""
+Backup em streaming (exportação e restauração)
+
+Os endpoints de backup carregavam cada coleção inteira com `.to_list(None)`,
+montavam um dict gigante e faziam um único `json.dumps` - várias vezes o
+tamanho do banco em RAM. Aqui os cursores são lidos em lotes e cada lote é
+serializado (e comprimido, se pedido) e enviado pela StreamingResponse,
+então a memória usada é limitada pelo tamanho do lote, não da coleção.
+
+Formatos:
+
+- json: o mesmo objeto de sempre, aceito pelo /backup/restore-data:
+      {"purchase_orders": [...], "users": [...], ..., "backup_info": {...}}
+  `backup_info` vai no final porque as estatísticas só são conhecidas depois
+  de percorrer os documentos.
+
+- ndjson: uma linha JSON por registro, para restauração incremental:
+      {"backup_info": {...}}                       cabeçalho
+      {"colecao": "purchase_orders", "doc": {...}} um por documento
+      {"backup_fim": {"estatisticas": {...}}}      rodapé (ausente = backup truncado)
+
+Compressão opcional em tempo real: gzip (zlib) ou zstd (pacote `zstandard`,
+opcional).
+
+A restauração (restaurar_backup) aceita os dois formatos, comprimidos ou não.
+
+Arquivos do GridFS (PDFs, NFs, imagens - services/blob_service.py) entram,
+quando pedidos, como a pseudo-coleção `_arquivos_gridfs`: um registro por
+chunk, em base64, com o blob_id original para que as referências dos
+documentos continuem válidas:
+      {"colecao": "_arquivos_gridfs", "doc": {"blob_id": "...", "parte": 0,
+       "filename": "...", "metadata": {...}, "dados": "<base64>", "fim": false}}
+Na restauração cada arquivo é regravado com o mesmo _id (os que já existem no
+bucket são mantidos).
+
+Backups incrementais (modo="incremental"): cada backup gerado é registrado em
+`backups_historico` com a sua marca d'água (início da exportação). O
+incremental seguinte exporta só as OCs com `updated_at` >= marca do anterior
+e as exclusões registradas desde então (`backup_exclusoes`); as coleções
+pequenas, sem carimbo de alteração, vão completas. Para restaurar, aplica-se
+o backup completo (base) e depois cada incremental, na ordem - a cadeia é
+conferida por `anterior_id`.
+"""
+import asyncio
+import codecs
+import json
+import logging
+import base64
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from pymongo import ReplaceOne
+
+from services.blob_service import BUCKET_NAME, abrir_gravacao_com_id, iterar_conteudo
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+FORMATOS = ("json", "ndjson")
+COMPRESSOES = ("nenhuma", "gzip", "zstd")
+MODOS = ("completo", "incremental")
+
+LOTE_DOCUMENTOS = 200  # documentos serializados por vez
+TAMANHO_BLOCO = 1024 * 1024  # bytes acumulados antes de enviar um pedaço
+
+_EXTENSOES = {"json": "json", "ndjson": "ndjson"}
+_MEDIA_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson"}
+_COMPRESSAO_EXTENSAO = {"gzip": ".gz", "zstd": ".zst"}
+_COMPRESSAO_MEDIA_TYPE = {"gzip": "application/gzip", "zstd": "application/zstd"}
+
+
+class ColecaoBackup(NamedTuple):
+    """
+    Coleção a exportar: filtro/projeção do find e transformação opcional por documento.
+    `documentos(filtro)` substitui o find quando os registros não vêm de uma coleção comum.
+    """
+    nome: str
+    filtro: dict = {}
+    projecao: dict = {"_id": 0}
+    transformar: Optional[Callable[[dict], dict]] = None
+    documentos: Optional[Callable[[dict], AsyncIterator[dict]]] = None
+    tamanho_lote: int = LOTE_DOCUMENTOS
+
+
+def validar_opcoes(formato: str, compressao: str) -> None:
+    if formato not in FORMATOS:
+        raise HTTPException(status_code=400, detail=f"Formato inválido. Use: {', '.join(FORMATOS)}")
+    if compressao not in COMPRESSOES:
+        raise HTTPException(status_code=400, detail=f"Compressão inválida. Use: {', '.join(COMPRESSOES)}")
+    if compressao == "zstd" and not ZSTD_AVAILABLE:
+        raise HTTPException(status_code=400, detail="Compressão zstd indisponível (pacote zstandard não instalado)")
+
+
+class _Compressor:
+    """Interface única para gzip/zstd/sem compressão"""
+
+    def __init__(self, compressao: str):
+        if compressao == "gzip":
+            self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: cabeçalho gzip
+        elif compressao == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            self._obj = None
+
+    def comprimir(self, dados: bytes) -> bytes:
+        return self._obj.compress(dados) if self._obj else dados
+
+    def finalizar(self) -> bytes:
+        return self._obj.flush() if self._obj else b""
+
+
+def _dumps(valor) -> str:
+    return json.dumps(valor, ensure_ascii=False, default=str, separators=(',', ':'))
+
+
+def _serializar_lote(nome: str, docs: List[dict], formato: str, primeiro: bool) -> bytes:
+    if formato == "ndjson":
+        return "".join(_dumps({"colecao": nome, "doc": d}) + "\n" for d in docs).encode("utf-8")
+    corpo = ",".join(_dumps(d) for d in docs)
+    return ((corpo if primeiro else "," + corpo) if corpo else "").encode("utf-8")
+
+
+async def gerar_backup(
+    colecoes: List[ColecaoBackup],
+    info: dict,
+    formato: str = "json",
+    compressao: str = "nenhuma",
+    observar: Optional[Callable[[str, dict], None]] = None,
+    estatisticas_extras: Optional[Callable[[], dict]] = None,
+    ao_concluir: Optional[Callable[[dict], Awaitable[None]]] = None
+) -> AsyncIterator[bytes]:
+    """
+    Gera o backup em pedaços de bytes.
+
+    Args:
+        colecoes: coleções a exportar, na ordem
+        info: conteúdo inicial de backup_info
+        observar: chamada para cada documento exportado (estatísticas)
+        estatisticas_extras: chamada no final; o retorno entra em backup_info["estatisticas"]
+        ao_concluir: chamada com as estatísticas depois do último pedaço
+            (não é chamada se o backup falhar ou o download for interrompido)
+    """
+    compressor = _Compressor(compressao)
+    buffer = bytearray()
+    totais: Dict[str, int] = {}
+
+    async def emitir(dados: bytes, forcar: bool = False):
+        buffer.extend(dados)
+        if len(buffer) >= TAMANHO_BLOCO or forcar:
+            pedaco = await asyncio.to_thread(compressor.comprimir, bytes(buffer))
+            buffer.clear()
+            return pedaco
+        return b""
+
+    if formato == "ndjson":
+        pedaco = await emitir((_dumps({"backup_info": {**info, "formato": "ndjson"}}) + "\n").encode("utf-8"))
+    else:
+        pedaco = await emitir(b"{")
+    if pedaco:
+        yield pedaco
+
+    try:
+        for i, colecao in enumerate(colecoes):
+            totais[colecao.nome] = 0
+            if formato == "json":
+                pedaco = await emitir(((", " if i else "") + _dumps(colecao.nome) + ":[").encode("utf-8"))
+                if pedaco:
+                    yield pedaco
+
+            lote = []
+            if colecao.documentos:
+                cursor = colecao.documentos(colecao.filtro)
+            else:
+                cursor = db[colecao.nome].find(colecao.filtro, colecao.projecao).batch_size(colecao.tamanho_lote)
+            async for doc in cursor:
+                if colecao.transformar:
+                    doc = colecao.transformar(doc)
+                if observar:
+                    observar(colecao.nome, doc)
+                lote.append(doc)
+                if len(lote) >= colecao.tamanho_lote:
+                    dados = await asyncio.to_thread(_serializar_lote, colecao.nome, lote, formato, totais[colecao.nome] == 0)
+                    totais[colecao.nome] += len(lote)
+                    lote = []
+                    pedaco = await emitir(dados)
+                    if pedaco:
+                        yield pedaco
+            if lote:
+                dados = await asyncio.to_thread(_serializar_lote, colecao.nome, lote, formato, totais[colecao.nome] == 0)
+                totais[colecao.nome] += len(lote)
+                pedaco = await emitir(dados)
+                if pedaco:
+                    yield pedaco
+
+            if formato == "json":
+                pedaco = await emitir(b"]")
+                if pedaco:
+                    yield pedaco
+    except Exception as e:
+        # O status HTTP já foi enviado: sinalizar no próprio arquivo. No JSON o
+        # documento fica inválido (truncado); no NDJSON falta o rodapé.
+        logger.error(f"Erro ao gerar backup: {e}")
+        if formato == "ndjson":
+            yield await emitir((_dumps({"backup_erro": str(e)}) + "\n").encode("utf-8"), forcar=True)
+        else:
+            yield await emitir(b"", forcar=True)
+        yield await asyncio.to_thread(compressor.finalizar)
+        return
+
+    estatisticas = {f"total_{nome}": total for nome, total in totais.items()}
+    if estatisticas_extras:
+        estatisticas.update(estatisticas_extras())
+
+    if formato == "ndjson":
+        final = _dumps({"backup_fim": {"estatisticas": estatisticas, "data_fim": datetime.now().isoformat()}}) + "\n"
+    else:
+        backup_info = {**info, "estatisticas": {**info.get("estatisticas", {}), **estatisticas}}
+        final = ("," if colecoes else "") + _dumps("backup_info") + ":" + _dumps(backup_info) + "}"
+    yield await emitir(final.encode("utf-8"), forcar=True)
+    yield await asyncio.to_thread(compressor.finalizar)
+    logger.info(f"Backup gerado: {sum(totais.values())} documentos de {len(totais)} coleções")
+    if ao_concluir:
+        await ao_concluir(estatisticas)
+
+
+def resposta_backup(gerador: AsyncIterator[bytes], nome_base: str, formato: str, compressao: str,
+                    headers: Optional[dict] = None) -> StreamingResponse:
+    """StreamingResponse com nome de arquivo e content-type coerentes com formato/compressão"""
+    filename = f"{nome_base}.{_EXTENSOES[formato]}{_COMPRESSAO_EXTENSAO.get(compressao, '')}"
+    media_type = _COMPRESSAO_MEDIA_TYPE.get(compressao, _MEDIA_TYPES[formato])
+    return StreamingResponse(
+        gerador,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            **(headers or {})
+        }
+    )
+
+
+# ============== ARQUIVOS DO GRIDFS ==============
+
+COLECAO_ARQUIVOS = "_arquivos_gridfs"
+# Registros (chunks de ~340 KB em base64) serializados por vez
+LOTE_ARQUIVOS = 4
+
+
+async def _registros_arquivos(filtro: dict) -> AsyncIterator[dict]:
+    """Um registro por chunk de cada arquivo do bucket; cabeçalho só na parte 0"""
+    cursor = db[f"{BUCKET_NAME}.files"].find(filtro, {"filename": 1, "metadata": 1})
+    async for arquivo in cursor:
+        chunks = iterar_conteudo({"blob_id": str(arquivo["_id"])}, "")
+        registro = {
+            "blob_id": str(arquivo["_id"]),
+            "filename": arquivo.get("filename"),
+            "metadata": arquivo.get("metadata") or {}
+        }
+        parte = 0
+        chunk = await anext(chunks, b"")
+        while True:
+            proximo = await anext(chunks, b"") if chunk else b""
+            yield {
+                **registro,
+                "parte": parte,
+                "dados": base64.b64encode(chunk).decode("ascii"),
+                "fim": not proximo
+            }
+            if not proximo:
+                break
+            registro = {"blob_id": registro["blob_id"]}
+            chunk, parte = proximo, parte + 1
+
+
+def colecao_arquivos() -> ColecaoBackup:
+    """Pseudo-coleção com o conteúdo do GridFS, para acrescentar à lista de um backup"""
+    return ColecaoBackup(COLECAO_ARQUIVOS, documentos=_registros_arquivos, tamanho_lote=LOTE_ARQUIVOS)
+
+
+# ============== BACKUPS INCREMENTAIS ==============
+
+COLECAO_HISTORICO = "backups_historico"
+COLECAO_EXCLUSOES = "backup_exclusoes"
+CAMPO_ALTERACAO = "updated_at"
+
+# Coleções exportadas apenas pelo que mudou, com a chave usada no replay
+COLECOES_INCREMENTAIS = {"purchase_orders": "id"}
+
+# Controle interno do backup: nunca exportadas nem substituídas na restauração
+COLECOES_CONTROLE = (COLECAO_HISTORICO, COLECAO_EXCLUSOES)
+
+
+def validar_modo(modo: str) -> None:
+    if modo not in MODOS:
+        raise HTTPException(status_code=400, detail=f"Modo inválido. Use: {', '.join(MODOS)}")
+
+
+async def criar_indices_backup() -> None:
+    await db.purchase_orders.create_index(CAMPO_ALTERACAO)
+    await db[COLECAO_EXCLUSOES].create_index("excluido_em")
+    await db[COLECAO_HISTORICO].create_index("id", unique=True)
+    await db[COLECAO_HISTORICO].create_index("referencia_em")
+
+
+async def registrar_exclusao(colecao: str, doc_id: str) -> None:
+    """Marca (tombstone) de um documento excluído, para o próximo incremental"""
+    await db[COLECAO_EXCLUSOES].insert_one({
+        "colecao": colecao,
+        "id": doc_id,
+        "excluido_em": datetime.now(timezone.utc).isoformat()
+    })
+
+
+async def ultimo_backup() -> Optional[dict]:
+    """
+    Último backup gerado ou restaurado neste banco - o ponto a partir do qual
+    o próximo incremental é calculado.
+    """
+    return await db[COLECAO_HISTORICO].find_one(
+        {}, {"_id": 0}, sort=[("referencia_em", -1)]
+    )
+
+
+async def preparar_backup(
+    modo: str,
+    colecoes: List[ColecaoBackup],
+    info: dict
+) -> Tuple[List[ColecaoBackup], dict, Callable[[dict], Awaitable[None]]]:
+    """
+    Ajusta coleções e backup_info ao modo pedido e devolve também a chamada
+    ao_concluir que registra o backup no histórico.
+
+    A marca é tirada ANTES de ler os documentos: uma OC alterada durante a
+    exportação pode sair neste backup e de novo no próximo, o que é inofensivo
+    (o replay é idempotente), mas nunca fica de fora dos dois.
+    """
+    validar_modo(modo)
+    marca = datetime.now(timezone.utc).isoformat()
+    backup_id = str(uuid.uuid4())
+    info = {**info, "tipo": modo, "backup_id": backup_id, "marca": marca}
+
+    if modo == "incremental":
+        anterior = await ultimo_backup()
+        if not anterior:
+            raise HTTPException(
+                status_code=400,
+                detail="Nenhum backup anterior registrado - gere um backup completo primeiro"
+            )
+        desde = anterior["marca"]
+        colecoes = [
+            c._replace(filtro={**c.filtro, CAMPO_ALTERACAO: {"$gte": desde}})
+            if c.nome in COLECOES_INCREMENTAIS
+            # Arquivos não mudam depois de gravados: só os novos
+            else c._replace(filtro={"uploadDate": {"$gte": datetime.fromisoformat(desde)}})
+            if c.nome == COLECAO_ARQUIVOS else c
+            for c in colecoes
+        ]
+        colecoes.append(ColecaoBackup(COLECAO_EXCLUSOES, filtro={"excluido_em": {"$gte": desde}}))
+        info.update({
+            "base_id": anterior.get("base_id") or anterior["id"],
+            "anterior_id": anterior["id"],
+            "desde": desde
+        })
+
+    async def ao_concluir(estatisticas: dict) -> None:
+        await db[COLECAO_HISTORICO].insert_one({
+            "id": backup_id,
+            "tipo": modo,
+            "base_id": info.get("base_id"),
+            "anterior_id": info.get("anterior_id"),
+            "marca": marca,
+            "desde": info.get("desde"),
+            "gerado_em": datetime.now(timezone.utc).isoformat(),
+            "referencia_em": marca,
+            "estatisticas": estatisticas
+        })
+        logger.info(f"Backup {modo} {backup_id} registrado (marca {marca})")
+
+    return colecoes, info, ao_concluir
+
+
+async def listar_backups(limite: int = 50) -> List[dict]:
+    return await db[COLECAO_HISTORICO].find({}, {"_id": 0}).sort("referencia_em", -1).to_list(limite)
+
+
+# ============== RESTAURAÇÃO ==============
+#
+# O arquivo é lido em pedaços, descomprimido e interpretado de forma
+# incremental (NDJSON ou o JSON tradicional). Os documentos são inseridos em
+# lotes em coleções temporárias; só depois que o arquivo inteiro foi lido com
+# sucesso cada coleção temporária é renomeada sobre a original
+# (renameCollection com dropTarget). Uma falha no meio descarta as
+# temporárias e deixa o banco intacto.
+
+COLECOES_PROTEGIDAS = ("users",)
+PREFIXO_TEMPORARIA = "_restauracao_"
+LOTE_INSERCAO = 500
+TAMANHO_LEITURA = 1024 * 1024
+LIMITE_BUFFER = 64 * 1024 * 1024  # um único documento maior que isso é tratado como arquivo inválido
+
+_MAGIC_GZIP = b"\x1f\x8b"
+_MAGIC_ZSTD = b"\x28\xb5\x2f\xfd"
+
+
+def _arquivo_invalido(detalhe: str) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Arquivo de backup inválido - {detalhe}")
+
+
+async def ler_upload(arquivo) -> AsyncIterator[bytes]:
+    """Lê um UploadFile em pedaços"""
+    while True:
+        pedaco = await arquivo.read(TAMANHO_LEITURA)
+        if not pedaco:
+            break
+        yield pedaco
+
+
+async def _descomprimir(pedacos: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Detecta gzip/zstd pelos bytes iniciais e descomprime em streaming"""
+    descompressor = None
+    primeiro = True
+    async for pedaco in pedacos:
+        if primeiro:
+            primeiro = False
+            if pedaco.startswith(_MAGIC_GZIP):
+                descompressor = zlib.decompressobj(47)  # gzip ou zlib, detecção automática
+            elif pedaco.startswith(_MAGIC_ZSTD):
+                if not ZSTD_AVAILABLE:
+                    raise HTTPException(status_code=400, detail="Backup zstd não suportado (pacote zstandard não instalado)")
+                descompressor = zstandard.ZstdDecompressor().decompressobj()
+        yield descompressor.decompress(pedaco) if descompressor else pedaco
+
+
+class _ParserJSONIncremental:
+    """
+    Interpreta o backup JSON tradicional ({"colecao": [docs...], "backup_info": {...}})
+    sem carregar o arquivo inteiro: cada documento das listas vira um evento
+    assim que está completo no buffer.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._estado = "inicio"  # inicio | chave | lista | fim
+        self._colecao = None
+
+    def _espacos(self, pos: int) -> int:
+        while pos < len(self._buf) and self._buf[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    def _valor(self, pos: int, final: bool):
+        """(valor, nova_pos) ou None se o valor ainda não está completo no buffer"""
+        try:
+            valor, fim = self._decoder.raw_decode(self._buf, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise _arquivo_invalido("JSON malformado ou truncado")
+            return None
+        # Um escalar no fim do buffer pode estar cortado ("12" de "123")
+        if fim == len(self._buf) and not final:
+            return None
+        return valor, fim
+
+    def alimentar(self, texto: str, final: bool = False) -> List[tuple]:
+        self._buf += texto
+        eventos = []
+        pos = 0
+        while True:
+            pos = self._espacos(pos)
+            if pos >= len(self._buf):
+                break
+            c = self._buf[pos]
+
+            if self._estado == "inicio":
+                if c != "{":
+                    raise _arquivo_invalido("esperado um objeto JSON")
+                pos += 1
+                self._estado = "chave"
+            elif self._estado == "chave":
+                if c == ",":
+                    pos += 1
+                    continue
+                if c == "}":
+                    pos += 1
+                    self._estado = "fim"
+                    continue
+                lido = self._valor(pos, final)
+                if lido is None:
+                    break
+                chave, depois_chave = lido
+                p = self._espacos(depois_chave)
+                if p >= len(self._buf):
+                    break
+                if self._buf[p] != ":":
+                    raise _arquivo_invalido("esperado ':'")
+                p = self._espacos(p + 1)
+                if p >= len(self._buf):
+                    break
+                if self._buf[p] == "[":
+                    eventos.append(("colecao", chave))
+                    self._colecao = chave
+                    self._estado = "lista"
+                    pos = p + 1
+                else:
+                    lido = self._valor(p, final)
+                    if lido is None:
+                        break
+                    valor, pos = lido
+                    if chave == "backup_info":
+                        eventos.append(("info", valor))
+            elif self._estado == "lista":
+                if c == ",":
+                    pos += 1
+                    continue
+                if c == "]":
+                    pos += 1
+                    self._estado = "chave"
+                    continue
+                lido = self._valor(pos, final)
+                if lido is None:
+                    break
+                doc, pos = lido
+                eventos.append(("doc", self._colecao, doc))
+            else:
+                raise _arquivo_invalido("conteúdo após o fim do JSON")
+
+        self._buf = self._buf[pos:]
+        if len(self._buf) > LIMITE_BUFFER:
+            raise _arquivo_invalido("documento grande demais ou JSON malformado")
+        if final and self._estado != "fim":
+            raise _arquivo_invalido("JSON truncado")
+        return eventos
+
+
+def _eh_ndjson(primeira_linha: str) -> bool:
+    """NDJSON começa com uma linha contendo apenas {"backup_info": {...}}"""
+    try:
+        registro = json.loads(primeira_linha)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(registro, dict) and list(registro) == ["backup_info"]
+
+
+def _eventos_linha_ndjson(linha: str) -> List[tuple]:
+    try:
+        registro = json.loads(linha)
+    except json.JSONDecodeError:
+        raise _arquivo_invalido("linha NDJSON malformada")
+    if "doc" in registro and "colecao" in registro:
+        return [("doc", registro["colecao"], registro["doc"])]
+    if "backup_info" in registro:
+        return [("info", registro["backup_info"])]
+    if "backup_fim" in registro:
+        return [("fim", registro["backup_fim"])]
+    if "backup_erro" in registro:
+        raise _arquivo_invalido(f"o backup foi gerado com erro: {registro['backup_erro']}")
+    return []
+
+
+async def ler_registros_backup(pedacos: AsyncIterator[bytes]) -> AsyncIterator[tuple]:
+    """
+    Converte os bytes do arquivo (comprimido ou não) em eventos:
+        ("info", backup_info), ("colecao", nome), ("doc", nome, doc), ("fim", rodape)
+    O formato (NDJSON ou JSON) é detectado pela primeira linha.
+    """
+    decodificador = codecs.getincrementaldecoder("utf-8")()
+    parser_json = None
+    ndjson = None
+    pendente = ""
+
+    async for pedaco in _descomprimir(pedacos):
+        texto = decodificador.decode(pedaco)
+        if ndjson is None:
+            pendente += texto
+            if "\n" not in pendente and len(pendente) < TAMANHO_LEITURA:
+                continue
+            ndjson = _eh_ndjson(pendente.split("\n", 1)[0])
+            texto, pendente = pendente, ""
+            if not ndjson:
+                parser_json = _ParserJSONIncremental()
+
+        if ndjson:
+            pendente += texto
+            *linhas, pendente = pendente.split("\n")
+            for linha in linhas:
+                if linha.strip():
+                    for evento in _eventos_linha_ndjson(linha):
+                        yield evento
+        else:
+            for evento in parser_json.alimentar(texto):
+                yield evento
+
+    texto = pendente + decodificador.decode(b"", final=True)
+    if ndjson is None:
+        ndjson = _eh_ndjson(texto.split("\n", 1)[0])
+        if not ndjson:
+            parser_json = _ParserJSONIncremental()
+    if ndjson:
+        for linha in texto.split("\n"):
+            if linha.strip():
+                for evento in _eventos_linha_ndjson(linha):
+                    yield evento
+    else:
+        for evento in parser_json.alimentar(texto, final=True):
+            yield evento
+
+
+async def registros_de_dict(backup: dict) -> AsyncIterator[tuple]:
+    """Eventos a partir de um backup já carregado (corpo JSON do /backup/restore-data)"""
+    if "backup_info" in backup:
+        yield ("info", backup["backup_info"])
+    for chave, valor in backup.items():
+        if isinstance(valor, list):
+            yield ("colecao", chave)
+            for doc in valor:
+                yield ("doc", chave, doc)
+
+
+def _colecao_restauravel(nome: str) -> bool:
+    return (
+        isinstance(nome, str) and bool(nome)
+        and nome not in COLECOES_PROTEGIDAS
+        and not nome.startswith(("system.", PREFIXO_TEMPORARIA))
+        and "$" not in nome
+    )
+
+
+async def _copiar_indices(origem: str, destino: str) -> None:
+    """Recria na temporária os índices da coleção atual (o rename descarta os do destino)"""
+    opcoes_copiadas = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression", "collation")
+    for nome, spec in (await db[origem].index_information()).items():
+        if nome == "_id_":
+            continue
+        opcoes = {k: spec[k] for k in opcoes_copiadas if k in spec}
+        await db[destino].create_index(spec["key"], name=nome, **opcoes)
+
+
+async def _mesclar(temporaria: str, colecao: str, chave: str) -> None:
+    """Replay de um incremental: upsert de cada documento pela chave"""
+    operacoes = []
+    async for doc in db[temporaria].find({}, {"_id": 0}).batch_size(LOTE_INSERCAO):
+        operacoes.append(ReplaceOne({chave: doc.get(chave)}, doc, upsert=True))
+        if len(operacoes) >= LOTE_INSERCAO:
+            await db[colecao].bulk_write(operacoes, ordered=False)
+            operacoes = []
+    if operacoes:
+        await db[colecao].bulk_write(operacoes, ordered=False)
+    await db.drop_collection(temporaria)
+
+
+async def _aplicar_exclusoes(temporaria: str) -> Dict[str, int]:
+    ids_por_colecao: Dict[str, List[str]] = {}
+    async for marca in db[temporaria].find({}, {"_id": 0, "colecao": 1, "id": 1}):
+        if marca.get("colecao") in COLECOES_INCREMENTAIS and marca.get("id"):
+            ids_por_colecao.setdefault(marca["colecao"], []).append(marca["id"])
+    await db.drop_collection(temporaria)
+
+    excluidos = {}
+    for colecao, ids in ids_por_colecao.items():
+        chave = COLECOES_INCREMENTAIS[colecao]
+        result = await db[colecao].delete_many({chave: {"$in": ids}})
+        excluidos[colecao] = result.deleted_count
+    return excluidos
+
+
+async def _validar_cadeia(info: dict) -> None:
+    """Um incremental só pode ser aplicado sobre o backup de que ele parte"""
+    atual = await ultimo_backup()
+    anterior_id = info.get("anterior_id")
+    if not atual or atual.get("id") != anterior_id:
+        raise HTTPException(
+            status_code=409,
+            detail=(
+                f"Backup incremental fora de ordem: ele parte do backup {anterior_id}, "
+                f"mas o último aplicado neste banco é {atual.get('id') if atual else 'nenhum'}. "
+                "Restaure a base e os incrementais na ordem (ou force a aplicação)."
+            )
+        )
+
+
+async def _registrar_restauracao(info: dict) -> None:
+    if not info.get("backup_id"):
+        return
+    agora = datetime.now(timezone.utc).isoformat()
+    await db[COLECAO_HISTORICO].update_one(
+        {"id": info["backup_id"]},
+        {
+            "$set": {"restaurado_em": agora, "referencia_em": agora},
+            "$setOnInsert": {
+                "tipo": info.get("tipo", "completo"),
+                "base_id": info.get("base_id"),
+                "anterior_id": info.get("anterior_id"),
+                "marca": info.get("marca"),
+                "desde": info.get("desde")
+            }
+        },
+        upsert=True
+    )
+
+
+class _RestauradorArquivos:
+    """
+    Regrava no GridFS, parte a parte, os arquivos da pseudo-coleção
+    COLECAO_ARQUIVOS com o blob_id original. Arquivos que já estão no bucket
+    (mesmo _id) são mantidos e suas partes ignoradas.
+    """
+
+    def __init__(self):
+        self._grid_in = None
+        self._blob_id = None
+        self._ignorando = False
+        self.restaurados = 0
+        self.existentes = 0
+
+    async def registro(self, doc: dict) -> None:
+        blob_id = doc.get("blob_id")
+        if doc.get("parte") == 0:
+            if self._blob_id is not None:
+                raise _arquivo_invalido(f"arquivo {self._blob_id} incompleto")
+            try:
+                oid = ObjectId(blob_id)
+            except (InvalidId, TypeError):
+                raise _arquivo_invalido(f"blob_id inválido: {blob_id}")
+            self._blob_id = blob_id
+            self._ignorando = await db[f"{BUCKET_NAME}.files"].find_one({"_id": oid}, {"_id": 1}) is not None
+            if not self._ignorando:
+                self._grid_in = abrir_gravacao_com_id(oid, doc.get("filename"), doc.get("metadata") or {})
+        elif blob_id != self._blob_id:
+            raise _arquivo_invalido(f"parte fora de ordem do arquivo {blob_id}")
+
+        if self._ignorando:
+            if doc.get("fim"):
+                self.existentes += 1
+        else:
+            await self._grid_in.write(base64.b64decode(doc.get("dados") or ""))
+            if doc.get("fim"):
+                await self._grid_in.close()
+                self._grid_in = None
+                self.restaurados += 1
+        if doc.get("fim"):
+            self._blob_id = None
+
+    def concluir(self) -> None:
+        if self._blob_id is not None:
+            raise _arquivo_invalido(f"arquivo {self._blob_id} truncado")
+
+    async def abortar(self) -> None:
+        if self._grid_in is not None:
+            await self._grid_in.abort()
+            self._grid_in = None
+
+
+async def restaurar_backup(registros: AsyncIterator[tuple], ignorar: tuple = (), forcar: bool = False) -> dict:
+    """
+    Restaura a partir dos eventos de ler_registros_backup()/registros_de_dict().
+
+    Backups completos substituem as coleções presentes no arquivo. Incrementais
+    fazem upsert das OCs alteradas, aplicam as exclusões e substituem as
+    coleções pequenas; só são aceitos na sequência da cadeia (anterior_id).
+
+    Arquivos do GridFS (COLECAO_ARQUIVOS) são gravados no bucket durante a
+    leitura, antes da troca das coleções; se a restauração falhar depois, os
+    já gravados ficam sem referência e saem em remover_blobs_orfaos().
+
+    Args:
+        ignorar: coleções presentes no backup que não devem ser restauradas
+            (ex.: read-models reconstruídos depois)
+        forcar: aplica um incremental mesmo fora da ordem da cadeia
+
+    Returns:
+        {"info", "tipo", "colecoes": {nome: documentos}, "excluidos": {nome: documentos},
+         "arquivos": {"restaurados", "existentes"}}
+    """
+    execucao = uuid.uuid4().hex[:8]
+    temporarias: Dict[str, str] = {}
+    contagens: Dict[str, int] = {}
+    lotes: Dict[str, List[dict]] = {}
+    info = None
+    rodape = None
+    formato_ndjson = False
+    arquivos = _RestauradorArquivos()
+
+    async def preparar(colecao: str) -> bool:
+        if not _colecao_restauravel(colecao) or colecao in ignorar or colecao == COLECAO_HISTORICO:
+            return False
+        if colecao not in temporarias:
+            temporarias[colecao] = f"{PREFIXO_TEMPORARIA}{execucao}_{colecao}"
+            contagens[colecao] = 0
+            lotes[colecao] = []
+            await db.create_collection(temporarias[colecao])
+        return True
+
+    async def gravar(colecao: str):
+        if lotes[colecao]:
+            await db[temporarias[colecao]].insert_many(lotes[colecao], ordered=False)
+            contagens[colecao] += len(lotes[colecao])
+            lotes[colecao] = []
+
+    try:
+        async for evento in registros:
+            tipo = evento[0]
+            if tipo == "info":
+                info = evento[1]
+                formato_ndjson = info.get("formato") == "ndjson"
+            elif tipo == "fim":
+                rodape = evento[1]
+            elif tipo == "colecao":
+                if evento[1] != COLECAO_ARQUIVOS:
+                    await preparar(evento[1])
+            elif tipo == "doc":
+                _, colecao, doc = evento
+                if colecao == COLECAO_ARQUIVOS and isinstance(doc, dict):
+                    await arquivos.registro(doc)
+                    continue
+                if not isinstance(doc, dict) or not await preparar(colecao):
+                    continue
+                doc.pop("_id", None)
+                lotes[colecao].append(doc)
+                if len(lotes[colecao]) >= LOTE_INSERCAO:
+                    await gravar(colecao)
+
+        arquivos.concluir()
+        if info is None:
+            raise _arquivo_invalido("falta backup_info")
+        if formato_ndjson and rodape is None:
+            raise _arquivo_invalido("arquivo truncado (sem rodapé backup_fim)")
+        incremental = info.get("tipo") == "incremental"
+        if incremental and not forcar:
+            await _validar_cadeia(info)
+        for colecao in temporarias:
+            await gravar(colecao)
+            if not (incremental and (colecao in COLECOES_INCREMENTAIS or colecao == COLECAO_EXCLUSOES)):
+                await _copiar_indices(colecao, temporarias[colecao])
+    except BaseException:
+        await arquivos.abortar()
+        for temporaria in temporarias.values():
+            try:
+                await db.drop_collection(temporaria)
+            except Exception as e:
+                logger.warning(f"Erro ao descartar {temporaria}: {e}")
+        raise
+
+    # Troca: cada rename é atômico e leva milissegundos - o banco nunca fica vazio
+    excluidos = {}
+    for colecao, temporaria in temporarias.items():
+        if colecao == COLECAO_EXCLUSOES:
+            continue
+        if incremental and colecao in COLECOES_INCREMENTAIS:
+            await _mesclar(temporaria, colecao, COLECOES_INCREMENTAIS[colecao])
+        else:
+            await db[temporaria].rename(colecao, dropTarget=True)
+        logger.info(f"  {colecao}: {contagens[colecao]} documentos restaurados")
+
+    # Exclusões depois dos upserts; num backup completo a marca não tem uso
+    if COLECAO_EXCLUSOES in temporarias:
+        if incremental:
+            excluidos = await _aplicar_exclusoes(temporarias[COLECAO_EXCLUSOES])
+        else:
+            await db.drop_collection(temporarias[COLECAO_EXCLUSOES])
+        contagens.pop(COLECAO_EXCLUSOES)
+
+    await _registrar_restauracao(info)
+    return {
+        "info": info,
+        "tipo": "incremental" if incremental else "completo",
+        "colecoes": contagens,
+        "excluidos": excluidos,
+        "arquivos": {"restaurados": arquivos.restaurados, "existentes": arquivos.existentes}
+    }
+
+
+async def _ler_arquivo(caminho: str) -> AsyncIterator[bytes]:
+    with open(caminho, "rb") as arquivo:
+        while True:
+            pedaco = await asyncio.to_thread(arquivo.read, TAMANHO_LEITURA)
+            if not pedaco:
+                break
+            yield pedaco
+
+
+async def restaurar_arquivos(caminhos: List[str], ignorar: tuple = (), forcar: bool = False) -> List[dict]:
+    """Aplica uma base e seus incrementais, na ordem dada"""
+    resultados = []
+    for caminho in caminhos:
+        logger.info(f"Restaurando {caminho}...")
+        resultado = await restaurar_backup(ler_registros_backup(_ler_arquivo(caminho)), ignorar, forcar)
+        resultados.append({
+            "arquivo": caminho,
+            "backup_id": resultado["info"].get("backup_id"),
+            "tipo": resultado["tipo"],
+            "colecoes": resultado["colecoes"],
+            "excluidos": resultado["excluidos"]
+        })
+    return resultados
+
+
+if __name__ == "__main__":
+    # python -m services.backup_service base.ndjson.gz incremental1.ndjson.gz ... [--forcar]
+    import sys
+    from services.po_items_service import COLECAO as PO_ITEMS, reconstruir_po_items
+    from services.historico_cotacoes_service import COLECAO as HISTORICO_COTACOES
+    from services.dashboard_service import COLECAO as DASHBOARD_COUNTERS
+    from services.correios_service import COLECAO_CACHE as RASTREIO_CACHE
+    from services.rastreio_service import COLECAO_AGENDA as RASTREIO_AGENDA, sincronizar_agenda_rastreio
+    from services.parse_cache_service import COLECAO as PARSE_CACHE
+    from services.job_service import COLECAO as JOBS
+
+    logging.basicConfig(level=logging.INFO)
+    argumentos = [a for a in sys.argv[1:] if a != "--forcar"]
+    if not argumentos:
+        sys.exit("uso: python -m services.backup_service BASE [INCREMENTAL ...] [--forcar]")
+
+    async def _main():
+        ignorar = (PO_ITEMS, HISTORICO_COTACOES, DASHBOARD_COUNTERS, RASTREIO_AGENDA, RASTREIO_CACHE, PARSE_CACHE, JOBS)
+        resultados = await restaurar_arquivos(argumentos, ignorar=ignorar, forcar="--forcar" in sys.argv)
+        await reconstruir_po_items()  # também reconcilia dashboard_counters
+        await sincronizar_agenda_rastreio()
+        return resultados
+
+    for r in asyncio.run(_main()):
+        print(r)
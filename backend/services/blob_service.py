@@ -0,0 +1,481 @@
+"""
+Serviço de armazenamento de arquivos binários (GridFS)
+
+PDFs das OCs, NFs e imagens de itens ficavam como strings base64 dentro dos
+documentos do MongoDB (+33% de tamanho e carregados em todo find_one).
+Agora os bytes ficam no bucket GridFS `arquivos`, deduplicados por SHA-256,
+e os documentos guardam apenas uma referência:
+
+    {"blob_id": "<ObjectId>", "sha256": "...", "size": 12345, ...}
+
+Leituras aceitam os dois formatos (referência ou base64 legado) até que a
+migração (`migrar_blobs_legados`) tenha sido executada.
+"""
+import base64
+import hashlib
+import logging
+import zipfile
+from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from bson import ObjectId
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from services.item_patch_service import montar_update_itens, snapshot_itens
+from services.job_service import COLECAO as JOBS, STATUS_CANCELADO, STATUS_CONCLUIDO
+from services.po_items_service import sincronizar_po
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = "arquivos"
+CHUNK_SIZE = 255 * 1024  # Tamanho padrão de chunk do GridFS
+
+# Tamanho (em caracteres base64) de cada fatia decodificada no fallback legado.
+# Múltiplo de 4 para que cada fatia seja base64 válido isoladamente.
+BASE64_SLICE = 4 * 64 * 1024
+
+_bucket: Optional[AsyncIOMotorGridFSBucket] = None
+
+
+def get_bucket() -> AsyncIOMotorGridFSBucket:
+    """Bucket GridFS criado sob demanda (precisa do event loop ativo)"""
+    global _bucket
+    if _bucket is None:
+        _bucket = AsyncIOMotorGridFSBucket(db, bucket_name=BUCKET_NAME, chunk_size_bytes=CHUNK_SIZE)
+    return _bucket
+
+
+async def criar_indices_blobs():
+    """Índice usado na deduplicação por hash"""
+    await db[f"{BUCKET_NAME}.files"].create_index("metadata.sha256")
+
+
+async def salvar_blob(conteudo: bytes, filename: str, content_type: str) -> Dict:
+    """
+    Salva bytes no GridFS e retorna a referência a ser gravada no documento.
+    Se já existir um arquivo com o mesmo SHA-256, reaproveita o existente.
+    """
+    sha256 = hashlib.sha256(conteudo).hexdigest()
+
+    existente = await db[f"{BUCKET_NAME}.files"].find_one(
+        {"metadata.sha256": sha256},
+        {"_id": 1}
+    )
+    if existente:
+        blob_id = existente["_id"]
+    else:
+        blob_id = await get_bucket().upload_from_stream(
+            filename or "arquivo",
+            conteudo,
+            metadata={"sha256": sha256, "content_type": content_type}
+        )
+
+    return {
+        "blob_id": str(blob_id),
+        "sha256": sha256,
+        "size": len(conteudo)
+    }
+
+
+async def iterar_upload(file, tamanho_chunk: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Chunks de um UploadFile (multipart), sem ler o arquivo inteiro de uma vez"""
+    while True:
+        chunk = await file.read(tamanho_chunk)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def salvar_blob_stream(
+    chunks: AsyncIterator[bytes],
+    filename: str,
+    content_type: str,
+    max_bytes: Optional[int] = None
+) -> Dict:
+    """
+    Versão em streaming de salvar_blob: cada chunk vai direto para o GridFS,
+    com SHA-256 e tamanho calculados no caminho. Como o hash só é conhecido
+    no fim, a deduplicação vem depois da gravação: se já existia um arquivo
+    com o mesmo SHA-256, o recém-gravado é apagado e o existente reaproveitado.
+    HTTPException 413 se o arquivo passar de max_bytes.
+    """
+    hasher = hashlib.sha256()
+    tamanho = 0
+    grid_in = get_bucket().open_upload_stream(
+        filename or "arquivo",
+        metadata={"content_type": content_type}
+    )
+    try:
+        async for chunk in chunks:
+            tamanho += len(chunk)
+            if max_bytes is not None and tamanho > max_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Arquivo maior que o limite de {max_bytes // (1024 * 1024)} MB"
+                )
+            hasher.update(chunk)
+            await grid_in.write(chunk)
+        await grid_in.close()
+    except BaseException:
+        await grid_in.abort()
+        raise
+
+    sha256 = hasher.hexdigest()
+    blob_id = grid_in._id
+    existente = await db[f"{BUCKET_NAME}.files"].find_one(
+        {"metadata.sha256": sha256, "_id": {"$ne": blob_id}},
+        {"_id": 1}
+    )
+    if existente:
+        await get_bucket().delete(blob_id)
+        blob_id = existente["_id"]
+    else:
+        await db[f"{BUCKET_NAME}.files"].update_one(
+            {"_id": blob_id},
+            {"$set": {"metadata.sha256": sha256}}
+        )
+
+    return {
+        "blob_id": str(blob_id),
+        "sha256": sha256,
+        "size": tamanho
+    }
+
+
+async def remover_blob(blob_id: str) -> None:
+    """
+    Apaga um arquivo do bucket. Só para blobs que o chamador sabe não estarem
+    referenciados; no caso geral, remover_blobs_orfaos().
+    """
+    await get_bucket().delete(ObjectId(blob_id))
+
+
+def abrir_gravacao_com_id(blob_id: ObjectId, filename: str, metadata: dict):
+    """
+    Stream de gravação de um arquivo com _id definido (restauração de backup,
+    em que os documentos já apontam para esse blob_id). write()/close()/abort().
+    """
+    return get_bucket().open_upload_stream_with_id(blob_id, filename or "arquivo", metadata=metadata)
+
+
+def tem_conteudo(ref: Optional[dict], campo_legado: str) -> bool:
+    """True se o documento aponta para um blob ou ainda tem o base64 legado"""
+    if not ref:
+        return False
+    return bool(ref.get("blob_id") or ref.get(campo_legado))
+
+
+def tamanho_conteudo(ref: dict, campo_legado: str) -> Optional[int]:
+    """Tamanho em bytes, quando conhecido sem ler o arquivo"""
+    if ref.get("blob_id"):
+        return ref.get("size")
+    legado = ref.get(campo_legado)
+    if legado:
+        padding = legado.count("=", -2)
+        return (len(legado) * 3) // 4 - padding
+    return None
+
+
+async def iterar_conteudo(ref: dict, campo_legado: str) -> AsyncIterator[bytes]:
+    """
+    Gera o conteúdo em chunks, sem montar o arquivo inteiro em memória.
+    - blob: lê chunk a chunk do GridFS
+    - legado: decodifica o base64 em fatias
+    """
+    blob_id = ref.get("blob_id")
+    if blob_id:
+        grid_out = await get_bucket().open_download_stream(ObjectId(blob_id))
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    legado = ref.get(campo_legado) or ""
+    for inicio in range(0, len(legado), BASE64_SLICE):
+        yield base64.b64decode(legado[inicio:inicio + BASE64_SLICE])
+
+
+class _SaidaZip:
+    """Destino não-seekable do ZipFile: acumula o que foi escrito até ser drenado"""
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, dados: bytes) -> int:
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def drenar(self) -> bytes:
+        dados = b"".join(self.partes)
+        self.partes.clear()
+        return dados
+
+
+async def iterar_zip(entradas: AsyncIterator[Tuple[str, AsyncIterator[bytes]]]) -> AsyncIterator[bytes]:
+    """
+    ZIP gerado em streaming a partir de (nome, chunks): cada entrada é
+    comprimida e devolvida à medida que os chunks chegam, sem montar o
+    arquivo em memória. Com destino não-seekable o zipfile usa data
+    descriptors, então tamanhos e CRC não precisam ser conhecidos antes.
+    """
+    saida = _SaidaZip()
+    usados = set()
+    with zipfile.ZipFile(saida, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        async for nome, chunks in entradas:
+            base, n = nome, 1
+            while nome in usados:
+                n += 1
+                nome = f"({n}) {base}"
+            usados.add(nome)
+
+            info = zipfile.ZipInfo(nome, date_time=datetime.now().timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zip_file.open(info, "w") as destino:
+                async for chunk in chunks:
+                    destino.write(chunk)
+                    if saida.partes:
+                        yield saida.drenar()
+            yield saida.drenar()
+    # Diretório central
+    yield saida.drenar()
+
+
+async def ler_conteudo(ref: Optional[dict], campo_legado: str) -> Optional[bytes]:
+    """
+    Lê o conteúdo completo (para parsing de PDF/XML, ZIP etc).
+    Retorna None se não houver arquivo.
+    """
+    if not tem_conteudo(ref, campo_legado):
+        return None
+    partes = [chunk async for chunk in iterar_conteudo(ref, campo_legado)]
+    return b"".join(partes)
+
+
+async def ler_conteudo_base64(ref: Optional[dict], campo_legado: str) -> Optional[str]:
+    """Conteúdo em base64 - compatibilidade com endpoints que respondem JSON"""
+    if not ref:
+        return None
+    if ref.get(campo_legado):
+        return ref[campo_legado]
+    conteudo = await ler_conteudo(ref, campo_legado)
+    return base64.b64encode(conteudo).decode("utf-8") if conteudo is not None else None
+
+
+async def converter_para_blob(ref: dict, campo_legado: str, filename: str, content_type: str) -> bool:
+    """
+    Converte in-place um sub-documento com base64 legado para referência de blob.
+    Retorna True se houve conversão.
+    """
+    legado = ref.get(campo_legado)
+    if not legado or ref.get("blob_id"):
+        return False
+    conteudo = base64.b64decode(legado)
+    ref.update(await salvar_blob(conteudo, filename, content_type))
+    del ref[campo_legado]
+    return True
+
+
+# ============== MIGRAÇÃO DOS DADOS LEGADOS ==============
+
+TENTATIVAS_MIGRACAO = 3
+
+
+async def _migrar_oc(po: dict) -> Optional[int]:
+    """
+    Converte os arquivos legados de uma OC e grava tudo num único update_one
+    guardado: itens pelo tamanho do array, `id` e versao_item
+    (item_patch_service.montar_update_itens); NFs de venda pela posição, `id`
+    e base64 ainda presente. Retorna quantos arquivos foram convertidos, ou
+    None se a OC mudou entre a leitura e a gravação.
+    """
+    itens_antes = snapshot_itens(po.get("items") or [])
+    campos_oc = {}
+    guarda = {}
+    convertidos = 0
+
+    pdf = po.get("pdf_original")
+    if pdf and await converter_para_blob(pdf, "data", pdf.get("filename"), pdf.get("content_type") or "application/pdf"):
+        campos_oc["pdf_original"] = pdf
+        guarda["pdf_original.data"] = {"$exists": True}
+        convertidos += 1
+
+    nf_venda = po.get("nota_fiscal_venda")
+    if nf_venda and await converter_para_blob(nf_venda, "file_data", nf_venda.get("filename"), nf_venda.get("content_type")):
+        campos_oc["nota_fiscal_venda"] = nf_venda
+        guarda["nota_fiscal_venda.file_data"] = {"$exists": True}
+        convertidos += 1
+
+    nfs_venda = po.get("notas_fiscais_venda") or []
+    for idx, nf in enumerate(nfs_venda):
+        nf_id = nf.get("id")
+        if await converter_para_blob(nf, "file_data", nf.get("filename"), nf.get("content_type")):
+            campos_oc[f"notas_fiscais_venda.{idx}"] = nf
+            guarda[f"notas_fiscais_venda.{idx}.id"] = nf_id
+            guarda[f"notas_fiscais_venda.{idx}.file_data"] = {"$exists": True}
+            guarda["notas_fiscais_venda"] = {"$size": len(nfs_venda)}
+            convertidos += 1
+
+    for item in po.get("items") or []:
+        for nf in item.get("notas_fiscais_fornecedor") or []:
+            if await converter_para_blob(nf, "file_data", nf.get("filename"), nf.get("content_type")):
+                convertidos += 1
+        nf_revenda = item.get("nota_fiscal_revenda")
+        if nf_revenda and await converter_para_blob(nf_revenda, "file_data", nf_revenda.get("filename"), nf_revenda.get("content_type")):
+            convertidos += 1
+
+    montado = montar_update_itens(po["id"], itens_antes, po.get("items") or [], campos_oc)
+    if not convertidos or montado is None:
+        return 0
+    filtro, update, indices = montado
+    filtro.update(guarda)
+    for idx in indices:
+        filtro[f"items.{idx}.id"] = itens_antes[idx].get("id")
+
+    result = await db.purchase_orders.update_one(filtro, update)
+    if result.matched_count == 0:
+        return None
+    if indices:
+        await sincronizar_po(po["id"], indices)
+    return convertidos
+
+
+async def migrar_blobs_legados() -> Dict:
+    """
+    Move os arquivos base64 legados para o GridFS:
+    - purchase_orders.pdf_original.data
+    - purchase_orders.nota_fiscal_venda.file_data / notas_fiscais_venda[].file_data
+    - purchase_orders.items[].notas_fiscais_fornecedor[].file_data
+    - purchase_orders.items[].nota_fiscal_revenda.file_data
+    - imagens_itens.imagem_base64
+
+    Processa uma OC por vez (cursor) para manter o uso de memória baixo.
+    Uma OC alterada durante a conversão é relida e convertida de novo (até
+    TENTATIVAS_MIGRACAO vezes); os blobs da tentativa descartada são
+    reaproveitados pela deduplicação ou saem em remover_blobs_orfaos().
+    Idempotente: documentos já migrados são ignorados.
+    """
+    stats = {"ocs_migradas": 0, "arquivos_migrados": 0, "imagens_migradas": 0, "conflitos": 0, "erros": 0}
+
+    filtro_legado = {"$or": [
+        {"pdf_original.data": {"$exists": True}},
+        {"nota_fiscal_venda.file_data": {"$exists": True}},
+        {"notas_fiscais_venda.file_data": {"$exists": True}},
+        {"items.notas_fiscais_fornecedor.file_data": {"$exists": True}},
+        {"items.nota_fiscal_revenda.file_data": {"$exists": True}},
+    ]}
+
+    cursor = db.purchase_orders.find(filtro_legado, {"_id": 0})
+    async for po in cursor:
+        try:
+            convertidos = None
+            for _ in range(TENTATIVAS_MIGRACAO):
+                convertidos = await _migrar_oc(po)
+                if convertidos is not None:
+                    break
+                po = await db.purchase_orders.find_one({"id": po["id"]}, {"_id": 0})
+                if po is None:  # excluída no meio tempo
+                    convertidos = 0
+                    break
+
+            if convertidos is None:
+                stats["conflitos"] += 1
+                logger.warning(f"OC {po.get('numero_oc')} alterada durante a migração de arquivos - ficou para a próxima execução")
+            elif convertidos:
+                stats["ocs_migradas"] += 1
+                stats["arquivos_migrados"] += convertidos
+        except Exception as e:
+            stats["erros"] += 1
+            logger.error(f"Erro ao migrar arquivos da OC {po.get('numero_oc')}: {e}")
+
+    cursor = db.imagens_itens.find({"imagem_base64": {"$exists": True}}, {"_id": 0})
+    async for imagem in cursor:
+        try:
+            if await converter_para_blob(imagem, "imagem_base64", imagem.get("filename"), imagem.get("content_type")):
+                # Sem blob_id: a imagem não foi trocada por um upload novo no meio tempo
+                result = await db.imagens_itens.update_one(
+                    {"codigo_item": imagem["codigo_item"], "blob_id": {"$exists": False}},
+                    {
+                        "$set": {"blob_id": imagem["blob_id"], "sha256": imagem["sha256"], "size": imagem["size"]},
+                        "$unset": {"imagem_base64": ""}
+                    }
+                )
+                if result.matched_count:
+                    stats["imagens_migradas"] += 1
+        except Exception as e:
+            stats["erros"] += 1
+            logger.error(f"Erro ao migrar imagem {imagem.get('codigo_item')}: {e}")
+
+    logger.info(f"Migração de arquivos para GridFS concluída: {stats}")
+    return stats
+
+
+def _blob_ids_em(valor) -> set:
+    """blob_ids de todas as referências {"blob_id": ...} aninhadas em dicts/listas"""
+    ids = set()
+    if isinstance(valor, dict):
+        if isinstance(valor.get("blob_id"), str):
+            ids.add(valor["blob_id"])
+        for filho in valor.values():
+            ids |= _blob_ids_em(filho)
+    elif isinstance(valor, list):
+        for filho in valor:
+            ids |= _blob_ids_em(filho)
+    return ids
+
+
+async def remover_blobs_orfaos(idade_minima_horas: int = 24) -> int:
+    """
+    Remove arquivos do GridFS que não são mais referenciados por nenhum documento.
+    Como há deduplicação, um blob só pode ser apagado quando ninguém mais aponta
+    para ele - por isso a remoção é feita aqui, e não na exclusão de cada NF/imagem.
+    Arquivos recentes são preservados para não competir com uploads em andamento,
+    e os PDFs que jobs ainda não concluídos/cancelados vão ler (ex: NCM em massa,
+    params {"arquivos": [{"filename", "blob_id", ...}]}) contam como referenciados.
+    """
+    referenciados = set()
+
+    cursor = db.purchase_orders.find({}, {
+        "_id": 0,
+        "pdf_original.blob_id": 1,
+        "nota_fiscal_venda.blob_id": 1,
+        "notas_fiscais_venda.blob_id": 1,
+        "items.notas_fiscais_fornecedor.blob_id": 1,
+        "items.nota_fiscal_revenda.blob_id": 1,
+    })
+    async for po in cursor:
+        refs = [po.get("pdf_original"), po.get("nota_fiscal_venda")]
+        refs.extend(po.get("notas_fiscais_venda") or [])
+        for item in po.get("items", []):
+            refs.extend(item.get("notas_fiscais_fornecedor") or [])
+            refs.append(item.get("nota_fiscal_revenda"))
+        referenciados.update(r["blob_id"] for r in refs if r and r.get("blob_id"))
+
+    async for imagem in db.imagens_itens.find({"blob_id": {"$exists": True}}, {"_id": 0, "blob_id": 1, "variantes": 1}):
+        referenciados.add(imagem["blob_id"])
+        # Miniatura/média em WebP e JPEG
+        for variante in (imagem.get("variantes") or {}).values():
+            referenciados.update(
+                ref["blob_id"] for ref in variante.values() if isinstance(ref, dict) and ref.get("blob_id")
+            )
+
+    async for job in db[JOBS].find(
+        {"status": {"$nin": [STATUS_CONCLUIDO, STATUS_CANCELADO]}}, {"_id": 0, "params": 1}
+    ):
+        referenciados |= _blob_ids_em(job.get("params"))
+
+    limite = datetime.now(timezone.utc) - timedelta(hours=idade_minima_horas)
+    removidos = 0
+    async for arquivo in db[f"{BUCKET_NAME}.files"].find({"uploadDate": {"$lt": limite}}, {"_id": 1}):
+        if str(arquivo["_id"]) not in referenciados:
+            await get_bucket().delete(arquivo["_id"])
+            removidos += 1
+
+    logger.info(f"{removidos} arquivos órfãos removidos do GridFS")
+    return removidos
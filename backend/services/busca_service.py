@@ -0,0 +1,103 @@
+"""
+Normalização de texto para buscas indexadas
+
+Códigos e descrições viram termos em maiúsculas e sem acento
+("Válvula de pressão" -> VALVULA, PRESSAO). Para buscar por prefixo sem
+`$regex`, cada palavra é guardada também com seus prefixos (edge n-grams a
+partir de TAMANHO_MIN_PALAVRA caracteres) num array com índice multikey:
+
+    termos_indexados(["Válvula 1/2"])  ->  ["VA", "VAL", "VALV", "VALVU", "VALVUL", "VALVULA"]
+
+Uma consulta vira igualdade sobre esse array (`{"termos": {"$all": [...]}}`),
+que o Mongo resolve pelo índice. Palavras com menos de TAMANHO_MIN_PALAVRA
+caracteres ("1", "2", "X") são ignoradas nos dois lados.
+
+Códigos ("12.345-6") são indexados também compactados ("123456"), e vários
+campos podem dividir o mesmo array com um prefixo por campo
+(termos_de_campos/filtro_termos: "COD:1234", "DESC:VALV").
+"""
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+TAMANHO_MIN_PALAVRA = 2
+# Palavras mais longas são indexadas (e consultadas) só até aqui
+TAMANHO_MAX_TERMO = 20
+
+_RE_PALAVRA = re.compile(r"[A-Z0-9]+")
+
+
+def normalizar_texto(texto: Optional[str]) -> str:
+    """Maiúsculas e sem acentos ("Pressão" -> "PRESSAO")"""
+    if not texto:
+        return ""
+    decomposto = unicodedata.normalize("NFD", str(texto))
+    return "".join(c for c in decomposto if unicodedata.category(c) != "Mn").upper()
+
+
+def palavras(texto: Optional[str]) -> List[str]:
+    """Palavras normalizadas, sem repetição, na ordem em que aparecem"""
+    encontradas = _RE_PALAVRA.findall(normalizar_texto(texto))
+    return list(dict.fromkeys(
+        p[:TAMANHO_MAX_TERMO] for p in encontradas if len(p) >= TAMANHO_MIN_PALAVRA
+    ))
+
+
+def _compactar(texto: Optional[str]) -> str:
+    """Só letras e dígitos ("12.345-6" -> "123456")"""
+    return "".join(_RE_PALAVRA.findall(normalizar_texto(texto)))[:TAMANHO_MAX_TERMO]
+
+
+def termos_indexados(textos: Iterable[Optional[str]], compacto: bool = False) -> List[str]:
+    """
+    Palavras e seus prefixos, para o array indexado do documento.
+    compacto=True (códigos) indexa também o texto sem separadores.
+    """
+    termos = set()
+    for texto in textos:
+        encontradas = palavras(texto)
+        if compacto:
+            inteiro = _compactar(texto)
+            if len(inteiro) >= TAMANHO_MIN_PALAVRA:
+                encontradas.append(inteiro)
+        for palavra in encontradas:
+            termos.add(palavra)
+            termos.update(palavra[:n] for n in range(TAMANHO_MIN_PALAVRA, len(palavra)))
+    return sorted(termos)
+
+
+def termos_consulta(texto: Optional[str]) -> List[str]:
+    """
+    Termos de uma consulta (todos obrigatórios, cada um casando como prefixo
+    de uma palavra indexada). As palavras mais longas vêm primeiro: o Mongo usa
+    o primeiro elemento do `$all` nos limites do índice, e elas são as mais
+    seletivas.
+    """
+    return sorted(palavras(texto), key=len, reverse=True)
+
+
+def termos_de_campos(campos: Dict[str, Optional[str]], compactos: Iterable[str] = ()) -> List[str]:
+    """Termos de vários campos num único array, cada um com o prefixo "CAMPO:" """
+    compactos = set(compactos)
+    return [
+        f"{campo}:{termo}"
+        for campo, texto in campos.items()
+        for termo in termos_indexados([texto], compacto=campo in compactos)
+    ]
+
+
+def filtro_termos(consultas: Dict[str, Optional[str]], caminho: str = "termos") -> Optional[dict]:
+    """
+    Filtro Mongo para consultas por campo ({"COD": "12.34", "DESC": "valv pres"}):
+    todas as palavras de todos os campos são obrigatórias (E), cada uma como
+    prefixo. None se nenhuma consulta tem palavras válidas.
+    """
+    termos = [
+        (len(termo), f"{campo}:{termo}")
+        for campo, texto in consultas.items()
+        for termo in termos_consulta(texto)
+    ]
+    if not termos:
+        return None
+    termos.sort(key=lambda t: t[0], reverse=True)
+    return {caminho: {"$all": [termo for _, termo in termos]}}
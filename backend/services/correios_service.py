@@ -1,13 +1,28 @@
 """
 Serviço de integração com a API dos Correios
 Rastreamento de objetos e atualização automática de status
+
+Todas as requisições passam por um único httpx.AsyncClient (pool de conexões
+keep-alive) e por _requisicao(), que limita a concorrência (semáforo) e a
+taxa por host (token bucket) - a verificação em lote dispara dezenas de
+consultas simultâneas e não pode estourar os limites dos Correios.
+
+Configuração (variáveis de ambiente):
+    CORREIOS_CONCORRENCIA      - requisições simultâneas (padrão: 8)
+    CORREIOS_REQ_POR_SEGUNDO   - requisições por segundo, por host (padrão: 5)
+    RASTREIO_CACHE_MAX         - entradas do cache de rastreio em memória (padrão: 2000)
 """
+import asyncio
 import os
+import time
 import httpx
 import logging
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 from typing import Optional, Dict, List, Any
 
+from utils.database import db
+
 logger = logging.getLogger(__name__)
 
 # Configurações da API dos Correios
@@ -20,12 +35,85 @@ CORREIOS_SENHA = os.environ.get('CORREIOS_SENHA')
 CORREIOS_CARTAO_POSTAGEM = os.environ.get('CORREIOS_CARTAO_POSTAGEM')
 CORREIOS_CONTRATO = os.environ.get('CORREIOS_CONTRATO')
 
+CORREIOS_CONCORRENCIA = int(os.environ.get('CORREIOS_CONCORRENCIA') or 8)
+CORREIOS_REQ_POR_SEGUNDO = float(os.environ.get('CORREIOS_REQ_POR_SEGUNDO') or 5)
+
 # Cache do token
 _token_cache = {
     'token': None,
     'expires_at': None
 }
 
+
+class _LimitadorTaxa:
+    """Token bucket: no máximo `taxa` requisições/s, com rajada de até `taxa`"""
+
+    def __init__(self, taxa: float):
+        self.taxa = taxa
+        self.capacidade = max(1.0, taxa)
+        self._tokens = self.capacidade
+        self._ultimo = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def aguardar(self):
+        # O lock mantém a ordem de chegada enquanto um chamador espera o próximo token
+        async with self._lock:
+            while True:
+                agora = time.monotonic()
+                self._tokens = min(self.capacidade, self._tokens + (agora - self._ultimo) * self.taxa)
+                self._ultimo = agora
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.taxa)
+
+
+_client: Optional[httpx.AsyncClient] = None
+_semaforo: Optional[asyncio.Semaphore] = None
+_limitadores: Dict[str, _LimitadorTaxa] = {}
+_token_lock: Optional[asyncio.Lock] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Cliente compartilhado, criado sob demanda (reaproveita conexões TLS entre consultas)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(
+                max_connections=CORREIOS_CONCORRENCIA * 2,
+                max_keepalive_connections=CORREIOS_CONCORRENCIA
+            )
+        )
+    return _client
+
+
+def _get_semaforo() -> asyncio.Semaphore:
+    global _semaforo
+    if _semaforo is None:
+        _semaforo = asyncio.Semaphore(CORREIOS_CONCORRENCIA)
+    return _semaforo
+
+
+async def _requisicao(metodo: str, url: str, **kwargs) -> httpx.Response:
+    """Requisição HTTP pelo cliente compartilhado, respeitando concorrência e taxa por host"""
+    host = httpx.URL(url).host
+    limitador = _limitadores.get(host)
+    if limitador is None:
+        limitador = _limitadores[host] = _LimitadorTaxa(CORREIOS_REQ_POR_SEGUNDO)
+
+    async with _get_semaforo():
+        await limitador.aguardar()
+        return await _get_client().request(metodo, url, **kwargs)
+
+
+async def fechar_cliente_correios():
+    """Chamado no shutdown da aplicação"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 # Mapeamento de eventos dos Correios para status do sistema
 EVENTOS_ENTREGA = [
     'BDE',  # Objeto entregue ao destinatário
@@ -78,7 +166,7 @@ async def obter_token_correios() -> Optional[str]:
     Obtém token de autenticação da API dos Correios.
     Usa cache para evitar requisições desnecessárias.
     """
-    global _token_cache
+    global _token_cache, _token_lock
     
     # Verificar se tem token válido em cache
     if _token_cache['token'] and _token_cache['expires_at']:
@@ -89,67 +177,78 @@ async def obter_token_correios() -> Optional[str]:
         logger.error("Credenciais dos Correios não configuradas")
         return None
     
+    # Consultas concorrentes sem token: apenas uma autentica, as demais reaproveitam
+    if _token_lock is None:
+        _token_lock = asyncio.Lock()
+    async with _token_lock:
+        if _token_cache['token'] and _token_cache['expires_at']:
+            if datetime.now(timezone.utc) < _token_cache['expires_at']:
+                return _token_cache['token']
+        return await _autenticar_correios()
+
+
+async def _autenticar_correios() -> Optional[str]:
+    """Autentica na API dos Correios e atualiza o cache do token"""
     try:
         import base64
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Autenticação Basic: base64(usuario:senha)
-            credentials = base64.b64encode(f"{CORREIOS_USUARIO}:{CORREIOS_SENHA}".encode()).decode()
+        # Autenticação Basic: base64(usuario:senha)
+        credentials = base64.b64encode(f"{CORREIOS_USUARIO}:{CORREIOS_SENHA}".encode()).decode()
             
-            # Endpoint com cartão de postagem
-            if CORREIOS_CARTAO_POSTAGEM:
-                endpoint = f"{CORREIOS_API_URL}/token/v1/autentica/cartaopostagem"
-                payload = {
-                    "numero": CORREIOS_CARTAO_POSTAGEM
-                }
-                if CORREIOS_CONTRATO:
-                    payload["contrato"] = CORREIOS_CONTRATO
-            else:
-                # Autenticação simples sem cartão
-                endpoint = f"{CORREIOS_API_URL}/token/v1/autentica"
-                payload = {}
+        # Endpoint com cartão de postagem
+        if CORREIOS_CARTAO_POSTAGEM:
+            endpoint = f"{CORREIOS_API_URL}/token/v1/autentica/cartaopostagem"
+            payload = {
+                "numero": CORREIOS_CARTAO_POSTAGEM
+            }
+            if CORREIOS_CONTRATO:
+                payload["contrato"] = CORREIOS_CONTRATO
+        else:
+            # Autenticação simples sem cartão
+            endpoint = f"{CORREIOS_API_URL}/token/v1/autentica"
+            payload = {}
             
-            logger.info(f"Obtendo token dos Correios: {endpoint}")
+        logger.info(f"Obtendo token dos Correios: {endpoint}")
             
-            response = await client.post(
-                endpoint,
-                json=payload,
-                headers={
-                    "Authorization": f"Basic {credentials}",
-                    "Content-Type": "application/json",
-                    "Accept": "application/json"
-                }
-            )
+        response = await _requisicao(
+            "POST", endpoint,
+            json=payload,
+            headers={
+                "Authorization": f"Basic {credentials}",
+                "Content-Type": "application/json",
+                "Accept": "application/json"
+            }
+        )
             
-            if response.status_code == 201 or response.status_code == 200:
-                data = response.json()
-                token = data.get('token')
+        if response.status_code == 201 or response.status_code == 200:
+            data = response.json()
+            token = data.get('token')
                 
-                # expiraEm pode vir como string datetime ou int (segundos)
-                expires_em = data.get('expiraEm')
-                if isinstance(expires_em, str):
-                    # É uma data/hora no formato ISO
-                    try:
-                        expires_at = datetime.fromisoformat(expires_em.replace('Z', '+00:00'))
-                        # Garantir que tem timezone
-                        if expires_at.tzinfo is None:
-                            expires_at = expires_at.replace(tzinfo=timezone.utc)
-                        _token_cache['expires_at'] = expires_at - timedelta(minutes=5)  # 5min de margem
-                    except:
-                        _token_cache['expires_at'] = datetime.now(timezone.utc) + timedelta(hours=23)
-                elif isinstance(expires_em, int):
-                    _token_cache['expires_at'] = datetime.now(timezone.utc) + timedelta(seconds=expires_em - 300)
-                else:
+            # expiraEm pode vir como string datetime ou int (segundos)
+            expires_em = data.get('expiraEm')
+            if isinstance(expires_em, str):
+                # É uma data/hora no formato ISO
+                try:
+                    expires_at = datetime.fromisoformat(expires_em.replace('Z', '+00:00'))
+                    # Garantir que tem timezone
+                    if expires_at.tzinfo is None:
+                        expires_at = expires_at.replace(tzinfo=timezone.utc)
+                    _token_cache['expires_at'] = expires_at - timedelta(minutes=5)  # 5min de margem
+                except:
                     _token_cache['expires_at'] = datetime.now(timezone.utc) + timedelta(hours=23)
+            elif isinstance(expires_em, int):
+                _token_cache['expires_at'] = datetime.now(timezone.utc) + timedelta(seconds=expires_em - 300)
+            else:
+                _token_cache['expires_at'] = datetime.now(timezone.utc) + timedelta(hours=23)
                 
-                # Atualizar cache
-                _token_cache['token'] = token
+            # Atualizar cache
+            _token_cache['token'] = token
                 
-                logger.info("Token dos Correios obtido com sucesso")
-                return token
-            else:
-                logger.error(f"Erro ao obter token dos Correios: {response.status_code} - {response.text}")
-                return None
+            logger.info("Token dos Correios obtido com sucesso")
+            return token
+        else:
+            logger.error(f"Erro ao obter token dos Correios: {response.status_code} - {response.text}")
+            return None
                 
     except Exception as e:
         logger.error(f"Exceção ao obter token dos Correios: {str(e)}")
@@ -179,41 +278,40 @@ async def rastrear_objeto_correios(codigo_rastreio: str) -> Dict[str, Any]:
         return await _rastrear_fallback(codigo)
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            endpoint = f"{CORREIOS_RASTRO_URL}/objetos/{codigo}"
+        endpoint = f"{CORREIOS_RASTRO_URL}/objetos/{codigo}"
             
-            response = await client.get(
-                endpoint,
-                params={"resultado": "T"},  # T = Todos os eventos
-                headers={
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {token}"
-                }
-            )
+        response = await _requisicao(
+            "GET", endpoint,
+            params={"resultado": "T"},  # T = Todos os eventos
+            headers={
+                "Accept": "application/json",
+                "Authorization": f"Bearer {token}"
+            }
+        )
             
-            if response.status_code == 200:
-                data = response.json()
+        if response.status_code == 200:
+            data = response.json()
                 
-                # Verificar se o objeto pertence ao contrato
-                objetos = data.get('objetos', [])
-                if objetos and objetos[0].get('mensagem'):
-                    msg = objetos[0].get('mensagem', '')
-                    if 'não pertence ao contrato' in msg.lower() or 'SRO-009' in msg:
-                        # Objeto não pertence ao contrato, usar fallback
-                        logger.info(f"Objeto {codigo} não pertence ao contrato, usando fallback")
-                        return await _rastrear_fallback(codigo)
+            # Verificar se o objeto pertence ao contrato
+            objetos = data.get('objetos', [])
+            if objetos and objetos[0].get('mensagem'):
+                msg = objetos[0].get('mensagem', '')
+                if 'não pertence ao contrato' in msg.lower() or 'SRO-009' in msg:
+                    # Objeto não pertence ao contrato, usar fallback
+                    logger.info(f"Objeto {codigo} não pertence ao contrato, usando fallback")
+                    return await _rastrear_fallback(codigo)
                 
-                return _processar_resposta_correios(data, codigo)
-            elif response.status_code == 401:
-                # Token expirado, limpar cache e tentar novamente
-                _token_cache['token'] = None
-                _token_cache['expires_at'] = None
-                logger.warning("Token expirado, obtendo novo...")
-                return await rastrear_objeto_correios(codigo)
-            else:
-                logger.warning(f"Erro na API Correios: {response.status_code}")
-                # Fallback para API pública
-                return await _rastrear_fallback(codigo)
+            return _processar_resposta_correios(data, codigo)
+        elif response.status_code == 401:
+            # Token expirado, limpar cache e tentar novamente
+            _token_cache['token'] = None
+            _token_cache['expires_at'] = None
+            logger.warning("Token expirado, obtendo novo...")
+            return await rastrear_objeto_correios(codigo)
+        else:
+            logger.warning(f"Erro na API Correios: {response.status_code}")
+            # Fallback para API pública
+            return await _rastrear_fallback(codigo)
                 
     except Exception as e:
         logger.error(f"Exceção ao rastrear objeto: {str(e)}")
@@ -322,58 +420,58 @@ async def _rastrear_seurastreio(codigo: str) -> Dict[str, Any]:
     Fallback usando API SeuRastreio.com.br (gratuita, sem autenticação).
     """
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            response = await client.get(
-                f"https://seurastreio.com.br/api/public/rastreio/{codigo}",
-                headers={"Accept": "application/json"}
-            )
+        response = await _requisicao(
+            "GET", f"https://seurastreio.com.br/api/public/rastreio/{codigo}",
+            timeout=15.0,
+            headers={"Accept": "application/json"}
+        )
             
-            if response.status_code == 200:
-                data = response.json()
+        if response.status_code == 200:
+            data = response.json()
                 
-                if data.get('status') == 'found' and data.get('ultimoEvento'):
-                    ultimo = data.get('ultimoEvento', {})
-                    status_desc = ultimo.get('descricao', '')
-                    status_lower = status_desc.lower()
+            if data.get('status') == 'found' and data.get('ultimoEvento'):
+                ultimo = data.get('ultimoEvento', {})
+                status_desc = ultimo.get('descricao', '')
+                status_lower = status_desc.lower()
                     
-                    entregue = any(d in status_lower for d in DESCRICOES_ENTREGA)
-                    saiu_para_entrega = any(d in status_lower for d in DESCRICOES_SAIU_ENTREGA)
-                    tentativa_entrega = any(d in status_lower for d in DESCRICOES_TENTATIVA)
+                entregue = any(d in status_lower for d in DESCRICOES_ENTREGA)
+                saiu_para_entrega = any(d in status_lower for d in DESCRICOES_SAIU_ENTREGA)
+                tentativa_entrega = any(d in status_lower for d in DESCRICOES_TENTATIVA)
                     
-                    evento = {
-                        "data": ultimo.get('data', ''),
-                        "hora": ultimo.get('hora', ''),
-                        "local": ultimo.get('local', ''),
-                        "cidade": ultimo.get('cidade', ''),
-                        "uf": ultimo.get('uf', ''),
-                        "status": status_desc,
-                        "tipo": '',
-                        "subStatus": '',
-                    }
+                evento = {
+                    "data": ultimo.get('data', ''),
+                    "hora": ultimo.get('hora', ''),
+                    "local": ultimo.get('local', ''),
+                    "cidade": ultimo.get('cidade', ''),
+                    "uf": ultimo.get('uf', ''),
+                    "status": status_desc,
+                    "tipo": '',
+                    "subStatus": '',
+                }
                     
-                    return {
-                        "success": True,
-                        "codigo": codigo,
-                        "eventos": [evento],
-                        "entregue": entregue,
-                        "saiu_para_entrega": saiu_para_entrega,
-                        "tentativa_entrega": tentativa_entrega,
-                        "ultimo_evento": evento,
-                        "fonte": "seurastreio",
-                        "link_detalhes": data.get('linkDetalhesCompletos', '')
-                    }
-                elif data.get('status') == 'no_events':
-                    return {
-                        "success": True,
-                        "codigo": codigo,
-                        "eventos": [],
-                        "entregue": False,
-                        "saiu_para_entrega": False,
-                        "tentativa_entrega": False,
-                        "ultimo_evento": None,
-                        "fonte": "seurastreio",
-                        "mensagem": "Objeto postado, aguardando movimentação"
-                    }
+                return {
+                    "success": True,
+                    "codigo": codigo,
+                    "eventos": [evento],
+                    "entregue": entregue,
+                    "saiu_para_entrega": saiu_para_entrega,
+                    "tentativa_entrega": tentativa_entrega,
+                    "ultimo_evento": evento,
+                    "fonte": "seurastreio",
+                    "link_detalhes": data.get('linkDetalhesCompletos', '')
+                }
+            elif data.get('status') == 'no_events':
+                return {
+                    "success": True,
+                    "codigo": codigo,
+                    "eventos": [],
+                    "entregue": False,
+                    "saiu_para_entrega": False,
+                    "tentativa_entrega": False,
+                    "ultimo_evento": None,
+                    "fonte": "seurastreio",
+                    "mensagem": "Objeto postado, aguardando movimentação"
+                }
     except Exception as e:
         logger.warning(f"SeuRastreio API falhou: {str(e)}")
     
@@ -385,59 +483,59 @@ async def _rastrear_linketrack(codigo: str) -> Dict[str, Any]:
     Fallback usando API LinkeTrack (gratuita, com credenciais de teste).
     """
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            response = await client.get(
-                f"https://api.linketrack.com/track/json",
-                params={
-                    "user": "teste",
-                    "token": "1abcd00b2731640e886fb41a8a9671ad1434c599dbaa0a0de9a5aa619f29a83f",
-                    "codigo": codigo
-                },
-                headers={"Accept": "application/json"}
-            )
+        response = await _requisicao(
+            "GET", "https://api.linketrack.com/track/json",
+            timeout=15.0,
+            params={
+                "user": "teste",
+                "token": "1abcd00b2731640e886fb41a8a9671ad1434c599dbaa0a0de9a5aa619f29a83f",
+                "codigo": codigo
+            },
+            headers={"Accept": "application/json"}
+        )
             
-            if response.status_code == 200:
-                data = response.json()
-                eventos_raw = data.get('eventos', [])
+        if response.status_code == 200:
+            data = response.json()
+            eventos_raw = data.get('eventos', [])
                 
-                eventos = []
-                entregue = False
-                saiu_para_entrega = False
-                tentativa_entrega = False
+            eventos = []
+            entregue = False
+            saiu_para_entrega = False
+            tentativa_entrega = False
                 
-                for evento in eventos_raw:
-                    status = evento.get('status', '')
-                    status_lower = status.lower()
+            for evento in eventos_raw:
+                status = evento.get('status', '')
+                status_lower = status.lower()
                     
-                    if any(d in status_lower for d in DESCRICOES_ENTREGA):
-                        entregue = True
-                    if any(d in status_lower for d in DESCRICOES_SAIU_ENTREGA):
-                        saiu_para_entrega = True
-                    if any(d in status_lower for d in DESCRICOES_TENTATIVA):
-                        tentativa_entrega = True
+                if any(d in status_lower for d in DESCRICOES_ENTREGA):
+                    entregue = True
+                if any(d in status_lower for d in DESCRICOES_SAIU_ENTREGA):
+                    saiu_para_entrega = True
+                if any(d in status_lower for d in DESCRICOES_TENTATIVA):
+                    tentativa_entrega = True
                     
-                    eventos.append({
-                        "data": evento.get('data', ''),
-                        "hora": evento.get('hora', ''),
-                        "local": evento.get('local', ''),
-                        "cidade": evento.get('local', '').split(' - ')[0] if ' - ' in evento.get('local', '') else '',
-                        "uf": evento.get('local', '').split(' - ')[-1] if ' - ' in evento.get('local', '') else '',
-                        "status": status,
-                        "tipo": '',
-                        "subStatus": evento.get('subStatus', []),
-                    })
+                eventos.append({
+                    "data": evento.get('data', ''),
+                    "hora": evento.get('hora', ''),
+                    "local": evento.get('local', ''),
+                    "cidade": evento.get('local', '').split(' - ')[0] if ' - ' in evento.get('local', '') else '',
+                    "uf": evento.get('local', '').split(' - ')[-1] if ' - ' in evento.get('local', '') else '',
+                    "status": status,
+                    "tipo": '',
+                    "subStatus": evento.get('subStatus', []),
+                })
                 
-                if eventos:
-                    return {
-                        "success": True,
-                        "codigo": codigo,
-                        "eventos": eventos,
-                        "entregue": entregue,
-                        "saiu_para_entrega": saiu_para_entrega,
-                        "tentativa_entrega": tentativa_entrega,
-                        "ultimo_evento": eventos[0] if eventos else None,
-                        "fonte": "linketrack"
-                    }
+            if eventos:
+                return {
+                    "success": True,
+                    "codigo": codigo,
+                    "eventos": eventos,
+                    "entregue": entregue,
+                    "saiu_para_entrega": saiu_para_entrega,
+                    "tentativa_entrega": tentativa_entrega,
+                    "ultimo_evento": eventos[0] if eventos else None,
+                    "fonte": "linketrack"
+                }
                     
     except Exception as e:
         logger.warning(f"LinkeTrack API falhou: {str(e)}")
@@ -489,3 +587,169 @@ def verificar_status_evento(eventos: List[Dict]) -> Dict[str, bool]:
         result["em_transito"] = True
     
     return result
+
+
+# ============== CACHE DE RASTREAMENTO ==============
+#
+# O mesmo código é consultado pela verificação horária, por /rastreio/{codigo}
+# e a cada abertura da tela. O resultado fica num LRU em memória e na coleção
+# `rastreio_cache` (sobrevive a reinícios), com validade conforme o último
+# evento: objeto entregue quase não muda; "saiu para entrega" muda em minutos.
+#
+# Consultas de usuário usam stale-while-revalidate: uma entrada vencida (até
+# CACHE_JANELA_DESATUALIZADO) é devolvida na hora e atualizada em background.
+# Consultas simultâneas do mesmo código compartilham uma única requisição.
+
+COLECAO_CACHE = "rastreio_cache"
+CACHE_TTL_ENTREGUE = timedelta(days=7)
+CACHE_TTL_SAIU_ENTREGA = timedelta(minutes=10)
+CACHE_TTL_TENTATIVA = timedelta(minutes=30)
+CACHE_TTL_TRANSITO = timedelta(minutes=45)  # menor que o intervalo da verificação horária
+CACHE_TTL_FALHA = timedelta(minutes=5)
+CACHE_JANELA_DESATUALIZADO = timedelta(days=2)
+CACHE_MAX_ENTRADAS = int(os.environ.get('RASTREIO_CACHE_MAX') or 2000)
+
+_cache_lru: "OrderedDict[str, dict]" = OrderedDict()
+_em_andamento: Dict[str, asyncio.Future] = {}
+_revalidacoes: set = set()  # referência às tarefas em background até terminarem
+
+
+def _ttl_resultado(resultado: Dict[str, Any]) -> timedelta:
+    if not resultado.get('success'):
+        return CACHE_TTL_FALHA
+    if resultado.get('entregue'):
+        return CACHE_TTL_ENTREGUE
+    if resultado.get('saiu_para_entrega'):
+        return CACHE_TTL_SAIU_ENTREGA
+    if resultado.get('tentativa_entrega'):
+        return CACHE_TTL_TENTATIVA
+    return CACHE_TTL_TRANSITO
+
+
+def _guardar_lru(codigo: str, entrada: dict):
+    _cache_lru[codigo] = entrada
+    _cache_lru.move_to_end(codigo)
+    while len(_cache_lru) > CACHE_MAX_ENTRADAS:
+        _cache_lru.popitem(last=False)
+
+
+async def _ler_cache(codigo: str) -> Optional[dict]:
+    entrada = _cache_lru.get(codigo)
+    if entrada is not None:
+        _cache_lru.move_to_end(codigo)
+        return entrada
+
+    entrada = await db.rastreio_cache.find_one({"codigo": codigo}, {"_id": 0})
+    if entrada is not None:
+        entrada["expira_em"] = _como_utc(entrada["expira_em"])
+        _guardar_lru(codigo, entrada)
+    return entrada
+
+
+def _como_utc(valor: datetime) -> datetime:
+    # O driver devolve datetimes sem timezone (UTC)
+    return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+
+
+def _resposta_cache(entrada: dict, desatualizado: bool) -> Dict[str, Any]:
+    return {
+        **entrada["resultado"],
+        "atualizado_em": entrada["atualizado_em"],
+        "desatualizado": desatualizado or entrada.get("falha_revalidacao", False)
+    }
+
+
+async def _atualizar_cache(codigo: str) -> dict:
+    """Consulta as APIs e grava o resultado. Falha não sobrescreve um resultado válido anterior."""
+    resultado = await rastrear_objeto_correios(codigo)
+    agora = datetime.now(timezone.utc)
+
+    if not resultado.get('success'):
+        anterior = await _ler_cache(codigo)
+        if anterior is not None and anterior["resultado"].get('success'):
+            # Mantém o último resultado válido e adia a próxima tentativa
+            anterior = {**anterior, "expira_em": agora + CACHE_TTL_FALHA, "falha_revalidacao": True}
+            _guardar_lru(codigo, anterior)
+            return anterior
+        entrada = {"codigo": codigo, "resultado": resultado, "atualizado_em": agora.isoformat(), "expira_em": agora + CACHE_TTL_FALHA}
+        _guardar_lru(codigo, entrada)
+        return entrada
+
+    entrada = {
+        "codigo": codigo,
+        "resultado": resultado,
+        "atualizado_em": agora.isoformat(),
+        "expira_em": agora + _ttl_resultado(resultado)
+    }
+    _guardar_lru(codigo, entrada)
+    await db.rastreio_cache.update_one(
+        {"codigo": codigo},
+        {"$set": {**entrada, "descartar_em": entrada["expira_em"] + CACHE_JANELA_DESATUALIZADO}},
+        upsert=True
+    )
+    return entrada
+
+
+async def _atualizar_unico(codigo: str) -> dict:
+    """Uma única atualização em andamento por código; os demais chamadores aguardam a mesma"""
+    futuro = _em_andamento.get(codigo)
+    if futuro is None:
+        futuro = asyncio.ensure_future(_atualizar_cache(codigo))
+        _em_andamento[codigo] = futuro
+        futuro.add_done_callback(lambda _: _em_andamento.pop(codigo, None))
+    return await asyncio.shield(futuro)
+
+
+def _revalidar_em_background(codigo: str):
+    if codigo in _em_andamento:
+        return
+
+    async def _revalidar():
+        try:
+            await _atualizar_unico(codigo)
+        except Exception as e:
+            logger.warning(f"Falha ao revalidar rastreio {codigo} em background: {e}")
+
+    tarefa = asyncio.ensure_future(_revalidar())
+    _revalidacoes.add(tarefa)
+    tarefa.add_done_callback(_revalidacoes.discard)
+
+
+async def rastrear_objeto_com_cache(codigo_rastreio: str, permitir_desatualizado: bool = True) -> Dict[str, Any]:
+    """
+    rastrear_objeto_correios com cache. A resposta inclui `atualizado_em` e
+    `desatualizado`.
+
+    permitir_desatualizado=True (telas): entrada vencida é devolvida na hora e
+    revalidada em background.
+    permitir_desatualizado=False (verificação agendada, atualização pedida
+    pelo usuário): entrada vencida é consultada de novo antes de responder.
+    """
+    if not codigo_rastreio:
+        return {"success": False, "error": "Código de rastreio não informado"}
+    codigo = codigo_rastreio.strip().upper()
+    agora = datetime.now(timezone.utc)
+
+    entrada = await _ler_cache(codigo)
+    if entrada is not None:
+        if agora < entrada["expira_em"]:
+            return _resposta_cache(entrada, desatualizado=False)
+        if (permitir_desatualizado and entrada["resultado"].get('success')
+                and agora < entrada["expira_em"] + CACHE_JANELA_DESATUALIZADO):
+            _revalidar_em_background(codigo)
+            return _resposta_cache(entrada, desatualizado=True)
+
+    entrada = await _atualizar_unico(codigo)
+    return _resposta_cache(entrada, desatualizado=False)
+
+
+async def invalidar_cache_rastreio(codigo_rastreio: str):
+    codigo = (codigo_rastreio or "").strip().upper()
+    _cache_lru.pop(codigo, None)
+    await db.rastreio_cache.delete_one({"codigo": codigo})
+
+
+async def criar_indices_cache_rastreio():
+    """Chamado no startup: busca por código e expiração automática (TTL) das entradas antigas"""
+    await db.rastreio_cache.create_index("codigo", unique=True)
+    await db.rastreio_cache.create_index("descartar_em", expireAfterSeconds=0)
@@ -0,0 +1,143 @@
+"""
+Contadores pré-calculados do dashboard (coleção `dashboard_counters`)
+
+O /dashboard é consultado por todos os usuários o tempo todo. Em vez de
+agregar todos os itens a cada carregamento, mantém um documento por
+responsável (normalizado, "" = sem responsável) e um documento de totais:
+
+    {
+        "_id": "MARIA" | "" | "*",
+        "itens": {"pendente": 3, "cotado": 1, ...},
+        "total": 4,          # itens
+        "ocs": 2,            # OCs com pelo menos um item do responsável
+        "atualizado_em"
+    }
+
+O documento de totais não tem "ocs": o total de OCs inclui as que não têm
+itens (sem linha em po_items) e é lido de purchase_orders (count_documents).
+
+Os contadores são incrementados ($inc) pela mesma camada que mantém o
+read-model po_items (services/po_items_service.py): cada linha substituída
+gera -1 no estado anterior e +1 no novo. A reconciliação periódica
+recalcula tudo a partir de po_items e corrige qualquer desvio.
+"""
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+COLECAO = "dashboard_counters"
+COLECAO_ITENS = "po_items"  # services/po_items_service.py
+CHAVE_TOTAL = "*"
+SEM_STATUS = "sem_status"
+
+
+def _chave_status(status: Optional[str]) -> str:
+    return status or SEM_STATUS
+
+
+class DeltasContadores:
+    """Acumula incrementos para aplicar num único bulk_write"""
+
+    def __init__(self):
+        self._inc: Dict[str, Counter] = defaultdict(Counter)
+
+    def item(self, linha: Optional[dict], sinal: int):
+        """Conta (+1) ou desconta (-1) uma linha de po_items"""
+        if not linha:
+            return
+        status = _chave_status(linha.get("status"))
+        for chave in (linha.get("responsavel_norm") or "", CHAVE_TOTAL):
+            self._inc[chave][f"itens.{status}"] += sinal
+            self._inc[chave]["total"] += sinal
+
+    def oc(self, responsaveis_antes: Iterable[str], responsaveis_depois: Iterable[str]):
+        """Atualiza a contagem de OCs pelos responsáveis presentes antes/depois na OC"""
+        antes, depois = set(responsaveis_antes), set(responsaveis_depois)
+        for resp in depois - antes:
+            self._inc[resp]["ocs"] += 1
+        for resp in antes - depois:
+            self._inc[resp]["ocs"] -= 1
+
+    def operacoes(self) -> List[UpdateOne]:
+        agora = datetime.now(timezone.utc).isoformat()
+        operacoes = []
+        for chave, contador in self._inc.items():
+            inc = {campo: valor for campo, valor in contador.items() if valor}
+            if inc:
+                operacoes.append(UpdateOne(
+                    {"_id": chave},
+                    {"$inc": inc, "$set": {"atualizado_em": agora}},
+                    upsert=True
+                ))
+        return operacoes
+
+
+async def aplicar_deltas(deltas: DeltasContadores) -> None:
+    operacoes = deltas.operacoes()
+    if not operacoes:
+        return
+    try:
+        await db[COLECAO].bulk_write(operacoes, ordered=False)
+    except Exception as e:
+        # A reconciliação periódica corrige o desvio
+        logger.error(f"Erro ao atualizar contadores do dashboard: {e}")
+
+
+async def ler_contadores(responsavel_norm: Optional[str] = None) -> List[dict]:
+    """
+    Admin (None): todos os documentos (um por responsável + totais).
+    Usuário: apenas o próprio documento, lido pelo _id.
+    """
+    if responsavel_norm is None:
+        return await db[COLECAO].find({}).to_list(None)
+    doc = await db[COLECAO].find_one({"_id": responsavel_norm})
+    return [doc] if doc else []
+
+
+async def reconciliar_contadores() -> dict:
+    """
+    Recalcula todos os contadores a partir de po_items e substitui os documentos.
+    Incrementos concorrentes durante a reconciliação podem se perder; a próxima
+    execução os recupera.
+    """
+    agora = datetime.now(timezone.utc).isoformat()
+    docs: Dict[str, dict] = {}
+
+    def doc(chave: str) -> dict:
+        novo = {"_id": chave, "itens": {}, "total": 0, "atualizado_em": agora}
+        if chave != CHAVE_TOTAL:
+            novo["ocs"] = 0
+        return docs.setdefault(chave, novo)
+
+    doc(CHAVE_TOTAL)
+    pipeline_itens = [{"$group": {
+        "_id": {"responsavel": "$responsavel_norm", "status": "$status"},
+        "n": {"$sum": 1}
+    }}]
+    async for r in db[COLECAO_ITENS].aggregate(pipeline_itens):
+        status = _chave_status(r["_id"].get("status"))
+        for chave in (r["_id"].get("responsavel") or "", CHAVE_TOTAL):
+            d = doc(chave)
+            d["itens"][status] = d["itens"].get(status, 0) + r["n"]
+            d["total"] += r["n"]
+
+    pipeline_ocs = [
+        {"$group": {"_id": {"responsavel": "$responsavel_norm", "po_id": "$po_id"}}},
+        {"$group": {"_id": "$_id.responsavel", "n": {"$sum": 1}}}
+    ]
+    async for r in db[COLECAO_ITENS].aggregate(pipeline_ocs):
+        doc(r["_id"] or "")["ocs"] = r["n"]
+
+    operacoes = [ReplaceOne({"_id": chave}, d, upsert=True) for chave, d in docs.items()]
+    operacoes.append(DeleteMany({"_id": {"$nin": list(docs)}}))
+    await db[COLECAO].bulk_write(operacoes, ordered=False)
+
+    logger.info(f"Contadores do dashboard reconciliados: {len(docs)} documento(s)")
+    return {"documentos": len(docs), "itens": docs[CHAVE_TOTAL]["total"]}
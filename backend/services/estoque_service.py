@@ -4,6 +4,7 @@ Serviço de Estoque - Funções de lógica de negócio para gestão de estoque
 import logging
 from datetime import datetime, timezone
 from utils.database import db
+from services.item_patch_service import snapshot_itens, salvar_itens
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +62,8 @@ async def reverter_uso_estoque(item: dict, po_id: str, numero_oc: str) -> dict:
             logger.warning(f"OC de origem {numero_oc_origem} não encontrada para reverter estoque")
             continue
         
+        itens_origem_antes = snapshot_itens(po_origem.get('items', []))
+        
         # Encontrar o item com o mesmo código na OC de origem
         codigo_item = item.get('codigo_item')
         item_origem_atualizado = False
@@ -86,11 +89,8 @@ async def reverter_uso_estoque(item: dict, po_id: str, numero_oc: str) -> dict:
             break
         
         if item_origem_atualizado:
-            # Salvar a OC de origem atualizada
-            await db.purchase_orders.update_one(
-                {"id": po_origem['id']},
-                {"$set": {"items": po_origem['items']}}
-            )
+            # Salvar a OC de origem atualizada (apenas o item alterado)
+            await salvar_itens(po_origem['id'], itens_origem_antes, po_origem['items'])
             
             resultado['fontes_revertidas'].append({
                 'numero_oc': numero_oc_origem,
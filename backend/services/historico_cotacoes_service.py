@@ -0,0 +1,212 @@
+"""
+Histórico de cotações: coleção `historico_cotacoes` (uma linha por fonte de compra)
+
+O diálogo de cotação mostra links e fornecedores de cotações anteriores do
+mesmo código ou de descrição parecida. Antes isso carregava até 5000 OCs
+inteiras e comparava descrições em Python a cada consulta. Aqui cada fonte de
+compra de um item já cotado vira uma linha com o código normalizado e os
+termos da descrição (services/busca_service.py), e a consulta é resolvida
+pelos índices, com o limite aplicado no próprio Mongo:
+
+    {
+        "_id": "<po_id>:<item_index>:<n>",
+        "po_id", "item_index", "numero_oc", "codigo_item", "codigo_norm",
+        "descricao", "termos", "status",
+        "fornecedor", "link", "preco_unitario", "frete", "data_compra"
+    }
+
+As linhas acompanham a sincronização de po_items (po_items_service chama
+sincronizar_historico() com a OC relida do banco) e são reconstruídas junto
+com ela, então valem as mesmas garantias: idempotente e corrigida pela
+próxima escrita ou pela reconstrução completa.
+"""
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
+
+from pymongo import DeleteMany, ReplaceOne
+
+from services.busca_service import termos_consulta, termos_indexados
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+COLECAO = "historico_cotacoes"
+TAMANHO_LOTE = 1000
+
+# Status em que o item já passou pela cotação
+STATUS_COTADOS = ("cotado", "comprado", "em_separacao", "em_transito", "entregue")
+
+LIMITE_PADRAO = 10
+LIMITE_MAXIMO = 50
+# Linhas mais recentes examinadas antes da deduplicação (termos muito comuns)
+LIMITE_VARREDURA = 500
+
+CAMPOS_RESPOSTA = (
+    "numero_oc", "codigo_item", "descricao", "status",
+    "fornecedor", "link", "preco_unitario", "frete", "data_compra",
+)
+
+
+def normalizar_codigo_item(codigo: Optional[str]) -> str:
+    return (codigo or "").strip().upper()
+
+
+def _data_item(item: dict) -> str:
+    data = item.get("updated_at") or item.get("created_at") or ""
+    return data.isoformat() if isinstance(data, datetime) else str(data)
+
+
+def montar_linhas(po: dict, item_index: int, item: dict) -> List[dict]:
+    """Linhas de um item (nenhuma se ainda não foi cotado ou não tem fontes)"""
+    status = (item.get("status") or "").lower()
+    if status not in STATUS_COTADOS:
+        return []
+
+    base = {
+        "po_id": po["id"],
+        "item_index": item_index,
+        "numero_oc": po.get("numero_oc", ""),
+        "codigo_item": item.get("codigo_item", ""),
+        "codigo_norm": normalizar_codigo_item(item.get("codigo_item")),
+        "descricao": item.get("descricao", ""),
+        "termos": termos_indexados([item.get("descricao")]),
+        "status": status,
+        "data_compra": _data_item(item),
+    }
+    linhas = []
+    for n, fonte in enumerate(item.get("fontes_compra") or []):
+        fornecedor = (fonte.get("fornecedor") or "").strip()
+        link = (fonte.get("link") or "").strip()
+        if not fornecedor and not link:
+            continue
+        linhas.append({
+            **base,
+            "_id": f"{po['id']}:{item_index}:{n}",
+            "fornecedor": fornecedor,
+            "link": link,
+            "preco_unitario": fonte.get("preco_unitario", 0),
+            "frete": fonte.get("frete", 0),
+        })
+    return linhas
+
+
+async def sincronizar_historico(po_id: str, po: Optional[dict], indices: Optional[Iterable[int]] = None) -> None:
+    """
+    Aplica em historico_cotacoes o estado atual da OC (`po` None = OC excluída).
+    indices None = OC inteira. _id determinístico: sincronizações concorrentes
+    da mesma OC nunca duplicam linhas.
+    """
+    items = (po or {}).get("items") or []
+    filtro = {"po_id": po_id}
+    if indices is None:
+        alvos = range(len(items))
+    else:
+        alvos = [i for i in indices if 0 <= i < len(items)]
+        filtro["item_index"] = {"$in": list(alvos)}
+
+    linhas = [linha for idx in alvos for linha in montar_linhas(po, idx, items[idx])]
+    operacoes = [ReplaceOne({"_id": linha["_id"]}, linha, upsert=True) for linha in linhas]
+    # Fontes removidas, itens que voltaram de status ou deixaram de existir
+    operacoes.append(DeleteMany({**filtro, "_id": {"$nin": [linha["_id"] for linha in linhas]}}))
+    await db[COLECAO].bulk_write(operacoes, ordered=False)
+
+
+async def buscar_historico(codigo_item: Optional[str], descricao: Optional[str],
+                           limite: int = LIMITE_PADRAO) -> List[dict]:
+    """
+    Cotações mais recentes do mesmo código OU com todas as palavras da
+    descrição (sem acento, por prefixo). Fornecedor/link/preço repetidos
+    aparecem uma vez só, com a data mais recente.
+    """
+    filtros = []
+    codigo = normalizar_codigo_item(codigo_item)
+    if codigo:
+        filtros.append({"codigo_norm": codigo})
+    termos = termos_consulta(descricao)
+    if termos:
+        filtros.append({"termos": {"$all": termos}})
+    if not filtros:
+        return []
+
+    pipeline = [
+        {"$match": filtros[0] if len(filtros) == 1 else {"$or": filtros}},
+        {"$sort": {"data_compra": -1}},
+        {"$limit": LIMITE_VARREDURA},
+        {"$group": {
+            "_id": {"fornecedor": "$fornecedor", "link": "$link", "preco": "$preco_unitario"},
+            "linha": {"$first": "$$ROOT"}
+        }},
+        {"$replaceRoot": {"newRoot": "$linha"}},
+        {"$sort": {"data_compra": -1}},
+        {"$limit": max(1, min(limite, LIMITE_MAXIMO))},
+        {"$project": {"_id": 0, **{campo: 1 for campo in CAMPOS_RESPOSTA}}},
+    ]
+    return await db[COLECAO].aggregate(pipeline).to_list(None)
+
+
+async def _criar_indices(colecao) -> None:
+    await colecao.create_index([("po_id", 1), ("item_index", 1)])
+    await colecao.create_index([("codigo_norm", 1), ("data_compra", -1)])
+    # Multikey: uma entrada por termo/prefixo da descrição
+    await colecao.create_index([("termos", 1), ("data_compra", -1)])
+
+
+async def criar_indices_historico() -> None:
+    """Chamado no startup da aplicação"""
+    await _criar_indices(db[COLECAO])
+
+
+async def reconstruir_historico() -> dict:
+    """
+    Reconstrói a coleção a partir de purchase_orders numa coleção temporária
+    renomeada sobre `historico_cotacoes` no final. Chamado por
+    reconstruir_po_items(), que ressincroniza as OCs alteradas no meio tempo.
+    """
+    inicio = datetime.now(timezone.utc)
+    nome_tmp = f"{COLECAO}_rebuild_{uuid.uuid4().hex[:8]}"
+    tmp = db[nome_tmp]
+    linhas = []
+    total = 0
+
+    try:
+        async for po in db.purchase_orders.find(
+            {"items.fontes_compra.0": {"$exists": True}},
+            {"_id": 0, "id": 1, "numero_oc": 1, "items": 1}
+        ):
+            for idx, item in enumerate(po.get("items") or []):
+                linhas.extend(montar_linhas(po, idx, item))
+            if len(linhas) >= TAMANHO_LOTE:
+                await tmp.insert_many(linhas, ordered=False)
+                total += len(linhas)
+                linhas = []
+        if linhas:
+            await tmp.insert_many(linhas, ordered=False)
+            total += len(linhas)
+    except BaseException:
+        await tmp.drop()
+        raise
+
+    if total:
+        await _criar_indices(tmp)
+        await db.client.admin.command(
+            "renameCollection", f"{db.name}.{nome_tmp}",
+            to=f"{db.name}.{COLECAO}", dropTarget=True
+        )
+    else:
+        await db[COLECAO].delete_many({})
+        await criar_indices_historico()
+
+    segundos = (datetime.now(timezone.utc) - inicio).total_seconds()
+    logger.info(f"historico_cotacoes reconstruída: {total} cotações em {segundos:.1f}s")
+    return {"cotacoes": total, "segundos": round(segundos, 1)}
+
+
+async def historico_precisa_reconstruir() -> bool:
+    """True se a coleção está vazia mas já existem OCs com fontes de compra"""
+    if await db[COLECAO].estimated_document_count() > 0:
+        return False
+    return await db.purchase_orders.find_one(
+        {"items.fontes_compra.0": {"$exists": True}}, {"_id": 1}
+    ) is not None
@@ -0,0 +1,375 @@
+"""
+Variantes das imagens de itens (miniatura e média) e respostas com ETag
+
+As grades de OCs mostram centenas de fotos de itens e cada célula baixava o
+upload original (até 5MB). No upload, o Pillow gera - fora do event loop -
+duas variantes em WebP e em JPEG, gravadas no GridFS como qualquer blob:
+
+    {
+        "codigo_item", "blob_id", "sha256", ...          # original
+        "variantes": {
+            "thumb": {"webp": {blob_id, sha256, size}, "jpeg": {...}, "largura", "altura"},
+            "media": {...}
+        },
+        "variantes_de": "<sha256 do original>"
+    }
+
+Junto vai um "lqip": prévia minúscula (WebP de ~16px em data URL, poucas
+centenas de bytes) que as grades mostram enquanto a miniatura carrega.
+
+Imagens enviadas antes disso ganham as variantes na primeira vez que uma
+delas é pedida. As respostas levam ETag forte (SHA-256 do conteúdo servido)
+e um If-None-Match que casa responde 304 sem ler o arquivo. URLs com a
+versão (?v=<início do SHA-256>) são imutáveis e ficam em cache por um ano.
+
+Os bytes já decodificados ficam num LRU em memória limitado por tamanho
+(IMAGEM_CACHE_MAX_BYTES), com chave (codigo_item, data_upload, variante):
+um novo upload muda data_upload, então outros workers nunca servem a imagem
+antiga; upload/remoção ainda invalidam o código no processo atual.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi.responses import Response
+
+from utils.database import db
+from services.blob_service import salvar_blob, ler_conteudo, remover_blob
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Maior lado (px) de cada variante
+VARIANTES = {
+    "thumb": int(os.environ.get('IMAGEM_THUMB_PX') or 240),
+    "media": int(os.environ.get('IMAGEM_MEDIA_PX') or 800),
+}
+QUALIDADE = int(os.environ.get('IMAGEM_QUALIDADE') or 80)
+FORMATOS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+LQIP_PX = 16
+TAMANHO_VERSAO = 16  # caracteres do SHA-256 usados em ?v=
+
+# Sem versão na URL a imagem pode mudar: o navegador guarda, mas revalida (304)
+CACHE_REVALIDAR = "public, no-cache"
+# Com a versão certa na URL o conteúdo nunca muda
+CACHE_IMUTAVEL = "public, max-age=31536000, immutable"
+
+CACHE_MAX_BYTES = int(os.environ.get('IMAGEM_CACHE_MAX_BYTES') or 64 * 1024 * 1024)
+# Uma entrada não passa de 1/8 do orçamento: originais enormes não esvaziam o cache
+CACHE_MAX_ENTRADA = CACHE_MAX_BYTES // 8
+
+_cache_imagens: "OrderedDict[tuple, tuple]" = OrderedDict()  # (codigo, data_upload, nome) -> (bytes, sha256)
+_chaves_por_codigo: Dict[str, set] = {}
+_bytes_em_cache = 0
+_metricas = {"hits": 0, "misses": 0, "evictions": 0, "invalidacoes": 0}
+
+# Gerações de variantes em curso: (codigo_item, data_upload) -> variantes
+_em_andamento: Dict[tuple, asyncio.Future] = {}
+
+
+def _cache_remover(chave: tuple) -> int:
+    global _bytes_em_cache
+    conteudo, _ = _cache_imagens.pop(chave)
+    _bytes_em_cache -= len(conteudo)
+    chaves = _chaves_por_codigo.get(chave[0])
+    if chaves is not None:
+        chaves.discard(chave)
+        if not chaves:
+            del _chaves_por_codigo[chave[0]]
+    return len(conteudo)
+
+
+def _cache_guardar(chave: tuple, conteudo: bytes, sha256: str):
+    global _bytes_em_cache
+    if len(conteudo) > CACHE_MAX_ENTRADA:
+        return
+    if chave in _cache_imagens:
+        _cache_remover(chave)
+    _cache_imagens[chave] = (conteudo, sha256)
+    _chaves_por_codigo.setdefault(chave[0], set()).add(chave)
+    _bytes_em_cache += len(conteudo)
+    while _bytes_em_cache > CACHE_MAX_BYTES:
+        _cache_remover(next(iter(_cache_imagens)))
+        _metricas["evictions"] += 1
+
+
+def invalidar_cache_imagem(codigo_item: str):
+    """Descarta todas as variantes em cache do código (upload ou remoção da imagem)"""
+    for chave in list(_chaves_por_codigo.get(codigo_item, ())):
+        _cache_remover(chave)
+    _metricas["invalidacoes"] += 1
+
+
+def estatisticas_cache_imagens() -> dict:
+    return {
+        **_metricas,
+        "entradas": len(_cache_imagens),
+        "bytes": _bytes_em_cache,
+        "max_bytes": CACHE_MAX_BYTES
+    }
+
+
+async def ler_imagem(imagem_doc: dict, nome: str = "original", ref: Optional[dict] = None) -> Optional[Tuple[bytes, str]]:
+    """
+    Bytes decodificados e SHA-256 da imagem do código, passando pelo LRU.
+    nome identifica o que é lido ("original", "thumb.webp"...); ref é a
+    referência da variante (None = original). O original legado, em base64
+    no documento, só é buscado no Mongo em caso de miss.
+    """
+    chave = (imagem_doc["codigo_item"], imagem_doc.get("data_upload"), nome)
+    entrada = _cache_imagens.get(chave)
+    if entrada is not None:
+        _cache_imagens.move_to_end(chave)
+        _metricas["hits"] += 1
+        return entrada
+    _metricas["misses"] += 1
+
+    ref = ref or imagem_doc
+    if not ref.get("blob_id"):
+        ref = await db.imagens_itens.find_one(
+            {"codigo_item": imagem_doc["codigo_item"], "data_upload": imagem_doc.get("data_upload")},
+            {"_id": 0, "imagem_base64": 1}
+        ) or {}
+    conteudo = await ler_conteudo(ref, "imagem_base64")
+    if conteudo is None:
+        return None
+    sha256 = ref.get("sha256") or hashlib.sha256(conteudo).hexdigest()
+    _cache_guardar(chave, conteudo, sha256)
+    return conteudo, sha256
+
+
+def _gerar_variantes_sync(conteudo: bytes) -> Tuple[Dict[str, dict], str]:
+    """Redimensiona e codifica cada variante e o LQIP. Síncrono (CPU): rodar em thread."""
+    with Image.open(io.BytesIO(conteudo)) as original:
+        original.seek(0)  # GIF animado: primeiro quadro
+        imagem = ImageOps.exif_transpose(original)
+        imagem = imagem.convert("RGBA" if imagem.mode in ("RGBA", "LA", "P") else "RGB")
+
+    variantes = {}
+    for nome, lado in VARIANTES.items():
+        copia = imagem.copy()
+        copia.thumbnail((lado, lado), Image.LANCZOS)
+
+        webp = io.BytesIO()
+        copia.save(webp, "WEBP", quality=QUALIDADE, method=4)
+
+        # JPEG não tem transparência: compor sobre fundo branco
+        if copia.mode == "RGBA":
+            fundo = Image.new("RGB", copia.size, (255, 255, 255))
+            fundo.paste(copia, mask=copia.getchannel("A"))
+            copia = fundo
+        jpeg = io.BytesIO()
+        copia.save(jpeg, "JPEG", quality=QUALIDADE, optimize=True, progressive=True)
+
+        variantes[nome] = {
+            "webp": webp.getvalue(),
+            "jpeg": jpeg.getvalue(),
+            "largura": copia.width,
+            "altura": copia.height
+        }
+
+    pequena = imagem.copy()
+    pequena.thumbnail((LQIP_PX, LQIP_PX), Image.BILINEAR)
+    lqip = io.BytesIO()
+    pequena.save(lqip, "WEBP", quality=40)
+    return variantes, "data:image/webp;base64," + base64.b64encode(lqip.getvalue()).decode()
+
+
+async def gerar_variantes(conteudo: bytes, codigo_item: str) -> Dict:
+    """
+    Campos a gravar em imagens_itens com as variantes da imagem.
+    Vazio se o Pillow não estiver disponível ou a imagem não puder ser lida:
+    o original continua sendo servido.
+    """
+    if not PIL_AVAILABLE:
+        return {}
+    try:
+        geradas, lqip = await asyncio.to_thread(_gerar_variantes_sync, conteudo)
+    except Exception as e:
+        logger.warning(f"Não foi possível gerar variantes da imagem {codigo_item}: {e}")
+        return {}
+
+    variantes = {}
+    for nome, dados in geradas.items():
+        variantes[nome] = {"largura": dados["largura"], "altura": dados["altura"]}
+        for formato, content_type in FORMATOS.items():
+            variantes[nome][formato] = await salvar_blob(
+                dados[formato], f"{codigo_item}_{nome}.{formato}", content_type
+            )
+    return {
+        "variantes": variantes,
+        "variantes_de": hashlib.sha256(conteudo).hexdigest(),
+        "lqip": lqip
+    }
+
+
+async def _descartar_variantes(variantes: Dict) -> None:
+    """Apaga do GridFS as variantes geradas que nenhuma imagem referencia"""
+    for por_formato in variantes.values():
+        for formato in FORMATOS:
+            blob_id = por_formato[formato]["blob_id"]
+            # Deduplicação: outra imagem de mesmo conteúdo pode usar o mesmo blob
+            if await db.imagens_itens.find_one(
+                {"$or": [{f"variantes.{n}.{f}.blob_id": blob_id} for n in VARIANTES for f in FORMATOS]},
+                {"_id": 1}
+            ) is None:
+                await remover_blob(blob_id)
+
+
+async def _gerar_e_gravar_variantes(imagem_doc: dict) -> Optional[Dict]:
+    lido = await ler_imagem(imagem_doc)
+    if not lido:
+        return None
+    campos = await gerar_variantes(lido[0], imagem_doc["codigo_item"])
+    if not campos:
+        return None
+    # Só grava se a imagem não foi trocada enquanto as variantes eram geradas
+    result = await db.imagens_itens.update_one(
+        {"codigo_item": imagem_doc["codigo_item"], "data_upload": imagem_doc.get("data_upload")},
+        {"$set": campos}
+    )
+    if result.matched_count == 0:
+        await _descartar_variantes(campos["variantes"])
+        return None
+    return campos["variantes"]
+
+
+async def obter_variante(imagem_doc: dict, variante: str, formato: str) -> Optional[dict]:
+    """
+    Referência da variante pedida, gerando-a na hora para imagens antigas.
+    None quando não há como gerar (sem Pillow, imagem ilegível) ou quando a
+    imagem foi trocada durante a geração (as variantes geradas são apagadas).
+
+    Pedidos simultâneos da mesma imagem (a grade pede dezenas de miniaturas de
+    uma vez) esperam uma única geração neste processo (_em_andamento).
+    """
+    variantes = imagem_doc.get("variantes") or {}
+    if variante not in variantes:
+        chave = (imagem_doc["codigo_item"], imagem_doc.get("data_upload"))
+        future = _em_andamento.get(chave)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            _em_andamento[chave] = future
+            try:
+                variantes = await _gerar_e_gravar_variantes(imagem_doc)
+                future.set_result(variantes)
+            except BaseException as e:
+                future.set_exception(e)
+                # Ninguém mais esperando: evita "exception was never retrieved"
+                future.exception()
+                raise
+            finally:
+                _em_andamento.pop(chave, None)
+        else:
+            variantes = await asyncio.shield(future)
+        if not variantes:
+            return None
+    return variantes[variante][formato]
+
+
+def versao_imagem(imagem_doc: dict) -> Optional[str]:
+    """Versão usada em ?v=: início do SHA-256 do original (None para base64 legado)"""
+    sha256 = imagem_doc.get("sha256")
+    return sha256[:TAMANHO_VERSAO] if sha256 else None
+
+
+def url_imagem(imagem_doc: dict) -> str:
+    """URL da imagem do código, versionada quando o SHA-256 é conhecido"""
+    url = f"/api/item-images-db/{imagem_doc['codigo_item']}"
+    versao = versao_imagem(imagem_doc)
+    return f"{url}?v={versao}" if versao else url
+
+
+async def resumo_imagens(codigos: List[str]) -> Dict[str, dict]:
+    """
+    Para cada código com imagem: URL versionada, SHA-256, dimensões da
+    miniatura e o LQIP - uma consulta só, sem ler nenhum arquivo.
+    """
+    resumo = {}
+    async for doc in db.imagens_itens.find(
+        {"codigo_item": {"$in": codigos}},
+        {"_id": 0, "codigo_item": 1, "sha256": 1, "lqip": 1,
+         "variantes.thumb.largura": 1, "variantes.thumb.altura": 1}
+    ):
+        thumb = (doc.get("variantes") or {}).get("thumb") or {}
+        resumo[doc["codigo_item"]] = {
+            "url": url_imagem(doc),
+            "sha256": doc.get("sha256"),
+            "lqip": doc.get("lqip"),
+            "largura": thumb.get("largura"),
+            "altura": thumb.get("altura")
+        }
+    return resumo
+
+
+def formato_aceito(accept: Optional[str]) -> str:
+    return "webp" if accept and "image/webp" in accept else "jpeg"
+
+
+def etag(sha256: str) -> str:
+    return f'"{sha256}"'
+
+
+def casa_if_none_match(if_none_match: Optional[str], valor_etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidato in if_none_match.split(","):
+        candidato = candidato.strip()
+        if candidato == "*" or candidato.removeprefix("W/") == valor_etag:
+            return True
+    return False
+
+
+async def responder_imagem(
+    imagem_doc: dict,
+    content_type: str,
+    if_none_match: Optional[str],
+    cache_control: str = CACHE_REVALIDAR,
+    nome: str = "original",
+    ref: Optional[dict] = None,
+    vary: Optional[str] = None
+) -> Optional[Response]:
+    """
+    Resposta da imagem (original ou variante ref/nome) com ETag pelo SHA-256.
+    Se o ETag já é conhecido e casa com If-None-Match, 304 sem ler nada; senão
+    os bytes vêm do LRU (ou do GridFS/base64 e entram no LRU).
+    None se não há conteúdo.
+    """
+    headers = {"Cache-Control": cache_control}
+    if vary:
+        headers["Vary"] = vary
+    sha256 = (ref or imagem_doc).get("sha256")
+    if sha256 and casa_if_none_match(if_none_match, etag(sha256)):
+        return Response(status_code=304, headers={**headers, "ETag": etag(sha256)})
+
+    lido = await ler_imagem(imagem_doc, nome, ref)
+    if lido is None:
+        return None
+    conteudo, sha256 = lido
+    headers["ETag"] = etag(sha256)
+    if casa_if_none_match(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=conteudo, media_type=content_type, headers=headers)
+
+
+def resposta_bytes_imagem(
+    conteudo: bytes,
+    content_type: str,
+    if_none_match: Optional[str],
+    cache_control: str = CACHE_REVALIDAR
+) -> Response:
+    """Mesma regra de ETag/304 para imagens já em memória (data URL legada)"""
+    headers = {"Cache-Control": cache_control, "ETag": etag(hashlib.sha256(conteudo).hexdigest())}
+    if casa_if_none_match(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=conteudo, media_type=content_type, headers=headers)
@@ -0,0 +1,355 @@
+"""
+Serviço de atualização atômica de itens das OCs
+
+Em vez de regravar o array `items` inteiro ({"$set": {"items": po['items']}}),
+calcula o diff campo a campo de cada item alterado e emite `$set`/`$unset`
+direcionados em `items.N.campo`. Cada escrita é protegida por controle
+otimista de concorrência: o filtro exige a mesma `versao_item` lida e o mesmo
+tamanho do array, e a versão é incrementada a cada gravação.
+
+Toda gravação aplicada é refletida no read-model `po_items`
+(services/po_items_service.py) e carimba `updated_at` na OC, usado pelos
+backups incrementais (services/backup_service.py).
+"""
+import copy
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from utils.database import db
+from services.po_items_service import sincronizar_po, sincronizar_pos
+
+logger = logging.getLogger(__name__)
+
+# Campo de versão mantido dentro de cada item
+CAMPO_VERSAO = 'versao_item'
+
+# Data da última alteração da OC (marca d'água dos backups incrementais)
+CAMPO_ALTERACAO = 'updated_at'
+
+MENSAGEM_CONFLITO = "O item foi alterado por outro usuário. Recarregue a página e tente novamente."
+
+
+def snapshot_itens(items: List[dict]) -> List[dict]:
+    """
+    Cópia profunda dos itens logo após a leitura da OC.
+    Deve ser tirada ANTES de qualquer alteração para servir de base ao diff.
+    """
+    return copy.deepcopy(items or [])
+
+
+def calcular_diff_item(antes: dict, depois: dict, prefixo: str) -> Tuple[Dict, Dict, Dict]:
+    """
+    Compara dois estados de um item e retorna (set_ops, unset_ops, push_ops)
+    com caminhos completos (ex: 'items.3.status').
+
+    Listas que apenas cresceram no final (NFs anexadas, eventos de rastreio)
+    viram `$push` dos novos elementos em vez de regravar a lista inteira.
+    O campo de versão nunca entra no diff - ele é controlado pelo $inc.
+    """
+    set_ops = {}
+    unset_ops = {}
+    push_ops = {}
+
+    for campo, valor in depois.items():
+        if campo == CAMPO_VERSAO:
+            continue
+        if campo in antes and antes[campo] == valor:
+            continue
+
+        anterior = antes.get(campo)
+        if (
+            isinstance(anterior, list) and isinstance(valor, list)
+            and anterior and len(valor) > len(anterior)
+            and valor[:len(anterior)] == anterior
+        ):
+            push_ops[f"{prefixo}.{campo}"] = {"$each": valor[len(anterior):]}
+        else:
+            set_ops[f"{prefixo}.{campo}"] = valor
+
+    for campo in antes:
+        if campo != CAMPO_VERSAO and campo not in depois:
+            unset_ops[f"{prefixo}.{campo}"] = ""
+
+    return set_ops, unset_ops, push_ops
+
+
+def _montar_operadores(set_ops: Dict, unset_ops: Dict, push_ops: Dict, inc_ops: Dict) -> Dict:
+    """Monta o documento de update omitindo operadores vazios"""
+    update = {}
+    if set_ops:
+        update["$set"] = set_ops
+    if unset_ops:
+        update["$unset"] = unset_ops
+    if push_ops:
+        update["$push"] = push_ops
+    if inc_ops:
+        update["$inc"] = inc_ops
+    return update
+
+
+def montar_update_itens(
+    po_id: str,
+    itens_antes: List[dict],
+    itens_depois: List[dict],
+    campos_oc: Optional[Dict] = None
+) -> Optional[Tuple[Dict, Dict, List[int]]]:
+    """
+    Monta (filtro, update, indices_alterados) para uma única chamada update_one.
+    Retorna None se nada mudou.
+
+    O filtro inclui:
+    - tamanho do array (detecta inserções/remoções concorrentes)
+    - versao_item de cada item alterado (detecta edições concorrentes no mesmo item)
+    """
+    if len(itens_antes) != len(itens_depois):
+        raise ValueError(
+            "salvar_itens não suporta mudança no número de itens - use dividir_item"
+        )
+
+    filtro = {"id": po_id, "items": {"$size": len(itens_antes)}}
+    set_ops = dict(campos_oc or {})
+    unset_ops = {}
+    push_ops = {}
+    inc_ops = {}
+    indices_alterados = []
+
+    for idx, (antes, depois) in enumerate(zip(itens_antes, itens_depois)):
+        item_set, item_unset, item_push = calcular_diff_item(antes, depois, f"items.{idx}")
+        if not item_set and not item_unset and not item_push:
+            continue
+
+        set_ops.update(item_set)
+        unset_ops.update(item_unset)
+        push_ops.update(item_push)
+        # None também casa com campo ausente (itens antigos sem versão)
+        filtro[f"items.{idx}.{CAMPO_VERSAO}"] = antes.get(CAMPO_VERSAO)
+        inc_ops[f"items.{idx}.{CAMPO_VERSAO}"] = 1
+        indices_alterados.append(idx)
+
+    if not indices_alterados and not set_ops:
+        return None
+
+    set_ops[CAMPO_ALTERACAO] = datetime.now(timezone.utc).isoformat()
+    return filtro, _montar_operadores(set_ops, unset_ops, push_ops, inc_ops), indices_alterados
+
+
+async def salvar_itens(
+    po_id: str,
+    itens_antes: List[dict],
+    itens_depois: List[dict],
+    campos_oc: Optional[Dict] = None,
+    levantar_conflito: bool = True
+) -> bool:
+    """
+    Persiste apenas os campos alterados dos itens de uma OC.
+
+    Args:
+        po_id: ID da OC
+        itens_antes: snapshot_itens() tirado logo após a leitura
+        itens_depois: lista de itens já modificada pela rota
+        campos_oc: campos de nível de OC a gravar na mesma operação (opcional)
+        levantar_conflito: se True, lança HTTP 409 em caso de edição concorrente;
+            se False, apenas registra e retorna False (jobs em lote)
+
+    Returns:
+        True se gravou (ou se não havia nada a gravar), False em conflito.
+    """
+    montado = montar_update_itens(po_id, itens_antes, itens_depois, campos_oc)
+    if montado is None:
+        return True
+
+    filtro, update, indices_alterados = montado
+    result = await db.purchase_orders.update_one(filtro, update)
+
+    if result.matched_count == 0:
+        logger.warning(f"Conflito de versão ao salvar itens {indices_alterados} da OC {po_id}")
+        if levantar_conflito:
+            raise HTTPException(status_code=409, detail=MENSAGEM_CONFLITO)
+        return False
+
+    # Manter a versão em memória coerente caso a rota grave novamente
+    for idx in indices_alterados:
+        itens_depois[idx][CAMPO_VERSAO] = (itens_antes[idx].get(CAMPO_VERSAO) or 0) + 1
+        itens_antes[idx] = copy.deepcopy(itens_depois[idx])
+
+    # Campos de nível de OC (numero_oc, data_entrega...) afetam todas as linhas
+    await sincronizar_po(po_id, None if campos_oc else indices_alterados)
+    return True
+
+
+async def substituir_itens(
+    po_id: str,
+    itens_antes: List[dict],
+    itens_novos: List[dict],
+    campos_oc: Optional[Dict] = None
+) -> None:
+    """
+    Regrava o array `items` inteiro quando o número de itens muda (edição
+    completa da OC com inclusão/remoção de linhas), onde o diff por índice
+    de salvar_itens não se aplica.
+
+    A guarda é de nível de OC: o filtro exige o mesmo tamanho do array e a
+    mesma versao_item de TODOS os itens lidos, então qualquer edição
+    concorrente em qualquer item resulta em HTTP 409.
+    """
+    filtro = {"id": po_id, "items": {"$size": len(itens_antes)}}
+    for idx, antes in enumerate(itens_antes):
+        filtro[f"items.{idx}.{CAMPO_VERSAO}"] = antes.get(CAMPO_VERSAO)
+
+    for idx, novo in enumerate(itens_novos):
+        anterior = itens_antes[idx].get(CAMPO_VERSAO) if idx < len(itens_antes) else None
+        novo[CAMPO_VERSAO] = (anterior or 0) + 1
+
+    set_ops = dict(campos_oc or {})
+    set_ops["items"] = itens_novos
+    set_ops[CAMPO_ALTERACAO] = datetime.now(timezone.utc).isoformat()
+
+    result = await db.purchase_orders.update_one(filtro, {"$set": set_ops})
+
+    if result.matched_count == 0:
+        logger.warning(f"Conflito de versão ao substituir os itens da OC {po_id}")
+        raise HTTPException(status_code=409, detail=MENSAGEM_CONFLITO)
+
+    await sincronizar_po(po_id)
+
+
+async def salvar_itens_em_lote(
+    lote: List[Tuple[str, List[dict], List[dict], Optional[Dict]]]
+) -> List[bool]:
+    """
+    Versão em lote de salvar_itens: um único bulk_write (ordered=False) para
+    várias OCs. Cada entrada é (po_id, itens_antes, itens_depois, campos_oc).
+
+    Retorna, para cada entrada, se a gravação foi aplicada. Conflitos não
+    levantam exceção - o chamador reporta por OC.
+    """
+    montados = [montar_update_itens(*entrada) for entrada in lote]
+    operacoes = [UpdateOne(m[0], m[1]) for m in montados if m is not None]
+    aplicados = [True] * len(lote)
+    if not operacoes:
+        return aplicados
+
+    result = await db.purchase_orders.bulk_write(operacoes, ordered=False)
+
+    if result.matched_count < len(operacoes):
+        # bulk_write não informa qual operação deixou de casar: conferir pelas
+        # versões esperadas (as aplicadas têm versao_item incrementada)
+        ids = [entrada[0] for entrada, m in zip(lote, montados) if m is not None]
+        atuais = {}
+        async for po in db.purchase_orders.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, f"items.{CAMPO_VERSAO}": 1}):
+            atuais[po["id"]] = po.get("items", [])
+
+        for i, ((po_id, itens_antes, _, _), m) in enumerate(zip(lote, montados)):
+            if m is None:
+                continue
+            itens_atuais = atuais.get(po_id, [])
+            aplicado = len(itens_atuais) == len(itens_antes) and all(
+                itens_atuais[idx].get(CAMPO_VERSAO) == (itens_antes[idx].get(CAMPO_VERSAO) or 0) + 1
+                for idx in m[2]
+            )
+            if not aplicado:
+                aplicados[i] = False
+                logger.warning(f"Conflito de versão ao salvar itens {m[2]} da OC {po_id} (lote)")
+
+    sincronizar = []
+    for (po_id, itens_antes, itens_depois, _), m, aplicado in zip(lote, montados, aplicados):
+        if m is None or not aplicado:
+            continue
+        sincronizar.append(po_id)
+        for idx in m[2]:
+            itens_depois[idx][CAMPO_VERSAO] = (itens_antes[idx].get(CAMPO_VERSAO) or 0) + 1
+            itens_antes[idx] = copy.deepcopy(itens_depois[idx])
+
+    await sincronizar_pos(sincronizar)
+    return aplicados
+
+
+async def salvar_item(
+    po_id: str,
+    item_index: int,
+    item_antes: dict,
+    item_depois: dict,
+    total_itens: int,
+    levantar_conflito: bool = True
+) -> bool:
+    """
+    Atalho para gravar um único item pelo índice.
+    `total_itens` é o tamanho do array lido, usado na guarda de concorrência.
+    """
+    prefixo = f"items.{item_index}"
+    set_ops, unset_ops, push_ops = calcular_diff_item(item_antes, item_depois, prefixo)
+    if not set_ops and not unset_ops and not push_ops:
+        return True
+
+    filtro = {
+        "id": po_id,
+        "items": {"$size": total_itens},
+        f"{prefixo}.{CAMPO_VERSAO}": item_antes.get(CAMPO_VERSAO)
+    }
+    set_ops[CAMPO_ALTERACAO] = datetime.now(timezone.utc).isoformat()
+    update = _montar_operadores(set_ops, unset_ops, push_ops, {f"{prefixo}.{CAMPO_VERSAO}": 1})
+
+    result = await db.purchase_orders.update_one(filtro, update)
+
+    if result.matched_count == 0:
+        logger.warning(f"Conflito de versão ao salvar item {item_index} da OC {po_id}")
+        if levantar_conflito:
+            raise HTTPException(status_code=409, detail=MENSAGEM_CONFLITO)
+        return False
+
+    item_depois[CAMPO_VERSAO] = (item_antes.get(CAMPO_VERSAO) or 0) + 1
+    await sincronizar_po(po_id, [item_index])
+    return True
+
+
+async def dividir_item(
+    po_id: str,
+    item_index: int,
+    item_antes: dict,
+    item_atualizado: dict,
+    item_novo: dict,
+    total_itens: int
+) -> None:
+    """
+    Substitui o item `item_index` e insere `item_novo` logo após ele,
+    numa única operação atômica (update com pipeline).
+    Usado por compra parcial e envio parcial.
+
+    Os valores são envolvidos em $literal para que strings iniciadas por '$'
+    (descrições, links) não sejam interpretadas como expressões.
+    """
+    versao_atual = item_antes.get(CAMPO_VERSAO)
+    item_atualizado = {**item_atualizado, CAMPO_VERSAO: (versao_atual or 0) + 1}
+    item_novo = {**item_novo, CAMPO_VERSAO: 1}
+
+    pipeline = [{
+        "$set": {
+            "items": {
+                "$concatArrays": [
+                    {"$slice": ["$items", item_index]},
+                    {"$literal": [item_atualizado, item_novo]},
+                    {"$slice": ["$items", item_index + 1, total_itens]}
+                ]
+            },
+            CAMPO_ALTERACAO: {"$literal": datetime.now(timezone.utc).isoformat()}
+        }
+    }]
+
+    result = await db.purchase_orders.update_one(
+        {
+            "id": po_id,
+            "items": {"$size": total_itens},
+            f"items.{item_index}.{CAMPO_VERSAO}": versao_atual
+        },
+        pipeline
+    )
+
+    if result.matched_count == 0:
+        logger.warning(f"Conflito de versão ao dividir item {item_index} da OC {po_id}")
+        raise HTTPException(status_code=409, detail=MENSAGEM_CONFLITO)
+
+    # Os índices dos itens seguintes mudaram
+    await sincronizar_po(po_id)
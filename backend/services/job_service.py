@@ -0,0 +1,317 @@
+"""
+Fila de jobs em background (MongoDB + workers asyncio)
+
+Operações administrativas longas (reprocessamentos, recálculos em massa)
+estouravam o timeout do proxy quando executadas dentro da requisição.
+Agora a rota apenas enfileira um job na coleção `jobs` e responde com o
+`job_id`; workers asyncio no próprio processo consomem a fila.
+
+Ciclo de vida: pendente → executando → concluido | erro | cancelado
+
+Documento:
+    {
+        "id", "tipo", "params", "status",
+        "progresso": {"processados": 0, "total": None, "mensagem": None},
+        "resultado", "erro", "cancelar": bool,
+        "criado_por", "created_at", "started_at", "finished_at", "heartbeat_at"
+    }
+
+Para registrar um novo tipo de job:
+
+    @registrar_job("meu_job")
+    async def meu_job(params: dict, ctx: JobContext) -> dict:
+        for i, x in enumerate(lista):
+            await ctx.verificar_cancelamento()
+            ...
+            await ctx.progresso(i + 1, len(lista))
+        return {...}  # vira job["resultado"]
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+COLECAO = "jobs"
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
+INTERVALO_POLLING = 2.0  # segundos entre consultas quando a fila está vazia
+INTERVALO_ATUALIZACAO = 1.0  # mínimo entre gravações de progresso / checagens de cancelamento
+HEARTBEAT_EXPIRADO = timedelta(minutes=5)
+
+STATUS_PENDENTE = "pendente"
+STATUS_EXECUTANDO = "executando"
+STATUS_CONCLUIDO = "concluido"
+STATUS_ERRO = "erro"
+STATUS_CANCELADO = "cancelado"
+STATUS_FINAIS = (STATUS_CONCLUIDO, STATUS_ERRO, STATUS_CANCELADO)
+
+_handlers: Dict[str, Callable[[dict, "JobContext"], Awaitable[dict]]] = {}
+_workers: List[asyncio.Task] = []
+_novo_job: Optional[asyncio.Event] = None
+
+
+class JobCancelado(Exception):
+    """Levantada por JobContext.verificar_cancelamento()"""
+
+
+def registrar_job(tipo: str):
+    """Decorator que associa um tipo de job à função que o executa"""
+    def decorator(func):
+        _handlers[tipo] = func
+        return func
+    return decorator
+
+
+def _agora() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobContext:
+    """Passado ao handler: progresso e cancelamento, com gravações limitadas no tempo"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self._ultima_atualizacao = 0.0
+        self._ultima_checagem = 0.0
+
+    async def progresso(self, processados: int, total: Optional[int] = None,
+                        mensagem: Optional[str] = None, forcar: bool = False):
+        agora = time.monotonic()
+        if not forcar and agora - self._ultima_atualizacao < INTERVALO_ATUALIZACAO:
+            return
+        self._ultima_atualizacao = agora
+
+        campos = {"progresso.processados": processados, "heartbeat_at": _agora()}
+        if total is not None:
+            campos["progresso.total"] = total
+        if mensagem is not None:
+            campos["progresso.mensagem"] = mensagem
+        await db.jobs.update_one({"id": self.job_id}, {"$set": campos})
+
+    async def verificar_cancelamento(self):
+        agora = time.monotonic()
+        if agora - self._ultima_checagem < INTERVALO_ATUALIZACAO:
+            return
+        self._ultima_checagem = agora
+
+        job = await db.jobs.find_one({"id": self.job_id}, {"_id": 0, "cancelar": 1})
+        if job and job.get("cancelar"):
+            raise JobCancelado()
+
+
+# ============== API DA FILA ==============
+
+async def enfileirar_job(tipo: str, params: Optional[dict] = None, criado_por: Optional[str] = None) -> dict:
+    """Cria o job como pendente e acorda os workers"""
+    if tipo not in _handlers:
+        raise HTTPException(status_code=400, detail=f"Tipo de job desconhecido: {tipo}")
+
+    job = {
+        "id": str(uuid.uuid4()),
+        "tipo": tipo,
+        "params": params or {},
+        "status": STATUS_PENDENTE,
+        "progresso": {"processados": 0, "total": None, "mensagem": None},
+        "resultado": None,
+        "erro": None,
+        "cancelar": False,
+        "criado_por": criado_por,
+        "created_at": _agora(),
+        "started_at": None,
+        "finished_at": None,
+        "heartbeat_at": None
+    }
+    await db.jobs.insert_one(job)
+    job.pop("_id", None)
+
+    if _novo_job is not None:
+        _novo_job.set()
+
+    logger.info(f"Job {tipo} enfileirado: {job['id']}")
+    return job
+
+
+def resposta_job_enfileirado(job: dict, mensagem: str) -> dict:
+    """Resposta padrão das rotas que enfileiram jobs"""
+    return {
+        "success": True,
+        "job_id": job["id"],
+        "tipo": job["tipo"],
+        "status": job["status"],
+        "message": mensagem
+    }
+
+
+async def obter_job(job_id: str, incluir_resultado: bool = False) -> dict:
+    projection = {"_id": 0, "params": 0}
+    if not incluir_resultado:
+        projection["resultado"] = 0
+    job = await db.jobs.find_one({"id": job_id}, projection)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job
+
+
+async def listar_jobs(tipo: Optional[str] = None, status: Optional[str] = None, limite: int = 50) -> List[dict]:
+    query = {}
+    if tipo:
+        query["tipo"] = tipo
+    if status:
+        query["status"] = status
+    cursor = db.jobs.find(query, {"_id": 0, "params": 0, "resultado": 0}).sort("created_at", -1).limit(limite)
+    return await cursor.to_list(limite)
+
+
+async def cancelar_job(job_id: str) -> dict:
+    """
+    Pendente: cancela imediatamente.
+    Executando: sinaliza; o handler para no próximo verificar_cancelamento().
+    """
+    job = await db.jobs.find_one_and_update(
+        {"id": job_id, "status": STATUS_PENDENTE},
+        {"$set": {"status": STATUS_CANCELADO, "cancelar": True, "finished_at": _agora()}},
+        projection={"_id": 0, "params": 0, "resultado": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if job:
+        return job
+
+    job = await db.jobs.find_one_and_update(
+        {"id": job_id, "status": STATUS_EXECUTANDO},
+        {"$set": {"cancelar": True}},
+        projection={"_id": 0, "params": 0, "resultado": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if job:
+        return job
+
+    job = await obter_job(job_id)
+    raise HTTPException(status_code=400, detail=f"Job já finalizado (status: {job['status']})")
+
+
+# ============== WORKERS ==============
+
+async def _pegar_proximo_job(worker_id: str) -> Optional[dict]:
+    """Reserva atomicamente o job pendente mais antigo"""
+    return await db.jobs.find_one_and_update(
+        {"status": STATUS_PENDENTE},
+        {"$set": {
+            "status": STATUS_EXECUTANDO,
+            "started_at": _agora(),
+            "heartbeat_at": _agora(),
+            "worker_id": worker_id
+        }},
+        sort=[("created_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _finalizar(job_id: str, status: str, resultado=None, erro: Optional[str] = None):
+    await db.jobs.update_one(
+        {"id": job_id},
+        {"$set": {
+            "status": status,
+            "resultado": resultado,
+            "erro": erro,
+            "finished_at": _agora(),
+            "heartbeat_at": _agora()
+        }}
+    )
+
+
+async def _executar_job(job: dict):
+    handler = _handlers.get(job["tipo"])
+    if handler is None:
+        await _finalizar(job["id"], STATUS_ERRO, erro=f"Tipo de job desconhecido: {job['tipo']}")
+        return
+
+    ctx = JobContext(job["id"])
+    try:
+        resultado = await handler(job.get("params") or {}, ctx)
+        await _finalizar(job["id"], STATUS_CONCLUIDO, resultado=resultado)
+        logger.info(f"Job {job['tipo']} {job['id']} concluído")
+    except JobCancelado:
+        await _finalizar(job["id"], STATUS_CANCELADO)
+        logger.info(f"Job {job['tipo']} {job['id']} cancelado")
+    except asyncio.CancelledError:
+        # Shutdown da aplicação no meio do job
+        await asyncio.shield(_finalizar(job["id"], STATUS_ERRO, erro="Job interrompido por reinício do servidor"))
+        raise
+    except HTTPException as e:
+        await _finalizar(job["id"], STATUS_ERRO, erro=str(e.detail))
+    except Exception as e:
+        logger.exception(f"Erro no job {job['tipo']} {job['id']}")
+        await _finalizar(job["id"], STATUS_ERRO, erro=str(e))
+
+
+async def _loop_worker(worker_id: str):
+    while True:
+        try:
+            job = await _pegar_proximo_job(worker_id)
+            if job:
+                await _executar_job(job)
+                continue
+
+            _novo_job.clear()
+            try:
+                await asyncio.wait_for(_novo_job.wait(), timeout=INTERVALO_POLLING)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro no worker de jobs {worker_id}: {e}")
+            await asyncio.sleep(INTERVALO_POLLING)
+
+
+async def _recuperar_jobs_interrompidos():
+    """
+    Jobs 'executando' sem heartbeat recente foram interrompidos por reinício
+    do servidor. Não são reexecutados automaticamente (podem ter aplicado
+    parte das alterações) - ficam como erro para o admin disparar de novo.
+    """
+    limite = (datetime.now(timezone.utc) - HEARTBEAT_EXPIRADO).isoformat()
+    result = await db.jobs.update_many(
+        {"status": STATUS_EXECUTANDO, "heartbeat_at": {"$lt": limite}},
+        {"$set": {
+            "status": STATUS_ERRO,
+            "erro": "Job interrompido por reinício do servidor",
+            "finished_at": _agora()
+        }}
+    )
+    if result.modified_count:
+        logger.warning(f"{result.modified_count} job(s) interrompido(s) marcados como erro")
+
+
+async def iniciar_workers(quantidade: int = JOB_WORKERS):
+    """Chamado no startup da aplicação"""
+    global _novo_job
+    _novo_job = asyncio.Event()
+
+    await db.jobs.create_index("id", unique=True)
+    await db.jobs.create_index([("status", 1), ("created_at", 1)])
+    await _recuperar_jobs_interrompidos()
+
+    for i in range(quantidade):
+        worker_id = f"{os.getpid()}-{i}"
+        _workers.append(asyncio.create_task(_loop_worker(worker_id)))
+    logger.info(f"{quantidade} worker(s) de jobs iniciados")
+
+
+async def parar_workers():
+    """Chamado no shutdown da aplicação"""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
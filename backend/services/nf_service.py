@@ -0,0 +1,290 @@
+"""
+Análise de notas fiscais (PDF/DANFE e XML da NFe)
+
+O upload de NF chamava três funções sobre os mesmos bytes (NCMs, número da
+NF, itens) e cada uma abria o PDF e concatenava o texto de todas as páginas
+de novo. Aqui o documento é lido UMA vez e todas as informações saem do
+mesmo texto (PDF) ou da mesma passada de iterparse (XML):
+
+    {
+        "ncm": "85444900, 85366990" | None,   # NCMs distintos, ordenados
+        "numero_nf": "000123456" | None,
+        "itens_nf": [{"descricao", "ncm"}],
+        "chave_acesso": "4125...(44 dígitos)" | None
+    }
+
+Funções puras e síncronas: o server as executa fora do event loop
+(asyncio.to_thread) e o resultado do PDF fica no cache de parsing
+(services/parse_cache_service.py).
+"""
+import io
+import logging
+import re
+import xml.etree.ElementTree as ET
+from typing import List, Optional
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+# Incrementar a cada mudança que altere o resultado de analisar_nf_pdf (invalida o cache)
+VERSAO_ANALISE_NF = "2"
+
+NAMESPACE_NFE = '{http://www.portalfiscal.inf.br/nfe}'
+
+# Valores de 8 dígitos que NÃO são NCM (CEPs, código de vendedor...)
+_NCMS_INVALIDOS = frozenset({'17582008', '83005430', '83704614'})
+# Capítulos mais comuns em compras: 84, 85, 73, 39, 40, 48, 90...
+_CAPITULOS_COMUNS = frozenset(['84', '85', '73', '39', '40', '48', '90', '94', '72', '76', '83'])
+
+_RE_NCM_SH = re.compile(r'NCM[/\s]*SH[:\s]*(\d{8})', re.IGNORECASE)
+_RE_NCM_TABELA = re.compile(r'(?:NCM|NCM/SH)\s*\n?\s*(\d{8})', re.IGNORECASE | re.MULTILINE)
+_RE_OITO_DIGITOS = re.compile(r'\b(\d{8})\b')
+_RE_NCM_FORMATADO = [
+    re.compile(r'NCM[:\s]*(\d{4}[\.\s]?\d{2}[\.\s]?\d{2})', re.IGNORECASE),
+    re.compile(r'Classifica[çc][ãa]o Fiscal[:\s]*(\d{4}[\.\s]?\d{2}[\.\s]?\d{2})', re.IGNORECASE),
+    re.compile(r'(\d{4}\.\d{2}\.\d{2})'),  # Padrão com pontos (mais específico)
+]
+_RE_SEPARADORES_NCM = re.compile(r'[\.\s]')
+
+_RE_NUMERO_NF = [
+    re.compile(r'N[°º]?\s*(?:da\s*)?(?:NF|Nota|Nota Fiscal)[:\s]*(\d{6,9})', re.IGNORECASE),
+    re.compile(r'(?:NF|Nota Fiscal)\s*N[°º]?\s*(\d{6,9})', re.IGNORECASE),
+    re.compile(r'N[úu]mero[:\s]*(\d{6,9})', re.IGNORECASE),
+    re.compile(r'(\d{9})'),  # Número de 9 dígitos solto
+]
+
+# DANFE: 11 grupos de 4 dígitos (com ou sem espaço/ponto entre eles)
+_RE_CHAVE_ACESSO = re.compile(r'(?<!\d)((?:\d{4}[ .]?){10}\d{4})(?!\d)')
+_RE_NAO_DIGITO = re.compile(r'\D')
+
+_RE_LETRA = re.compile(r'[A-Za-z]')
+_RE_PEDIDO = re.compile(r'\s*\|\s*Ped:.*')
+_CABECALHOS_DEPOIS = ('DESCRIÇÃO', 'NCM/SH', 'CFOP', 'QUANT', 'VALOR', 'DADOS DO', 'CST', 'ALÍQUOTA')
+_CABECALHOS_ANTES = ('DESCRIÇÃO', 'NCM/SH', 'CFOP', 'QUANT', 'VALOR', 'DADOS DO')
+_FIM_PRODUTOS = ("CÁLCULO DO ISSQN", "DADOS ADICIONAIS", "INFORMAÇÕES COMPLEMENTARES")
+
+
+def _analise_vazia() -> dict:
+    return {"ncm": None, "numero_nf": None, "itens_nf": [], "chave_acesso": None}
+
+
+def _capitulo_valido(ncm: str) -> bool:
+    return 1 <= int(ncm[:2]) <= 97
+
+
+def chave_acesso_valida(chave: str) -> bool:
+    """44 dígitos com dígito verificador (módulo 11, pesos 2 a 9 da direita para a esquerda)"""
+    if len(chave) != 44 or not chave.isdigit():
+        return False
+    soma = sum(int(d) * (2 + i % 8) for i, d in enumerate(reversed(chave[:43])))
+    resto = soma % 11
+    return int(chave[43]) == (0 if resto < 2 else 11 - resto)
+
+
+def _unicos(itens: List[dict]) -> List[dict]:
+    """Remove duplicatas (descrição, NCM) mantendo a ordem"""
+    vistos = set()
+    unicos = []
+    for item in itens:
+        chave = (item['descricao'], item['ncm'])
+        if chave not in vistos:
+            vistos.add(chave)
+            unicos.append(item)
+    return unicos
+
+
+# ============== PDF (DANFE) ==============
+
+def _ncms_texto(full_text: str) -> Optional[str]:
+    ncm_list = set()
+
+    # Estratégia 1: "NCM/SH" seguido diretamente por 8 dígitos (mais confiável)
+    for m in _RE_NCM_SH.findall(full_text):
+        if m not in _NCMS_INVALIDOS:
+            ncm_list.add(m)
+
+    # Estratégia 2: cabeçalho NCM na tabela do DANFE e o valor na linha seguinte
+    for m in _RE_NCM_TABELA.findall(full_text):
+        if m not in _NCMS_INVALIDOS and _capitulo_valido(m):
+            ncm_list.add(m)
+
+    # Estratégia 3: números de 8 dígitos que começam com capítulos comuns
+    for num in _RE_OITO_DIGITOS.findall(full_text):
+        if num[:2] in _CAPITULOS_COMUNS and num not in _NCMS_INVALIDOS:
+            ncm_list.add(num)
+
+    # Estratégia 4: padrões tradicionais com formatação
+    for padrao in _RE_NCM_FORMATADO:
+        for match in padrao.findall(full_text):
+            ncm = _RE_SEPARADORES_NCM.sub('', match)
+            if len(ncm) == 8 and ncm.isdigit() and ncm not in _NCMS_INVALIDOS and _capitulo_valido(ncm):
+                ncm_list.add(ncm)
+
+    return ', '.join(sorted(ncm_list)) if ncm_list else None
+
+
+def _numero_nf_texto(full_text: str) -> Optional[str]:
+    for padrao in _RE_NUMERO_NF:
+        match = padrao.search(full_text)
+        if match:
+            return match.group(1)
+    return None
+
+
+def _chave_acesso_texto(full_text: str) -> Optional[str]:
+    for match in _RE_CHAVE_ACESSO.finditer(full_text):
+        chave = _RE_NAO_DIGITO.sub('', match.group(1))
+        if chave_acesso_valida(chave):
+            return chave
+    return None
+
+
+def _descricao_linha(linha: str, cabecalhos: tuple) -> Optional[str]:
+    """
+    None se a linha não é descrição (até 15 caracteres, sem letras ou
+    cabeçalho). Linha aceita encerra a busca mesmo que a limpeza a esvazie.
+    """
+    linha = linha.strip()
+    if len(linha) <= 15 or not _RE_LETRA.search(linha):
+        return None
+    maiuscula = linha.upper()
+    if any(cabecalho in maiuscula for cabecalho in cabecalhos):
+        return None
+    # Limpar a descrição (remover | Ped: etc)
+    return _RE_PEDIDO.sub('', linha)[:80].strip()
+
+
+def _itens_texto(full_text: str) -> List[dict]:
+    start = full_text.find("DADOS DO PRODUTO")
+    if start == -1:
+        start = full_text.find("DADOS DOS PRODUTOS")
+    if start == -1:
+        return []
+
+    # Seção de produtos: até CÁLCULO DO ISSQN ou DADOS ADICIONAIS
+    end = len(full_text)
+    for marcador in _FIM_PRODUTOS:
+        idx = full_text.find(marcador, start)
+        if idx != -1 and idx < end:
+            end = idx
+    secao = full_text[start:end]
+
+    itens = []
+    for match in _RE_OITO_DIGITOS.finditer(secao):
+        ncm = match.group(1)
+        if not _capitulo_valido(ncm) or ncm in _NCMS_INVALIDOS:
+            continue
+
+        # A descrição costuma vir DEPOIS do NCM nos DANFEs; senão, antes
+        descricao = None
+        for linha in secao[match.end():match.end() + 500].split('\n')[:8]:
+            descricao = _descricao_linha(linha, _CABECALHOS_DEPOIS)
+            if descricao is not None:
+                break
+        if not descricao:
+            for linha in reversed(secao[:match.start()].split('\n')[-10:]):
+                descricao = _descricao_linha(linha, _CABECALHOS_ANTES)
+                if descricao is not None:
+                    break
+
+        if descricao:
+            itens.append({'descricao': descricao.upper(), 'ncm': ncm})
+    return _unicos(itens)
+
+
+def analisar_nf_texto(full_text: str) -> dict:
+    """NCMs, número, itens e chave de acesso a partir do texto do DANFE"""
+    return {
+        "ncm": _ncms_texto(full_text),
+        "numero_nf": _numero_nf_texto(full_text),
+        "itens_nf": _itens_texto(full_text),
+        "chave_acesso": _chave_acesso_texto(full_text)
+    }
+
+
+def analisar_nf_pdf(pdf_bytes: bytes) -> dict:
+    """Abre o PDF uma única vez e extrai tudo do mesmo texto"""
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            full_text = "".join(page.get_text() for page in doc)
+        finally:
+            doc.close()
+    except Exception as e:
+        logger.error(f"Erro ao ler PDF da NF: {e}")
+        return _analise_vazia()
+    return analisar_nf_texto(full_text)
+
+
+# ============== XML (NFe) ==============
+
+_TAGS_NUMERO_NF = ('nNF', 'nf', 'numero')
+
+
+def analisar_nf_xml(xml_bytes: bytes) -> dict:
+    """
+    Uma passada de iterparse pelo XML. Critérios de prioridade:
+      - NCM: elementos NCM no namespace da NFe; senão NCM sem namespace;
+        senão qualquer tag terminada em NCM;
+      - número: o primeiro nNF (depois nf, numero) no namespace da NFe ou sem
+        namespace; senão a primeira tag terminada em nNF com texto;
+      - chave: atributo Id de infNFe ("NFe" + 44 dígitos) ou chNFe.
+    Cada <det> é descartado da memória depois de lido.
+    """
+    analise = _analise_vazia()
+    ncms_nfe, ncms_sem_ns, ncms_outros = set(), set(), set()
+    primeiros = {}  # (tag, com namespace da NFe) -> texto do primeiro elemento
+    numero_alternativo = None
+    itens = []
+
+    try:
+        for _, elem in ET.iterparse(io.BytesIO(xml_bytes), events=("end",)):
+            tag = elem.tag
+            namespace, _, local = tag.rpartition('}')
+            texto = elem.text.strip() if elem.text else ""
+
+            if tag.endswith('NCM') and texto:
+                if local == 'NCM' and namespace + '}' == NAMESPACE_NFE:
+                    ncms_nfe.add(texto)
+                elif tag == 'NCM':
+                    ncms_sem_ns.add(texto)
+                ncms_outros.add(texto)
+
+            if local in _TAGS_NUMERO_NF and (not namespace or namespace + '}' == NAMESPACE_NFE):
+                primeiros.setdefault((local, bool(namespace)), elem.text)
+            if numero_alternativo is None and tag.endswith('nNF') and texto:
+                numero_alternativo = texto
+
+            if local == 'prod':
+                campos = {filho.tag.rpartition('}')[2]: (filho.text or "").strip() for filho in elem}
+                if campos.get('xProd') and campos.get('NCM'):
+                    itens.append({'descricao': campos['xProd'][:80].strip().upper(), 'ncm': campos['NCM']})
+            elif local == 'det':
+                elem.clear()
+            elif local == 'infNFe' and analise["chave_acesso"] is None:
+                chave = elem.get('Id', '')[3:]
+                if chave_acesso_valida(chave):
+                    analise["chave_acesso"] = chave
+            elif local == 'chNFe' and analise["chave_acesso"] is None and chave_acesso_valida(texto):
+                analise["chave_acesso"] = texto
+    except Exception as e:
+        logger.error(f"Erro ao ler XML da NF: {e}")
+
+    ncms = ncms_nfe or ncms_sem_ns or ncms_outros
+    if ncms:
+        analise["ncm"] = ', '.join(sorted(ncms))
+
+    for tag in _TAGS_NUMERO_NF:
+        for com_namespace in (True, False):
+            texto = primeiros.get((tag, com_namespace))
+            if texto:
+                analise["numero_nf"] = texto.strip()
+                break
+        if analise["numero_nf"]:
+            break
+    if not analise["numero_nf"]:
+        analise["numero_nf"] = numero_alternativo
+
+    analise["itens_nf"] = _unicos(itens)
+    return analise
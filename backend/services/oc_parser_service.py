@@ -0,0 +1,599 @@
+"""
+Parser das OCs FIEP
+
+O parser anterior chamava dezenas de re.match/re.search dentro de laços
+aninhados: para cada candidato a código de 6 dígitos varria até 40 linhas à
+frente aplicando de novo todos os padrões, e dividia o texto em linhas duas
+vezes. Aqui:
+
+1. os padrões são compilados uma única vez, no import do módulo;
+2. cada linha é classificada UMA vez num token tipado (código, inteiro,
+   NCM, preço BR, unidade, texto de descrição, "Descritivo Completo");
+3. uma máquina de estados percorre os tokens uma única vez montando os itens
+   e os descritivos completos.
+
+A saída é idêntica à do parser anterior (corpus em tests/fixtures/oc_parser,
+conferido por tests/test_oc_parser.py; benchmark em
+tests/benchmark_oc_parser.py).
+
+Modo layout (motor versão 3): com PDFs de texto, os itens são reconstruídos
+pelas coordenadas das palavras (page.get_text("words")), coluna a coluna;
+ver extrair_itens_layout. O motor de texto continua sendo o fallback (PDFs
+sem tabela reconhecível, OCR).
+
+Funções puras: rodam nos processos do parsing_service.
+"""
+import re
+import uuid
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Incrementar a cada mudança que altere o resultado do parsing
+VERSAO_PARSER = "3"
+
+# ============== PADRÕES (compilados uma vez) ==============
+
+_RE_NUMERO_OC = [
+    re.compile(r'OC[- ]?(\d+[\.\d]+)', re.IGNORECASE),  # OC-2.121437 ou OC 2.121437
+    re.compile(r'Ordem de Compra[:\s]+(\d+[\.\d]+)', re.IGNORECASE),
+    re.compile(r'N[úu]mero[:\s]+(\d+[\.\d]+)', re.IGNORECASE),
+]
+_RE_ENDERECO = [
+    re.compile(r'Endere[çc]o de Entrega[:\s]*(.*?)(?:\n\n|Linha|Item)', re.IGNORECASE | re.DOTALL),
+    re.compile(r'Local de Entrega[:\s]*(.*?)(?:\n\n|Linha|Item)', re.IGNORECASE | re.DOTALL),
+    re.compile(r'Entregar em[:\s]*(.*?)(?:\n\n|Linha|Item)', re.IGNORECASE | re.DOTALL),
+]
+# Resto da linha (mesmo grupo que o antigo (.*?)(?:\n|$), sem retrocesso caractere a caractere)
+_RE_REGIAO = re.compile(r'Regi[ãa]o[:\s]*([^\n]*)', re.IGNORECASE)
+_RE_CNPJ = [
+    re.compile(r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})'),
+    re.compile(r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})'),
+]
+_RE_REQUISITANTE_NOME = re.compile(
+    r'requisitante[:\s]*([A-Za-záéíóúâêôãõçÁÉÍÓÚÂÊÔÃÕÇ\s]+?)[\s]*[-]?\s*$', re.IGNORECASE
+)
+_RE_REQUISITANTE_NOME_2 = re.compile(r'requisitante[:\s]+(.+?)(?:\s*-\s*)?$', re.IGNORECASE)
+_RE_EMAIL = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+_RE_DATA_ENTREGA = [
+    re.compile(r'Data de Entrega[:\s]*(\d{2}/\d{2}/\d{4})', re.IGNORECASE),
+    re.compile(r'Data Entrega[:\s]*(\d{2}/\d{2}/\d{4})', re.IGNORECASE),
+    re.compile(r'Entrega[:\s]*(\d{2}/\d{2}/\d{4})', re.IGNORECASE),
+    re.compile(r'Prazo de Entrega[:\s]*(\d{2}/\d{2}/\d{4})', re.IGNORECASE),
+    re.compile(r'Dt\.\s*Entrega[:\s]*(\d{2}/\d{2}/\d{4})', re.IGNORECASE),
+]
+_RE_DATA_APOS_REQUISICAO = re.compile(r'\d{1,2}\.\d{2}\.\d{6,}\s*(\d{2}/\d{2}/\d{4})')
+
+# Aplicados à linha já sem espaços nas pontas
+_RE_NUMERICO = re.compile(r'[\d.,]+')
+_RE_PRECO_BR = re.compile(r'\d{1,3}(?:\.\d{3})*,\d{2}')  # 518,95 ou 1.234,56
+_RE_DESCRITIVO = re.compile(r'([01]\d{5})\s*-\s*(.+)')   # "085674 - DIODO; LED; ..."
+_RE_COMECA_DIGITO = re.compile(r'\d')
+
+# Fallback genérico (linhas completas, sem strip)
+_RE_CODIGO_GENERICO = re.compile(r'\b([01]\d{5})\b')
+_RE_QTD_UNIDADE_GENERICO = re.compile(
+    r'\b(\d+)\s*(UN|UND|UNID|KG|PC|M|L|CX|KIT|CT|CEN|CENTO|PAR|PCT)\b', re.IGNORECASE
+)
+
+_MARCADOR_DESCRITIVO = 'Descritivo Completo'
+_PRIMEIRO_DIGITO_NCM = '123456789'
+
+# Linhas curtas de unidade que nunca entram na descrição
+_UNIDADES_CURTAS = frozenset(['UN', 'UND', 'UNID', 'KG', 'PC', 'M', 'L', 'CX', 'PAR', 'KIT', 'CJ'])
+
+# Unidade aceita após a quantidade -> unidade normalizada
+_UNIDADES = {
+    u: u for u in [
+        'UN', 'UND', 'UNID', 'KG', 'PC', 'PÇA', 'PÇ', 'PCA', 'M', 'L', 'CX', 'PAR', 'PCT', 'KIT',
+        'JG', 'JOGO', 'RL', 'ROLO', 'MT', 'METRO', 'CT', 'CEN', 'CENTO', 'MILHEIRO', 'MIL', 'CJ'
+    ]
+}
+_UNIDADES.update({u: 'UN' for u in ['UND', 'UNID', 'PÇA', 'PÇ', 'PCA', 'PC']})
+_UNIDADES.update({'MT': 'M', 'METRO': 'M', 'JOGO': 'JG', 'ROLO': 'RL'})
+
+# Linhas examinadas após o código em busca de quantidade/unidade
+JANELA_ITEM = 40
+
+def eh_texto_descricao(token: str) -> bool:
+    """Linha candidata a descrição curta: não é número, preço, unidade curta nem CFOP"""
+    return (
+        len(token) > 2 and token not in _UNIDADES_CURTAS and 'CFOP' not in token
+        and not ((token[0] in '.,' or token[0].isdecimal()) and _RE_NUMERICO.fullmatch(token))
+    )
+
+
+def unidade_linha(texto: str) -> Optional[str]:
+    """Unidade normalizada (UND/PÇ -> UN, METRO -> M...) ou None"""
+    return _UNIDADES.get(texto.upper())
+
+
+def preco_linha(texto: str) -> Optional[float]:
+    """Preço no formato brasileiro (1.234,56) ou None"""
+    if ',' not in texto or not _RE_PRECO_BR.fullmatch(texto):
+        return None
+    return float(texto.replace('.', '').replace(',', '.'))
+
+
+# ============== CAMPOS DE CABEÇALHO ==============
+
+def _numero_oc(texto: str) -> str:
+    for padrao in _RE_NUMERO_OC:
+        m = padrao.search(texto)
+        if m:
+            return f"OC-{m.group(1)}"
+    return "OC-" + str(uuid.uuid4())[:8]
+
+
+def tem_numero_oc(texto: str) -> bool:
+    """O texto já traz o número da OC (sem ele _numero_oc gera um aleatório)"""
+    return any(padrao.search(texto) for padrao in _RE_NUMERO_OC)
+
+
+def _endereco_entrega(texto: str) -> str:
+    for padrao in _RE_ENDERECO:
+        m = padrao.search(texto)
+        if m:
+            return ' '.join(m.group(1).strip().split())
+    return ""
+
+
+def _regiao(texto: str) -> str:
+    m = _RE_REGIAO.search(texto)
+    return m.group(1).strip() if m else ""
+
+
+def _cnpj_requisitante(texto: str) -> str:
+    # O CNPJ da ON (fornecedor) é 46.663.556/0001-69: pegar o primeiro diferente
+    for padrao in _RE_CNPJ:
+        encontrados = padrao.findall(texto)
+        if encontrados:
+            for cnpj in encontrados:
+                if cnpj != "46.663.556/0001-69":
+                    return cnpj
+            return ""
+    return ""
+
+
+def _requisitante(linhas: List[str]) -> tuple:
+    """Formato "Requisitante: NOME -" com o email na linha seguinte (ou na mesma)"""
+    nome = ""
+    email = ""
+    for i, linha in enumerate(linhas):
+        if 'requisitante:' not in linha.lower() or i + 1 >= len(linhas):
+            continue
+        m = _RE_REQUISITANTE_NOME.search(linha)
+        if m:
+            nome = m.group(1).strip()
+        else:
+            m = _RE_REQUISITANTE_NOME_2.search(linha)
+            if m:
+                candidato = _RE_EMAIL.sub('', m.group(1).strip().rstrip('-').strip()).strip()
+                if candidato:
+                    nome = candidato
+
+        m = _RE_EMAIL.search(linhas[i + 1].strip())
+        if m:
+            email = m.group(0)
+        if not email:
+            m = _RE_EMAIL.search(linha)
+            if m:
+                email = m.group(0)
+
+        if nome:
+            break
+    return nome, email
+
+
+def _data_entrega(texto: str) -> Optional[str]:
+    for padrao in _RE_DATA_ENTREGA:
+        m = padrao.search(texto)
+        if m:
+            dia, mes, ano = m.group(1).split('/')
+            return f"{ano}-{mes}-{dia}"
+
+    # Tabela de itens: "requisição DD/MM/YYYY" no final de cada linha
+    m = _RE_DATA_APOS_REQUISICAO.search(texto)
+    if m:
+        dia, mes, ano = m.group(1).split('/')
+        if int(ano) >= 2024:
+            return f"{ano}-{mes}-{dia}"
+    return None
+
+
+# ============== ITENS (máquina de estados) ==============
+
+def _descritivo(tokens: List[str], i: int) -> Optional[tuple]:
+    """(codigo, descricao) do "Descritivo Completo" da linha i: "CODIGO - DESCRIÇÃO" na linha seguinte"""
+    n = len(tokens)
+    if i + 1 >= n:
+        return None
+    m = _RE_DESCRITIVO.fullmatch(tokens[i + 1])
+    if not m:
+        return None
+    descricao = m.group(2).strip()
+    if i + 2 < n:
+        # Pode continuar na linha seguinte
+        seguinte = tokens[i + 2]
+        if (seguinte and not _RE_COMECA_DIGITO.match(seguinte)
+                and 'Descritivo' not in seguinte and 'Linha' not in seguinte):
+            descricao += ' ' + seguinte
+    return m.group(1), descricao
+
+
+def _montar_itens(linhas: List[str], endereco_entrega: str, regiao: str) -> List[dict]:
+    """
+    Tokenização: cada linha é reduzida uma vez ao token sem espaços nas pontas
+    e classificada pelo tipo - NUMERO (só dígitos: número da linha, código,
+    NCM, quantidade), DESCRITIVO, TEXTO (descrição curta) ou irrelevante.
+
+    Máquina de estados, numa única passada:
+
+    PROCURANDO: só interessam códigos (abrem um item se o token anterior é o
+        número da linha, 1-100) e "Descritivo Completo".
+    ITEM: os tokens são consumidos até
+        - NUMERO seguido de unidade -> quantidade (e preço duas linhas
+          abaixo): item fechado, volta a PROCURANDO
+        - DESCRITIVO, outro código ou o fim da janela de JANELA_ITEM linhas:
+          item descartado
+      No caminho, o primeiro NUMERO de 8 dígitos (ou 6 + 2) é o NCM e os
+      TEXTOs formam a descrição curta.
+
+    A descrição de cada item é resolvida no fim, quando todos os descritivos
+    completos (que costumam vir depois da tabela) já foram lidos.
+    """
+    tokens = list(map(str.strip, linhas))
+    n = len(tokens)
+    descritivos: Dict[str, str] = {}
+    encontrados = []  # (item_data, partes)
+    vistos = set()
+
+    aberto = False
+    codigo = linha_num = limite = ncm = partes = None
+
+    for i, token in enumerate(tokens):
+        if not token.isdecimal():
+            if _MARCADOR_DESCRITIVO in token:
+                aberto = False
+                descritivo = _descritivo(tokens, i)
+                if descritivo:
+                    descritivos[descritivo[0]] = descritivo[1]
+            elif aberto:
+                if i >= limite:
+                    aberto = False
+                # eh_texto_descricao() sem a chamada de função: é o caso mais comum da tabela
+                elif (len(token) > 2 and token not in _UNIDADES_CURTAS and 'CFOP' not in token
+                      and not ((token[0] in '.,' or token[0].isdecimal()) and _RE_NUMERICO.fullmatch(token))):
+                    partes.append(token)
+            continue
+
+        # NUMERO
+        if len(token) == 6 and token[0] in '01':
+            # Código de produto FIEP (NCMs começam com 8 ou 9)
+            aberto = False
+            anterior = tokens[i - 1] if i else ""
+            if len(anterior) <= 2 and anterior.isdecimal() and 1 <= int(anterior) <= 100:
+                aberto = True
+                codigo, linha_num, limite = token, int(anterior), i + JANELA_ITEM
+                ncm, partes = None, []
+            continue
+
+        if not aberto:
+            continue
+        if i >= limite:
+            aberto = False
+            continue
+
+        if ncm is None and token[0] in _PRIMEIRO_DIGITO_NCM:
+            if len(token) == 8:
+                ncm = token
+                continue
+            if len(token) == 6 and i + 1 < n:
+                sufixo = tokens[i + 1]
+                if len(sufixo) == 2 and sufixo.isdecimal():
+                    ncm = token + sufixo
+                    continue
+
+        if i + 1 >= n:
+            continue
+        unidade = unidade_linha(tokens[i + 1])
+        if unidade is None:
+            continue
+
+        aberto = False
+        quantidade = int(token)
+        chave = f"{linha_num}-{codigo}"
+        if quantidade <= 0 or chave in vistos:
+            continue
+        vistos.add(chave)
+        item_data = {
+            "codigo_item": codigo,
+            "quantidade": quantidade,
+            "descricao": None,
+            "unidade": unidade,
+            "endereco_entrega": endereco_entrega,
+            "regiao": regiao
+        }
+        preco = preco_linha(tokens[i + 2]) if i + 2 < n else None
+        if preco is not None:
+            item_data["preco_venda_pdf"] = preco
+        if ncm:
+            item_data["ncm"] = ncm
+        encontrados.append((item_data, partes))
+
+    logger.info(f"Descritivos completos encontrados: {list(descritivos.keys())}")
+
+    itens = []
+    for item_data, partes in encontrados:
+        # "Descritivo Completo" tem prioridade sobre a descrição curta
+        codigo = item_data["codigo_item"]
+        if codigo in descritivos:
+            item_data["descricao"] = descritivos[codigo]
+        else:
+            item_data["descricao"] = ' '.join(partes) if partes else f"Item {codigo}"
+        itens.append(item_data)
+    return itens
+
+
+def _montar_itens_generico(texto: str, linhas: List[str], endereco_entrega: str, regiao: str) -> List[dict]:
+    """Fallback: código em qualquer posição da linha e "QTD UNIDADE" na mesma linha ou nas 7 seguintes"""
+    itens = []
+    vistos = set()
+    i = 0  # linha da posição pos
+    pos = 0
+    ultima = -1
+    # Uma busca no texto inteiro; vale só o primeiro código de cada linha
+    for m in _RE_CODIGO_GENERICO.finditer(texto):
+        i += texto.count('\n', pos, m.start())
+        pos = m.start()
+        if i == ultima:
+            continue
+        ultima = i
+        codigo = m.group(1)
+        if codigo in vistos:
+            continue
+
+        qtd = _RE_QTD_UNIDADE_GENERICO.search(linhas[i])
+        if not qtd:
+            for j in range(i + 1, min(i + 8, len(linhas))):
+                qtd = _RE_QTD_UNIDADE_GENERICO.search(linhas[j])
+                if qtd:
+                    break
+        if not qtd or int(qtd.group(1)) <= 0:
+            continue
+
+        vistos.add(codigo)
+        itens.append({
+            "codigo_item": codigo,
+            "quantidade": int(qtd.group(1)),
+            "descricao": f"Item {codigo}",
+            "unidade": qtd.group(2).upper(),
+            "endereco_entrega": endereco_entrega,
+            "regiao": regiao
+        })
+    return itens
+
+
+def _dados_oc(full_text: str, linhas: List[str], endereco_entrega: str, regiao: str, items: List[dict]) -> dict:
+    requisitante_nome, requisitante_email = _requisitante(linhas)
+    logger.info(f"Requisitante extraído: {requisitante_nome} - {requisitante_email}")
+    return {
+        "numero_oc": _numero_oc(full_text),
+        "items": items,
+        "endereco_entrega": endereco_entrega,
+        "regiao": regiao,
+        "cnpj_requisitante": _cnpj_requisitante(full_text),
+        "data_entrega": _data_entrega(full_text),
+        "requisitante_nome": requisitante_nome,
+        "requisitante_email": requisitante_email
+    }
+
+
+def extrair_dados_oc_texto(full_text: str) -> dict:
+    """Dados da OC a partir do texto extraído do PDF (ou do OCR)"""
+    linhas = full_text.split('\n')
+
+    endereco_entrega = _endereco_entrega(full_text)
+    regiao = _regiao(full_text)
+
+    items = _montar_itens(linhas, endereco_entrega, regiao)
+    if not items:
+        items = _montar_itens_generico(full_text, linhas, endereco_entrega, regiao)
+
+    return _dados_oc(full_text, linhas, endereco_entrega, regiao, items)
+
+
+# ============== LAYOUT (coordenadas das palavras) ==============
+#
+# Palavras no formato de page.get_text("words"):
+#     (x0, y0, x1, y1, texto, bloco, linha, palavra)
+#
+# A tabela de itens da FIEP tem as colunas, da esquerda para a direita:
+# Linha | Código | Descrição | NCM | Qtd | Un | Preço | ... Em vez de adivinhar
+# as colunas pela ordem das linhas do texto simples, as palavras são
+# agrupadas em linhas visuais (pelo centro vertical) e cada item ocupa a
+# faixa que vai da linha visual com "Linha Código" até a próxima dessas (ou o
+# fim da tabela). Dentro da faixa:
+#   - quantidade: o par "inteiro unidade" mais à direita (a coluna Qtd fica à
+#     direita da descrição, então "2 M" no meio da descrição não confunde);
+#   - preço: primeiro preço BR à direita da unidade, na mesma linha visual;
+#   - NCM: 8 dígitos entre a descrição e a quantidade (ou 6 + 2 quebrado na
+#     linha visual de baixo, na mesma coluna);
+#   - descrição: palavras entre o código e a coluna NCM/Qtd, em todas as
+#     linhas visuais da faixa (descrições quebradas em várias linhas).
+
+TOLERANCIA_Y = 3.0  # pt: centros verticais mais próximos que isso = mesma linha visual
+TOLERANCIA_X = 2.0  # pt: folga no alinhamento de colunas
+_FIM_TABELA = ('total', 'valor total', 'observa')
+
+
+def agrupar_linhas_visuais(palavras) -> List[list]:
+    """Agrupa as palavras em linhas visuais, cada uma ordenada da esquerda para a direita"""
+    linhas = []
+    atual = []
+    centro = 0.0
+    for p in sorted(palavras, key=lambda p: (p[1] + p[3], p[0])):
+        c = (p[1] + p[3]) / 2
+        if atual and c - centro > TOLERANCIA_Y:
+            linhas.append(sorted(atual, key=lambda q: q[0]))
+            atual = []
+        if not atual:
+            centro = c
+        atual.append(p)
+    if atual:
+        linhas.append(sorted(atual, key=lambda q: q[0]))
+    return linhas
+
+
+def _ancora(linha: list) -> Optional[int]:
+    """Índice da palavra do código se a linha visual abre um item (número da linha 1-100 + código)"""
+    for k in range(len(linha) - 1):
+        num = linha[k][4]
+        if len(num) <= 2 and num.isdecimal() and 1 <= int(num) <= 100:
+            cod = linha[k + 1][4]
+            if len(cod) == 6 and cod.isdecimal() and cod[0] in '01':
+                return k + 1
+    return None
+
+
+def _fim_tabela(linha: list) -> bool:
+    texto = ' '.join(p[4] for p in linha)
+    return _MARCADOR_DESCRITIVO in texto or texto.lower().startswith(_FIM_TABELA)
+
+
+def _item_da_faixa(faixa: List[list], linha_num: int, codigo: tuple) -> Optional[dict]:
+    x_desc = codigo[2]
+
+    # Quantidade + unidade: o par mais à direita da faixa
+    qtd = None
+    for r, linha in enumerate(faixa):
+        for k in range(len(linha) - 1):
+            p = linha[k]
+            if p[0] <= x_desc or not p[4].isdecimal():
+                continue
+            unidade = unidade_linha(linha[k + 1][4])
+            if unidade and (qtd is None or p[0] > qtd[0][0]):
+                qtd = (p, unidade, r, k)
+    if qtd is None:
+        return None
+    p_qtd, unidade, r_qtd, k_qtd = qtd
+    quantidade = int(p_qtd[4])
+    if quantidade <= 0:
+        return None
+
+    item = {"linha": linha_num, "codigo_item": codigo[4], "quantidade": quantidade, "unidade": unidade}
+    for p in faixa[r_qtd][k_qtd + 2:]:
+        preco = preco_linha(p[4])
+        if preco is not None:
+            item["preco_venda_pdf"] = preco
+            break
+
+    # NCM: mais à direita entre a descrição e a quantidade
+    limite_desc = p_qtd[0]
+    ncm = None
+    palavras_ncm = ()
+    for r, linha in enumerate(faixa):
+        for p in linha:
+            t = p[4]
+            if not (x_desc < p[0] < p_qtd[0]) or not t.isdecimal() or t[0] not in _PRIMEIRO_DIGITO_NCM:
+                continue
+            if ncm and p[0] <= ncm[0][0]:
+                continue
+            if len(t) == 8:
+                ncm = (p, t)
+                palavras_ncm = (p,)
+            elif len(t) == 6 and r + 1 < len(faixa):
+                for s in faixa[r + 1]:
+                    if (len(s[4]) == 2 and s[4].isdecimal()
+                            and abs(s[0] - p[0]) <= TOLERANCIA_X):
+                        ncm = (p, t + s[4])
+                        palavras_ncm = (p, s)
+                        break
+    if ncm:
+        item["ncm"] = ncm[1]
+        limite_desc = ncm[0][0]
+
+    partes = [
+        p[4] for linha in faixa for p in linha
+        if x_desc - TOLERANCIA_X <= p[0] < limite_desc and p not in palavras_ncm
+    ]
+    item["descricao"] = ' '.join(partes)
+    return item
+
+
+def extrair_itens_layout(palavras) -> tuple:
+    """
+    Itens da tabela de uma página a partir das palavras com coordenadas.
+    Retorna (itens, tabela_encerrada): tabela_encerrada indica que a página
+    mostra o fim da tabela depois do último item ("Descritivo Completo",
+    "Total"...), então as páginas seguintes não têm mais itens.
+    """
+    linhas = agrupar_linhas_visuais(palavras)
+    ancoras = []
+    for r, linha in enumerate(linhas):
+        k = _ancora(linha)
+        if k is not None:
+            ancoras.append((r, k))
+
+    itens = []
+    encerrada = False
+    for a, (r, k) in enumerate(ancoras):
+        fim = ancoras[a + 1][0] if a + 1 < len(ancoras) else min(len(linhas), r + JANELA_ITEM)
+        altura = linhas[r][k][3] - linhas[r][k][1]
+        faixa = [linhas[r]]
+        for s in range(r + 1, fim):
+            linha = linhas[s]
+            anterior = faixa[-1]
+            # Linha fora da tabela ou salto vertical grande: a faixa acabou
+            if _fim_tabela(linha) or linha[0][1] - anterior[0][3] > 3 * altura:
+                encerrada = a + 1 == len(ancoras)
+                break
+            faixa.append(linha)
+        item = _item_da_faixa(faixa, int(linhas[r][k - 1][4]), linhas[r][k])
+        if item:
+            itens.append(item)
+    return itens, encerrada
+
+
+def montar_dados_oc_layout(full_text: str, itens_layout: List[dict]) -> dict:
+    """
+    Dados da OC com os itens reconstruídos por coordenadas (extrair_itens_layout)
+    e os campos de cabeçalho/descritivos completos lidos do texto das mesmas páginas.
+    """
+    linhas = full_text.split('\n')
+    endereco_entrega = _endereco_entrega(full_text)
+    regiao = _regiao(full_text)
+
+    descritivos: Dict[str, str] = {}
+    if _MARCADOR_DESCRITIVO in full_text:
+        tokens = list(map(str.strip, linhas))
+        for i, token in enumerate(tokens):
+            if _MARCADOR_DESCRITIVO in token:
+                descritivo = _descritivo(tokens, i)
+                if descritivo:
+                    descritivos[descritivo[0]] = descritivo[1]
+
+    items = []
+    vistos = set()
+    for bruto in itens_layout:
+        codigo = bruto["codigo_item"]
+        chave = f"{bruto['linha']}-{codigo}"
+        if chave in vistos:
+            continue
+        vistos.add(chave)
+        item_data = {
+            "codigo_item": codigo,
+            "quantidade": bruto["quantidade"],
+            # "Descritivo Completo" tem prioridade sobre a descrição curta
+            "descricao": descritivos.get(codigo) or bruto["descricao"] or f"Item {codigo}",
+            "unidade": bruto["unidade"],
+            "endereco_entrega": endereco_entrega,
+            "regiao": regiao
+        }
+        for campo in ("preco_venda_pdf", "ncm"):
+            if campo in bruto:
+                item_data[campo] = bruto[campo]
+        items.append(item_data)
+
+    return _dados_oc(full_text, linhas, endereco_entrega, regiao, items)
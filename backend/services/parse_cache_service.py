@@ -0,0 +1,157 @@
+"""
+Cache de resultados de parsing de PDFs (coleção `pdf_parse_cache`)
+
+O mesmo PDF é processado várias vezes: preview-pdf, upload-pdf,
+atualizar-pdf, reprocessar-requisitantes, atualizar-ncm-em-massa... e cada
+chamada repetia fitz.open + regex (às vezes OCR) sobre bytes idênticos.
+
+A chave é o SHA-256 do conteúdo, por tipo de parsing ("oc", "texto", "nf").
+Cada entrada guarda a versão do parser que a produziu: entrada de versão
+diferente é ignorada (e sobrescrita), e o startup apaga as versões antigas.
+
+    {
+        "_id": "oc:<sha256>",
+        "tipo": "oc", "sha256", "versao": "3-layout",
+        "resultado": {...},
+        "criado_em", "acessado_em"   # datetime; TTL por acessado_em
+    }
+
+Na frente do Mongo fica um LRU em memória (PDF_PARSE_CACHE_MAX entradas).
+Chamadas simultâneas com o mesmo PDF compartilham um único parsing.
+Erros de parsing não são guardados.
+"""
+import asyncio
+import copy
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+COLECAO = "pdf_parse_cache"
+CACHE_MAX_ENTRADAS = int(os.environ.get('PDF_PARSE_CACHE_MAX') or 256)
+CACHE_DIAS = int(os.environ.get('PDF_PARSE_CACHE_DIAS') or 90)
+# Resultados maiores que isso (texto de PDFs enormes) ficam só no LRU
+MAX_BYTES_PERSISTIDOS = 4 * 1024 * 1024
+
+_cache_lru: "OrderedDict[str, tuple]" = OrderedDict()  # chave -> (versao, resultado)
+_em_andamento: Dict[str, asyncio.Future] = {}
+_estatisticas = {"lru": 0, "mongo": 0, "parsing": 0}
+
+
+def hash_conteudo(conteudo: bytes) -> str:
+    return hashlib.sha256(conteudo).hexdigest()
+
+
+def _guardar_lru(chave: str, versao: str, resultado: Any):
+    _cache_lru[chave] = (versao, resultado)
+    _cache_lru.move_to_end(chave)
+    while len(_cache_lru) > CACHE_MAX_ENTRADAS:
+        _cache_lru.popitem(last=False)
+
+
+async def _ler(chave: str, versao: str) -> Optional[Any]:
+    entrada = _cache_lru.get(chave)
+    if entrada is not None and entrada[0] == versao:
+        _cache_lru.move_to_end(chave)
+        _estatisticas["lru"] += 1
+        return entrada[1]
+
+    try:
+        doc = await db[COLECAO].find_one_and_update(
+            {"_id": chave, "versao": versao},
+            {"$set": {"acessado_em": datetime.now(timezone.utc)}},
+            projection={"resultado": 1}
+        )
+    except Exception as e:
+        logger.warning(f"Erro ao ler cache de parsing: {e}")
+        return None
+    if doc is None:
+        return None
+    _estatisticas["mongo"] += 1
+    _guardar_lru(chave, versao, doc["resultado"])
+    return doc["resultado"]
+
+
+async def _gravar(chave: str, tipo: str, sha256: str, versao: str, resultado: Any):
+    _guardar_lru(chave, versao, resultado)
+    if isinstance(resultado, str) and len(resultado) > MAX_BYTES_PERSISTIDOS:
+        return
+    agora = datetime.now(timezone.utc)
+    try:
+        await db[COLECAO].replace_one(
+            {"_id": chave},
+            {"tipo": tipo, "sha256": sha256, "versao": versao, "resultado": resultado,
+             "criado_em": agora, "acessado_em": agora},
+            upsert=True
+        )
+    except Exception as e:
+        # O cache é só otimização: falha ao gravar não afeta o resultado
+        logger.warning(f"Erro ao gravar cache de parsing: {e}")
+
+
+async def obter_ou_calcular(
+    tipo: str,
+    versao: str,
+    conteudo: Optional[bytes],
+    calcular: Callable[[], Awaitable[Any]],
+    guardar: Callable[[Any], bool] = lambda resultado: True,
+    sha256: Optional[str] = None
+) -> Any:
+    """
+    Resultado em cache para (tipo, SHA-256 do conteúdo, versão) ou o de
+    calcular(), que é então guardado se guardar(resultado) for verdadeiro.
+    Com sha256 já conhecido (upload em streaming) o conteúdo pode ser None:
+    calcular() é quem lê o arquivo, e só em caso de miss.
+    Devolve sempre uma cópia: o chamador pode alterar o resultado.
+    """
+    sha256 = sha256 or hash_conteudo(conteudo)
+    chave = f"{tipo}:{sha256}"
+
+    resultado = await _ler(chave, versao)
+    if resultado is not None:
+        return copy.deepcopy(resultado)
+
+    chave_versao = f"{chave}:{versao}"
+    future = _em_andamento.get(chave_versao)
+    if future is None:
+        future = asyncio.get_running_loop().create_future()
+        _em_andamento[chave_versao] = future
+        try:
+            resultado = await calcular()
+            _estatisticas["parsing"] += 1
+            if guardar(resultado):
+                await _gravar(chave, tipo, sha256, versao, resultado)
+            future.set_result(resultado)
+        except BaseException as e:
+            future.set_exception(e)
+            # Ninguém mais esperando: evita "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            _em_andamento.pop(chave_versao, None)
+        return copy.deepcopy(resultado)
+
+    resultado = await asyncio.shield(future)
+    return copy.deepcopy(resultado)
+
+
+def estatisticas_parse_cache() -> dict:
+    return {**_estatisticas, "entradas_lru": len(_cache_lru)}
+
+
+async def criar_indices_parse_cache(versoes: Dict[str, str]):
+    """
+    Chamado no startup com a versão atual de cada tipo de parsing: apaga as
+    entradas de versões anteriores e cria o TTL por último acesso.
+    """
+    for tipo, versao in versoes.items():
+        removidas = await db[COLECAO].delete_many({"tipo": tipo, "versao": {"$ne": versao}})
+        if removidas.deleted_count:
+            logger.info(f"Cache de parsing '{tipo}': {removidas.deleted_count} entrada(s) de versão antiga removida(s)")
+    await db[COLECAO].create_index("acessado_em", expireAfterSeconds=CACHE_DIAS * 86400)
@@ -0,0 +1,186 @@
+"""
+Serviço de parsing de PDFs em processos separados
+
+PyMuPDF e Tesseract são CPU-bound e síncronos: chamados direto dentro de uma
+rota `async def`, um PDF escaneado trava o event loop por segundos e congela
+as requisições de todos os outros usuários. Aqui o parsing roda num
+ProcessPoolExecutor com número de workers configurável, fila limitada e
+timeout por PDF.
+
+Configuração (variáveis de ambiente):
+    PDF_PARSER_WORKERS  - número de processos (padrão: min(4, núcleos))
+    PDF_PARSER_TIMEOUT  - timeout em segundos por PDF (padrão: 120)
+
+No máximo PDF_PARSER_WORKERS PDFs estão no pool ao mesmo tempo: cada um
+começa a rodar assim que entra, e o timeout conta só a execução (não o tempo
+esperando atrás de um PDF lento). Um timeout derruba o pool inteiro (o worker
+travado não pode ser cancelado); os outros PDFs que estavam rodando nele são
+repetidos uma vez no pool novo. Pool quebrado que não se recupera vira 503.
+
+Os resultados ficam no cache por hash do conteúdo
+(services/parse_cache_service.py): o mesmo PDF não volta ao pool.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+from services.parse_cache_service import obter_ou_calcular
+from services.pdf_service import (
+    extract_oc_from_pdf, extrair_texto_pdf, VERSAO_EXTRACAO_OC, VERSAO_EXTRACAO_TEXTO
+)
+
+logger = logging.getLogger(__name__)
+
+PDF_PARSER_WORKERS = int(os.environ.get('PDF_PARSER_WORKERS') or min(4, os.cpu_count() or 1))
+PDF_PARSER_TIMEOUT = float(os.environ.get('PDF_PARSER_TIMEOUT') or 120)
+
+# PDFs em execução no pool: um por worker, para que nenhum fique na fila
+# interna do executor com o timeout correndo. Os demais aguardam no semáforo.
+MAX_JOBS_EM_EXECUCAO = PDF_PARSER_WORKERS
+
+# Tipo de parsing -> versão atual, para o cache (limpeza no startup)
+VERSOES_PARSING = {"oc": VERSAO_EXTRACAO_OC, "texto": VERSAO_EXTRACAO_TEXTO}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_geracao_pool = 0  # incrementada a cada reinício: identifica quem foi afetado
+_semaforo: Optional[asyncio.Semaphore] = None
+
+
+class _PoolReiniciado(Exception):
+    """O PDF não falhou por si: o pool foi reiniciado (ou quebrou) durante a execução"""
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Pool criado sob demanda. 'spawn' evita herdar threads do Motor/event loop via fork."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=PDF_PARSER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(f"Pool de parsing de PDF iniciado com {PDF_PARSER_WORKERS} workers")
+    return _pool
+
+
+def _get_semaforo() -> asyncio.Semaphore:
+    global _semaforo
+    if _semaforo is None:
+        _semaforo = asyncio.Semaphore(MAX_JOBS_EM_EXECUCAO)
+    return _semaforo
+
+
+def _reiniciar_pool(geracao: int, motivo: str):
+    """
+    Descarta o pool após um timeout ou um worker morto. O worker travado não
+    pode ser cancelado pelo Future, então os processos do pool antigo são
+    encerrados à força. `geracao` é a do pool em que o problema ocorreu: se já
+    foi reiniciado por outra execução, não faz nada.
+    """
+    global _pool, _geracao_pool
+    if geracao != _geracao_pool:
+        return
+    pool_antigo, _pool = _pool, None
+    _geracao_pool += 1
+    if pool_antigo is None:
+        return
+    processos = list(getattr(pool_antigo, "_processes", {}).values())
+    pool_antigo.shutdown(wait=False, cancel_futures=True)
+    for processo in processos:
+        if processo.is_alive():
+            processo.terminate()
+    logger.warning(f"Pool de parsing de PDF reiniciado: {motivo}")
+
+
+def _executar_extracao_oc(pdf_bytes: bytes) -> dict:
+    """
+    Roda no processo worker. HTTPException não é serializável de forma
+    confiável entre processos, então o erro volta como dado.
+    """
+    try:
+        return {"ok": True, "dados": extract_oc_from_pdf(pdf_bytes)}
+    except HTTPException as e:
+        return {"ok": False, "status_code": e.status_code, "detail": e.detail}
+
+
+async def _executar_uma_vez(funcao: Callable, pdf_bytes: bytes, timeout: float):
+    geracao = _geracao_pool
+    try:
+        future = _get_pool().submit(funcao, pdf_bytes)
+    except BrokenProcessPool:
+        _reiniciar_pool(geracao, "pool quebrado")
+        raise _PoolReiniciado()
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except asyncio.TimeoutError:
+        _reiniciar_pool(geracao, f"timeout de {timeout:.0f}s")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tempo limite excedido ao processar PDF ({timeout:.0f}s)"
+        )
+    except BrokenProcessPool:
+        # Worker encerrado por um reinício (timeout de outro PDF) ou morto
+        _reiniciar_pool(geracao, "worker encerrado")
+        raise _PoolReiniciado()
+    except asyncio.CancelledError:
+        # cancel_futures do reinício cancela o que ainda não tinha começado
+        tarefa = asyncio.current_task()
+        if future.cancelled() and geracao != _geracao_pool and not (tarefa and tarefa.cancelling()):
+            raise _PoolReiniciado()
+        raise
+
+
+async def _executar_no_pool(funcao: Callable, pdf_bytes: bytes, timeout: Optional[float]):
+    timeout = timeout or PDF_PARSER_TIMEOUT
+    async with _get_semaforo():
+        try:
+            return await _executar_uma_vez(funcao, pdf_bytes, timeout)
+        except _PoolReiniciado:
+            logger.warning("PDF interrompido por reinício do pool de parsing - nova tentativa")
+        try:
+            return await _executar_uma_vez(funcao, pdf_bytes, timeout)
+        except _PoolReiniciado:
+            raise HTTPException(
+                status_code=503,
+                detail="Processamento de PDF temporariamente indisponível. Tente novamente."
+            )
+
+
+async def extrair_oc_pdf(pdf_bytes: bytes, timeout: Optional[float] = None) -> dict:
+    """
+    Equivalente assíncrono de extract_oc_from_pdf (inclui fallback de OCR).
+    Lança HTTPException 400 em erro de parsing ou timeout.
+    """
+    async def calcular():
+        resultado = await _executar_no_pool(_executar_extracao_oc, pdf_bytes, timeout)
+        if not resultado["ok"]:
+            raise HTTPException(status_code=resultado["status_code"], detail=resultado["detail"])
+        return resultado["dados"]
+
+    # OC sem itens não é guardada: pode ser um escaneado sem OCR disponível
+    return await obter_ou_calcular(
+        "oc", VERSAO_EXTRACAO_OC, pdf_bytes, calcular,
+        guardar=lambda dados: bool(dados.get("items"))
+    )
+
+
+async def extrair_texto(pdf_bytes: bytes, timeout: Optional[float] = None) -> str:
+    """Texto simples de todas as páginas, extraído fora do event loop"""
+    return await obter_ou_calcular(
+        "texto", VERSAO_EXTRACAO_TEXTO, pdf_bytes,
+        lambda: _executar_no_pool(extrair_texto_pdf, pdf_bytes, timeout),
+        guardar=lambda texto: bool(texto.strip())
+    )
+
+
+def encerrar_pool_parsing():
+    """Chamado no shutdown da aplicação"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
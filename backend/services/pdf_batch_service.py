@@ -0,0 +1,137 @@
+"""
+Pipeline de importação em lote de PDFs de OC
+
+Usado por /purchase-orders/upload-multiple-pdfs e /admin/atualizar-todas-ocs-pdf.
+Em vez de ler → parsear → find_one → buscar referências → inserir, arquivo por
+arquivo, o lote passa por etapas:
+
+1. leitura concorrente dos arquivos
+2. parsing em paralelo no pool de processos (parsing_service)
+3. UMA consulta de OCs existentes e UMA consulta de reference_items para o lote
+4. gravação única (insert_many / bulk_write)
+
+As rotas escrevem o pipeline como um gerador assíncrono de eventos; o mesmo
+gerador atende a resposta JSON tradicional e o modo streaming (NDJSON), em que
+cada arquivo processado gera uma linha de progresso.
+"""
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+
+from services.parsing_service import extrair_oc_pdf
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+# Tipos de evento emitidos pelos pipelines
+EVENTO_PROGRESSO = "progresso"
+EVENTO_RESULTADO = "resultado"
+
+
+async def ler_arquivos(files: List[UploadFile]) -> List[Dict]:
+    """
+    Lê todos os uploads concorrentemente, preservando a ordem.
+    Retorna [{"indice", "filename", "conteudo", "erro"}]; arquivos que não são
+    PDF vêm com `erro` preenchido e `conteudo` None.
+    """
+    async def _ler(indice: int, file: UploadFile) -> Dict:
+        if not file.filename.lower().endswith('.pdf'):
+            return {"indice": indice, "filename": file.filename, "conteudo": None, "erro": "Arquivo não é PDF"}
+        return {"indice": indice, "filename": file.filename, "conteudo": await file.read(), "erro": None}
+
+    return list(await asyncio.gather(*[_ler(i, f) for i, f in enumerate(files)]))
+
+
+async def parsear_em_lote(arquivos: List[Dict]) -> AsyncIterator[Dict]:
+    """
+    Parseia os PDFs em paralelo e gera cada arquivo assim que termina
+    (ordem de conclusão), com `oc_data` ou `erro` preenchido.
+    A concorrência real é limitada pelo pool do parsing_service.
+    """
+    async def _parsear(arquivo: Dict) -> Dict:
+        if arquivo["erro"]:
+            return arquivo
+        try:
+            arquivo["oc_data"] = await extrair_oc_pdf(arquivo["conteudo"])
+        except HTTPException as e:
+            arquivo["erro"] = e.detail
+        except Exception as e:
+            arquivo["erro"] = str(e)
+        return arquivo
+
+    for tarefa in asyncio.as_completed([_parsear(a) for a in arquivos]):
+        yield await tarefa
+
+
+async def buscar_ocs_por_numero(numeros_oc: List[str], projection: Optional[Dict] = None) -> Dict[str, dict]:
+    """Uma única consulta $in para todas as OCs do lote → {numero_oc: po}"""
+    if not numeros_oc:
+        return {}
+    cursor = db.purchase_orders.find(
+        {"numero_oc": {"$in": list(set(numeros_oc))}},
+        projection or {"_id": 0}
+    )
+    return {po["numero_oc"]: po async for po in cursor}
+
+
+async def buscar_referencias(codigos: List[str]) -> Dict[str, List[dict]]:
+    """Uma única consulta $in em reference_items → {codigo_item: [refs]}"""
+    codigos = list({c for c in codigos if c})
+    if not codigos:
+        return {}
+    ref_lookup: Dict[str, List[dict]] = {}
+    async for ref in db.reference_items.find({"codigo_item": {"$in": codigos}}, {"_id": 0}):
+        ref_lookup.setdefault(ref["codigo_item"], []).append(ref)
+    return ref_lookup
+
+
+async def mapear_concorrente(funcao: Callable, valores: List, limite: int = 8) -> Dict:
+    """
+    Executa `funcao(valor)` para valores distintos com concorrência limitada
+    (ex.: busca de CEP por endereço) → {valor: resultado}. Falhas viram None.
+    """
+    semaforo = asyncio.Semaphore(limite)
+    distintos = list(dict.fromkeys(v for v in valores if v))
+
+    async def _executar(valor):
+        async with semaforo:
+            try:
+                return await funcao(valor)
+            except Exception as e:
+                logger.warning(f"Falha em {getattr(funcao, '__name__', 'funcao')}({valor!r}): {e}")
+                return None
+
+    resultados = await asyncio.gather(*[_executar(v) for v in distintos])
+    return dict(zip(distintos, resultados))
+
+
+def evento_progresso(arquivo: str, processados: int, total: int, **dados) -> Dict:
+    return {"tipo": EVENTO_PROGRESSO, "arquivo": arquivo, "processados": processados, "total": total, **dados}
+
+
+def evento_resultado(resultado: Dict) -> Dict:
+    return {"tipo": EVENTO_RESULTADO, "resultado": resultado}
+
+
+async def responder_pipeline(eventos: AsyncIterator[Dict], stream: bool):
+    """
+    stream=False: consome o pipeline e devolve apenas o resultado final (JSON).
+    stream=True: devolve NDJSON - uma linha por evento de progresso e a última
+    linha com {"tipo": "resultado", "resultado": {...}}.
+    """
+    if not stream:
+        resultado = None
+        async for evento in eventos:
+            if evento["tipo"] == EVENTO_RESULTADO:
+                resultado = evento["resultado"]
+        return resultado
+
+    async def _linhas():
+        async for evento in eventos:
+            yield json.dumps(evento, ensure_ascii=False, default=str) + "\n"
+
+    return StreamingResponse(_linhas(), media_type="application/x-ndjson")
@@ -1,211 +1,237 @@
 """
 PDF extraction service for Purchase Orders
+
+Funções puras (sem acesso ao banco nem ao event loop): podem ser executadas
+em processos separados pelo parsing_service.
 """
+import os
 import fitz  # PyMuPDF
-import re
-import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 from fastapi import HTTPException
 
+from services.oc_parser_service import (
+    extrair_dados_oc_texto, extrair_itens_layout, montar_dados_oc_layout, tem_numero_oc, VERSAO_PARSER
+)
+
+logger = logging.getLogger(__name__)
+
+# OCR para PDFs escaneados
+try:
+    import pytesseract
+    from PIL import Image
+    OCR_AVAILABLE = True
+    # As páginas já rodam em paralelo: uma thread OpenMP por processo tesseract
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+except ImportError:
+    OCR_AVAILABLE = False
+    logger.warning("pytesseract ou PIL não instalados - OCR não disponível")
+
+# "texto" (padrão): parser de texto; "layout" (opcional): itens pelas
+# coordenadas das palavras, com fallback para o texto simples. O layout só foi
+# conferido com PDFs sintéticos - o corpus de referência
+# (tests/fixtures/oc_parser) é de texto e não cobre a extração por coordenadas.
+PDF_PARSER_MODO = os.environ.get('PDF_PARSER_MODO') or 'texto'
+
+# OCR: páginas em paralelo (processos tesseract), DPI baixo primeiro e
+# reprocessamento em DPI alto só quando a confiança média fica abaixo do mínimo
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS') or min(4, os.cpu_count() or 1))
+OCR_DPI_INICIAL = int(os.environ.get('OCR_DPI_INICIAL') or 150)
+OCR_DPI_MAXIMO = int(os.environ.get('OCR_DPI_MAXIMO') or 300)
+OCR_CONFIANCA_MINIMA = float(os.environ.get('OCR_CONFIANCA_MINIMA') or 70)
+
+# Versões dos resultados guardados no cache de parsing (services/parse_cache_service.py)
+VERSAO_EXTRACAO_TEXTO = f"1-pymupdf{fitz.VersionBind}"
+VERSAO_EXTRACAO_OC = f"{VERSAO_PARSER}-{PDF_PARSER_MODO}-{VERSAO_EXTRACAO_TEXTO}"
+
+
+def extrair_texto_pdf(pdf_bytes: bytes) -> str:
+    """Extrair texto simples de todas as páginas do PDF"""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    full_text = ""
+    for page in doc:
+        full_text += page.get_text()
+    doc.close()
+    return full_text
+
+
+def _renderizar_pagina(page, dpi: int):
+    """Página em tons de cinza (1 byte por pixel: 3x menos memória e OCR mais rápido que RGB)"""
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    return Image.frombytes("L", [pix.width, pix.height], pix.samples)
+
+
+def _ocr_imagem(img) -> tuple:
+    """
+    (texto, confiança média) de uma imagem. Roda em thread: o trabalho pesado
+    é do processo tesseract. O texto continua vindo de image_to_string, o
+    mesmo que o parser de texto sempre recebeu; image_to_data é usado só para
+    a confiança que decide a releitura em OCR_DPI_MAXIMO.
+    """
+    texto = pytesseract.image_to_string(img, lang='por+eng')
+    dados = pytesseract.image_to_data(img, lang='por+eng', output_type=pytesseract.Output.DICT)
+    confiancas = [
+        float(confianca)
+        for palavra, confianca in zip(dados["text"], dados["conf"])
+        if palavra.strip() and float(confianca) >= 0
+    ]
+    media = sum(confiancas) / len(confiancas) if confiancas else 0.0
+    return texto, media
+
+
+def extract_text_with_ocr(pdf_bytes: bytes, parar: Optional[Callable[[str, str], bool]] = None) -> str:
+    """
+    Extrair texto de PDF usando OCR (para PDFs escaneados).
+
+    As páginas são renderizadas aqui (PyMuPDF não é thread-safe) e
+    reconhecidas em paralelo por OCR_WORKERS threads, cada uma com seu
+    processo tesseract. Página com confiança abaixo de OCR_CONFIANCA_MINIMA é
+    refeita em OCR_DPI_MAXIMO. Os resultados são consumidos em ordem;
+    parar(texto_acumulado, texto_da_pagina) verdadeiro encerra a leitura e
+    descarta as páginas restantes.
+    """
+    if not OCR_AVAILABLE:
+        logger.warning("OCR não disponível - pytesseract não instalado")
+        return ""
+    
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except Exception as e:
+        logger.error(f"Erro ao extrair texto com OCR: {e}")
+        return ""
+
+    executor = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+    pendentes = {}
+    full_text = ""
+    try:
+        total = doc.page_count
+
+        def submeter(page_num: int, dpi: int):
+            img = _renderizar_pagina(doc[page_num], dpi)
+            pendentes[page_num] = executor.submit(_ocr_imagem, img)
+
+        proxima = 0
+        while proxima < min(OCR_WORKERS, total):
+            try:
+                submeter(proxima, OCR_DPI_INICIAL)
+            except Exception as render_error:
+                logger.warning(f"Erro ao renderizar página {proxima + 1}: {render_error}")
+            proxima += 1
+
+        for page_num in range(total):
+            # Mantém a janela cheia enquanto esta página é aguardada
+            if proxima < total:
+                try:
+                    submeter(proxima, OCR_DPI_INICIAL)
+                except Exception as render_error:
+                    logger.warning(f"Erro ao renderizar página {proxima + 1}: {render_error}")
+                proxima += 1
+            try:
+                page_text, confianca = pendentes.pop(page_num).result()
+                if confianca < OCR_CONFIANCA_MINIMA and OCR_DPI_MAXIMO > OCR_DPI_INICIAL:
+                    submeter(page_num, OCR_DPI_MAXIMO)
+                    texto_alta, confianca_alta = pendentes.pop(page_num).result()
+                    logger.info(
+                        f"OCR página {page_num + 1}: confiança {confianca:.0f} em {OCR_DPI_INICIAL} DPI, "
+                        f"{confianca_alta:.0f} em {OCR_DPI_MAXIMO} DPI"
+                    )
+                    if confianca_alta > confianca:
+                        page_text = texto_alta
+                full_text += page_text + "\n"
+                logger.info(f"OCR página {page_num + 1}: {len(page_text)} caracteres extraídos")
+            except Exception as ocr_error:
+                logger.warning(f"Erro OCR na página {page_num + 1}: {ocr_error}")
+                page_text = ""
+
+            if parar is not None and parar(full_text, page_text):
+                if page_num + 1 < total:
+                    logger.info(f"OCR encerrado após {page_num + 1} de {total} página(s)")
+                break
+        return full_text
+    finally:
+        # Páginas ainda na fila são canceladas; as em andamento terminam sozinhas
+        executor.shutdown(wait=False, cancel_futures=True)
+        doc.close()
+
+
+def _parada_ocr_oc() -> Callable[[str, str], bool]:
+    """
+    Critério de parada do OCR de uma OC: número da OC encontrado e tabela de
+    itens encerrada (uma página sem itens novos nem "Descritivo Completo"
+    depois de já haver itens).
+    """
+    itens_anteriores = 0
+
+    def parar(texto: str, texto_pagina: str) -> bool:
+        nonlocal itens_anteriores
+        itens = len(extrair_dados_oc_texto(texto)["items"])
+        encerrada = (
+            itens > 0 and itens == itens_anteriores
+            and 'Descritivo Completo' not in texto_pagina
+        )
+        itens_anteriores = itens
+        return encerrada and tem_numero_oc(texto)
+
+    return parar
+
+
+def _extrair_oc_layout(doc) -> Optional[dict]:
+    """
+    Itens pelas coordenadas das palavras enquanto a tabela continua; depois
+    do fim da tabela as páginas seguintes só têm o texto lido (um único
+    TextPage por página). Cabeçalho (requisitante, endereço de entrega...) e
+    descritivos completos vêm do texto de todas as páginas, como no parser
+    de texto. None se nenhuma página tem tabela reconhecível.
+    """
+    textos = []
+    itens = []
+    paginas_tabela = 0
+    tabela_encerrada = False
+    for page in doc:
+        textpage = page.get_textpage()
+        textos.append(page.get_text(textpage=textpage))
+        if tabela_encerrada:
+            continue
+        paginas_tabela += 1
+        itens_pagina, fim = extrair_itens_layout(page.get_text("words", textpage=textpage))
+        itens.extend(itens_pagina)
+        if itens and (fim or not itens_pagina):
+            tabela_encerrada = True
+
+    if not itens:
+        return None
+    if paginas_tabela < doc.page_count:
+        logger.info(f"Tabela de itens encerrada: coordenadas lidas em {paginas_tabela} de {doc.page_count} página(s)")
+    return montar_dados_oc_layout("".join(textos), itens)
+
 
 def extract_oc_from_pdf(pdf_bytes: bytes) -> dict:
     """Extrair dados de OC de um PDF"""
     try:
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
-        
-        for page in doc:
-            full_text += page.get_text()
-        
-        doc.close()
-        
-        # Extrair número da OC
-        oc_patterns = [
-            r'OC[- ]?(\d+[\.\d]+)',
-            r'Ordem de Compra[:\s]+(\d+[\.\d]+)',
-            r'N[úu]mero[:\s]+(\d+[\.\d]+)'
-        ]
-        
-        numero_oc = None
-        for pattern in oc_patterns:
-            oc_match = re.search(pattern, full_text, re.IGNORECASE)
-            if oc_match:
-                numero_oc = f"OC-{oc_match.group(1)}"
-                break
-        
-        if not numero_oc:
-            numero_oc = "OC-" + str(uuid.uuid4())[:8]
-        
-        # Extrair endereço de entrega
-        endereco_patterns = [
-            r'Endere[çc]o de Entrega[:\s]*(.*?)(?:\n\n|Linha|Item)',
-            r'Local de Entrega[:\s]*(.*?)(?:\n\n|Linha|Item)',
-            r'Entregar em[:\s]*(.*?)(?:\n\n|Linha|Item)'
-        ]
-        
-        endereco_entrega = ""
-        for pattern in endereco_patterns:
-            endereco_match = re.search(pattern, full_text, re.IGNORECASE | re.DOTALL)
-            if endereco_match:
-                endereco_entrega = endereco_match.group(1).strip()
-                endereco_entrega = ' '.join(endereco_entrega.split())
-                break
-        
-        # Extrair região de entrega
-        regiao = ""
-        regiao_match = re.search(r'Regi[ãa]o[:\s]*(.*?)(?:\n|$)', full_text, re.IGNORECASE)
-        if regiao_match:
-            regiao = regiao_match.group(1).strip()
-        
-        # Extrair CNPJ do requisitante/cliente
-        cnpj_requisitante = ""
-        cnpj_patterns = [
-            r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
-            r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})'
-        ]
-        
-        for pattern in cnpj_patterns:
-            cnpj_matches = re.findall(pattern, full_text)
-            if cnpj_matches:
-                for cnpj in cnpj_matches:
-                    if cnpj != "46.663.556/0001-69":
-                        cnpj_requisitante = cnpj
-                        break
-                break
-        
-        # Parser para PDFs FIEP
-        items = []
-        seen_items = set()
-        lines = full_text.split('\n')
-        
-        for i, line in enumerate(lines):
-            line_stripped = line.strip()
-            
-            # Procurar código de 6 dígitos que começa com 0 ou 1
-            if re.match(r'^([01]\d{5})$', line_stripped):
-                codigo = line_stripped
-                
-                if i > 0:
-                    prev = lines[i-1].strip()
-                    if re.match(r'^\d{1,2}$', prev):
-                        try:
-                            linha_num = int(prev)
-                            if 1 <= linha_num <= 100:
-                                quantidade = 0
-                                unidade = "UN"
-                                descricao_parts = []
-                                preco_pdf = None
-                                
-                                for j in range(i+1, min(i+40, len(lines))):
-                                    check_line = lines[j].strip()
-                                    
-                                    if re.match(r'^([01]\d{5})$', check_line):
-                                        break
-                                    
-                                    if len(check_line) > 2 and not re.match(r'^[\d.,]+$', check_line):
-                                        if check_line not in ['UN', 'UND', 'UNID', 'KG', 'PC', 'M', 'L', 'CX', 'PAR', 'KIT']:
-                                            if 'Descritivo Completo' not in check_line and 'CFOP' not in check_line:
-                                                descricao_parts.append(check_line)
-                                    
-                                    qty_match = re.match(r'^(\d+)$', check_line)
-                                    if qty_match and quantidade == 0:
-                                        qty = int(qty_match.group(1))
-                                        if j+1 < len(lines):
-                                            unit_line = lines[j+1].strip().upper()
-                                            valid_units = ['UN', 'UND', 'UNID', 'KG', 'PC', 'PÇA', 'PÇ', 'PCA', 'M', 'L', 'CX', 'PAR', 'PCT', 'KIT', 'JG', 'JOGO', 'RL', 'ROLO', 'MT', 'METRO']
-                                            if unit_line in valid_units:
-                                                quantidade = qty
-                                                if unit_line in ['UND', 'UNID', 'PÇA', 'PÇ', 'PCA', 'PC']:
-                                                    unidade = 'UN'
-                                                elif unit_line in ['MT', 'METRO']:
-                                                    unidade = 'M'
-                                                elif unit_line in ['JOGO']:
-                                                    unidade = 'JG'
-                                                elif unit_line in ['ROLO']:
-                                                    unidade = 'RL'
-                                                else:
-                                                    unidade = unit_line
-                                                
-                                                preco_pdf = None
-                                                if j+2 < len(lines):
-                                                    preco_line = lines[j+2].strip()
-                                                    preco_match = re.match(r'^(\d{1,3}(?:\.\d{3})*,\d{2})$', preco_line)
-                                                    if preco_match:
-                                                        preco_str = preco_match.group(1).replace('.', '').replace(',', '.')
-                                                        try:
-                                                            preco_pdf = float(preco_str)
-                                                        except:
-                                                            pass
-                                                
-                                                break
-                                
-                                if quantidade > 0:
-                                    key = f"{linha_num}-{codigo}"
-                                    if key not in seen_items:
-                                        seen_items.add(key)
-                                        descricao = ' '.join(descricao_parts) if descricao_parts else f"Item {codigo}"
-                                        item_data = {
-                                            "codigo_item": codigo,
-                                            "quantidade": quantidade,
-                                            "descricao": descricao,
-                                            "unidade": unidade,
-                                            "endereco_entrega": endereco_entrega,
-                                            "regiao": regiao
-                                        }
-                                        try:
-                                            if preco_pdf is not None:
-                                                item_data["preco_venda_pdf"] = preco_pdf
-                                        except NameError:
-                                            pass
-                                        items.append(item_data)
-                        except ValueError:
-                            pass
+        try:
+            if PDF_PARSER_MODO == 'layout':
+                dados = _extrair_oc_layout(doc)
+                if dados:
+                    return dados
+            full_text = ""
+            for page in doc:
+                full_text += page.get_text()
+        finally:
+            doc.close()
         
-        # Método 2 (fallback)
-        if len(items) == 0:
-            items = []
-            seen_codes = set()
-            
-            for i, line in enumerate(lines):
-                codigo_match = re.search(r'\b([01]\d{5})\b', line)
-                if codigo_match:
-                    codigo = codigo_match.group(1)
-                    
-                    if codigo in seen_codes:
-                        continue
-                    
-                    quantidade = 0
-                    unidade = "UN"
-                    
-                    qty_match = re.search(r'\b(\d+)\s*(UN|UND|UNID|KG|PC|M|L|CX|KIT)\b', line, re.IGNORECASE)
-                    if qty_match:
-                        quantidade = int(qty_match.group(1))
-                        unidade = qty_match.group(2).upper()
-                    else:
-                        for j in range(i+1, min(i+8, len(lines))):
-                            qty_match = re.search(r'\b(\d+)\s*(UN|UND|UNID|KG|PC|M|L|CX|KIT)\b', lines[j], re.IGNORECASE)
-                            if qty_match:
-                                quantidade = int(qty_match.group(1))
-                                unidade = qty_match.group(2).upper()
-                                break
-                    
-                    if quantidade > 0:
-                        seen_codes.add(codigo)
-                        items.append({
-                            "codigo_item": codigo,
-                            "quantidade": quantidade,
-                            "descricao": f"Item {codigo}",
-                            "unidade": unidade,
-                            "endereco_entrega": endereco_entrega,
-                            "regiao": regiao
-                        })
+        # Se o PDF não tem texto (é escaneado), usar OCR
+        if not full_text.strip() and OCR_AVAILABLE:
+            logger.info("PDF parece ser escaneado - tentando OCR...")
+            full_text = extract_text_with_ocr(pdf_bytes, parar=_parada_ocr_oc())
+            if full_text.strip():
+                logger.info(f"OCR extraiu {len(full_text)} caracteres")
+            else:
+                logger.warning("OCR não conseguiu extrair texto")
         
-        return {
-            "numero_oc": numero_oc,
-            "items": items,
-            "endereco_entrega": endereco_entrega,
-            "regiao": regiao,
-            "cnpj_requisitante": cnpj_requisitante
-        }
+        # Campos da OC e itens: services/oc_parser_service.py
+        return extrair_dados_oc_texto(full_text)
     
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Erro ao processar PDF: {str(e)}")
@@ -0,0 +1,347 @@
+"""
+Read-model de itens: coleção `po_items` (uma linha por item de OC)
+
+Listagens e painéis faziam `$unwind` do array `items` de todas as OCs a cada
+requisição. A coleção `po_items` guarda, por item, apenas os campos usados
+para filtrar/ordenar/agregar, com índices próprios:
+
+    {
+        "po_id", "item_index", "numero_oc", "oc_data_entrega", "oc_created_at",
+        "codigo_item", "status", "responsavel", "responsavel_norm", "lote",
+        "quantidade", "preco_compra", "preco_venda", "frete_compra",
+        "frete_envio", "imposto", "lucro_liquido",
+        "data_cotacao", "data_compra", "data_envio", "data_entrega",
+        "codigo_rastreio", "descricao", "unidade", "marca_modelo", "imagem_url",
+        "quantidade_comprada", "atendido_por_estoque", "quantidade_usada_estoque",
+        "fonte_compra", "quantidade_fontes", "termos", "versao", "sincronizado_em"
+    }
+
+`fonte_compra` é a primeira fonte de compra do item (preço unitário,
+fornecedor e link) e `quantidade_fontes` a soma das quantidades de todas as
+fontes (None sem fontes): comissões, resumo de lucro, planilhas e estoque
+agregam só a partir das linhas, sem carregar as OCs.
+
+`termos` junta número da OC, código e descrição do item já normalizados
+(maiúsculas, sem acento, com prefixos - services/busca_service.py), com
+índice multikey: os filtros de texto da listagem de OCs são resolvidos aqui.
+
+`purchase_orders` continua sendo a fonte da verdade. Toda escrita que altera
+esses campos chama sincronizar_po()/remover_po() logo após gravar a OC
+(item_patch_service faz isso para todas as edições de itens; a troca de
+imagem por código usa sincronizar_pos_por_filtro). Escritas que só tocam
+campos fora da linha (endereço, NFs, dados bancários) não precisam
+sincronizar. As linhas são sempre recalculadas a partir da OC relida
+do banco, então a sincronização é idempotente e uma chamada perdida é
+corrigida pela próxima escrita ou pela reconstrução completa. Cada linha
+alterada também ajusta os contadores do dashboard (services/dashboard_service.py),
+e a mesma sincronização mantém o histórico de cotações
+(services/historico_cotacoes_service.py).
+
+Linhas de uma VERSAO_LINHA anterior (formato antigo) disparam a reconstrução
+no startup.
+
+Reconstrução:
+
+    python -m services.po_items_service          # CLI
+    POST /api/admin/po-items/reconstruir         # job em background
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from pymongo import ReturnDocument
+
+from services.busca_service import termos_de_campos
+from services.dashboard_service import DeltasContadores, aplicar_deltas, reconciliar_contadores
+from services.historico_cotacoes_service import reconstruir_historico, sincronizar_historico
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+COLECAO = "po_items"
+TAMANHO_LOTE = 1000
+CONCORRENCIA_ESCRITA = 50  # linhas gravadas em paralelo numa sincronização
+# Incrementar ao mudar o formato das linhas (força a reconstrução no startup)
+VERSAO_LINHA = 3
+
+# Campos copiados do item para a linha do read-model
+CAMPOS_ITEM = (
+    "codigo_item", "status", "responsavel", "lote", "quantidade",
+    "preco_compra", "preco_venda", "frete_compra", "frete_envio", "imposto", "lucro_liquido",
+    "data_cotacao", "data_compra", "data_envio", "data_entrega", "codigo_rastreio",
+    "descricao", "unidade", "marca_modelo", "imagem_url",
+    "quantidade_comprada", "atendido_por_estoque", "quantidade_usada_estoque",
+)
+
+# Campos da primeira fonte de compra copiados para `fonte_compra`
+CAMPOS_FONTE = ("preco_unitario", "fornecedor", "link")
+
+# Projeção mínima da OC necessária para montar as linhas
+PROJECAO_OC = {"_id": 0, "id": 1, "numero_oc": 1, "data_entrega": 1, "created_at": 1, "items": 1}
+
+# OCs sincronizadas enquanto uma reconstrução está em andamento (None = sem reconstrução)
+_alteradas_durante_rebuild: Optional[set] = None
+
+
+def normalizar_responsavel(responsavel: Optional[str]) -> str:
+    """Mesma normalização usada nos filtros por responsável (trim + maiúsculas)"""
+    return (responsavel or "").strip().upper()
+
+
+def montar_linha(po: dict, item_index: int, item: dict, agora: str) -> dict:
+    linha = {campo: item.get(campo) for campo in CAMPOS_ITEM}
+    fontes = item.get("fontes_compra") or []
+    linha.update({
+        # Só as chaves presentes: as rotas mantêm os defaults de fonte.get(campo, padrão)
+        "fonte_compra": {campo: fontes[0][campo] for campo in CAMPOS_FONTE if campo in fontes[0]} if fontes else None,
+        "quantidade_fontes": sum(f.get("quantidade") or 0 for f in fontes) if fontes else None,
+        "po_id": po["id"],
+        "item_index": item_index,
+        "numero_oc": po.get("numero_oc"),
+        "oc_data_entrega": po.get("data_entrega"),
+        "oc_created_at": po.get("created_at"),
+        "responsavel_norm": normalizar_responsavel(item.get("responsavel")),
+        "termos": termos_de_campos(
+            {"OC": po.get("numero_oc"), "COD": item.get("codigo_item"), "DESC": item.get("descricao")},
+            compactos=("OC", "COD")
+        ),
+        "versao": VERSAO_LINHA,
+        "sincronizado_em": agora,
+    })
+    return linha
+
+
+def _mesma_linha(anterior: Optional[dict], nova: dict) -> bool:
+    if anterior is None:
+        return False
+    return all(anterior.get(campo) == valor for campo, valor in nova.items() if campo != "sincronizado_em")
+
+
+async def _substituir_linha(po_id: str, idx: int, linha: dict, deltas: DeltasContadores) -> None:
+    """
+    Substitui uma linha devolvendo o estado anterior de forma atômica, para
+    que os contadores do dashboard recebam exatamente -1 no estado antigo e
+    +1 no novo mesmo com sincronizações concorrentes da mesma OC.
+    """
+    anterior = await db[COLECAO].find_one_and_replace(
+        {"po_id": po_id, "item_index": idx},
+        linha,
+        projection={"_id": 0, "status": 1, "responsavel_norm": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    deltas.item(anterior, -1)
+    deltas.item(linha, 1)
+
+
+async def _remover_linha(po_id: str, idx: int, deltas: DeltasContadores) -> None:
+    anterior = await db[COLECAO].find_one_and_delete(
+        {"po_id": po_id, "item_index": idx},
+        projection={"_id": 0, "status": 1, "responsavel_norm": 1}
+    )
+    deltas.item(anterior, -1)
+
+
+async def _sincronizar_linhas(po_id: str, po: Optional[dict], indices: Optional[Iterable[int]],
+                              deltas: DeltasContadores) -> None:
+    """
+    Aplica em po_items o estado atual da OC (`po` None = OC excluída).
+    Só grava as linhas que realmente mudaram.
+    """
+    antigas = {
+        linha["item_index"]: linha
+        async for linha in db[COLECAO].find({"po_id": po_id}, {"_id": 0})
+    }
+    items = (po or {}).get("items") or []
+    agora = datetime.now(timezone.utc).isoformat()
+
+    if indices is None:
+        alvos = range(len(items))
+        remover = [idx for idx in antigas if idx >= len(items)]
+    else:
+        alvos = [i for i in indices if 0 <= i < len(items)]
+        remover = []
+
+    novas = {idx: montar_linha(po, idx, items[idx], agora) for idx in alvos}
+    tarefas = [
+        _substituir_linha(po_id, idx, linha, deltas)
+        for idx, linha in novas.items() if not _mesma_linha(antigas.get(idx), linha)
+    ]
+    tarefas.extend(_remover_linha(po_id, idx, deltas) for idx in remover)
+    for i in range(0, len(tarefas), CONCORRENCIA_ESCRITA):
+        await asyncio.gather(*tarefas[i:i + CONCORRENCIA_ESCRITA])
+
+    # Responsáveis presentes na OC antes/depois, para a contagem de OCs
+    finais = {idx: linha for idx, linha in antigas.items() if idx not in remover}
+    finais.update(novas)
+    deltas.oc(
+        (linha.get("responsavel_norm") or "" for linha in antigas.values()),
+        (linha.get("responsavel_norm") or "" for linha in finais.values())
+    )
+    await sincronizar_historico(po_id, po, None if indices is None else alvos)
+
+
+async def sincronizar_po(po_id: str, indices: Optional[Iterable[int]] = None) -> None:
+    """
+    Recalcula as linhas de uma OC a partir do documento atual
+    e ajusta os contadores do dashboard.
+
+    Args:
+        po_id: ID da OC
+        indices: apenas estes itens (edição pontual). None = OC inteira
+            (criação, campos de nível de OC, itens inseridos/removidos).
+
+    Erros são apenas registrados: a escrita principal já foi feita e a
+    reconstrução corrige divergências.
+    """
+    if _alteradas_durante_rebuild is not None:
+        _alteradas_durante_rebuild.add(po_id)
+    deltas = DeltasContadores()
+    try:
+        po = await db.purchase_orders.find_one({"id": po_id}, PROJECAO_OC)
+        await _sincronizar_linhas(po_id, po, indices if po else None, deltas)
+    except Exception as e:
+        logger.error(f"Erro ao sincronizar po_items da OC {po_id}: {e}")
+    await aplicar_deltas(deltas)
+
+
+async def sincronizar_pos(po_ids: Iterable[str]) -> None:
+    """Versão em lote de sincronizar_po (OC inteira) - um find e uma gravação dos contadores"""
+    ids = list(dict.fromkeys(po_ids))
+    if not ids:
+        return
+    if _alteradas_durante_rebuild is not None:
+        _alteradas_durante_rebuild.update(ids)
+    deltas = DeltasContadores()
+    try:
+        pos = {po["id"]: po async for po in db.purchase_orders.find({"id": {"$in": ids}}, PROJECAO_OC)}
+        for po_id in ids:
+            await _sincronizar_linhas(po_id, pos.get(po_id), None, deltas)
+    except Exception as e:
+        logger.error(f"Erro ao sincronizar po_items de {len(ids)} OC(s): {e}")
+    await aplicar_deltas(deltas)
+
+
+async def sincronizar_pos_por_filtro(filtro: dict) -> None:
+    """Sincroniza as OCs que casam com um filtro (após update_many em purchase_orders)"""
+    ids = [po["id"] async for po in db.purchase_orders.find(filtro, {"_id": 0, "id": 1})]
+    for i in range(0, len(ids), TAMANHO_LOTE):
+        await sincronizar_pos(ids[i:i + TAMANHO_LOTE])
+
+
+async def remover_po(po_id: str) -> None:
+    """Remove as linhas de uma OC excluída"""
+    if _alteradas_durante_rebuild is not None:
+        _alteradas_durante_rebuild.add(po_id)
+    deltas = DeltasContadores()
+    try:
+        await _sincronizar_linhas(po_id, None, None, deltas)
+    except Exception as e:
+        logger.error(f"Erro ao remover po_items da OC {po_id}: {e}")
+    await aplicar_deltas(deltas)
+
+
+async def _criar_indices(colecao) -> None:
+    await colecao.create_index([("po_id", 1), ("item_index", 1)], unique=True)
+    # Listagem por status (com e sem filtro de responsável), ordenada por OC
+    await colecao.create_index([("status", 1), ("numero_oc", -1), ("item_index", 1)])
+    await colecao.create_index([("responsavel_norm", 1), ("status", 1), ("numero_oc", -1), ("item_index", 1)])
+    # Estoque e detalhes por código (fontes com excedente: código + status)
+    await colecao.create_index([("codigo_item", 1), ("status", 1)])
+    # Filtros de texto (número da OC, código, descrição) - multikey
+    await colecao.create_index("termos")
+
+
+async def criar_indices_po_items() -> None:
+    """Chamado no startup da aplicação"""
+    await _criar_indices(db[COLECAO])
+
+
+async def reconstruir_po_items(progresso=None) -> dict:
+    """
+    Reconstrói o read-model inteiro (e o histórico de cotações) a partir de
+    purchase_orders.
+
+    Monta uma coleção temporária e a renomeia sobre `po_items` no final
+    (renameCollection com dropTarget), de modo que as leituras nunca veem a
+    coleção pela metade. As OCs sincronizadas por escritas concorrentes
+    durante a reconstrução são ressincronizadas após o rename.
+
+    Args:
+        progresso: callback async opcional (processadas, total)
+    """
+    global _alteradas_durante_rebuild
+    if _alteradas_durante_rebuild is not None:
+        raise RuntimeError("Reconstrução de po_items já em andamento")
+    _alteradas_durante_rebuild = set()
+    try:
+        resultado = await _reconstruir(progresso)
+        resultado["historico_cotacoes"] = await reconstruir_historico()
+    finally:
+        alteradas, _alteradas_durante_rebuild = _alteradas_durante_rebuild, None
+    await sincronizar_pos(alteradas)
+    # Os contadores do dashboard passam a refletir a coleção reconstruída
+    resultado["contadores"] = await reconciliar_contadores()
+    return resultado
+
+
+async def _reconstruir(progresso) -> dict:
+    inicio = datetime.now(timezone.utc)
+    nome_tmp = f"{COLECAO}_rebuild_{uuid.uuid4().hex[:8]}"
+    tmp = db[nome_tmp]
+
+    total = await db.purchase_orders.count_documents({})
+    agora = inicio.isoformat()
+    linhas = []
+    processadas = 0
+    total_linhas = 0
+
+    try:
+        async for po in db.purchase_orders.find({}, PROJECAO_OC):
+            for idx, item in enumerate(po.get("items") or []):
+                linhas.append(montar_linha(po, idx, item, agora))
+            processadas += 1
+            if len(linhas) >= TAMANHO_LOTE:
+                await tmp.insert_many(linhas, ordered=False)
+                total_linhas += len(linhas)
+                linhas = []
+                if progresso:
+                    await progresso(processadas, total)
+        if linhas:
+            await tmp.insert_many(linhas, ordered=False)
+            total_linhas += len(linhas)
+    except BaseException:
+        # Cancelamento ou erro: descartar a coleção parcial
+        await tmp.drop()
+        raise
+
+    if total_linhas:
+        await _criar_indices(tmp)
+        await db.client.admin.command(
+            "renameCollection", f"{db.name}.{nome_tmp}",
+            to=f"{db.name}.{COLECAO}", dropTarget=True
+        )
+    else:
+        await db[COLECAO].delete_many({})
+        await criar_indices_po_items()
+
+    segundos = (datetime.now(timezone.utc) - inicio).total_seconds()
+    logger.info(f"po_items reconstruída: {processadas} OCs, {total_linhas} itens em {segundos:.1f}s")
+    return {"ocs": processadas, "itens": total_linhas, "segundos": round(segundos, 1)}
+
+
+async def po_items_precisa_reconstruir() -> bool:
+    """
+    True se o read-model precisa ser construído: coleção vazia com OCs
+    existentes, ou linhas de uma VERSAO_LINHA anterior
+    """
+    if await db[COLECAO].estimated_document_count() > 0:
+        return await db[COLECAO].find_one({"versao": {"$ne": VERSAO_LINHA}}, {"_id": 1}) is not None
+    return await db.purchase_orders.estimated_document_count() > 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(reconstruir_po_items()))
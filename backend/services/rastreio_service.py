@@ -0,0 +1,418 @@
+"""
+Serviço de rastreamento - verificação em lote dos itens com código de rastreio
+
+As verificações (agendada e manual) consultavam os Correios item a item, em
+sequência, e gravavam OC por OC. Agora o lote passa por etapas:
+
+1. uma leitura das OCs com itens rastreáveis (projeção de id/numero_oc/items)
+2. cada código distinto é consultado uma única vez, em paralelo - concorrência
+   e taxa são limitadas em correios_service
+3. as regras de status de cada item (função do chamador) rodam em memória
+4. um único bulk_write das OCs alteradas e um insert_many das notificações
+
+Agenda adaptativa (coleção `rastreio_agenda`, um documento por código):
+cada código guarda `proxima_verificacao`, e a verificação periódica processa
+apenas os códigos vencidos (índice ativo + proxima_verificacao). O intervalo
+dobra enquanto os eventos não mudam, encurta perto da entrega e a agenda é
+desativada quando o objeto é entregue. Códigos novos entram por
+agendar_rastreio() nas rotas que definem rastreio e pela sincronização diária.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+from services.correios_service import rastrear_objeto_com_cache
+from services.item_patch_service import snapshot_itens, salvar_itens_em_lote
+from utils.database import db
+
+logger = logging.getLogger(__name__)
+
+COLECAO_AGENDA = "rastreio_agenda"
+STATUS_RASTREAVEIS = ['pronto_envio', 'em_transito']
+
+INTERVALO_BASE = timedelta(hours=1)
+INTERVALO_MINIMO = timedelta(minutes=15)
+INTERVALO_MAXIMO = timedelta(hours=12)
+INTERVALO_PERTO_ENTREGA = timedelta(hours=2)  # teto perto da data de entrega da OC
+INTERVALO_FALHA = timedelta(minutes=30)
+LIMITE_POR_EXECUCAO = 500
+
+
+def normalizar_codigo(codigo: str) -> str:
+    return (codigo or "").strip().upper()
+
+
+async def buscar_rastreio_api(codigo: str, permitir_desatualizado: bool = True) -> dict:
+    """
+    Busca rastreio usando a API oficial dos Correios (com fallback para API pública).
+    Passa pelo cache de rastreamento - ver rastrear_objeto_com_cache.
+    """
+    result = await rastrear_objeto_com_cache(codigo, permitir_desatualizado)
+
+    if result.get('success'):
+        return {
+            "success": True,
+            "eventos": result.get('eventos', []),
+            "entregue": result.get('entregue', False),
+            "saiu_para_entrega": result.get('saiu_para_entrega', False),
+            "tentativa_entrega": result.get('tentativa_entrega', False),
+            "fonte": result.get('fonte', 'correios'),
+            "link_detalhes": result.get('link_detalhes', ''),
+            "atualizado_em": result.get('atualizado_em'),
+            "desatualizado": result.get('desatualizado', False)
+        }
+
+    # Retornar informações úteis quando falhar
+    return {
+        "success": False,
+        "eventos": [],
+        "message": result.get('error', "Não foi possível consultar o rastreio."),
+        "rastreamento_manual": result.get('rastreamento_manual', False),
+        "link_correios": f"https://rastreamento.correios.com.br/app/resultado.php?objeto={codigo}"
+    }
+
+
+async def rastrear_codigos(codigos: Iterable[str]) -> Dict[str, Optional[dict]]:
+    """
+    Consulta cada código distinto uma única vez, em paralelo → {codigo: resultado}.
+    Códigos cuja consulta levantou exceção ficam com None.
+    Entradas de cache vencidas são consultadas de novo (sem stale-while-revalidate).
+    """
+    distintos = list(dict.fromkeys(normalizar_codigo(c) for c in codigos if c))
+
+    async def _consultar(codigo: str) -> Optional[dict]:
+        try:
+            return await buscar_rastreio_api(codigo, permitir_desatualizado=False)
+        except Exception as e:
+            logger.warning(f"Erro ao verificar rastreio {codigo}: {e}")
+            return None
+
+    resultados = await asyncio.gather(*[_consultar(c) for c in distintos])
+    return dict(zip(distintos, resultados))
+
+
+def montar_notificacao_rastreio(po: dict, item: dict, tipo: str, titulo: str, mensagem: str) -> dict:
+    """Documento de notificação de rastreio (gravado em lote por verificar_rastreios_em_lote)"""
+    descricao = item.get('descricao', '')
+    return {
+        "id": str(uuid.uuid4()),
+        "tipo": tipo,
+        "titulo": titulo,
+        "mensagem": mensagem,
+        "numero_oc": po.get('numero_oc', ''),
+        "codigo_item": item.get('codigo_item', ''),
+        "codigo_rastreio": item.get('codigo_rastreio', ''),
+        "descricao_item": (descricao[:50] + '...') if len(descricao) > 50 else descricao,
+        "lida": False,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def verificar_rastreios_em_lote(
+    status_alvo: List[str],
+    aplicar: Callable[[dict, dict, dict, dict, List[dict]], bool],
+    stats: Optional[dict] = None,
+    codigos: Optional[List[str]] = None
+) -> dict:
+    """
+    Verifica todos os itens com código de rastreio e status em `status_alvo`
+    (ou apenas os itens com os `codigos` informados) e reagenda cada código.
+
+    `aplicar(po, item, resultado, stats, notificacoes)` recebe o resultado de
+    buscar_rastreio_api, altera o item em memória, acrescenta notificações à
+    lista e retorna True se a OC deve ser gravada.
+
+    Em conflito com edição do usuário a edição prevalece: a OC não é gravada,
+    suas notificações são descartadas e a próxima verificação tenta de novo
+    (os códigos dessa OC ficam ativos na agenda, vencidos imediatamente).
+    """
+    stats = stats if stats is not None else {}
+    for chave in ("verificados", "erros", "codigos_consultados", "conflitos"):
+        stats.setdefault(chave, 0)
+
+    filtro_codigos = set(codigos) if codigos is not None else None
+
+    def _rastreavel(item: dict) -> bool:
+        if not item.get('codigo_rastreio') or item.get('status') not in status_alvo:
+            return False
+        return filtro_codigos is None or normalizar_codigo(item['codigo_rastreio']) in filtro_codigos
+
+    # 1. Leitura das OCs e códigos
+    if filtro_codigos is not None:
+        filtro = {"items.codigo_rastreio": {"$in": list(filtro_codigos)}}
+    else:
+        filtro = {"items": {"$elemMatch": {
+            "status": {"$in": status_alvo},
+            "codigo_rastreio": {"$nin": [None, ""]}
+        }}}
+    pos = []
+    codigos_itens = []
+    cursor = db.purchase_orders.find(filtro, {"_id": 0, "id": 1, "numero_oc": 1, "data_entrega": 1, "items": 1})
+    async for po in cursor:
+        pos.append(po)
+        codigos_itens.extend(item['codigo_rastreio'] for item in po.get('items', []) if _rastreavel(item))
+
+    # 2. Consultas em paralelo (uma por código distinto)
+    resultados = await rastrear_codigos(codigos_itens)
+    stats["codigos_consultados"] += len(resultados)
+
+    # 3. Regras de status em memória
+    lote = []
+    notificacoes_por_oc = []
+    for po in pos:
+        itens_antes = snapshot_itens(po['items'])
+        notificacoes = []
+        po_atualizado = False
+
+        for item in po['items']:
+            if not _rastreavel(item):
+                continue
+            stats["verificados"] += 1
+
+            resultado = resultados.get(normalizar_codigo(item['codigo_rastreio']))
+            if resultado is None:
+                stats["erros"] += 1
+                continue
+            try:
+                if aplicar(po, item, resultado, stats, notificacoes):
+                    po_atualizado = True
+            except Exception as e:
+                stats["erros"] += 1
+                logger.warning(f"Erro ao aplicar rastreio {item['codigo_rastreio']}: {e}")
+
+        if po_atualizado:
+            lote.append((po['id'], itens_antes, po['items'], None))
+            notificacoes_por_oc.append(notificacoes)
+
+    # 4. Gravação única
+    nao_gravadas: Dict[str, List[dict]] = {}  # po_id -> itens como estão no banco
+    if lote:
+        aplicados = await salvar_itens_em_lote(lote)
+        stats["conflitos"] += aplicados.count(False)
+        nao_gravadas = {
+            po_id: itens_antes
+            for (po_id, itens_antes, _, _), aplicado in zip(lote, aplicados) if not aplicado
+        }
+        notificacoes_gravar = [
+            n for aplicado, notificacoes in zip(aplicados, notificacoes_por_oc) if aplicado
+            for n in notificacoes
+        ]
+        if notificacoes_gravar:
+            await db.notificacoes.insert_many(notificacoes_gravar)
+
+    # 5. Agenda: códigos que continuam em status rastreável e data de entrega mais próxima.
+    # OCs não gravadas contam pelo estado do banco (itens_antes), não pelo alterado em memória.
+    situacao: Dict[str, Optional[str]] = {}
+    repetir = set()
+    for po in pos:
+        itens = nao_gravadas.get(po['id'], po['items'])
+        for item in itens:
+            if item.get('codigo_rastreio') and item.get('status') in STATUS_RASTREAVEIS:
+                codigo = normalizar_codigo(item['codigo_rastreio'])
+                data_entrega = po.get('data_entrega')
+                atual = situacao.get(codigo)
+                situacao[codigo] = min(filter(None, [atual, data_entrega]), default=None)
+                if po['id'] in nao_gravadas:
+                    repetir.add(codigo)
+    await _reagendar(resultados, situacao, codigos, repetir)
+
+    return stats
+
+
+# ============== AGENDA ADAPTATIVA ==============
+
+def _perto_da_entrega(data_entrega: Optional[str], agora: datetime) -> bool:
+    """Data de entrega da OC (YYYY-MM-DD) entre ontem e amanhã - ou já vencida"""
+    if not data_entrega:
+        return False
+    try:
+        data = datetime.strptime(data_entrega[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return False
+    return data <= (agora + timedelta(days=1)).date()
+
+
+def calcular_proximo_intervalo(
+    anterior: Optional[dict],
+    resultado: Optional[dict],
+    data_entrega: Optional[str],
+    agora: datetime
+) -> timedelta:
+    """
+    - falha na consulta: recua a partir de INTERVALO_FALHA
+    - saiu para entrega: INTERVALO_MINIMO
+    - eventos mudaram: INTERVALO_BASE
+    - sem mudança: dobra o intervalo anterior até INTERVALO_MAXIMO
+    - perto da data de entrega da OC: no máximo INTERVALO_PERTO_ENTREGA
+    """
+    intervalo_anterior = timedelta(minutes=(anterior or {}).get('intervalo_minutos') or INTERVALO_BASE.total_seconds() / 60)
+
+    if not resultado or not resultado.get('success'):
+        intervalo = max(INTERVALO_FALHA, intervalo_anterior * 2)
+    elif resultado.get('saiu_para_entrega') and not resultado.get('entregue'):
+        intervalo = INTERVALO_MINIMO
+    elif anterior is None or len(resultado.get('eventos', [])) != anterior.get('qtd_eventos'):
+        intervalo = INTERVALO_BASE
+    else:
+        intervalo = intervalo_anterior * 2
+
+    if _perto_da_entrega(data_entrega, agora):
+        intervalo = min(intervalo, INTERVALO_PERTO_ENTREGA)
+    return max(INTERVALO_MINIMO, min(intervalo, INTERVALO_MAXIMO))
+
+
+async def _reagendar(resultados: Dict[str, Optional[dict]], situacao: Dict[str, Optional[str]],
+                     codigos_solicitados: Optional[List[str]], repetir: Iterable[str] = ()):
+    """
+    Atualiza a agenda dos códigos consultados (bulk_write único).
+    Códigos solicitados que não têm mais item rastreável são desativados.
+    Códigos em `repetir` (resultado não gravado por conflito) continuam
+    ativos e vencidos, para a próxima execução aplicar o resultado.
+    """
+    repetir = set(repetir)
+    agora = datetime.now(timezone.utc)
+    anteriores = {}
+    if resultados:
+        async for doc in db.rastreio_agenda.find({"codigo": {"$in": list(resultados)}}, {"_id": 0}):
+            anteriores[doc['codigo']] = doc
+
+    operacoes = []
+    for codigo, resultado in resultados.items():
+        if codigo in repetir:
+            operacoes.append(UpdateOne(
+                {"codigo": codigo},
+                {"$set": {"ativo": True, "ultima_verificacao": agora, "proxima_verificacao": agora}},
+                upsert=True
+            ))
+            continue
+        if codigo not in situacao or (resultado or {}).get('entregue'):
+            operacoes.append(UpdateOne(
+                {"codigo": codigo},
+                {"$set": {"ativo": False, "ultima_verificacao": agora}},
+                upsert=True
+            ))
+            continue
+
+        anterior = anteriores.get(codigo)
+        intervalo = calcular_proximo_intervalo(anterior, resultado, situacao[codigo], agora)
+        campos = {
+            "ativo": True,
+            "ultima_verificacao": agora,
+            "proxima_verificacao": agora + intervalo,
+            "intervalo_minutos": intervalo.total_seconds() / 60
+        }
+        if resultado and resultado.get('success'):
+            qtd_eventos = len(resultado.get('eventos', []))
+            campos["qtd_eventos"] = qtd_eventos
+            if anterior is None or anterior.get('qtd_eventos') != qtd_eventos:
+                campos["ultima_mudanca"] = agora
+        operacoes.append(UpdateOne({"codigo": codigo}, {"$set": campos}, upsert=True))
+
+    for codigo in set(codigos_solicitados or []) - set(resultados):
+        operacoes.append(UpdateOne({"codigo": codigo}, {"$set": {"ativo": False, "ultima_verificacao": agora}}))
+
+    if operacoes:
+        await db.rastreio_agenda.bulk_write(operacoes, ordered=False)
+
+
+async def agendar_rastreio_itens(itens: Iterable[dict]):
+    """
+    Chamado pelas rotas que definem código de rastreio ou mudam o status de
+    itens: códigos de itens rastreáveis são verificados na próxima execução.
+    """
+    codigos = {
+        normalizar_codigo(item['codigo_rastreio']) for item in itens
+        if item.get('codigo_rastreio') and item.get('status') in STATUS_RASTREAVEIS
+    }
+    if not codigos:
+        return
+    agora = datetime.now(timezone.utc)
+    await db.rastreio_agenda.bulk_write([
+        UpdateOne(
+            {"codigo": codigo},
+            {
+                "$set": {"ativo": True, "proxima_verificacao": agora},
+                "$setOnInsert": {"intervalo_minutos": INTERVALO_BASE.total_seconds() / 60}
+            },
+            upsert=True
+        )
+        for codigo in codigos
+    ], ordered=False)
+
+
+async def verificar_rastreios_devidos(
+    aplicar: Callable[[dict, dict, dict, dict, List[dict]], bool],
+    stats: Optional[dict] = None,
+    limite: int = LIMITE_POR_EXECUCAO
+) -> dict:
+    """Verifica apenas os códigos com proxima_verificacao vencida (mais atrasados primeiro)"""
+    stats = stats if stats is not None else {}
+    cursor = db.rastreio_agenda.find(
+        {"ativo": True, "proxima_verificacao": {"$lte": datetime.now(timezone.utc)}},
+        {"_id": 0, "codigo": 1}
+    ).sort("proxima_verificacao", 1).limit(limite)
+    codigos = [doc['codigo'] async for doc in cursor]
+    stats["codigos_devidos"] = len(codigos)
+    if not codigos:
+        return stats
+    return await verificar_rastreios_em_lote(STATUS_RASTREAVEIS, aplicar, stats, codigos=codigos)
+
+
+async def sincronizar_agenda_rastreio() -> dict:
+    """
+    Reconciliação diária (e no startup): registra códigos de itens rastreáveis
+    que ainda não estão na agenda - gravados por rotas sem agendar_rastreio(),
+    importações, restauração de backup - e desativa os que não têm mais item.
+    """
+    agora = datetime.now(timezone.utc)
+    ativos = set()
+    cursor = db.purchase_orders.find(
+        {"items": {"$elemMatch": {
+            "status": {"$in": STATUS_RASTREAVEIS},
+            "codigo_rastreio": {"$nin": [None, ""]}
+        }}},
+        {"_id": 0, "items.codigo_rastreio": 1, "items.status": 1}
+    )
+    async for po in cursor:
+        for item in po.get('items', []):
+            if item.get('codigo_rastreio') and item.get('status') in STATUS_RASTREAVEIS:
+                ativos.add(normalizar_codigo(item['codigo_rastreio']))
+
+    operacoes = []
+    for codigo in ativos:
+        operacoes.append(UpdateOne(
+            {"codigo": codigo},
+            {"$setOnInsert": {
+                "ativo": True,
+                "proxima_verificacao": agora,
+                "intervalo_minutos": INTERVALO_BASE.total_seconds() / 60
+            }},
+            upsert=True
+        ))
+        operacoes.append(UpdateOne(
+            {"codigo": codigo, "ativo": False},
+            {"$set": {"ativo": True, "proxima_verificacao": agora}}
+        ))
+    novos = reativados = 0
+    if operacoes:
+        result = await db.rastreio_agenda.bulk_write(operacoes, ordered=False)
+        novos, reativados = result.upserted_count, result.modified_count
+
+    result = await db.rastreio_agenda.update_many(
+        {"ativo": True, "codigo": {"$nin": list(ativos)}},
+        {"$set": {"ativo": False}}
+    )
+    stats = {"ativos": len(ativos), "novos": novos, "reativados": reativados, "desativados": result.modified_count}
+    logger.info(f"Agenda de rastreio sincronizada: {stats}")
+    return stats
+
+
+async def criar_indices_agenda_rastreio():
+    """Chamado no startup"""
+    await db.rastreio_agenda.create_index("codigo", unique=True)
+    await db.rastreio_agenda.create_index([("ativo", 1), ("proxima_verificacao", 1)])
+    await db.purchase_orders.create_index("items.codigo_rastreio")
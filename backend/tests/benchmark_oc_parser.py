@@ -0,0 +1,77 @@
+"""
+Benchmark do parser de texto das OCs: motor atual x parser anterior
+
+    python tests/benchmark_oc_parser.py [--itens 300] [--repeticoes 20]
+
+Mede só a etapa de texto -> dados (a extração do texto pelo PyMuPDF é igual
+nos dois). Além do corpus, gera uma OC sintética grande no layout FIEP, com
+descrições de várias linhas e "Descritivo Completo" ao final.
+
+Resultado medido (6 execuções, padrões): OC sintética de 300 itens 4,2x a
+4,9x; corpus 2,2x a 2,7x. A meta de 5x não é atingida em nenhum dos dois. Os
+arquivos do corpus têm menos de 1 KB e o tempo é dividido entre a máquina de
+estados e as regexes de cabeçalho (uma busca no texto inteiro por padrão,
+mesma semântica do parser anterior); na OC sintética as buscas de cabeçalho
+sem match (região, CNPJ) percorrem o texto inteiro.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark_oc_parser")
+
+from services.oc_parser_service import extrair_dados_oc_texto  # noqa: E402
+from oc_parser_legado import extract_oc_from_text  # noqa: E402
+
+
+def oc_sintetica(n_itens: int) -> str:
+    linhas = [
+        "ORDEM DE COMPRA", "OC-2.999999", "CNPJ: 46.663.556/0001-69", "CNPJ: 03.802.018/0001-03",
+        "Requisitante: FULANO DE TAL -", "fulano@fiep.org.br", "Data de Entrega: 01/12/2025",
+        "Endereço de Entrega: RUA TESTE, 100", "Linha",
+    ]
+    for i in range(1, n_itens + 1):
+        codigo = f"{(89000 + i) % 200000:06d}"
+        linhas += [str(i % 100 or 1), codigo]
+        linhas += [f"DESCRICAO DO ITEM {i} PARTE {p}" for p in range(1, 4 + i % 6)]
+        linhas += ["85444900", str(1 + i % 50), ("UN", "PÇ", "CX", "METRO")[i % 4], "12,34", "123,40"]
+    for i in range(1, n_itens + 1, 3):
+        codigo = f"{(89000 + i) % 200000:06d}"
+        linhas += ["Descritivo Completo:", f"{codigo} - DESCRITIVO COMPLETO DO ITEM {i}", "CONTINUACAO"]
+    return "\n".join(linhas)
+
+
+def medir(funcao, textos, repeticoes: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for texto in textos:
+            funcao(texto)
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--itens", type=int, default=300)
+    parser.add_argument("--repeticoes", type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    corpus = [p.read_text(encoding="utf-8") for p in sorted((Path(__file__).parent / "fixtures" / "oc_parser").glob("*.txt"))]
+    cenarios = {
+        "corpus": corpus,
+        f"oc_sintetica_{args.itens}_itens": [oc_sintetica(args.itens)],
+    }
+    for nome, textos in cenarios.items():
+        anterior = medir(extract_oc_from_text, textos, args.repeticoes)
+        atual = medir(extrair_dados_oc_texto, textos, args.repeticoes)
+        print(f"{nome:28s} anterior {anterior * 1000:9.1f} ms   atual {atual * 1000:9.1f} ms   {anterior / atual:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
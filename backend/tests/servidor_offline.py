@@ -0,0 +1,134 @@
+"""
+Backend em memória para testes que não dependem do servidor em execução
+
+Carrega server.py com o MongoDB trocado por mongomock-motor e o bucket GridFS
+por uma versão em memória. Usado por tests/test_servidor_offline.py:
+
+    srv = criar_servidor()          # banco vazio a cada chamada
+    srv.cliente.post("/api/...")    # TestClient autenticado como admin
+    srv.rodar(corrotina)            # chamadas diretas a serviços/jobs
+"""
+import asyncio
+import io
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "teste_offline")
+os.environ.setdefault("JWT_SECRET_KEY", "teste")
+
+from bson import ObjectId  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import server  # noqa: E402
+import services.blob_service as blob_service  # noqa: E402
+
+USUARIO_ADMIN = {"sub": "admin@teste", "role": "admin", "owner_name": "ADMIN"}
+
+
+class _GridIn:
+    def __init__(self, bucket, filename, metadata):
+        self._id = ObjectId()
+        self._bucket = bucket
+        self._filename = filename
+        self._metadata = metadata
+        self._buffer = io.BytesIO()
+
+    async def write(self, dados):
+        self._buffer.write(dados)
+
+    async def close(self):
+        conteudo = self._buffer.getvalue()
+        self._bucket.arquivos[self._id] = conteudo
+        await self._bucket.db[f"{blob_service.BUCKET_NAME}.files"].insert_one({
+            "_id": self._id, "filename": self._filename, "metadata": self._metadata,
+            "length": len(conteudo), "chunkSize": blob_service.CHUNK_SIZE,
+            "uploadDate": datetime.now(timezone.utc),
+        })
+
+    async def abort(self):
+        self._bucket.arquivos.pop(self._id, None)
+
+
+class _GridOut:
+    def __init__(self, conteudo):
+        self._conteudo = conteudo
+        self._posicao = 0
+
+    async def readchunk(self):
+        chunk = self._conteudo[self._posicao:self._posicao + blob_service.CHUNK_SIZE]
+        self._posicao += len(chunk)
+        return chunk
+
+
+class BucketMemoria:
+    """Subconjunto de AsyncIOMotorGridFSBucket usado por blob_service"""
+
+    def __init__(self, db):
+        self.db = db
+        self.arquivos = {}
+
+    def open_upload_stream(self, filename, metadata=None):
+        return _GridIn(self, filename, metadata)
+
+    def open_upload_stream_with_id(self, file_id, filename, metadata=None):
+        entrada = _GridIn(self, filename, metadata)
+        entrada._id = file_id
+        return entrada
+
+    async def upload_from_stream(self, filename, dados, metadata=None):
+        entrada = _GridIn(self, filename, metadata)
+        await entrada.write(dados)
+        await entrada.close()
+        return entrada._id
+
+    async def open_download_stream(self, file_id):
+        return _GridOut(self.arquivos[file_id])
+
+    async def delete(self, file_id):
+        self.arquivos.pop(file_id, None)
+        await self.db[f"{blob_service.BUCKET_NAME}.files"].delete_one({"_id": file_id})
+
+
+class ServidorOffline:
+    def __init__(self):
+        self.db = AsyncMongoMockClient()["teste_offline"]
+        # Cada módulo importou `db` de utils.database
+        for modulo in list(sys.modules.values()):
+            nome = getattr(modulo, "__name__", "") or ""
+            if nome == "server" or nome.startswith(("services", "utils", "routes")):
+                if getattr(modulo, "db", None) is not None:
+                    modulo.db = self.db
+        self.bucket = BucketMemoria(self.db)
+        blob_service.get_bucket = lambda: self.bucket
+        server.app.dependency_overrides[server.get_current_user] = lambda: USUARIO_ADMIN
+        server.app.dependency_overrides[server.require_admin] = lambda: USUARIO_ADMIN
+        self.cliente = TestClient(server.app)
+        self._loop = asyncio.new_event_loop()
+
+    def rodar(self, corrotina):
+        return self._loop.run_until_complete(corrotina)
+
+    def fechar(self):
+        self._loop.close()
+
+
+def criar_servidor() -> ServidorOffline:
+    return ServidorOffline()
+
+
+def pdf_texto(linhas) -> bytes:
+    """PDF de uma página com as linhas dadas (PyMuPDF)"""
+    import fitz
+
+    documento = fitz.open()
+    pagina = documento.new_page()
+    y = 50
+    for linha in linhas:
+        pagina.insert_text((50, y), linha, fontsize=9)
+        y += 12
+    return documento.tobytes()
@@ -0,0 +1,180 @@
+"""
+Corpus de referência do parser de OCs (services/oc_parser_service.py)
+
+Cada tests/fixtures/oc_parser/*.txt é o texto extraído de uma OC e o .json ao
+lado é a saída do parser anterior (tests/oc_parser_legado.py). O motor atual
+deve produzir exatamente o mesmo resultado.
+
+O modo layout (itens pelas coordenadas das palavras, opcional via
+PDF_PARSER_MODO=layout) é conferido com PDFs gerados pelo PyMuPDF no fim do
+arquivo.
+
+Não depende do backend em execução: python -m pytest tests/test_oc_parser.py
+"""
+import json
+import os
+import random
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+# O pacote services importa utils.database; o cliente Motor não conecta no import
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "teste_oc_parser")
+
+from services.oc_parser_service import extrair_dados_oc_texto  # noqa: E402
+from oc_parser_legado import extract_oc_from_text  # noqa: E402
+
+PASTA_CORPUS = Path(__file__).parent / "fixtures" / "oc_parser"
+CORPUS = sorted(PASTA_CORPUS.glob("*.txt"))
+NUMERO_ALEATORIO = "OC-<aleatorio>"
+
+
+def _normalizar(resultado: dict) -> dict:
+    if re.fullmatch(r'OC-[0-9a-f]{8}', resultado["numero_oc"]) and not re.search(r'\d\.', resultado["numero_oc"]):
+        resultado = {**resultado, "numero_oc": NUMERO_ALEATORIO}
+    return resultado
+
+
+@pytest.mark.parametrize("arquivo", CORPUS, ids=[a.stem for a in CORPUS])
+def test_corpus_igual_ao_parser_anterior(arquivo):
+    esperado = json.loads(arquivo.with_suffix(".json").read_text(encoding="utf-8"))
+    obtido = _normalizar(extrair_dados_oc_texto(arquivo.read_text(encoding="utf-8")))
+    assert obtido == esperado
+
+
+# Linhas típicas do texto das OCs, combinadas aleatoriamente
+_VOCABULARIO = [
+    "1", "2", "3", "12", "00", "101", "0", "7", "15",
+    "089847", "114720", "100300", "099999", "123456",
+    "85444900", "08912345", "853890", "902830", "31", "12345678",
+    "UN", "un", "PÇ", "METRO", "JOGO", "ROLO", "CX", "KIT", "CENTO", "XY", "UNIDADE",
+    "189,90", "1.234,56", "0,35", "1,5", "2.500,00",
+    "CABO FLEXIVEL 2,5MM", "DISJUNTOR 32A", "CFOP 5102", "Linha", "", "   ",
+    "Descritivo Completo:", "089847 - CABO FLEXIVEL; AZUL; 100M", "Descritivo Completo",
+    "3 089847 CABO 10 UN", "200 PC", "Requisitante: ANA LIMA -", "ana@fiep.org.br",
+]
+
+
+@pytest.mark.parametrize("semente", range(300))
+def test_textos_aleatorios_iguais_ao_parser_anterior(semente):
+    rnd = random.Random(semente)
+    texto = "\n".join(rnd.choice(_VOCABULARIO) for _ in range(rnd.randint(0, 150)))
+    assert _normalizar(extrair_dados_oc_texto(texto)) == _normalizar(extract_oc_from_text(texto))
+
+
+# ============== MODO LAYOUT (coordenadas das palavras) ==============
+
+def _pdf_tabela(n_itens: int, paginas_condicoes: int, rodape: tuple = ()) -> bytes:
+    """
+    OC com a tabela em colunas: descrições quebradas, NCM 6+2 e páginas de
+    condições no fim (a última com as linhas de `rodape`)
+    """
+    import fitz
+    doc = fitz.open()
+    page = doc.new_page()
+
+    def escrever(x, y, s):
+        page.insert_text((x, y), s, fontsize=8, fontname="helv")
+
+    escrever(40, 50, "Ordem de Compra: 2.123456")
+    escrever(40, 64, "Endereço de Entrega: RUA X, 100 CURITIBA")
+    y = 100
+    for x, titulo in [(40, "Linha"), (70, "Código"), (110, "Descrição"), (300, "NCM"),
+                      (350, "Qtd"), (380, "Un"), (410, "Preço")]:
+        escrever(x, y, titulo)
+    y += 14
+    for i in range(1, n_itens + 1):
+        if y > 760:
+            page = doc.new_page()
+            y = 50
+        escrever(40, y, str(i))
+        escrever(70, y, f"{100000 + i:06d}")
+        escrever(110, y, f"CABO {i} M 2,5MM")
+        if i % 2:
+            escrever(300, y, "85444900")
+        else:
+            escrever(300, y, "854449")
+            escrever(300, y + 10, "00")
+        escrever(350, y, str(i * 2))
+        escrever(380, y, "UND")
+        escrever(410, y, f"{i},50")
+        escrever(110, y + 10, "COBRE ANTICHAMA")
+        y += 26
+    escrever(40, y + 10, "Total: 99,00")
+    for _ in range(paginas_condicoes):
+        page = doc.new_page()
+        page.insert_text((40, 50), "Condições gerais de fornecimento", fontsize=8)
+    for n, linha in enumerate(rodape):
+        page.insert_text((40, 80 + 12 * n), linha, fontsize=8)
+    pdf = doc.tobytes()
+    doc.close()
+    return pdf
+
+
+@pytest.fixture
+def modo_layout(monkeypatch):
+    from services import pdf_service
+
+    monkeypatch.setattr(pdf_service, "PDF_PARSER_MODO", "layout")
+
+
+def test_layout_reconstroi_tabela_por_colunas(caplog, modo_layout):
+    from services import pdf_service
+
+    caplog.set_level("INFO", logger="services.pdf_service")
+
+    pdf = _pdf_tabela(n_itens=40, paginas_condicoes=3)
+    dados = pdf_service.extract_oc_from_pdf(pdf)
+
+    assert dados["numero_oc"] == "OC-2.123456"
+    assert len(dados["items"]) == 40
+    for i, item in enumerate(dados["items"], 1):
+        assert item["codigo_item"] == f"{100000 + i:06d}"
+        assert item["quantidade"] == i * 2
+        assert item["unidade"] == "UN"
+        assert item["preco_venda_pdf"] == i + 0.5
+        assert item["ncm"] == "85444900"
+        # Descrição quebrada em duas linhas visuais; "M" no meio dela não é a unidade
+        assert item["descricao"] == f"CABO {i} M 2,5MM COBRE ANTICHAMA"
+
+    # Parada antecipada: as coordenadas das páginas de condições não são lidas
+    assert "Tabela de itens encerrada" in caplog.text
+
+
+def test_layout_le_cabecalho_das_paginas_depois_da_tabela(modo_layout):
+    from services import pdf_service
+
+    pdf = _pdf_tabela(n_itens=3, paginas_condicoes=2, rodape=(
+        "Requisitante: MARIA SILVA -", "maria.silva@sistemafiep.org.br"
+    ))
+    dados = pdf_service.extract_oc_from_pdf(pdf)
+
+    assert len(dados["items"]) == 3
+    assert dados["requisitante_nome"] == "MARIA SILVA"
+    assert dados["requisitante_email"] == "maria.silva@sistemafiep.org.br"
+
+
+def test_layout_sem_tabela_usa_parser_de_texto(modo_layout):
+    import fitz
+    from services import pdf_service
+
+    texto = (PASTA_CORPUS / "oc_basica.txt").read_text(encoding="utf-8")
+    doc = fitz.open()
+    y = 40
+    page = doc.new_page()
+    for linha in texto.split("\n"):
+        if y > 800:
+            page = doc.new_page()
+            y = 40
+        page.insert_text((40, y), linha, fontsize=8, fontname="helv")
+        y += 10
+    pdf = doc.tobytes()
+    doc.close()
+
+    esperado = pdf_service.extrair_dados_oc_texto(pdf_service.extrair_texto_pdf(pdf))
+    assert _normalizar(pdf_service.extract_oc_from_pdf(pdf)) == _normalizar(esperado)
@@ -0,0 +1,91 @@
+"""
+Pool de processos do parsing de PDFs (services/parsing_service.py):
+timeout só da execução, nova tentativa após reinício do pool e 503 com o
+pool quebrado.
+
+Não depende do backend em execução: python -m pytest tests/test_parsing_pool.py
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "teste_parsing_pool")
+
+import services.parsing_service as parsing  # noqa: E402
+
+
+# Executadas nos processos worker (precisam ser importáveis pelo nome)
+def _ecoar(dados: bytes) -> bytes:
+    return dados
+
+
+def _dormir(dados: bytes) -> bytes:
+    time.sleep(float(dados.decode()))
+    return dados
+
+
+def _morrer(dados: bytes) -> bytes:
+    os._exit(1)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    def configurar(workers: int):
+        monkeypatch.setattr(parsing, "PDF_PARSER_WORKERS", workers)
+        monkeypatch.setattr(parsing, "MAX_JOBS_EM_EXECUCAO", workers)
+        monkeypatch.setattr(parsing, "_semaforo", None)
+        parsing.encerrar_pool_parsing()
+    yield configurar
+    parsing.encerrar_pool_parsing()
+
+
+async def _aquecer(workers: int):
+    """Sobe os processos antes de medir (o spawn não deve contar nos timeouts curtos)"""
+    await asyncio.gather(*[parsing._executar_no_pool(_dormir, b"0.3", 30) for _ in range(workers)])
+
+
+def test_timeout_nao_conta_espera_na_fila(pool):
+    pool(1)
+
+    async def cenario():
+        await _aquecer(1)
+        # O segundo espera ~0,6s pelo primeiro; o timeout de 1s vale só para a execução
+        return await asyncio.gather(
+            parsing._executar_no_pool(_dormir, b"0.6", 1.0),
+            parsing._executar_no_pool(_dormir, b"0.6", 1.0),
+        )
+
+    assert asyncio.run(cenario()) == [b"0.6", b"0.6"]
+
+
+def test_timeout_reinicia_pool_e_repete_os_outros(pool):
+    pool(2)
+
+    async def cenario():
+        await _aquecer(2)
+        lento = asyncio.create_task(parsing._executar_no_pool(_dormir, b"30", 0.5))
+        normal = asyncio.create_task(parsing._executar_no_pool(_dormir, b"1.5", 30))
+        return await asyncio.gather(lento, normal, return_exceptions=True)
+
+    lento, normal = asyncio.run(cenario())
+    assert isinstance(lento, HTTPException) and lento.status_code == 400
+    assert normal == b"1.5"
+
+
+def test_pool_quebrado_vira_503_e_se_recupera(pool):
+    pool(1)
+
+    async def cenario():
+        with pytest.raises(HTTPException) as erro:
+            await parsing._executar_no_pool(_morrer, b"", 30)
+        assert erro.value.status_code == 503
+        return await parsing._executar_no_pool(_ecoar, b"ok", 30)
+
+    assert asyncio.run(cenario()) == b"ok"
@@ -0,0 +1,372 @@
+"""
+Rotas e jobs do backend contra um MongoDB em memória (tests/servidor_offline.py)
+
+Não depende do backend em execução: python -m pytest tests/test_servidor_offline.py
+Requer mongomock-motor (pulado se não estiver instalado).
+"""
+import pytest
+
+pytest.importorskip("mongomock_motor")
+
+from servidor_offline import criar_servidor, pdf_texto  # noqa: E402
+from server import _job_atualizar_ncm_em_massa  # noqa: E402
+from services.blob_service import salvar_blob  # noqa: E402
+from services.job_service import JobContext  # noqa: E402
+
+
+def _pdf_oc(numero_oc: str, itens) -> bytes:
+    linhas = ["ORDEM DE COMPRA", f"OC-{numero_oc}", "Data de Entrega: 15/02/2026", "ITENS:"]
+    for idx, (codigo, descricao, ncm) in enumerate(itens, 1):
+        linhas += [str(idx), codigo, descricao, "10", "UN", ncm]
+    return pdf_texto(linhas)
+
+
+@pytest.fixture
+def srv():
+    servidor = criar_servidor()
+    yield servidor
+    servidor.fechar()
+
+
+def test_upload_pdf_cria_oc_com_pdf_no_gridfs(srv):
+    pdf = _pdf_oc("2.118938.0", [("089847", "CABO FLEXIVEL AZUL", "85444900")])
+
+    r = srv.cliente.post(
+        "/api/purchase-orders/upload-pdf",
+        files={"file": ("oc.pdf", pdf, "application/pdf")}
+    )
+
+    assert r.status_code == 200, r.text
+    po = srv.rodar(srv.db.purchase_orders.find_one({"id": r.json()["po_id"]}))
+    assert po["updated_at"] == po["pdf_original"]["uploaded_at"]
+    assert po["pdf_original"]["size"] == len(pdf)
+    assert len(srv.bucket.arquivos) == 1
+
+
+def test_job_ncm_em_massa_le_pdf_do_gridfs(srv):
+    srv.rodar(srv.db.purchase_orders.insert_one({
+        "id": "po-ncm", "numero_oc": "OC-2.118938",
+        "items": [{"id": "it-1", "codigo_item": "089847", "descricao": "CABO", "status": "pendente"}]
+    }))
+    pdf = pdf_texto(["Ordem de Compra: 2.118938", "089847", "CABO FLEXIVEL", "85444900"])
+    blob = srv.rodar(salvar_blob(pdf, "oc.pdf", "application/pdf"))
+
+    resultado = srv.rodar(_job_atualizar_ncm_em_massa(
+        {"arquivos": [{"filename": "oc.pdf", **blob}], "rejeitados": []},
+        JobContext("job-teste")
+    ))
+
+    assert resultado["resultados"][0]["success"], resultado
+    assert resultado["resultados"][0]["ncm_por_item"] == {"089847": "85444900"}
+    assert resultado["total_ncm_atualizados"] == 1
+    po = srv.rodar(srv.db.purchase_orders.find_one({"id": "po-ncm"}))
+    assert po["items"][0]["ncm"] == "85444900"
+
+
+def test_dashboard_conta_ocs_sem_itens(srv):
+    from services.po_items_service import sincronizar_po
+
+    srv.rodar(srv.db.purchase_orders.insert_many([
+        {"id": "po-vazia", "numero_oc": "OC-1", "items": []},
+        {"id": "po-itens", "numero_oc": "OC-2", "items": [
+            {"id": "it-1", "codigo_item": "089847", "status": "pendente", "responsavel": "Maria"}
+        ]},
+    ]))
+    for po_id in ("po-vazia", "po-itens"):
+        srv.rodar(sincronizar_po(po_id))
+
+    r = srv.cliente.get("/api/dashboard")
+
+    assert r.status_code == 200, r.text
+    assert r.json()["total_ocs"] == 2
+    assert r.json()["total_items"] == 1
+    assert r.json()["items_por_responsavel"]["Maria"]["pendente"] == 1
+
+
+def test_rastreio_em_conflito_fica_vencido_na_agenda(srv, monkeypatch):
+    import services.rastreio_service as rastreio_service
+
+    srv.rodar(srv.db.purchase_orders.insert_one({
+        "id": "po-rastreio", "numero_oc": "OC-3",
+        "items": [{"id": "it-1", "codigo_item": "089847", "status": "em_transito",
+                   "codigo_rastreio": "AA123456789BR"}]
+    }))
+
+    async def rastrear(codigos):
+        return {"AA123456789BR": {"success": True, "entregue": True, "eventos": [{}]}}
+
+    async def salvar_em_conflito(lote):
+        return [False] * len(lote)
+
+    def aplicar(po, item, resultado, stats, notificacoes):
+        item["status"] = "entregue"
+        notificacoes.append({"id": "n-1"})
+        return True
+
+    monkeypatch.setattr(rastreio_service, "rastrear_codigos", rastrear)
+    monkeypatch.setattr(rastreio_service, "salvar_itens_em_lote", salvar_em_conflito)
+
+    stats = srv.rodar(rastreio_service.verificar_rastreios_em_lote(["em_transito"], aplicar))
+
+    assert stats["conflitos"] == 1
+    agenda = srv.rodar(srv.db.rastreio_agenda.find_one({"codigo": "AA123456789BR"}))
+    assert agenda["ativo"] is True
+    assert agenda["proxima_verificacao"] == agenda["ultima_verificacao"]
+    assert srv.rodar(srv.db.notificacoes.count_documents({})) == 0
+
+
+def test_backup_ndjson_leva_e_restaura_arquivos_do_gridfs(srv):
+    from services.blob_service import BUCKET_NAME, ler_conteudo
+
+    conteudo = bytes(range(256)) * 2100  # ~540 KB: três chunks do GridFS
+    blob = srv.rodar(salvar_blob(conteudo, "nf.pdf", "application/pdf"))
+    srv.rodar(srv.db.purchase_orders.insert_one({
+        "id": "po-backup", "numero_oc": "OC-4",
+        "pdf_original": {"filename": "oc.pdf", **blob}, "items": []
+    }))
+
+    backup = srv.cliente.get("/api/backup/export", params={"formato": "ndjson", "compressao": "gzip"})
+    assert backup.status_code == 200, backup.text
+
+    # Banco novo: só o bucket vazio
+    srv.bucket.arquivos.clear()
+    srv.rodar(srv.db[f"{BUCKET_NAME}.files"].delete_many({}))
+    srv.rodar(srv.db.purchase_orders.delete_many({}))
+
+    r = srv.cliente.post(
+        "/api/backup/restore",
+        files={"file": ("backup.ndjson.gz", backup.content, "application/gzip")}
+    )
+
+    assert r.status_code == 200, r.text
+    assert r.json()["detalhes"]["arquivos"] == {"restaurados": 1, "existentes": 0}
+    po = srv.rodar(srv.db.purchase_orders.find_one({"id": "po-backup"}))
+    assert srv.rodar(ler_conteudo(po["pdf_original"], "data")) == conteudo
+
+
+def test_migracao_de_blobs_reler_oc_alterada_no_meio(srv, monkeypatch):
+    import base64
+    import services.blob_service as blob_service
+
+    srv.rodar(srv.db.purchase_orders.insert_one({
+        "id": "po-legado", "numero_oc": "OC-5",
+        "items": [{"id": "it-1", "codigo_item": "089847", "status": "comprado", "notas_fiscais_fornecedor": [
+            {"id": "nf-1", "filename": "nf1.pdf", "file_data": base64.b64encode(b"nf antiga").decode()}
+        ]}]
+    }))
+    converter = blob_service.converter_para_blob
+    editado = []
+
+    async def converter_com_edicao_concorrente(ref, campo_legado, filename, content_type):
+        if not editado:
+            # Outra NF entra na frente entre a leitura e a gravação da migração
+            editado.append(True)
+            await srv.db.purchase_orders.update_one({"id": "po-legado"}, {
+                "$push": {"items.0.notas_fiscais_fornecedor": {
+                    "$each": [{"id": "nf-2", "filename": "nf2.pdf"}], "$position": 0
+                }},
+                "$inc": {"items.0.versao_item": 1}
+            })
+        return await converter(ref, campo_legado, filename, content_type)
+
+    monkeypatch.setattr(blob_service, "converter_para_blob", converter_com_edicao_concorrente)
+
+    stats = srv.rodar(blob_service.migrar_blobs_legados())
+
+    nfs = srv.rodar(srv.db.purchase_orders.find_one({"id": "po-legado"}))["items"][0]["notas_fiscais_fornecedor"]
+    assert [nf["id"] for nf in nfs] == ["nf-2", "nf-1"]
+    assert "file_data" not in nfs[1]
+    assert srv.rodar(blob_service.ler_conteudo(nfs[1], "file_data")) == b"nf antiga"
+    assert stats["ocs_migradas"] == 1 and stats["conflitos"] == 0, stats
+
+
+def _png(cor) -> bytes:
+    import io
+    from PIL import Image
+
+    saida = io.BytesIO()
+    Image.new("RGB", (300, 200), cor).save(saida, "PNG")
+    return saida.getvalue()
+
+
+def test_variantes_geradas_uma_vez_para_pedidos_simultaneos(srv, monkeypatch):
+    import asyncio
+    import services.imagem_service as imagem_service
+
+    original = srv.rodar(salvar_blob(_png((200, 30, 30)), "foto.png", "image/png"))
+    doc = {"codigo_item": "089847", "data_upload": "2026-01-01T00:00:00", "content_type": "image/png", **original}
+    srv.rodar(srv.db.imagens_itens.insert_one(dict(doc)))
+    gerar = imagem_service.gerar_variantes
+    chamadas = []
+
+    async def gerar_contando(conteudo, codigo_item):
+        chamadas.append(codigo_item)
+        return await gerar(conteudo, codigo_item)
+
+    monkeypatch.setattr(imagem_service, "gerar_variantes", gerar_contando)
+
+    async def pedidos():
+        return await asyncio.gather(*[
+            imagem_service.obter_variante(dict(doc), "thumb", formato) for formato in ("webp", "jpeg", "webp")
+        ])
+
+    refs = srv.rodar(pedidos())
+
+    assert len(chamadas) == 1
+    assert all(ref and ref["blob_id"] for ref in refs)
+    gravado = srv.rodar(srv.db.imagens_itens.find_one({"codigo_item": "089847"}))
+    assert gravado["variantes"]["thumb"]["webp"] == refs[0]
+
+
+def test_variantes_de_imagem_trocada_sao_apagadas(srv):
+    import services.imagem_service as imagem_service
+
+    original = srv.rodar(salvar_blob(_png((30, 30, 200)), "foto.png", "image/png"))
+    doc = {"codigo_item": "089848", "data_upload": "2026-01-01T00:00:00", "content_type": "image/png", **original}
+    # Novo upload entre a leitura do documento e a gravação das variantes
+    srv.rodar(srv.db.imagens_itens.insert_one({**doc, "data_upload": "2026-02-01T00:00:00"}))
+
+    ref = srv.rodar(imagem_service.obter_variante(dict(doc), "media", "jpeg"))
+
+    assert ref is None
+    assert [str(blob_id) for blob_id in srv.bucket.arquivos] == [original["blob_id"]]
+
+
+def test_restauracao_ignora_colecoes_operacionais(srv):
+    backup = {
+        "purchase_orders": [{"id": "po-restaurada", "numero_oc": "OC-6", "items": [
+            {"id": "it-1", "codigo_item": "089847", "status": "em_transito", "codigo_rastreio": "BB123456789BR"}
+        ]}],
+        "jobs": [{"id": "job-antigo", "tipo": "recalcular_lucros", "status": "pendente"}],
+        "dashboard_counters": [{"_id": "__total__", "total_itens": 999}],
+        "rastreio_agenda": [{"codigo": "CC123456789BR", "ativo": True}],
+        "backup_info": {"versao": "4.1", "tipo": "completo"},
+    }
+
+    r = srv.cliente.post("/api/backup/restore-data", json=backup)
+
+    assert r.status_code == 200, r.text
+    assert set(r.json()["detalhes"]["collections_restauradas"]) == {"purchase_orders"}
+    assert srv.rodar(srv.db.jobs.find_one({"id": "job-antigo"})) is None
+    assert srv.rodar(srv.db.dashboard_counters.count_documents({})) == 0
+    agenda = srv.rodar(srv.db.rastreio_agenda.find({}, {"_id": 0, "codigo": 1, "ativo": 1}).to_list(None))
+    assert agenda == [{"codigo": "BB123456789BR", "ativo": True}]
+
+
+@pytest.mark.parametrize("itens_enviados", [1, 2], ids=["mesmos-itens", "item-incluido"])
+def test_edicao_completa_da_oc_com_edicao_concorrente_retorna_409(srv, monkeypatch, itens_enviados):
+    import server
+
+    srv.rodar(srv.db.purchase_orders.insert_one({
+        "id": "po-edicao", "numero_oc": "OC-6",
+        "items": [{"id": "it-1", "codigo_item": "089847", "quantidade": 10, "status": "pendente", "versao_item": 3}]
+    }))
+
+    def editar_antes(funcao):
+        async def com_edicao_concorrente(po_id, itens_antes, itens_novos, campos_oc=None, **kwargs):
+            # Outro usuário marca o item como cotado entre a leitura e a gravação
+            await srv.db.purchase_orders.update_one({"id": "po-edicao"}, {
+                "$set": {"items.0.status": "cotado"}, "$inc": {"items.0.versao_item": 1}
+            })
+            return await funcao(po_id, itens_antes, itens_novos, campos_oc, **kwargs)
+        return com_edicao_concorrente
+
+    monkeypatch.setattr(server, "salvar_itens", editar_antes(server.salvar_itens))
+    monkeypatch.setattr(server, "substituir_itens", editar_antes(server.substituir_itens))
+
+    r = srv.cliente.put("/api/purchase-orders/po-edicao", json={
+        "numero_oc": "OC-6",
+        "items": [{"codigo_item": f"08984{n}", "quantidade": 5} for n in range(7, 7 + itens_enviados)]
+    })
+
+    assert r.status_code == 409, r.text
+    po = srv.rodar(srv.db.purchase_orders.find_one({"id": "po-edicao"}))
+    assert len(po["items"]) == 1
+    assert po["items"][0]["status"] == "cotado" and po["items"][0]["quantidade"] == 10
+
+
+def test_edicao_completa_da_oc_incrementa_versao_dos_itens(srv):
+    srv.rodar(srv.db.purchase_orders.insert_one({
+        "id": "po-edicao", "numero_oc": "OC-6",
+        "items": [{"id": "it-1", "codigo_item": "089847", "quantidade": 10, "status": "pendente", "versao_item": 3}]
+    }))
+
+    r = srv.cliente.put("/api/purchase-orders/po-edicao", json={
+        "numero_oc": "OC-7",
+        "items": [{"codigo_item": "089847", "quantidade": 5}, {"codigo_item": "089848", "quantidade": 2}]
+    })
+
+    assert r.status_code == 200, r.text
+    po = srv.rodar(srv.db.purchase_orders.find_one({"id": "po-edicao"}))
+    assert po["numero_oc"] == "OC-7"
+    assert [(i["quantidade"], i["versao_item"]) for i in po["items"]] == [(5, 4), (2, 1)]
+    linhas = srv.rodar(srv.db.po_items.count_documents({"po_id": "po-edicao"}))
+    assert linhas == 2
+
+
+def test_planilhas_comissoes_e_estoque_lidos_de_po_items(srv):
+    from services.po_items_service import sincronizar_po
+
+    srv.rodar(srv.db.purchase_orders.insert_many([
+        {"id": "po-a", "numero_oc": "OC-10", "items": [
+            {"codigo_item": "089847", "descricao": "CABO", "quantidade": 10, "status": "entregue",
+             "lote": "Lote 36", "responsavel": "Fabio", "preco_venda": 20.0, "preco_compra": 8.0,
+             "fontes_compra": [{"quantidade": 12, "preco_unitario": 7.5, "fornecedor": "LOJA A"}]},
+            {"codigo_item": "089848", "descricao": "FITA", "quantidade": 4, "status": "pendente",
+             "lote": "CHAMAMENTO", "responsavel": "Maria"},
+        ]},
+        {"id": "po-b", "numero_oc": "OC-2.118938", "items": [
+            {"codigo_item": "089847", "quantidade": 5, "status": "entregue", "responsavel": "Maria",
+             "preco_venda": 10.0, "quantidade_comprada": 5},
+        ]},
+    ]))
+    for po_id in ("po-a", "po-b"):
+        srv.rodar(sincronizar_po(po_id))
+    # As rotas abaixo agregam só as linhas de po_items
+    srv.rodar(srv.db.purchase_orders.delete_many({}))
+
+    planilha = srv.cliente.get("/api/planilha-itens").json()
+    cabo = next(i for i in planilha["itens"] if i["codigo_item"] == "089847")
+    assert (cabo["quantidade_total_necessaria"], cabo["quantidade_total_comprada"]) == (15, 15)
+    assert cabo["descricao"] == "CABO" and cabo["lotes"] == ["Lote 36"]
+    assert [o["preco_unitario"] for o in cabo["ocorrencias"]] == [0, 7.5]
+    assert planilha["estatisticas"]["total_quantidade_faltante"] == 4
+
+    comissoes = {c["responsavel"]: c for c in srv.cliente.get("/api/admin/comissoes").json()}
+    assert comissoes["FABIO"]["valor_venda_total"] == 200.0 and comissoes["FABIO"]["qtd_itens"] == 1
+    assert comissoes["MARIA"]["qtd_itens"] == 0  # OC-2.118938 não gera comissão
+
+    resumo = srv.cliente.get("/api/admin/resumo-lucro").json()["resumo"]
+    assert resumo["total_itens_entregues"] == 2
+    assert resumo["total_venda"] == 250.0 and resumo["total_compra"] == 80.0
+    assert resumo["total_comissoes"] == 3.0
+
+    estoque = srv.cliente.get("/api/estoque").json()["estoque"]
+    assert [(e["codigo_item"], e["disponivel"], e["fornecedor"]) for e in estoque] == [("089847", 2, "LOJA A")]
+    detalhes = srv.cliente.get("/api/estoque/detalhes/089847").json()
+    assert detalhes["total_disponivel"] == 2 and detalhes["fontes"][0]["numero_oc"] == "OC-10"
+
+
+def test_orfaos_preservam_pdfs_de_jobs_nao_concluidos(srv):
+    from datetime import datetime, timedelta, timezone
+    from services.blob_service import BUCKET_NAME, remover_blobs_orfaos
+
+    pendente = srv.rodar(salvar_blob(b"oc pendente", "oc1.pdf", "application/pdf"))
+    concluido = srv.rodar(salvar_blob(b"oc concluida", "oc2.pdf", "application/pdf"))
+    srv.rodar(srv.db.jobs.insert_many([
+        {"id": "job-1", "tipo": "atualizar_ncm_em_massa", "status": "pendente",
+         "params": {"arquivos": [{"filename": "oc1.pdf", **pendente}], "rejeitados": []}},
+        {"id": "job-2", "tipo": "atualizar_ncm_em_massa", "status": "concluido",
+         "params": {"arquivos": [{"filename": "oc2.pdf", **concluido}], "rejeitados": []}},
+    ]))
+
+    # Arquivos antigos o bastante para a varredura
+    srv.rodar(srv.db[f"{BUCKET_NAME}.files"].update_many(
+        {}, {"$set": {"uploadDate": datetime.now(timezone.utc) - timedelta(days=2)}}
+    ))
+
+    removidos = srv.rodar(remover_blobs_orfaos())
+
+    assert removidos == 1
+    restantes = srv.rodar(srv.db[f"{BUCKET_NAME}.files"].find({}, {"_id": 1}).to_list(None))
+    assert [str(f["_id"]) for f in restantes] == [pendente["blob_id"]]
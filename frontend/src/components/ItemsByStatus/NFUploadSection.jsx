@@ -3,7 +3,7 @@
  * Extraído de ItemsByStatus.js para melhorar performance
  */
 import React, { useState, useRef } from 'react';
-import { apiPost, apiGet, apiDelete, API } from '../../utils/api';
+import { apiPost, apiDelete, baixarArquivo, API } from '../../utils/api';
 
 const NFUploadSection = ({ 
   item, 
@@ -35,24 +35,17 @@ const NFUploadSection = ({
     setUploading(true);
     
     try {
-      const base64 = await new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onload = (e) => resolve(e.target.result.split(',')[1]);
-        reader.onerror = () => reject(new Error('Erro ao ler arquivo'));
-        reader.readAsDataURL(file);
-      });
-      
       const contentType = file.type || (fileExtension === '.xml' ? 'text/xml' : 'application/pdf');
       
+      // Multipart: o arquivo vai em streaming para o servidor, sem base64
+      const formData = new FormData();
+      formData.append('file', new File([file], file.name, { type: contentType }));
+      formData.append('tipo', tipo);
+      if (ncmManual) formData.append('ncm_manual', ncmManual);
+      
       const response = await apiPost(
-        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais`,
-        {
-          filename: file.name,
-          content_type: contentType,
-          file_data: base64,
-          ncm_manual: ncmManual || null,
-          tipo: tipo
-        }
+        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/upload`,
+        formData
       );
       
       alert(`Nota fiscal adicionada! NCM: ${response.data.ncm || 'Não detectado'}`);
@@ -69,27 +62,10 @@ const NFUploadSection = ({
 
   const handleDownload = async (nf) => {
     try {
-      const response = await apiGet(
-        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/${nf.id}/download`
+      await baixarArquivo(
+        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/${nf.id}/arquivo`,
+        nf.filename
       );
-      
-      const { file_data, content_type, filename } = response.data;
-      
-      const byteCharacters = atob(file_data);
-      const byteArray = new Uint8Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteArray[i] = byteCharacters.charCodeAt(i);
-      }
-      
-      const blob = new Blob([byteArray], { type: content_type });
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = filename || nf.filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
     } catch (error) {
       console.error('Erro ao baixar:', error);
       alert('Erro ao baixar nota fiscal.');
@@ -1,5 +1,5 @@
 import React, { useState, useCallback } from 'react';
-import { API_URL } from '../../utils/api';
+import { API_URL, urlVariante } from '../../utils/api';
 
 /**
  * Componente para exibir thumbnail de imagem com popup para visualização completa
@@ -18,6 +18,7 @@ const ItemImage = ({
   const [isUploading, setIsUploading] = useState(false);
 
   const isSmall = size === 'small';
+  const urlCompleta = imagemUrl && (imagemUrl.startsWith('http') ? imagemUrl : `${API_URL}${imagemUrl}`);
   const thumbnailSize = isSmall ? '40px' : '60px';
 
   const handleDragOver = useCallback((e) => {
@@ -139,7 +140,7 @@ const ItemImage = ({
         }}
       >
         <img
-          src={imagemUrl.startsWith('http') ? imagemUrl : `${API_URL}${imagemUrl}`}
+          src={urlVariante(urlCompleta, 'thumb')}
           alt={`Item ${codigoItem}`}
           style={{
             width: '100%',
@@ -198,7 +199,7 @@ const ItemImage = ({
             }}
           >
             <img
-              src={imagemUrl.startsWith('http') ? imagemUrl : `${API_URL}${imagemUrl}`}
+              src={urlVariante(urlCompleta, 'media')}
               alt={`Item ${codigoItem}`}
               style={{
                 maxWidth: '100%',
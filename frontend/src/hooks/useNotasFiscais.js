@@ -3,7 +3,7 @@
  * Extraído de ItemsByStatus.js
  */
 import { useState, useRef } from 'react';
-import { apiPost, apiGet, apiDelete, API } from '../utils/api';
+import { apiPost, apiDelete, baixarArquivo, API } from '../utils/api';
 
 export const useNotasFiscais = (reloadSingleItem) => {
   const [expandedNF, setExpandedNF] = useState({});
@@ -31,28 +31,18 @@ export const useNotasFiscais = (reloadSingleItem) => {
     setUploadingNF(`${item._uniqueId}-${tipo}`);
     
     try {
-      // Usar Promise para aguardar a leitura do arquivo
-      const base64 = await new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onload = (e) => resolve(e.target.result.split(',')[1]);
-        reader.onerror = (e) => reject(new Error('Erro ao ler arquivo'));
-        reader.readAsDataURL(file);
-      });
-      
       const contentType = file.type || (fileExtension === '.xml' ? 'text/xml' : 'application/pdf');
       const ncm = ncmManual[`${item._uniqueId}-${tipo}`] || null;
       
-      const payload = {
-        filename: file.name,
-        content_type: contentType,
-        file_data: base64,
-        ncm_manual: ncm,
-        tipo: tipo
-      };
+      // Multipart: o arquivo vai em streaming para o servidor, sem base64
+      const formData = new FormData();
+      formData.append('file', new File([file], file.name, { type: contentType }));
+      formData.append('tipo', tipo);
+      if (ncm) formData.append('ncm_manual', ncm);
       
       const response = await apiPost(
-        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais`,
-        payload
+        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/upload`,
+        formData
       );
       
       alert(`Nota fiscal adicionada! NCM: ${response.data.ncm || 'Não detectado'}`);
@@ -72,29 +62,10 @@ export const useNotasFiscais = (reloadSingleItem) => {
 
   const downloadNF = async (item, nfId, filename) => {
     try {
-      const response = await apiGet(
-        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/${nfId}/download`
+      await baixarArquivo(
+        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/${nfId}/arquivo`,
+        filename
       );
-      
-      const { file_data, content_type, filename: downloadFilename } = response.data;
-      
-      // Criar blob e fazer download
-      const byteCharacters = atob(file_data);
-      const byteNumbers = new Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
-      }
-      const byteArray = new Uint8Array(byteNumbers);
-      const blob = new Blob([byteArray], { type: content_type });
-      
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = downloadFilename || filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
     } catch (error) {
       console.error('Erro ao baixar arquivo:', error);
       alert('Erro ao baixar nota fiscal.');
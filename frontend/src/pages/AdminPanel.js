@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useMemo } from 'react';
 import axios from 'axios';
-import { formatBRL } from '../utils/api';
+import { formatBRL, aguardarJob, baixarArquivo } from '../utils/api';
 import Pagination from '../components/Pagination';
 import { useAuth } from '../contexts/AuthContext';
 
@@ -65,8 +65,10 @@ const RelatorioSection = () => {
         headers: { Authorization: `Bearer ${token}` }
       });
       
-      setResultadoReprocessamento(response.data);
-      alert(`✅ Processamento concluído!\n${response.data.total_atualizados} OCs atualizadas.`);
+      // Executado em background - aguardar o job terminar
+      const resultado = await aguardarJob(response.data.job_id);
+      setResultadoReprocessamento(resultado);
+      alert(`✅ Processamento concluído!\n${resultado.total_atualizados} OCs atualizadas.`);
     } catch (error) {
       console.error('Erro ao reprocessar requisitantes:', error);
       alert('❌ Erro: ' + (error.response?.data?.detail || error.message));
@@ -837,10 +839,16 @@ const AdminPanel = () => {
         }
       });
       
-      const result = await response.json();
+      const job = await response.json();
       
       if (!response.ok) {
-        throw new Error(result.detail || 'Erro ao reprocessar');
+        throw new Error(job.detail || 'Erro ao reprocessar');
+      }
+      
+      // Executado em background - aguardar o job terminar
+      const result = await aguardarJob(job.job_id);
+      if (!result.success) {
+        throw new Error(result.message || 'Erro ao reprocessar');
       }
       
       setResultadoReprocessamento(result);
@@ -1226,8 +1234,6 @@ const AdminPanel = () => {
 
     setDownloadingBulk(true);
     try {
-      const token = localStorage.getItem('token');
-      
       // Montar lista de NFs para download
       const nfsToDownload = nfList
         .filter(nf => selectedSet.has(`${nf.po_id}_${nf.item_index}_${nf.id}`))
@@ -1238,31 +1244,8 @@ const AdminPanel = () => {
           tipo: tipo === 'compra' ? 'fornecedor' : 'revenda'
         }));
 
-      const response = await axios.post(
-        `${API}/admin/notas-fiscais/bulk-download`,
-        { nfs: nfsToDownload },
-        { headers: { Authorization: `Bearer ${token}` } }
-      );
-
-      const { file_data, filename, content_type } = response.data;
-      
-      // Criar download
-      const byteCharacters = atob(file_data);
-      const byteNumbers = new Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
-      }
-      const byteArray = new Uint8Array(byteNumbers);
-      const blob = new Blob([byteArray], { type: content_type });
-      
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
+      // ZIP gerado em streaming pelo servidor
+      await baixarArquivo(`${API}/admin/notas-fiscais/bulk-download/arquivo`, null, { nfs: nfsToDownload });
 
       // Limpar seleção e recarregar dados
       if (tipo === 'compra') {
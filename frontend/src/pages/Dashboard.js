@@ -438,33 +438,12 @@ const Dashboard = () => {
     }
     
     try {
-      let fileContent;
+      // Arquivo enviado como está (JSON/NDJSON, .gz ou .zst): o backend lê em
+      // streaming e valida o conteúdo, sem carregar o backup inteiro no navegador
+      const formData = new FormData();
+      formData.append('file', file);
       
-      // Verificar se é arquivo comprimido (.gz)
-      if (file.name.endsWith('.gz')) {
-        // Descomprimir usando pako
-        const arrayBuffer = await file.arrayBuffer();
-        const uint8Array = new Uint8Array(arrayBuffer);
-        
-        // Usar DecompressionStream nativo do browser
-        const ds = new DecompressionStream('gzip');
-        const decompressedStream = new Blob([uint8Array]).stream().pipeThrough(ds);
-        const decompressedBlob = await new Response(decompressedStream).blob();
-        fileContent = await decompressedBlob.text();
-      } else {
-        fileContent = await file.text();
-      }
-      
-      const backupData = JSON.parse(fileContent);
-      
-      // Verificar se é um backup válido (v3.x ou v4.x)
-      if (!backupData.backup_info) {
-        alert('❌ Arquivo de backup inválido! Falta informações do backup.');
-        event.target.value = '';
-        return;
-      }
-      
-      const response = await apiPost(`${API}/backup/restore-data`, backupData);
+      const response = await apiPost(`${API}/backup/restore`, formData);
       
       if (response.data.success) {
         const detalhes = response.data.detalhes;
@@ -483,7 +462,7 @@ const Dashboard = () => {
       }
     } catch (error) {
       console.error('Erro ao restaurar backup:', error);
-      alert(`❌ Erro ao restaurar backup: ${error.message}`);
+      alert(`❌ Erro ao restaurar backup: ${error.response?.data?.detail || error.message}`);
     }
     
     event.target.value = '';
@@ -1264,7 +1243,7 @@ const Dashboard = () => {
               📤 Restaurar Backup
               <input 
                 type="file" 
-                accept=".json,.json.gz,.gz"
+                accept=".json,.ndjson,.gz,.zst"
                 onChange={handleRestoreBackup}
                 style={{ display: 'none' }}
               />
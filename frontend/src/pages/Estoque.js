@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
 import axios from 'axios';
+import { aguardarJob } from '../utils/api';
 
 const API = process.env.REACT_APP_BACKEND_URL;
 
@@ -49,7 +50,8 @@ const Estoque = () => {
   
   // Cache de imagens
   const [imagensCache, setImagensCache] = useState({});
-  const [imageCacheTimestamp, setImageCacheTimestamp] = useState(Date.now());
+  // Só muda após upload/remoção: URL estável entre visitas para o navegador revalidar pelo ETag
+  const [imageCacheTimestamp, setImageCacheTimestamp] = useState(0);
 
   useEffect(() => {
     loadEstoque();
@@ -476,7 +478,8 @@ const Estoque = () => {
         headers: { Authorization: `Bearer ${token}` }
       });
       
-      const { itens_corrigidos, detalhes } = response.data;
+      // Executado em background - aguardar o job terminar
+      const { itens_corrigidos, detalhes } = await aguardarJob(response.data.job_id);
       
       if (itens_corrigidos > 0) {
         alert(`${itens_corrigidos} item(ns) corrigido(s):\n${detalhes.map(d => `• ${d.numero_oc} - Item ${d.codigo_item}`).join('\n')}`);
@@ -727,7 +730,7 @@ const Estoque = () => {
                       {imagensCache[item.codigo_item] || item.imagem_url ? (
                         <div style={{ position: 'relative' }}>
                           <img 
-                            src={`${API}/api/itens/${item.codigo_item}/imagem?t=${imageCacheTimestamp}`}
+                            src={`${API}/api/itens/${item.codigo_item}/imagem?t=${imageCacheTimestamp}&variante=thumb`}
                             alt={item.codigo_item}
                             style={{
                               width: '60px',
@@ -1282,7 +1285,7 @@ const Estoque = () => {
                       {imagensCache[itemExistenteEstoque.codigo_item] || itemExistenteEstoque.imagem_url ? (
                         <>
                           <img 
-                            src={`${API}/api/itens/${itemExistenteEstoque.codigo_item}/imagem?t=${imageCacheTimestamp}`}
+                            src={`${API}/api/itens/${itemExistenteEstoque.codigo_item}/imagem?t=${imageCacheTimestamp}&variante=thumb`}
                             alt={itemExistenteEstoque.codigo_item}
                             style={{ width: '100%', height: '100%', objectFit: 'cover' }}
                             onError={(e) => e.target.src = ''}
@@ -1437,7 +1440,7 @@ const Estoque = () => {
                       {imagensCache[codigoBusca] ? (
                         <>
                           <img 
-                            src={`${API}/api/itens/${codigoBusca}/imagem?t=${imageCacheTimestamp}`}
+                            src={`${API}/api/itens/${codigoBusca}/imagem?t=${imageCacheTimestamp}&variante=thumb`}
                             alt={codigoBusca}
                             style={{ width: '100%', height: '100%', objectFit: 'cover' }}
                           />
@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useMemo } from 'react';
-import { apiGet, API } from '../utils/api';
+import { apiGet, urlVariante, API } from '../utils/api';
 import Pagination from '../components/Pagination';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || '';
@@ -383,7 +383,7 @@ const Galeria = () => {
               }}>
                 {imageUrl ? (
                   <img
-                    src={imageUrl}
+                    src={urlVariante(imageUrl, 'media')}
                     alt={item.codigo_item}
                     style={{ 
                       maxWidth: '100%', 
@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useMemo, useRef, useCallback, memo } from 'react';
 import { useParams, useNavigate, Link } from 'react-router-dom';
-import { apiGet, apiPatch, apiPost, apiDelete, API, BACKEND_URL, formatBRL, API_URL } from '../utils/api';
+import { apiGet, apiPatch, apiPost, apiDelete, baixarArquivo, urlVariante, API, BACKEND_URL, formatBRL, API_URL } from '../utils/api';
 import { useAuth } from '../contexts/AuthContext';
 import { v4 as uuidv4 } from 'uuid';
 import { normalizeText } from '../utils/textUtils';
@@ -175,9 +175,11 @@ const ItemsByStatus = () => {
   
   // Mapa de imagens por código de item
   const [imagensItens, setImagensItens] = useState({});
+  const [imagensLote, setImagensLote] = useState({});  // codigo -> {url versionada, lqip}
   
   // Timestamp de cache para forçar reload de imagens - atualizado apenas após upload/delete
-  const [imageCacheTimestamp, setImageCacheTimestamp] = useState(Date.now());
+  // Só muda após upload/remoção: URL estável entre visitas para o navegador revalidar pelo ETag
+  const [imageCacheTimestamp, setImageCacheTimestamp] = useState(0);
   
   // Itens que irão na próxima remessa por OC (não estão em separação/pronto/transito/entregue)
   const [itensProximaRemessaPorOC, setItensProximaRemessaPorOC] = useState({});
@@ -680,6 +682,32 @@ const ItemsByStatus = () => {
     return displayItems.slice(startIndex, startIndex + itemsPerPage);
   }, [displayItems, currentPage, itemsPerPage]);
 
+  // Códigos com imagem entre os itens exibidos (string: chave estável para o efeito abaixo)
+  const codigosComImagem = useMemo(() => (
+    [...new Set(displayItems.map(item => item.codigo_item))]
+      .filter(codigo => imagensItens[codigo])
+      .slice(0, 2000)
+      .join('|')
+  ), [displayItems, imagensItens]);
+
+  // Imagens exibidas em uma requisição: URL versionada (cache imutável) + prévia LQIP
+  useEffect(() => {
+    if (!codigosComImagem) return;
+    apiPost(`${API}/imagens-itens/lote`, { codigos: codigosComImagem.split('|') })
+      .then(response => setImagensLote(response.data || {}))
+      .catch(err => console.warn('Erro ao carregar imagens em lote:', err));
+  }, [codigosComImagem, imageCacheTimestamp]);
+
+  // URL da imagem do código (versionada quando o lote já chegou) e fundo com a prévia
+  const srcImagem = (codigo, urlFallback, variante) => {
+    const info = imagensLote[codigo];
+    if (info) return urlVariante(`${BACKEND_URL}${info.url}`, variante);
+    return urlVariante(`${BACKEND_URL}${urlFallback}?t=${imageCacheTimestamp}`, variante);
+  };
+  const estiloLqip = (codigo) => (
+    imagensLote[codigo]?.lqip ? { backgroundImage: `url(${imagensLote[codigo].lqip})`, backgroundSize: 'cover' } : {}
+  );
+
   // Reset página quando filtros mudam
   useEffect(() => {
     setCurrentPage(1);
@@ -1505,28 +1533,18 @@ const ItemsByStatus = () => {
     setUploadingNF(`${item._uniqueId}-${tipo}`);
     
     try {
-      // Usar Promise para aguardar a leitura do arquivo
-      const base64 = await new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onload = (e) => resolve(e.target.result.split(',')[1]);
-        reader.onerror = (e) => reject(new Error('Erro ao ler arquivo'));
-        reader.readAsDataURL(file);
-      });
-      
       const contentType = file.type || (fileExtension === '.xml' ? 'text/xml' : 'application/pdf');
       const ncm = ncmManual[`${item._uniqueId}-${tipo}`] || null;
       
-      const payload = {
-        filename: file.name,
-        content_type: contentType,
-        file_data: base64,
-        ncm_manual: ncm,
-        tipo: tipo
-      };
+      // Multipart: o arquivo vai em streaming para o servidor, sem base64
+      const formData = new FormData();
+      formData.append('file', new File([file], file.name, { type: contentType }));
+      formData.append('tipo', tipo);
+      if (ncm) formData.append('ncm_manual', ncm);
       
       const response = await apiPost(
-        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais`,
-        payload
+        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/upload`,
+        formData
       );
       
       alert(`Nota fiscal adicionada! NCM: ${response.data.ncm || 'Não detectado'}`);
@@ -1545,29 +1563,10 @@ const ItemsByStatus = () => {
 
   const downloadNF = async (item, nfId, filename) => {
     try {
-      const response = await apiGet(
-        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/${nfId}/download`
+      await baixarArquivo(
+        `${API}/purchase-orders/${item.po_id}/items/by-index/${item._itemIndexInPO}/notas-fiscais/${nfId}/arquivo`,
+        filename
       );
-      
-      const { file_data, content_type, filename: downloadFilename } = response.data;
-      
-      // Criar blob e fazer download
-      const byteCharacters = atob(file_data);
-      const byteNumbers = new Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
-      }
-      const byteArray = new Uint8Array(byteNumbers);
-      const blob = new Blob([byteArray], { type: content_type });
-      
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = downloadFilename || filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
     } catch (error) {
       console.error('Erro ao baixar arquivo:', error);
       alert('Erro ao baixar nota fiscal.');
@@ -1628,6 +1627,14 @@ const ItemsByStatus = () => {
 
   // ============== FUNÇÕES PARA NF DE VENDA DA OC (não do item) ==============
 
+  // Multipart da NF de Venda: arquivo em streaming, nome em maiúsculas e índices separados por vírgula
+  const formDataNFVenda = (file, contentType, itensIndices) => {
+    const formData = new FormData();
+    formData.append('file', new File([file], file.name.toUpperCase(), { type: contentType }));
+    formData.append('itens_indices', itensIndices.join(','));
+    return formData;
+  };
+
   const uploadNFVendaOC = async (poId, file, ocItems) => {
     // Obter os índices dos itens selecionados
     const selectedSet = itensParaNFVenda[poId] || new Set();
@@ -1651,23 +1658,14 @@ const ItemsByStatus = () => {
     
     setUploadingNFVendaOC(poId);
     try {
-      const reader = new FileReader();
-      reader.onload = async () => {
-        const base64 = reader.result.split(',')[1];
-        const payload = {
-          filename: file.name.toUpperCase(),
-          content_type: file.type || 'application/pdf',
-          file_data: base64,
-          itens_indices: itensIndices
-        };
-        
-        const response = await apiPost(`${API}/purchase-orders/${poId}/nf-venda`, payload);
-        alert(`NF de Venda adicionada para ${response.data.itens_incluidos} item(s)!`);
-        // Limpar seleção após adicionar NF
-        setItensParaNFVenda(prev => ({ ...prev, [poId]: new Set() }));
-        loadItems(); // Recarregar para atualizar dados da OC
-      };
-      reader.readAsDataURL(file);
+      const response = await apiPost(
+        `${API}/purchase-orders/${poId}/nf-venda/upload`,
+        formDataNFVenda(file, file.type || 'application/pdf', itensIndices)
+      );
+      alert(`NF de Venda adicionada para ${response.data.itens_incluidos} item(s)!`);
+      // Limpar seleção após adicionar NF
+      setItensParaNFVenda(prev => ({ ...prev, [poId]: new Set() }));
+      loadItems(); // Recarregar para atualizar dados da OC
     } catch (error) {
       console.error('Erro ao enviar NF de Venda:', error);
       alert('Erro ao enviar NF de Venda.');
@@ -1706,34 +1704,14 @@ const ItemsByStatus = () => {
       // Processar cada arquivo sequencialmente
       for (const file of Array.from(files)) {
         try {
-          await new Promise((resolve, reject) => {
-            const reader = new FileReader();
-            reader.onload = async () => {
-              try {
-                const base64 = reader.result.split(',')[1];
-                const payload = {
-                  filename: file.name.toUpperCase(),
-                  content_type: file.type || (file.name.endsWith('.xml') ? 'application/xml' : 'application/pdf'),
-                  file_data: base64,
-                  itens_indices: itensIndices
-                };
-                
-                await apiPost(`${API}/purchase-orders/${poId}/nf-venda`, payload);
-                successCount++;
-                resolve();
-              } catch (err) {
-                errorCount++;
-                resolve(); // Continuar mesmo com erro
-              }
-            };
-            reader.onerror = () => {
-              errorCount++;
-              resolve();
-            };
-            reader.readAsDataURL(file);
-          });
+          const contentType = file.type || (file.name.endsWith('.xml') ? 'application/xml' : 'application/pdf');
+          await apiPost(
+            `${API}/purchase-orders/${poId}/nf-venda/upload`,
+            formDataNFVenda(file, contentType, itensIndices)
+          );
+          successCount++;
         } catch (err) {
-          errorCount++;
+          errorCount++; // Continuar mesmo com erro
         }
       }
       
@@ -1754,25 +1732,7 @@ const ItemsByStatus = () => {
 
   const downloadNFVendaOC = async (poId, filename) => {
     try {
-      const response = await apiGet(`${API}/purchase-orders/${poId}/nf-venda/download`);
-      const { file_data, content_type } = response.data;
-      
-      const byteCharacters = atob(file_data);
-      const byteNumbers = new Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
-      }
-      const byteArray = new Uint8Array(byteNumbers);
-      const blob = new Blob([byteArray], { type: content_type });
-      
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
+      await baixarArquivo(`${API}/purchase-orders/${poId}/nf-venda/arquivo`, filename);
     } catch (error) {
       console.error('Erro ao baixar NF de Venda:', error);
       alert('Erro ao baixar NF de Venda.');
@@ -5040,7 +5000,7 @@ DADOS BANCÁRIOS - Banco: ${dados.banco} | Ag: ${dados.agencia} | Cc: ${dados.co
                                             {/* Foto do item - tamanho maior com funcionalidades */}
                                             <ItemImage
                                               codigoItem={item.codigo_item}
-                                              imagemUrl={imagensItens[item.codigo_item] ? `${API_URL}/itens/${item.codigo_item}/imagem?t=${imageCacheTimestamp}` : null}
+                                              imagemUrl={imagensItens[item.codigo_item] ? (imagensLote[item.codigo_item] ? `${BACKEND_URL}${imagensLote[item.codigo_item].url}` : `${API_URL}/itens/${item.codigo_item}/imagem?t=${imageCacheTimestamp}`) : null}
                                               onUpload={async (file) => {
                                                 const formData = new FormData();
                                                 formData.append('file', file);
@@ -5280,7 +5240,7 @@ DADOS BANCÁRIOS - Banco: ${dados.banco} | Ag: ${dados.agencia} | Cc: ${dados.co
                                   {/* Foto do item - com funcionalidades */}
                                   <ItemImage
                                     codigoItem={item.codigo_item}
-                                    imagemUrl={imagensItens[item.codigo_item] ? `${API_URL}/itens/${item.codigo_item}/imagem?t=${imageCacheTimestamp}` : null}
+                                    imagemUrl={imagensItens[item.codigo_item] ? (imagensLote[item.codigo_item] ? `${BACKEND_URL}${imagensLote[item.codigo_item].url}` : `${API_URL}/itens/${item.codigo_item}/imagem?t=${imageCacheTimestamp}`) : null}
                                     onUpload={async (file) => {
                                       const formData = new FormData();
                                       formData.append('file', file);
@@ -5585,9 +5545,9 @@ DADOS BANCÁRIOS - Banco: ${dados.banco} | Ag: ${dados.agencia} | Cc: ${dados.co
                               }}
                             >
                               <img 
-                                src={`${BACKEND_URL}${group.imagem_url}?t=${imageCacheTimestamp}`} 
+                                src={srcImagem(group.codigo_item, group.imagem_url, 'thumb')} 
                                 alt={`Imagem ${group.codigo_item}`}
-                                style={{ width: '100%', height: '100%', objectFit: 'cover' }}
+                                style={{ width: '100%', height: '100%', objectFit: 'cover', ...estiloLqip(group.codigo_item) }}
                                 onError={(e) => {
                                   e.target.style.display = 'none';
                                   e.target.parentElement.innerHTML = '<span style="font-size: 1.5rem; color: #ef4444;">⚠️</span>';
@@ -7411,9 +7371,9 @@ DADOS BANCÁRIOS - Banco: ${dados.banco} | Ag: ${dados.agencia} | Cc: ${dados.co
                             {imagemUrl ? (
                               <>
                                 <img 
-                                  src={`${BACKEND_URL}${imagemUrl}?t=${imageCacheTimestamp}`} 
+                                  src={srcImagem(item.codigo_item, imagemUrl, 'thumb')} 
                                   alt={`Imagem ${item.codigo_item}`}
-                                  style={{ width: '100%', height: '100%', objectFit: 'cover' }}
+                                  style={{ width: '100%', height: '100%', objectFit: 'cover', ...estiloLqip(item.codigo_item) }}
                                   onError={(e) => {
                                     // Esconder imagem quebrada mas manter container
                                     e.target.style.display = 'none';
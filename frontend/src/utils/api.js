@@ -47,6 +47,51 @@ export const apiDelete = (url) => {
   return axios.delete(url, { ...axiosConfig, headers: getAuthHeaders() });
 };
 
+// Baixar um arquivo binário (resposta em streaming, sem base64) e salvar com o nome informado.
+// Com `body`, faz POST JSON (ex.: ZIP de várias NFs); sem `filename`, usa o nome do Content-Disposition.
+export const baixarArquivo = async (url, filename = null, body = null) => {
+  const response = await fetch(url, body
+    ? { method: 'POST', headers: getAuthHeaders(), body: JSON.stringify(body) }
+    : { headers: getAuthHeaders() });
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({}));
+    throw new Error(error.detail || 'Erro ao baixar arquivo');
+  }
+  if (!filename) {
+    const disposition = response.headers.get('Content-Disposition') || '';
+    filename = disposition.match(/filename="([^"]+)"/)?.[1] || 'download';
+  }
+  const blob = await response.blob();
+  const href = window.URL.createObjectURL(blob);
+  const a = document.createElement('a');
+  a.href = href;
+  a.download = filename;
+  document.body.appendChild(a);
+  a.click();
+  window.URL.revokeObjectURL(href);
+  a.remove();
+};
+
+// URL de uma variante reduzida da imagem de item ('thumb' para grades, 'media' para popups).
+// Sem Pillow no servidor a resposta é o original.
+export const urlVariante = (url, variante) => {
+  if (!url || url.startsWith('data:')) return url;
+  return `${url}${url.includes('?') ? '&' : '?'}variante=${variante}`;
+};
+
+// Aguardar um job em background do backend (POST que responde com job_id).
+// Consulta /jobs/{id} até terminar e retorna o resultado; lança erro se falhar ou for cancelado.
+export const aguardarJob = async (jobId, onProgresso = null, intervaloMs = 2000) => {
+  for (;;) {
+    const { data: job } = await apiGet(`${API}/jobs/${jobId}`);
+    if (onProgresso) onProgresso(job.progresso);
+    if (job.status === 'concluido') return job.resultado;
+    if (job.status === 'erro') throw new Error(job.erro || 'Erro ao executar o processamento');
+    if (job.status === 'cancelado') throw new Error('Processamento cancelado');
+    await new Promise((resolve) => setTimeout(resolve, intervaloMs));
+  }
+};
+
 // Formatar valor monetário no padrão brasileiro: R$ 1.234,56
 export const formatBRL = (value) => {
   if (value === null || value === undefined || isNaN(value)) return 'R$ 0,00';